@@ -0,0 +1,293 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Change-driven rendering of the confd templates.
+
+Rather than running confd in watch mode over the whole of the BGP tree, this
+watches the etcd trees that the templates read (as described by the prefix
+and keys of each TOML file in conf.d), and maps each changed key to the
+templates that depend on it.  The affected templates are rendered with
+'confd -onetime', using a confd directory holding just the template's TOML
+file, so an unrelated change does not re-render every template.
+
+The node-to-node mesh templates read the whole per-host BGP tree, but only
+use a few keys of the other hosts' subtrees (MESH_HOST_KEYS).  A change to
+another host's peers or log level, for example, does not re-render them.
+
+Bursts of changes (for example, many hosts restarting) are coalesced: the
+templates are only rendered once no change has been seen for DEBOUNCE_SECS,
+or MAX_DELAY_SECS after the first change.  confd only writes a template's
+output and runs its reload command (reconfiguring BIRD) when the rendered
+output differs from the current file.
+
+The number of renders and reloads are logged, and written to STATS_FILE.
+
+Usage:
+  python confd_watch.py <CONFD ARGS>...
+      Where the confd arguments are the etcd options to pass to confd.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from etcd import EtcdEventIndexCleared, EtcdException, EtcdWatchTimedOut
+from pycalico.ipam import IPAMClient
+
+CONFD_DIR = "/etc/calico/confd"
+WATCH_DIR = "/etc/calico/confd-watch"
+STATS_DIR = "/var/run/calico"
+STATS_FILE = os.path.join(STATS_DIR, "confd-stats.json")
+
+DEBOUNCE_SECS = 1
+MAX_DELAY_SECS = 5
+WATCH_TIMEOUT_SECS = 60
+WATCH_RETRY_SECS = 5
+
+# The per-host BGP tree, and the keys of the other hosts' subtrees that each
+# mesh template reads (to peer with them).  The whole of this host's subtree
+# is read.
+HOST_PATH = "/calico/bgp/v1/host"
+MESH_HOST_KEYS = {"bird": {"ip_addr_v4", "as_num"},
+                  "bird6": {"ip_addr_v6", "as_num"}}
+
+TOML_RE = re.compile(r'^(dest|prefix)\s*=\s*"([^"]*)"', re.MULTILINE)
+KEYS_RE = re.compile(r'^keys\s*=\s*\[([^\]]*)\]', re.MULTILINE)
+
+
+class Template(object):
+    """
+    A confd template, described by a TOML file.
+    """
+    def __init__(self, name, toml_path, toml):
+        self.name = name
+        self.toml_path = toml_path
+        fields = dict(TOML_RE.findall(toml))
+        self.dest = fields.get("dest")
+        prefix = fields.get("prefix", "").rstrip("/")
+        keys_match = KEYS_RE.search(toml)
+        keys = re.findall(r'"([^"]*)"', keys_match.group(1)) \
+            if keys_match else []
+
+        # The etcd paths the template reads.
+        self.paths = set((prefix + "/" + key.strip("/")).rstrip("/")
+                         for key in keys)
+        self.host_keys = MESH_HOST_KEYS.get(name)
+
+    def depends_on(self, key):
+        """
+        Return whether the template depends on an etcd key.
+
+        :param key: The key (or directory) which changed.
+        """
+        if not any(key == path or key.startswith(path + "/") or
+                   path.startswith(key + "/") for path in self.paths):
+            return False
+        if self.host_keys is None or not key.startswith(HOST_PATH + "/"):
+            return True
+
+        # A key in a host's subtree.  Other hosts matter only if they are
+        # added or removed, or one of the keys we read for them changes.
+        parts = key[len(HOST_PATH) + 1:].split("/")
+        return (parts[0] == os.getenv("HOSTNAME") or len(parts) == 1 or
+                (len(parts) == 2 and parts[1] in self.host_keys))
+
+    @property
+    def confdir(self):
+        return os.path.join(WATCH_DIR, self.name)
+
+    def prepare(self):
+        """
+        Create a confd directory holding just this template's TOML file.
+        """
+        if os.path.exists(self.confdir):
+            shutil.rmtree(self.confdir)
+        os.makedirs(os.path.join(self.confdir, "conf.d"))
+        shutil.copy(self.toml_path, os.path.join(self.confdir, "conf.d"))
+        os.symlink(os.path.join(CONFD_DIR, "templates"),
+                   os.path.join(self.confdir, "templates"))
+
+
+def load_templates():
+    """
+    Load the templates from the TOML files in the confd directory.
+
+    :return: A list of Templates.
+    """
+    templates = []
+    toml_dir = os.path.join(CONFD_DIR, "conf.d")
+    for filename in sorted(os.listdir(toml_dir)):
+        if not filename.endswith(".toml"):
+            continue
+        path = os.path.join(toml_dir, filename)
+        with open(path) as f:
+            templates.append(Template(filename[:-len(".toml")], path,
+                                      f.read()))
+    return templates
+
+
+def _digest(path):
+    try:
+        with open(path) as f:
+            return hashlib.md5(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+class Renderer(object):
+    """
+    Renders templates when the etcd paths they depend on change.
+    """
+    def __init__(self, templates, confd_args):
+        self.templates = templates
+        self.confd_args = confd_args
+        self.condition = threading.Condition()
+        self.dirty = set()
+        self.first_change = None
+        self.last_change = None
+        self.stats = {"changes": 0, "renders": 0, "reloads": 0}
+
+    def changed(self, key):
+        """
+        Note that an etcd key has changed.
+
+        :param key: The key, or None if all templates should be rendered.
+        """
+        with self.condition:
+            self.stats["changes"] += 1
+            templates = [template for template in self.templates
+                         if key is None or template.depends_on(key)]
+            if not templates:
+                # Don't start (or extend) the debounce for a key no template
+                # reads, so that first_change is only set while templates are
+                # dirty.
+                return
+            now = time.time()
+            self.dirty.update(templates)
+            if self.first_change is None:
+                self.first_change = now
+            self.last_change = now
+            self.condition.notify()
+
+    def wait_for_changes(self):
+        """
+        Wait until a change has been followed by DEBOUNCE_SECS without
+        changes, or MAX_DELAY_SECS have passed since the first change.
+
+        :return: The templates to render.
+        """
+        with self.condition:
+            while not self.dirty:
+                self.condition.wait()
+            while True:
+                now = time.time()
+                wait = min(self.last_change + DEBOUNCE_SECS,
+                           self.first_change + MAX_DELAY_SECS) - now
+                if wait <= 0:
+                    break
+                self.condition.wait(wait)
+            dirty = self.dirty
+            self.dirty = set()
+            self.first_change = None
+            return sorted(dirty, key=lambda template: template.name)
+
+    def render(self, templates):
+        """
+        Render templates, counting the renders and reloads.
+        """
+        for template in templates:
+            before = _digest(template.dest)
+            subprocess.call(["confd", "-confdir=%s" % template.confdir,
+                             "-onetime"] + self.confd_args)
+            self.stats["renders"] += 1
+            if _digest(template.dest) != before:
+                self.stats["reloads"] += 1
+                print "Updated %s" % template.dest
+
+        print "Rendered %s: %d changes, %d renders, %d reloads" % (
+            ", ".join(template.name for template in templates),
+            self.stats["changes"], self.stats["renders"],
+            self.stats["reloads"])
+        _write_stats(self.stats)
+
+
+def _write_stats(stats):
+    """
+    Atomically write the stats file.
+    """
+    if not os.path.exists(STATS_DIR):
+        os.makedirs(STATS_DIR)
+    tmp_path = STATS_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(stats, f)
+    os.rename(tmp_path, STATS_FILE)
+
+
+def watch(etcd_client, path, wait_index, renderer):
+    """
+    Watch an etcd path, notifying the renderer of changes.  Never returns.
+    """
+    while True:
+        try:
+            result = etcd_client.read(path, recursive=True, wait=True,
+                                      waitIndex=wait_index,
+                                      timeout=WATCH_TIMEOUT_SECS)
+        except EtcdWatchTimedOut:
+            continue
+        except EtcdEventIndexCleared:
+            # We have missed some changes, so assume the path changed.
+            wait_index = None
+            renderer.changed(path)
+            continue
+        except EtcdException as e:
+            print "Error watching %s: %s" % (path, e)
+            time.sleep(WATCH_RETRY_SECS)
+            continue
+        wait_index = result.modifiedIndex + 1
+        renderer.changed(result.key)
+
+
+def main(confd_args):
+    templates = load_templates()
+    for template in templates:
+        template.prepare()
+    renderer = Renderer(templates, confd_args)
+    etcd_client = IPAMClient().etcd_client
+
+    # Start watching from the current etcd index, then render everything in
+    # case anything changed before we started.
+    wait_index = etcd_client.read("/").etcd_index + 1
+    paths = set()
+    for template in templates:
+        paths.update(template.paths)
+    for path in sorted(paths):
+        print "Watching %s" % path
+        thread = threading.Thread(target=watch,
+                                  args=(etcd_client, path, wait_index,
+                                        renderer))
+        thread.daemon = True
+        thread.start()
+    renderer.changed(None)
+
+    while True:
+        renderer.render(renderer.wait_for_changes())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,284 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Publishes a compact diagnostics summary of this node, for
+'calicoctl diags --cluster' to gather.
+
+The summary is a JSON object holding:
+  - "hostname" and "time" (seconds since the epoch)
+  - "request_index": the etcd index of the last request, if any
+  - "routes": the number of IPv4 and IPv6 routes
+  - "iptables_rules": the number of IPv4 and IPv6 iptables rules, by table
+  - "ipsets": the number of entries in each ipset
+  - "bird_protocols": the state and info of each BIRD BGP protocol
+  - "felix": whether Felix is running, its memory use and the number of
+    local endpoints
+  - "errors": the error collecting each section that could not be collected
+
+It is written to SUMMARY_FILE and to the etcd key SUMMARY_PATH (with a TTL,
+so nodes that stop publishing drop out) every SUMMARY_INTERVAL_SECS, and
+whenever the REQUEST_PATH key is written.
+
+Usage:
+  python diags_summary.py
+"""
+import json
+import os
+import socket
+import subprocess
+import time
+
+from etcd import EtcdEventIndexCleared, EtcdException, EtcdWatchTimedOut
+from pycalico.ipam import IPAMClient
+
+SUMMARY_DIR = "/var/run/calico"
+SUMMARY_FILE = os.path.join(SUMMARY_DIR, "diags-summary.json")
+
+DIAGS_PATH = "/calico/diags/v1"
+SUMMARY_PATH = DIAGS_PATH + "/host/%s/summary"
+REQUEST_PATH = DIAGS_PATH + "/request"
+
+SUMMARY_INTERVAL_SECS = int(os.getenv("CALICO_DIAGS_SUMMARY_INTERVAL", 300))
+SUMMARY_TTL_SECS = 3 * SUMMARY_INTERVAL_SECS
+RETRY_SECS = 5
+
+BIRD_CTL_PATHS = {"ipv4": "/var/run/calico/bird.ctl",
+                  "ipv6": "/var/run/calico/bird6.ctl"}
+BIRD_TIMEOUT_SECS = 5
+
+# Each workload endpoint has a host interface with this prefix.
+ENDPOINT_INTERFACE_PREFIX = "cali"
+
+
+def _output(command):
+    with open(os.devnull, "w") as devnull:
+        return subprocess.check_output(command, stderr=devnull)
+
+
+def count_routes():
+    """
+    :return: The number of IPv4 and IPv6 routes.
+    """
+    return dict((version, len(_output(["ip", "-%s" % version[-1],
+                                       "route"]).splitlines()))
+                for version in ["ipv4", "ipv6"])
+
+
+def _count_rules(iptables_save):
+    counts = {}
+    table = None
+    for line in iptables_save.splitlines():
+        if line.startswith("*"):
+            table = line[1:]
+            counts[table] = 0
+        elif line.startswith("-A ") and table:
+            counts[table] += 1
+    return counts
+
+
+def count_iptables_rules():
+    """
+    :return: The number of IPv4 and IPv6 iptables rules in each table.
+    """
+    return {"ipv4": _count_rules(_output(["iptables-save"])),
+            "ipv6": _count_rules(_output(["ip6tables-save"]))}
+
+
+def _count_ipset_entries(ipset_list):
+    counts = {}
+    name = None
+    for line in ipset_list.splitlines():
+        key, _, value = line.partition(":")
+        if key == "Name":
+            name = value.strip()
+        elif key == "Number of entries" and name:
+            counts[name] = int(value)
+    return counts
+
+
+def count_ipset_entries():
+    """
+    :return: The number of entries in each ipset.
+    """
+    # The terse listing gives the number of entries without the members.
+    return _count_ipset_entries(_output(["ipset", "list", "-terse"]))
+
+
+def _bird_protocols(ctl_path):
+    """
+    Get the BGP protocols from BIRD.
+
+    :return: A dict of the state and info of each protocol, by name.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(BIRD_TIMEOUT_SECS)
+    try:
+        sock.connect(ctl_path)
+        sock_file = sock.makefile("r")
+        sock_file.readline()
+        sock.sendall("show protocols\n")
+        protocols = {}
+        code = None
+        while True:
+            line = sock_file.readline()
+            if not line:
+                raise IOError("BIRD closed the connection")
+            # Lines starting with a space continue the previous reply code.
+            if line.startswith(" "):
+                text = line[1:]
+            else:
+                code, text = line[:4], line[5:]
+            if code == "0000":
+                break
+            if code[0] in "89":
+                raise IOError("BIRD error: %s" % text.strip())
+            columns = text.split(None, 5)
+            if code == "1002" and len(columns) >= 4 and \
+                    columns[1] == "BGP":
+                protocols[columns[0]] = {
+                    "state": columns[3],
+                    "info": columns[5].strip() if len(columns) > 5 else ""}
+        return protocols
+    finally:
+        sock.close()
+
+
+def bird_protocols():
+    """
+    :return: The BGP protocols of the IPv4 and IPv6 BIRDs that are running.
+    """
+    return dict((version, _bird_protocols(ctl_path))
+                for version, ctl_path in BIRD_CTL_PATHS.items()
+                if os.path.exists(ctl_path))
+
+
+def felix_stats():
+    """
+    :return: Whether Felix is running, its resident memory in kB and the
+    number of local endpoints.
+    """
+    stats = {"running": False,
+             "endpoints": len([name for name in os.listdir("/sys/class/net")
+                               if name.startswith(
+                                   ENDPOINT_INTERFACE_PREFIX)])}
+    try:
+        pid = _output(["pidof", "calico-felix"]).split()[0]
+    except (subprocess.CalledProcessError, IndexError):
+        return stats
+    stats["running"] = True
+    with open("/proc/%s/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                stats["rss_kb"] = int(line.split()[1])
+    return stats
+
+
+SECTIONS = [("routes", count_routes),
+            ("iptables_rules", count_iptables_rules),
+            ("ipsets", count_ipset_entries),
+            ("bird_protocols", bird_protocols),
+            ("felix", felix_stats)]
+
+
+def summarize(hostname, request_index=None):
+    """
+    Collect the diagnostics summary of this node.
+
+    :param hostname: The hostname of this node.
+    :param request_index: The etcd index of the request being answered.
+    :return: The summary, as a dict.
+    """
+    summary = {"hostname": hostname, "time": time.time(),
+               "request_index": request_index, "errors": {}}
+    for name, collect in SECTIONS:
+        try:
+            summary[name] = collect()
+        except Exception as e:
+            summary["errors"][name] = "%s: %s" % (type(e).__name__, e)
+    return summary
+
+
+def _write_summary(summary):
+    """
+    Atomically write the summary file.
+    """
+    if not os.path.exists(SUMMARY_DIR):
+        os.makedirs(SUMMARY_DIR)
+    tmp_path = SUMMARY_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(summary, f)
+    os.rename(tmp_path, SUMMARY_FILE)
+
+
+def publish(etcd_client, hostname, request_index=None):
+    """
+    Collect the summary, and write it to the summary file and etcd.
+    """
+    summary = summarize(hostname, request_index)
+    _write_summary(summary)
+    etcd_client.write(SUMMARY_PATH % hostname, json.dumps(summary),
+                      ttl=SUMMARY_TTL_SECS)
+    print "Published diagnostics summary (errors: %s)" % \
+          (", ".join(sorted(summary["errors"])) or "none")
+
+
+def current_index(etcd_client):
+    """
+    :return: The current etcd index.
+    """
+    # Every read returns the current etcd index, and the root always exists.
+    return etcd_client.read("/").etcd_index
+
+
+def wait_for_request(etcd_client, request_index, since_index):
+    """
+    Wait for a summary to be requested after since_index, or for
+    SUMMARY_INTERVAL_SECS.
+
+    :param request_index: The etcd index of the last request, or None.
+    :param since_index: The etcd index to watch for requests after.  This is
+    read before collecting the summary, so that requests made while it is
+    being collected are not missed.
+    :return: The etcd index of the last request.
+    """
+    try:
+        result = etcd_client.read(REQUEST_PATH, wait=True,
+                                  waitIndex=since_index + 1,
+                                  timeout=SUMMARY_INTERVAL_SECS)
+    except EtcdWatchTimedOut:
+        return request_index
+    except EtcdEventIndexCleared:
+        # Too many changes to tell whether there was a request, so answer
+        # any there were.
+        return current_index(etcd_client)
+    return result.modifiedIndex
+
+
+def main():
+    hostname = os.getenv("HOSTNAME")
+    etcd_client = IPAMClient().etcd_client
+    request_index = None
+    while True:
+        try:
+            since_index = current_index(etcd_client)
+            publish(etcd_client, hostname, request_index)
+            request_index = wait_for_request(etcd_client, request_index,
+                                             since_index)
+        except EtcdException as e:
+            print "Error publishing diagnostics summary: %s" % e
+            time.sleep(RETRY_SECS)
+
+
+if __name__ == "__main__":
+    main()
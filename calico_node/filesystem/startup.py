@@ -14,6 +14,8 @@
 
 import os
 import sys
+import threading
+import time
 
 import netaddr
 from netaddr import AddrFormatError, IPAddress
@@ -21,9 +23,27 @@ from pycalico.datastore_datatypes import IPPool
 from pycalico.ipam import IPAMClient
 from pycalico.util import get_host_ips, validate_asn
 
+import timings as timings_file
+
 DEFAULT_IPV4_POOL = IPPool("192.168.0.0/16")
 DEFAULT_IPV6_POOL = IPPool("fd80:24e2:f998:72d6::/64")
 
+CONFD_TOML_DIR = "/etc/calico/confd/conf.d"
+
+# The confd TOML for each BIRD config, as generated by confd from
+# templates/bird.toml.template and templates/bird6.toml.template.
+BIRD_TOML = """[template]
+src = "%(bird)s.cfg.%(mesh)s.template"
+dest = "/etc/calico/confd/config/%(bird)s.cfg"
+prefix = "/calico/bgp/v1"
+keys = [
+    "%(hosts)s",
+    "/global"
+]
+check_cmd = "%(bird)s -p -c {{.src}}"
+reload_cmd = "pkill -HUP %(bird)s || true"
+"""
+
 
 def _find_pool(ip_addr, ipv4_pools):
     """
@@ -222,7 +242,138 @@ def warn_if_hostname_conflict(ip):
             print hostname_warning
 
 
+def run_steps(steps):
+    """
+    Run the startup steps.  The steps are run in waves: each wave runs, in
+    parallel, every step whose dependencies have completed, so steps which do
+    not depend on each other (such as independent etcd reads) are not
+    serialized.
+
+    If a step fails (including by calling sys.exit()), the remaining steps in
+    its wave are completed and the exception is then re-raised.
+
+    :param steps: A list of (name, function, list of names of the steps it
+    depends on) tuples.  Each function is called with a dict of the results
+    of the steps that have already completed.
+    :return: A tuple of (dict of step name to result, list of (step name,
+    start time, duration in seconds) tuples in the order the steps
+    completed).
+    """
+    results = {}
+    timings = []
+    pending = list(steps)
+    while pending:
+        wave = [step for step in pending
+                if all(dep in results for dep in step[2])]
+        if not wave:
+            raise ValueError("Startup steps have unmet dependencies: %s" %
+                             ", ".join(step[0] for step in pending))
+        outcomes = {}
+
+        def run_step(name, fn, completed):
+            start = time.time()
+            try:
+                outcomes[name] = (True, fn(completed))
+            except BaseException:
+                outcomes[name] = (False, sys.exc_info())
+            timings.append((name, start, time.time() - start))
+
+        completed = dict(results)
+        threads = [threading.Thread(target=run_step,
+                                    args=(name, fn, completed))
+                   for name, fn, _ in wave]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for name, _, _ in wave:
+            ok, value = outcomes[name]
+            if not ok:
+                raise value[0], value[1], value[2]
+            results[name] = value
+        pending = [step for step in pending if step not in wave]
+    return results, timings
+
+
+def record_timings(timings):
+    """
+    Print and record the time taken by each startup step.
+
+    :param timings: A list of (step name, start time, duration in seconds)
+    tuples.
+    """
+    for name, start, duration in timings:
+        print "Startup step %s took %.3fs" % (name, duration)
+        timings_file.record("startup_checks.%s" % name, start, duration)
+
+
+def _ensure_default_pools(ipv4_pools, ipv6_pools):
+    """
+    Create the default pools if no pools are configured.
+
+    :param ipv4_pools: The configured IPv4 pools.
+    :param ipv6_pools: The configured IPv6 pools.
+    :return: The IPv4 pools, including the default pool if it was created.
+    """
+    # Create default pools if required
+    if not ipv4_pools:
+        client.add_ip_pool(4, DEFAULT_IPV4_POOL)
+        ipv4_pools = [DEFAULT_IPV4_POOL]
+
+    # If the OS has not been built with IPv6 then the /proc config for IPv6
+    # will not be present.
+    if not ipv6_pools and os.path.exists('/proc/sys/net/ipv6'):
+        client.add_ip_pool(6, DEFAULT_IPV6_POOL)
+    return ipv4_pools
+
+
+def _configure_host_tunnel_addr(ipv4_pools):
+    """
+    If IPIP is enabled, the host requires an IP address for its tunnel
+    device, which is in an IPIP pool.  Without this, a host can't originate
+    traffic to a pool address because the response traffic would not be
+    routed via the tunnel (likely being dropped by RPF checks in the fabric).
+
+    :param ipv4_pools: The configured IPv4 pools.
+    """
+    ipip_pools = [p for p in ipv4_pools if p.ipip]
+
+    if ipip_pools:
+        # IPIP is enabled, make sure the host has an address for its tunnel.
+        _ensure_host_tunnel_addr(ipv4_pools, ipip_pools)
+    else:
+        # No IPIP pools, clean up any old address.
+        _remove_host_tunnel_addr()
+
+
+def write_bird_tomls(node_mesh):
+    """
+    Write the confd TOML for the BIRD configs, which confd would otherwise
+    only generate on its first pass (so needing a second pass to generate the
+    BIRD configs themselves).
+
+    :param node_mesh: Whether the node-to-node mesh is enabled.
+    """
+    for bird in ["bird", "bird6"]:
+        toml = BIRD_TOML % {
+            "bird": bird,
+            "mesh": "mesh" if node_mesh else "no-mesh",
+            "hosts": "/host" if node_mesh else "/host/%s" % hostname
+        }
+        path = os.path.join(CONFD_TOML_DIR, "%s.toml" % bird)
+        with open(path + ".tmp", "w") as f:
+            f.write(toml)
+        os.rename(path + ".tmp", path)
+    print "Generated BIRD confd templates (node-to-node mesh %s), so a " \
+          "single confd pass is needed" % ("enabled" if node_mesh
+                                           else "disabled")
+
+
 def main():
+    start = time.time()
+    timings_file.reset(start)
+
     ip = os.getenv("IP")
     ip = ip or None
     if ip and not netaddr.valid_ipv4(ip):
@@ -263,44 +414,47 @@ def main():
     with open('startup.env', 'w') as f:
         f.write("IP=" + ip)
 
-    warn_if_hostname_conflict(ip)
-
-    # Verify that IPs are not already in use by another host.
-    error_if_bgp_ip_conflict(ip, ip6)
-
-    # Verify that the chosen IP exists on the current host
-    warn_if_unknown_ip(ip, ip6)
-
-    if os.getenv("NO_DEFAULT_POOLS", "").lower() != "true":
-        # Set up etcd
-        ipv4_pools = client.get_ip_pools(4)
-        ipv6_pools = client.get_ip_pools(6)
-
-        # Create default pools if required
-        if not ipv4_pools:
-            client.add_ip_pool(4, DEFAULT_IPV4_POOL)
-
-        # If the OS has not been built with IPv6 then the /proc config for IPv6
-        # will not be present.
-        if not ipv6_pools and os.path.exists('/proc/sys/net/ipv6'):
-            client.add_ip_pool(6, DEFAULT_IPV6_POOL)
-
-    client.ensure_global_config()
-    client.create_host(hostname, ip, ip6, as_num)
-
-    # If IPIP is enabled, the host requires an IP address for its tunnel
-    # device, which is in an IPIP pool.  Without this, a host can't originate
-    # traffic to a pool address because the response traffic would not be
-    # routed via the tunnel (likely being dropped by RPF checks in the fabric).
-    ipv4_pools = client.get_ip_pools(4)
-    ipip_pools = [p for p in ipv4_pools if p.ipip]
-
-    if ipip_pools:
-        # IPIP is enabled, make sure the host has an address for its tunnel.
-        _ensure_host_tunnel_addr(ipv4_pools, ipip_pools)
-    else:
-        # No IPIP pools, clean up any old address.
-        _remove_host_tunnel_addr()
+    # The pre-flight checks and datastore reads are independent, so run
+    # concurrently.  The datastore is only updated once the checks have
+    # passed.
+    default_pools = os.getenv("NO_DEFAULT_POOLS", "").lower() != "true"
+    networking = os.getenv("CALICO_NETWORKING", "").lower() != "false"
+    checks = ["hostname_conflict", "bgp_ip_conflict", "unknown_ip"]
+    steps = [
+        ("hostname_conflict", lambda r: warn_if_hostname_conflict(ip), []),
+
+        # Verify that IPs are not already in use by another host.
+        ("bgp_ip_conflict", lambda r: error_if_bgp_ip_conflict(ip, ip6), []),
+
+        # Verify that the chosen IP exists on the current host
+        ("unknown_ip", lambda r: warn_if_unknown_ip(ip, ip6), []),
+
+        ("ipv4_pools", lambda r: client.get_ip_pools(4), []),
+        ("ipv6_pools",
+         lambda r: client.get_ip_pools(6) if default_pools else None, []),
+        ("default_pools",
+         lambda r: _ensure_default_pools(r["ipv4_pools"], r["ipv6_pools"])
+                   if default_pools else r["ipv4_pools"],
+         checks + ["ipv4_pools", "ipv6_pools"]),
+        ("global_config", lambda r: client.ensure_global_config(), checks),
+        ("create_host",
+         lambda r: client.create_host(hostname, ip, ip6, as_num), checks),
+        ("tunnel_addr",
+         lambda r: _configure_host_tunnel_addr(r["default_pools"]),
+         ["default_pools", "global_config", "create_host"]),
+
+        # Resolve the BIRD templates from one read of the global BGP config.
+        ("bird_tomls",
+         lambda r: write_bird_tomls(client.get_bgp_node_mesh())
+                   if networking else None,
+         ["global_config"]),
+    ]
+    _, timings = run_steps(steps)
+    record_timings(timings)
+
+    duration = time.time() - start
+    print "Startup checks took %.3fs" % duration
+    timings_file.record("startup_checks", start, duration)
 
 
 hostname = os.getenv("HOSTNAME")
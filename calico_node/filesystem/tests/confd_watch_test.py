@@ -0,0 +1,169 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import patch
+from nose.tools import *
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+
+from filesystem import confd_watch
+
+BIRD_TOML = """[template]
+src = "bird.cfg.mesh.template"
+dest = "%s"
+prefix = "/calico/bgp/v1"
+keys = [
+    "/host",
+    "/global"
+]
+check_cmd = "bird -p -c {{.src}}"
+reload_cmd = "pkill -HUP bird || true"
+"""
+
+AGGR_TOML = """[template]
+src = "bird_aggr.cfg.template"
+dest = "/etc/calico/confd/config/bird_aggr.cfg"
+prefix = "/calico/ipam/v2/host/host/ipv4/block"
+keys = [
+    "/",
+]
+reload_cmd = "pkill -HUP bird || true"
+"""
+
+
+class TestConfdWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dest = os.path.join(self.tmpdir, "bird.cfg")
+        self.bird = confd_watch.Template("bird", "bird.toml",
+                                         BIRD_TOML % self.dest)
+        self.aggr = confd_watch.Template("bird_aggr", "bird_aggr.toml",
+                                         AGGR_TOML)
+        patcher = patch("filesystem.confd_watch.STATS_DIR", self.tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("filesystem.confd_watch.STATS_FILE",
+                        os.path.join(self.tmpdir, "confd-stats.json"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_template_paths(self):
+        assert_equal(self.bird.dest, self.dest)
+        assert_equal(self.bird.paths, {"/calico/bgp/v1/host",
+                                       "/calico/bgp/v1/global"})
+        assert_equal(self.aggr.paths,
+                     {"/calico/ipam/v2/host/host/ipv4/block"})
+
+    @patch.dict(os.environ, {"HOSTNAME": "host1"})
+    def test_depends_on(self):
+        host = "/calico/bgp/v1/host"
+        for key, bird, aggr in [
+                # This host's subtree and the global config.
+                (host + "/host1/peer_v4/10.0.0.9", True, False),
+                (host + "/host1/loglevel", True, False),
+                ("/calico/bgp/v1/global/as_num", True, False),
+                # Other hosts are only read for their address and AS number.
+                (host + "/host2", True, False),
+                (host + "/host2/ip_addr_v4", True, False),
+                (host + "/host2/as_num", True, False),
+                (host + "/host2/ip_addr_v6", False, False),
+                (host + "/host2/loglevel", False, False),
+                (host + "/host2/peer_v4/10.0.0.9", False, False),
+                # Directories above the watched trees.
+                (host, True, False),
+                ("/calico", True, True),
+                ("/calico/ipam/v2/host/host/ipv4/block/10.0.0.0-26", False,
+                 True),
+                ("/calico/v1/config", False, False)]:
+            assert_equal((key, self.bird.depends_on(key)), (key, bird))
+            assert_equal((key, self.aggr.depends_on(key)), (key, aggr))
+
+    @patch("filesystem.confd_watch.time.time", autospec=True)
+    def test_changes_debounced(self, m_time):
+        renderer = confd_watch.Renderer([self.bird, self.aggr], [])
+        m_time.return_value = 100
+        renderer.changed("/calico/bgp/v1/host")
+
+        # A further change during the debounce window delays the render.
+        def wait(timeout):
+            assert_equal(timeout, confd_watch.DEBOUNCE_SECS)
+            m_time.return_value += timeout
+            if m_time.return_value == 101:
+                renderer.changed("/calico/bgp/v1/global")
+        renderer.condition.wait = wait
+
+        assert_equal(renderer.wait_for_changes(), [self.bird])
+        assert_equal(m_time.return_value, 102)
+        assert_equal(renderer.dirty, set())
+
+    @patch("filesystem.confd_watch.time.time", autospec=True)
+    def test_changes_max_delay(self, m_time):
+        renderer = confd_watch.Renderer([self.bird, self.aggr], [])
+        m_time.return_value = 100
+        renderer.changed("/calico/ipam/v2/host/host/ipv4/block")
+
+        # Continuous changes are rendered after MAX_DELAY_SECS.
+        def wait(timeout):
+            m_time.return_value += timeout
+            renderer.changed("/calico/ipam/v2/host/host/ipv4/block")
+        renderer.condition.wait = wait
+
+        assert_equal(renderer.wait_for_changes(), [self.aggr])
+        assert_equal(m_time.return_value, 100 + confd_watch.MAX_DELAY_SECS)
+
+    @patch("filesystem.confd_watch.time.time", autospec=True)
+    def test_irrelevant_change_ignored(self, m_time):
+        renderer = confd_watch.Renderer([self.bird, self.aggr], [])
+        m_time.return_value = 100
+        renderer.changed("/calico/v1/config/LogSeverityFile")
+        assert_equal(renderer.first_change, None)
+        assert_equal(renderer.stats["changes"], 1)
+
+        # A later relevant change is still debounced.
+        m_time.return_value = 100 + confd_watch.MAX_DELAY_SECS
+        renderer.changed("/calico/bgp/v1/global")
+
+        def wait(timeout):
+            assert_equal(timeout, confd_watch.DEBOUNCE_SECS)
+            m_time.return_value += timeout
+        renderer.condition.wait = wait
+
+        assert_equal(renderer.wait_for_changes(), [self.bird])
+        assert_equal(m_time.return_value,
+                     100 + confd_watch.MAX_DELAY_SECS +
+                     confd_watch.DEBOUNCE_SECS)
+
+    @patch("filesystem.confd_watch.subprocess.call", autospec=True)
+    def test_render_counts_reloads(self, m_call):
+        renderer = confd_watch.Renderer([self.bird], ["-node=http://etcd"])
+        outputs = itertools.cycle(["config 1", "config 1", "config 2"])
+
+        def confd(args):
+            with open(self.dest, "w") as f:
+                f.write(next(outputs))
+        m_call.side_effect = confd
+
+        for _ in range(3):
+            renderer.render([self.bird])
+
+        m_call.assert_called_with(["confd",
+                                   "-confdir=%s" % self.bird.confdir,
+                                   "-onetime", "-node=http://etcd"])
+        assert_equal(renderer.stats["renders"], 3)
+        assert_equal(renderer.stats["reloads"], 2)
@@ -0,0 +1,174 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from etcd import EtcdEventIndexCleared, EtcdWatchTimedOut
+from mock import Mock, patch
+from nose.tools import *
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from filesystem import diags_summary
+
+IPTABLES_SAVE = """# Generated by iptables-save
+*nat
+:PREROUTING ACCEPT [0:0]
+-A POSTROUTING -j felix-POSTROUTING
+COMMIT
+*filter
+:INPUT ACCEPT [0:0]
+-A INPUT -j felix-INPUT
+-A FORWARD -j felix-FORWARD
+COMMIT
+"""
+
+IPSET_LIST = """Name: felix-v4-all-hosts
+Type: hash:ip
+Header: family inet hashsize 1024 maxelem 1048576
+Number of entries: 3
+Members:
+Name: felix-v4-profile
+Type: hash:ip
+Number of entries: 0
+Members:
+"""
+
+BIRD_PROTOCOLS = ["0001 BIRD 1.5.0 ready.",
+                  "2002-name     proto    table    state  since       info",
+                  "1002-static1  Static   master   up     2016-05-06  ",
+                  " Mesh_10_0_0_2 BGP      master   up     2016-05-06  "
+                  "Established   ",
+                  " Mesh_10_0_0_3 BGP      master   start  2016-05-06  "
+                  "Connect       Socket: Connection refused",
+                  "0000 "]
+
+
+class TestDiagsSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patchers = [
+            patch("filesystem.diags_summary.SUMMARY_DIR", self.tmpdir),
+            patch("filesystem.diags_summary.SUMMARY_FILE",
+                  os.path.join(self.tmpdir, "diags-summary.json")),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_count_rules(self):
+        assert_equal(diags_summary._count_rules(IPTABLES_SAVE),
+                     {"nat": 1, "filter": 2})
+
+    def test_count_ipset_entries(self):
+        assert_equal(diags_summary._count_ipset_entries(IPSET_LIST),
+                     {"felix-v4-all-hosts": 3, "felix-v4-profile": 0})
+
+    def test_bird_protocols(self):
+        ctl_path = os.path.join(self.tmpdir, "bird.ctl")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(ctl_path)
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def serve():
+            conn, _ = server.accept()
+            conn.sendall(BIRD_PROTOCOLS[0] + "\n")
+            conn.makefile("r").readline()
+            conn.sendall("\n".join(BIRD_PROTOCOLS[1:]) + "\n")
+            conn.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+
+        protocols = diags_summary._bird_protocols(ctl_path)
+        thread.join()
+        assert_equal(protocols, {
+            "Mesh_10_0_0_2": {"state": "up", "info": "Established"},
+            "Mesh_10_0_0_3": {"state": "start",
+                              "info": "Connect       Socket: "
+                                      "Connection refused"}})
+
+    @patch("filesystem.diags_summary.time.time", autospec=True,
+           return_value=1000.0)
+    def test_publish(self, m_time):
+        def failing():
+            raise OSError("no ipset")
+        sections = [("routes", lambda: {"ipv4": 2, "ipv6": 0}),
+                    ("ipsets", failing)]
+        etcd_client = Mock()
+
+        with patch("filesystem.diags_summary.SECTIONS", sections):
+            diags_summary.publish(etcd_client, "host1", 10)
+
+        expected = {"hostname": "host1", "time": 1000.0, "request_index": 10,
+                    "routes": {"ipv4": 2, "ipv6": 0},
+                    "errors": {"ipsets": "OSError: no ipset"}}
+        path, value = etcd_client.write.call_args[0]
+        assert_equal(path, "/calico/diags/v1/host/host1/summary")
+        assert_equal(json.loads(value), expected)
+        assert_equal(etcd_client.write.call_args[1],
+                     {"ttl": diags_summary.SUMMARY_TTL_SECS})
+        with open(diags_summary.SUMMARY_FILE) as f:
+            assert_equal(json.load(f), expected)
+
+    def test_wait_for_request(self):
+        etcd_client = Mock()
+        etcd_client.read.return_value = Mock(modifiedIndex=10)
+        assert_equal(diags_summary.wait_for_request(etcd_client, None, 7), 10)
+        etcd_client.read.assert_called_with(
+            "/calico/diags/v1/request", wait=True, waitIndex=8,
+            timeout=diags_summary.SUMMARY_INTERVAL_SECS)
+
+        etcd_client.read.side_effect = EtcdWatchTimedOut()
+        assert_equal(diags_summary.wait_for_request(etcd_client, 10, 12), 10)
+        etcd_client.read.assert_called_with(
+            "/calico/diags/v1/request", wait=True, waitIndex=13,
+            timeout=diags_summary.SUMMARY_INTERVAL_SECS)
+
+    def test_wait_for_request_cleared(self):
+        etcd_client = Mock()
+        etcd_client.read.side_effect = [EtcdEventIndexCleared(),
+                                        Mock(etcd_index=2000)]
+        assert_equal(diags_summary.wait_for_request(etcd_client, 10, 12),
+                     2000)
+
+    @patch("filesystem.diags_summary.IPAMClient", autospec=True)
+    @patch("filesystem.diags_summary.publish", autospec=True)
+    def test_main_request_while_publishing(self, m_publish, m_IPAMClient):
+        """
+        Test a request made while the summary is being collected is answered
+        by the next summary.
+        """
+        etcd_client = m_IPAMClient.return_value.etcd_client
+        etcd_client.read.side_effect = [
+            # The etcd index before the first summary is collected.
+            Mock(etcd_index=5),
+            # The request made while it was being collected.
+            Mock(modifiedIndex=6),
+            Mock(etcd_index=7)]
+        m_publish.side_effect = iter([None, KeyboardInterrupt])
+
+        with patch.dict(os.environ, {"HOSTNAME": "host1"}):
+            assert_raises(KeyboardInterrupt, diags_summary.main)
+
+        etcd_client.read.assert_any_call(
+            "/calico/diags/v1/request", wait=True, waitIndex=6,
+            timeout=diags_summary.SUMMARY_INTERVAL_SECS)
+        assert_equal(m_publish.call_args_list[1][0],
+                     (etcd_client, "host1", 6))
@@ -16,6 +16,10 @@ from mock import patch, Mock, call
 from netaddr import IPAddress
 from nose.tools import *
 from pycalico.datastore_datatypes import IPPool
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 
 from filesystem import startup
@@ -150,4 +154,53 @@ class TestStartup(unittest.TestCase):
         startup._remove_host_tunnel_addr()
         assert_equal(m_client.release_ips.mock_calls, [call({ip_address})])
         assert_equal(m_client.remove_per_host_config.mock_calls,
-                     [call("host", "IpInIpTunnelAddr")])
\ No newline at end of file
+                     [call("host", "IpInIpTunnelAddr")])
+    def test_run_steps(self):
+        order = []
+        steps = [
+            ("b", lambda r: order.append("b") or r["a"] + 1, ["a"]),
+            ("a", lambda r: order.append("a") or 1, []),
+            ("c", lambda r: order.append("c") or 3, []),
+        ]
+        results, timings = startup.run_steps(steps)
+        assert_equal(results, {"a": 1, "b": 2, "c": 3})
+        assert_equal(order[-1], "b")
+        assert_equal(sorted(name for name, _, _ in timings), ["a", "b", "c"])
+
+    def test_run_steps_failure(self):
+        def fail(results):
+            sys.exit(1)
+        m_later = Mock()
+        steps = [
+            ("check", fail, []),
+            ("read", lambda r: 1, []),
+            ("write", m_later, ["check", "read"]),
+        ]
+        assert_raises(SystemExit, startup.run_steps, steps)
+        assert_false(m_later.called)
+
+    @patch("filesystem.startup._remove_host_tunnel_addr", autospec=True)
+    @patch("filesystem.startup._ensure_host_tunnel_addr", autospec=True)
+    @patch("filesystem.startup.client", autospec=True)
+    def test_configure_host_tunnel_addr_default_pool(self, m_client,
+                                                     m_ensure, m_remove):
+        pools = startup._ensure_default_pools([], [IPPool("fd80::/64")])
+        startup._configure_host_tunnel_addr(pools)
+        assert_equal(m_client.add_ip_pool.mock_calls,
+                     [call(4, startup.DEFAULT_IPV4_POOL)])
+        assert_false(m_ensure.called)
+        assert_true(m_remove.called)
+        assert_false(m_client.get_ip_pools.called)
+
+    def test_write_bird_tomls(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        startup.hostname = "host"
+        with patch("filesystem.startup.CONFD_TOML_DIR", tmpdir):
+            startup.write_bird_tomls(False)
+        with open(os.path.join(tmpdir, "bird6.toml")) as f:
+            toml = f.read()
+        assert_true('src = "bird6.cfg.no-mesh.template"' in toml)
+        assert_true('"/host/host",' in toml)
+        assert_true('check_cmd = "bird6 -p -c {{.src}}"' in toml)
+        assert_equal(sorted(os.listdir(tmpdir)), ["bird.toml", "bird6.toml"])
@@ -0,0 +1,87 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import patch
+from nose.tools import *
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from filesystem import timings
+
+
+class TestTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patchers = [
+            patch("filesystem.timings.TIMINGS_DIR", self.tmpdir),
+            patch("filesystem.timings.TIMINGS_FILE",
+                  os.path.join(self.tmpdir, "startup-timings.json")),
+            patch("filesystem.timings.LOCK_FILE",
+                  os.path.join(self.tmpdir, "startup-timings.lock")),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_record(self):
+        timings.reset(1000.0)
+        timings.record("startup_checks", 1000.0, 1.5)
+        timings.record("confd_pass", 1001.5, 0.25)
+        assert_equal(timings.load(),
+                     {"started": 1000.0,
+                      "stages": [{"name": "startup_checks", "start": 0.0,
+                                  "duration": 1.5},
+                                 {"name": "confd_pass", "start": 1.5,
+                                  "duration": 0.25}]})
+
+    def test_record_concurrent(self):
+        timings.reset(1000.0)
+        threads = [threading.Thread(target=timings.record,
+                                    args=("stage%d" % i, 1000.0, 1.0))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(sorted(stage["name"]
+                            for stage in timings.load()["stages"]),
+                     sorted("stage%d" % i for i in range(20)))
+
+    @patch("filesystem.timings.subprocess.call", autospec=True)
+    def test_run(self, m_call):
+        m_call.return_value = 3
+        timings.reset(1000.0)
+        assert_equal(timings.run("confd_pass", ["confd", "-onetime"]), 3)
+        m_call.assert_called_once_with(["confd", "-onetime"])
+        assert_equal([stage["name"] for stage in timings.load()["stages"]],
+                     ["confd_pass"])
+
+    @patch("filesystem.timings.time.sleep", autospec=True)
+    @patch("filesystem.timings._felix_ready", autospec=True)
+    @patch("filesystem.timings._bird_ready", autospec=True)
+    def test_wait_ready(self, m_bird_ready, m_felix_ready, m_sleep):
+        m_bird_ready.return_value = True
+        m_felix_ready.side_effect = iter([False, True])
+        timings.reset(1000.0)
+        with patch.dict(os.environ, {"CALICO_NETWORKING": "true",
+                                     "IP6": ""}):
+            timings.wait_ready()
+        assert_equal([stage["name"] for stage in timings.load()["stages"]],
+                     ["bird_ready", "felix_ready"])
+        assert_equal(m_sleep.call_count, 1)
@@ -0,0 +1,194 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Records how long each stage of calico/node start-up takes.
+
+The timings are written to TIMINGS_FILE as JSON, holding an exclusive lock on
+LOCK_FILE while it is updated (stages are recorded by several threads and
+processes at once):
+  {"started": <time startup.py started, in seconds since the epoch>,
+   "stages": [{"name": <stage>,
+               "start": <seconds after "started">,
+               "duration": <seconds>}, ...]}
+
+Usage (from rc.local):
+  python timings.py run <STAGE> <COMMAND>...
+      Run a command, printing and recording how long it takes as a stage, and
+      exit with its exit code.
+  python timings.py wait-ready
+      Wait for BIRD and Felix to become ready, recording how long after
+      start-up each was ready.
+"""
+import fcntl
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+TIMINGS_DIR = "/var/run/calico"
+TIMINGS_FILE = os.path.join(TIMINGS_DIR, "startup-timings.json")
+LOCK_FILE = os.path.join(TIMINGS_DIR, "startup-timings.lock")
+
+READY_POLL_SECS = 0.1
+READY_TIMEOUT_SECS = 300
+
+# Felix creates this chain when it first programs the dataplane.
+FELIX_READY_CHAIN = "felix-FORWARD"
+
+
+@contextmanager
+def _flock():
+    """
+    Context manager which holds an exclusive lock on LOCK_FILE.
+    """
+    if not os.path.exists(TIMINGS_DIR):
+        os.makedirs(TIMINGS_DIR)
+    with open(LOCK_FILE, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _write(timings):
+    """
+    Atomically write the timings file.
+    """
+    if not os.path.exists(TIMINGS_DIR):
+        os.makedirs(TIMINGS_DIR)
+    tmp_path = TIMINGS_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(timings, f, indent=2)
+    os.rename(tmp_path, TIMINGS_FILE)
+
+
+def load():
+    """
+    Load the timings file.
+
+    :return: The timings, or None if there are none.
+    """
+    try:
+        with open(TIMINGS_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def reset(started):
+    """
+    Start recording the timings of a new start-up.
+
+    :param started: The time start-up started.
+    """
+    with _flock():
+        _write({"started": started, "stages": []})
+
+
+def record(name, start, duration):
+    """
+    Record the timing of a start-up stage.
+
+    :param name: The name of the stage.
+    :param start: The time the stage started.
+    :param duration: How long the stage took, in seconds.
+    """
+    with _flock():
+        timings = load() or {"started": start, "stages": []}
+        timings["stages"].append({"name": name,
+                                  "start": round(start - timings["started"],
+                                                 3),
+                                  "duration": round(duration, 3)})
+        _write(timings)
+
+
+def run(name, command):
+    """
+    Run a command, recording how long it takes.
+
+    :param name: The name of the stage.
+    :param command: The command to run, as a list.
+    :return: The exit code of the command.
+    """
+    start = time.time()
+    retcode = subprocess.call(command)
+    duration = time.time() - start
+    print "Startup stage %s took %.3fs" % (name, duration)
+    record(name, start, duration)
+    return retcode
+
+
+def _bird_ready(ctl_path):
+    """
+    Return whether BIRD is accepting connections on its control socket.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(ctl_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def _felix_ready():
+    """
+    Return whether Felix has programmed the dataplane.
+    """
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call(["iptables", "-n", "-L", FELIX_READY_CHAIN],
+                               stdout=devnull, stderr=devnull) == 0
+
+
+def wait_ready():
+    """
+    Wait for BIRD and Felix to become ready, recording when each was ready.
+    BIRD is not waited for if Calico networking is disabled.
+    """
+    checks = {"felix_ready": _felix_ready}
+    if os.getenv("CALICO_NETWORKING", "").lower() != "false":
+        checks["bird_ready"] = \
+            lambda: _bird_ready("/var/run/calico/bird.ctl")
+        if os.getenv("IP6"):
+            checks["bird6_ready"] = \
+                lambda: _bird_ready("/var/run/calico/bird6.ctl")
+
+    start = time.time()
+    while True:
+        for name, check in sorted(checks.items()):
+            if check():
+                record(name, start, time.time() - start)
+                del checks[name]
+        if not checks or time.time() - start > READY_TIMEOUT_SECS:
+            break
+        time.sleep(READY_POLL_SECS)
+
+
+def main(argv):
+    if len(argv) > 2 and argv[0] == "run":
+        sys.exit(run(argv[1], argv[2:]))
+    elif argv == ["wait-ready"]:
+        wait_ready()
+    else:
+        print __doc__
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
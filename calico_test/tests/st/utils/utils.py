@@ -136,39 +136,25 @@ def check_bird_status(host, expected):
     the IP address of the peer, and state is the expected BGP state (e.g.
     "Established" or "Idle").
     """
-    output = host.calicoctl("status")
-    lines = output.split("\n")
+    output = host.calicoctl("status --output=json")
+    status = json.loads(output)
+    peers = [peer for bgp in status["bgp"].values() for peer in bgp["peers"]]
     for (peertype, ipaddr, state) in expected:
-        for line in lines:
-            # Status table format is of the form:
-            # +--------------+-------------------+-------+----------+-------------+
-            # | Peer address |     Peer type     | State |  Since   |     Info    |
-            # +--------------+-------------------+-------+----------+-------------+
-            # | 172.17.42.21 | node-to-node mesh |   up  | 16:17:25 | Established |
-            # | 10.20.30.40  |       global      | start | 16:28:38 |   Connect   |
-            # |  192.10.0.0  |   node specific   | start | 16:28:57 |   Connect   |
-            # +--------------+-------------------+-------+----------+-------------+
-            #
-            # Splitting based on | separators results in an array of the
-            # form:
-            # ['', 'Peer address', 'Peer type', 'State', 'Since', 'Info', '']
-            columns = re.split("\s*\|\s*", line.strip())
-            if len(columns) != 7:
-                continue
-
+        for peer in peers:
             # Find the entry matching this peer.
-            if columns[1] == ipaddr and columns[2] == peertype:
+            if peer["peer_address"] == ipaddr and \
+                    peer["peer_type"] == peertype:
 
                 # Check that the connection state is as expected.  We check
                 # that the state starts with the expected value since there
                 # may be additional diagnostic information included in the
                 # info field.
-                if columns[5].startswith(state):
+                if peer["info"].startswith(state):
                     break
                 else:
                     msg = "Error in BIRD status for peer %s:\n" \
                           "Expected: %s; Actual: %s\n" \
-                          "Output:\n%s" % (ipaddr, state, columns[5],
+                          "Output:\n%s" % (ipaddr, state, peer["info"],
                                            output)
                     raise AssertionError(msg)
         else:
@@ -6,8 +6,15 @@ block_cipher = None
 a = Analysis(['calicoctl/calicoctl.py'],
              pathex=['/code'],
              binaries=None,
-             datas=[('birdcl', '.') ],
-             hiddenimports=[],
+             datas=None,
+             # Command modules are imported by name when they are run.
+             hiddenimports=['calico_ctl.bgp', 'calico_ctl.checksystem',
+                            'calico_ctl.config', 'calico_ctl.container',
+                            'calico_ctl.diags', 'calico_ctl.endpoint',
+                            'calico_ctl.ipam', 'calico_ctl.node',
+                            'calico_ctl.pool', 'calico_ctl.profile',
+                            'calico_ctl.serve', 'calico_ctl.status',
+                            'calico_ctl.version'],
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare the latency of running a calicoctl command directly (cold) against
+running it through a 'calicoctl serve' process (warm).
+
+The server must already be running, e.g.
+  sudo calicoctl serve &
+
+Usage:
+  serve_benchmark.py [--runs=<RUNS>] [--calicoctl=<CALICOCTL>]
+                     [--client=<CLIENT>] [--socket=<SOCKET>] [<args>...]
+
+Options:
+  --runs=<RUNS>            Number of runs of each variant [default: 20]
+  --calicoctl=<CALICOCTL>  Command used for cold runs [default: calicoctl]
+  --client=<CLIENT>        Command used for warm runs
+                           [default: calicoctl/calicoctl_client.py]
+  --socket=<SOCKET>        The server socket
+                           [default: /var/run/calico/calicoctl.sock]
+
+The calicoctl command to run defaults to 'version'.
+"""
+import os
+import subprocess
+import time
+
+from docopt import docopt
+
+
+def time_runs(cmd, runs, env=None):
+    """
+    Time a number of runs of a command.
+
+    :param cmd: The command (as a list).
+    :param runs: The number of runs.
+    :param env: The environment to run the command with.
+    :return: A sorted list of durations in seconds.
+    """
+    durations = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(cmd, stdout=devnull, stderr=devnull, env=env)
+            durations.append(time.time() - start)
+    return sorted(durations)
+
+
+def percentile(durations, pct):
+    index = min(len(durations) - 1, int(round(pct / 100.0 * len(durations))))
+    return durations[index]
+
+
+def report(name, durations):
+    mean = sum(durations) / len(durations)
+    print "%-6s mean %7.1fms  p50 %7.1fms  p95 %7.1fms" % (
+        name, mean * 1000, percentile(durations, 50) * 1000,
+        percentile(durations, 95) * 1000)
+    return mean
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    runs = int(arguments["--runs"])
+    args = arguments["<args>"] or ["version"]
+
+    # Disable the fallback for warm runs so we only ever measure the server.
+    env = dict(os.environ)
+    env["CALICOCTL_SOCKET"] = arguments["--socket"]
+    env["CALICOCTL_FALLBACK"] = "false"
+
+    cold = report("cold",
+                  time_runs([arguments["--calicoctl"]] + args, runs))
+    warm = report("warm",
+                  time_runs([arguments["--client"]] + args, runs, env=env))
+    print "speedup %.1fx" % (cold / warm)
@@ -16,7 +16,9 @@ Usage:
   calicoctl bgp peer add <PEER_IP> as <AS_NUM>
   calicoctl bgp peer remove <PEER_IP>
   calicoctl bgp peer show [--ipv4 | --ipv6]
+  calicoctl bgp peer status [--ipv4 | --ipv6] [--output=<OUTPUT>]
   calicoctl bgp node-mesh [on|off]
+  calicoctl bgp node-mesh rr [--count=<COUNT>]
   calicoctl bgp default-node-as [<AS_NUM>]
 
 
@@ -24,20 +26,44 @@ Description:
   Configure default global BGP settings for all nodes. Note: per-node settings
   will override these globals for that node.
 
+  'node-mesh rr' replaces the full node-to-node mesh with route reflectors: the
+  selected nodes peer with every node, and the other nodes peer only with the
+  route reflectors.  'node-mesh on' restores the full mesh.
+
+  'peer status' shows every BGP peer of this node, global, node specific and
+  node-to-node mesh, with the state of its session from BIRD.
+
 Options:
- --ipv4    Show IPv4 information only.
- --ipv6    Show IPv6 information only.
+ --ipv4             Show IPv4 information only.
+ --ipv6             Show IPv6 information only.
+ --count=<COUNT>    The number of nodes to select as route reflectors.
+                    [default: 3]
+ --output=<OUTPUT>  The output format: table or json [default: table]
 """
+import hashlib
+import json
 import sys
 
+from etcd import EtcdKeyNotFound
+from pycalico.datastore import BGP_GLOBAL_PATH, BGP_HOST_PATH
+
 from pycalico.datastore_datatypes import BGPPeer
 from netaddr import IPAddress
 from prettytable import PrettyTable
 from pycalico.util import validate_asn, validate_ip
 
+import bird
 from connectors import client
 from utils import get_container_ipv_from_arguments
-from utils import convert_asn_to_asplain
+from utils import convert_asn_to_asplain, enforce_root, hostname
+
+BGP_RR_PATH = BGP_GLOBAL_PATH + "route_reflector/"
+OUTPUT_FORMATS = ["table", "json"]
+
+# The fields of each peer in the peer status output.
+PEER_STATUS_FIELDS = ["peer_address", "peer_type", "as_num", "state", "since",
+                      "bgp_state", "info", "routes_imported",
+                      "routes_exported", "last_error"]
 
 
 def validate_arguments(arguments):
@@ -59,14 +85,29 @@ def validate_arguments(arguments):
     if asnum:
         asnum_ok = validate_asn(asnum)
 
+    count_ok = True
+    count = arguments.get("--count")
+    if count is not None:
+        try:
+            count_ok = int(count) > 0
+        except ValueError:
+            count_ok = False
+
     # Print error messages
     if not peer_ip_ok:
         print "Invalid IP address specified."
     if not asnum_ok:
         print "Invalid AS Number specified."
+    if not count_ok:
+        print "Invalid count specified.  Argument must be a positive integer."
+
+    output_ok = arguments.get("--output") in [None] + OUTPUT_FORMATS
+    if not output_ok:
+        print "Invalid output format specified.  Must be one of: %s." % \
+              ", ".join(OUTPUT_FORMATS)
 
     # Exit if not valid arguments
-    if not (peer_ip_ok and asnum_ok):
+    if not (peer_ip_ok and asnum_ok and count_ok and output_ok):
         sys.exit(1)
 
 
@@ -95,9 +136,14 @@ def bgp(arguments):
                 bgp_peer_show(6)
             else:
                 bgp_peer_show(ip_version)
+        elif arguments.get("status"):
+            bgp_peer_status([ip_version] if ip_version else [4, 6],
+                            arguments.get("--output") or "table")
 
     elif arguments.get("node-mesh"):
-        if arguments.get("on") or arguments.get("off"):
+        if arguments.get("rr"):
+            set_route_reflectors(int(arguments.get("--count")))
+        elif arguments.get("on") or arguments.get("off"):
             set_bgp_node_mesh(arguments.get("on"))
         else:
             show_bgp_node_mesh()
@@ -158,6 +204,90 @@ def bgp_peer_show(version):
         print "No global IPv%s BGP Peers defined.\n" % version
 
 
+def get_peer_status(version):
+    """
+    Get the BGP peers of this node, joining the configured global and node
+    specific peers with the BGP sessions in BIRD.
+
+    :param version: 4 or 6
+    :return: A tuple of (list of dicts of the PEER_STATUS_FIELDS of each
+    peer, error talking to BIRD or None).
+    """
+    peers = {}
+    for peer_type, configured in [
+            ("global", client.get_bgp_peers(version)),
+            ("node specific", client.get_bgp_peers(version,
+                                                   hostname=hostname))]:
+        for peer in configured:
+            peers[(str(peer.ip), peer_type)] = {
+                "peer_address": str(peer.ip), "peer_type": peer_type,
+                "as_num": str(peer.as_num), "state": "not running"}
+
+    try:
+        protocols = bird.show_protocols(version)
+        error = None
+    except bird.BirdError as e:
+        protocols = []
+        error = str(e)
+
+    for protocol in protocols:
+        peer = bird.bgp_peer(protocol, version)
+        if peer is None:
+            continue
+        status = peers.setdefault(peer, {"peer_address": peer[0],
+                                         "peer_type": peer[1]})
+        status.setdefault("as_num", protocol.get("neighbor_as"))
+        for field in PEER_STATUS_FIELDS[3:]:
+            status[field] = protocol.get(field)
+
+    result = []
+    for key in sorted(peers, key=lambda key: (key[1], IPAddress(key[0]))):
+        result.append(dict((field, peers[key].get(field))
+                           for field in PEER_STATUS_FIELDS))
+    return result, error
+
+
+def bgp_peer_status(versions, output):
+    """
+    Print the BGP peers of this node, and the state of their sessions.
+
+    :param versions: The IP versions to show.
+    :param output: The output format: table or json.
+    :return: None
+    """
+    # This needs to be run as root to access the BIRD control socket.
+    enforce_root()
+
+    statuses = dict((version, get_peer_status(version))
+                    for version in versions)
+    if output == "json":
+        print json.dumps(dict(("ipv%d" % version,
+                               {"peers": peers, "error": error})
+                              for version, (peers, error)
+                              in statuses.iteritems()),
+                         indent=2, sort_keys=True)
+        return
+
+    for version in versions:
+        peers, error = statuses[version]
+        print "IPv%d BGP peers" % version
+        if error:
+            print error
+        x = PrettyTable(["Peer address", "Peer type", "AS Num", "State",
+                         "Since", "BGP state", "Imported", "Exported"])
+        for peer in peers:
+            x.add_row([peer["peer_address"], peer["peer_type"],
+                       peer["as_num"] or "", peer["state"],
+                       peer["since"] or "", peer["bgp_state"] or "",
+                       _count(peer["routes_imported"]),
+                       _count(peer["routes_exported"])])
+        print str(x) + "\n"
+
+
+def _count(value):
+    return "" if value is None else value
+
+
 def set_default_node_as(as_num):
     """
     Set the default node BGP AS Number.
@@ -185,15 +315,131 @@ def show_bgp_node_mesh():
     :return: None.
     """
     value = client.get_bgp_node_mesh()
-    print "on" if value else "off"
+    if not value:
+        print "off"
+        return
+
+    route_reflectors = get_route_reflectors()
+    if route_reflectors:
+        print "rr (route reflectors: %s)" % ", ".join(route_reflectors)
+    else:
+        print "on"
 
 
 def set_bgp_node_mesh(enable):
     """
-    Set the BGP node mesh setting.
+    Set the BGP node mesh setting.  This replaces any route reflectors with
+    the full node-to-node mesh (or no mesh).
 
     :param enable:  (Boolean) Whether to enable or disable the node-to-node
     mesh.
     :return: None.
     """
+    _write_route_reflectors([])
     client.set_bgp_node_mesh(enable)
+
+
+def get_route_reflectors():
+    """
+    Get the nodes selected as route reflectors.
+
+    :return: A sorted list of hostnames, empty if the node-to-node mesh is not
+    using route reflectors.
+    """
+    return _list_children(BGP_RR_PATH)
+
+
+def _list_children(path):
+    """
+    Return the sorted names of the children of an etcd directory.
+    """
+    try:
+        result = client.etcd_client.read(path)
+    except EtcdKeyNotFound:
+        return []
+    return sorted(leaf.key.rsplit("/", 1)[-1] for leaf in result.leaves
+                  if leaf.key.rstrip("/") != path.rstrip("/"))
+
+
+def select_route_reflectors(hostnames, current, count):
+    """
+    Select the nodes to act as route reflectors.  Existing route reflectors
+    are kept, so that selecting again does not move the route reflectors.
+    Other nodes are chosen by a hash of their hostname, so the selection does
+    not depend on the order nodes were added.
+
+    :param hostnames: The hostnames of the nodes.
+    :param current: The hostnames of the existing route reflectors.
+    :param count: The number of route reflectors.
+    :return: A sorted list of the selected hostnames.
+    """
+    ranked = sorted(hostnames,
+                    key=lambda host: (host not in current,
+                                      hashlib.md5(host).hexdigest()))
+    return sorted(ranked[:count])
+
+
+def set_route_reflectors(count):
+    """
+    Select nodes to act as route reflectors, in place of the full
+    node-to-node mesh.
+
+    :param count: The number of route reflectors.
+    :return: None.
+    """
+    hostnames = _list_children(BGP_HOST_PATH % {"hostname": ""})
+    if not hostnames:
+        print "No Calico nodes are configured."
+        sys.exit(1)
+    if count >= len(hostnames):
+        print "There are only %d nodes, so all nodes will be route " \
+              "reflectors." % len(hostnames)
+
+    selected = select_route_reflectors(hostnames, get_route_reflectors(),
+                                       count)
+    _write_route_reflectors(selected)
+    client.set_bgp_node_mesh(True)
+    print "Route reflectors: %s" % ", ".join(selected)
+
+
+def reselect_route_reflectors(removed_hostname):
+    """
+    Replace a node which was a route reflector, keeping the same number of
+    route reflectors.
+
+    :param removed_hostname: The hostname of the node which was removed.
+    :return: None.
+    """
+    current = get_route_reflectors()
+    if removed_hostname not in current:
+        return
+
+    remaining = [host for host in current if host != removed_hostname]
+    hostnames = _list_children(BGP_HOST_PATH % {"hostname": ""})
+    selected = select_route_reflectors(
+        [host for host in hostnames if host != removed_hostname],
+        remaining, len(current))
+    _write_route_reflectors(selected)
+    if selected:
+        print "Route reflectors: %s" % ", ".join(selected)
+
+
+def _write_route_reflectors(selected):
+    """
+    Set the route reflectors.  The new route reflectors are added before the
+    old ones are removed, so that nodes always have a route reflector to peer
+    with.
+
+    :param selected: The hostnames of the route reflectors, or an empty list
+    for none.
+    """
+    current = get_route_reflectors()
+    for host in selected:
+        if host not in current:
+            client.etcd_client.write(BGP_RR_PATH + host, "")
+    for host in current:
+        if host not in selected:
+            try:
+                client.etcd_client.delete(BGP_RR_PATH + host)
+            except EtcdKeyNotFound:
+                pass
@@ -0,0 +1,183 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Client for the BIRD control socket.
+
+BIRD replies to each command with a series of lines, each starting with a
+four digit reply code followed by "-" if more lines follow, or " " for the
+last line.  Lines starting with a space continue the previous code.  Codes
+starting with 8 or 9 are errors, and the codes used here are:
+  0001  Welcome message
+  0000  End of reply
+  2002  Protocol list header
+  1002  Protocol list entry
+  1006  Protocol details
+"""
+import re
+import socket
+
+BIRD_CTL_PATHS = {4: "/var/run/calico/bird.ctl",
+                  6: "/var/run/calico/bird6.ctl"}
+BIRD_TIMEOUT_SECS = 10
+
+# The prefixes of the names of the BGP protocols in our BIRD config, and the
+# type of peer each is for.
+PEER_TYPES = [("Mesh_", "node-to-node mesh"),
+              ("Node_", "node specific"),
+              ("Global_", "global")]
+
+# The protocol details we report, by their name in the BIRD output.
+DETAILS = {"Description": "description",
+           "BGP state": "bgp_state",
+           "Neighbor address": "neighbor_address",
+           "Neighbor AS": "neighbor_as",
+           "Neighbor ID": "neighbor_id",
+           "Last error": "last_error",
+           "Hold timer": "hold_timer",
+           "Keepalive timer": "keepalive_timer"}
+ROUTES_RE = re.compile(r"(\d+) (\w+)")
+
+
+class BirdError(Exception):
+    """
+    Failure to talk to BIRD, or an error reply from BIRD.
+    """
+    pass
+
+
+class BirdClient(object):
+    """
+    A connection to the BIRD control socket.
+    """
+    def __init__(self, ctl_path, timeout=BIRD_TIMEOUT_SECS):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(ctl_path)
+        except socket.error as e:
+            self.sock.close()
+            raise BirdError("Couldn't connect to BIRD at %s: %s" %
+                            (ctl_path, e))
+        self.sock_file = self.sock.makefile("r")
+
+        # BIRD starts by sending a welcome message.
+        self._read_reply()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.sock_file.close()
+        self.sock.close()
+
+    def command(self, command):
+        """
+        Run a BIRD command.
+
+        :param command: The command, e.g. "show protocols all".
+        :return: A list of (reply code, text) tuples, one for each line of the
+        reply.
+        """
+        try:
+            self.sock.sendall(command + "\n")
+        except socket.error as e:
+            raise BirdError("Couldn't send command to BIRD: %s" % e)
+        return self._read_reply()
+
+    def _read_reply(self):
+        lines = []
+        code = None
+        while True:
+            try:
+                line = self.sock_file.readline()
+            except socket.error as e:
+                raise BirdError("Couldn't read reply from BIRD: %s" % e)
+            if not line:
+                raise BirdError("BIRD closed the connection")
+            line = line.rstrip("\n")
+
+            if len(line) >= 5 and line[:4].isdigit() and line[4] in "- ":
+                code, last, text = line[:4], line[4] == " ", line[5:]
+            else:
+                # A continuation of the previous code.
+                last, text = False, line[1:]
+
+            if code is None:
+                raise BirdError("Unexpected reply from BIRD: %s" % line)
+            if code[0] in "89":
+                raise BirdError(text.strip())
+            if code != "0000":
+                lines.append((code, text))
+            if last:
+                return lines
+
+
+def parse_protocols(lines):
+    """
+    Parse the reply to "show protocols all".
+
+    :param lines: The reply, as returned by BirdClient.command().
+    :return: A list of dicts, one for each protocol, holding the name, proto,
+    table, state, since and info columns, the imported, exported and
+    preferred route counts (where BIRD reports them) and the DETAILS.
+    """
+    protocols = []
+    for code, text in lines:
+        if code == "1002":
+            # The info column may itself contain spaces.
+            columns = text.split(None, 5)
+            columns += [""] * (6 - len(columns))
+            protocols.append(dict(zip(["name", "proto", "table", "state",
+                                       "since", "info"],
+                                      [column.strip() for column in columns])))
+        elif code == "1006" and protocols:
+            key, _, value = text.strip().partition(":")
+            value = value.strip()
+            if key == "Routes":
+                for count, kind in ROUTES_RE.findall(value):
+                    protocols[-1]["routes_%s" % kind] = int(count)
+            elif key in DETAILS and value:
+                protocols[-1][DETAILS[key]] = value
+    return protocols
+
+
+def show_protocols(version):
+    """
+    Get the protocols from the BIRD for an IP version.
+
+    :param version: 4 or 6.
+    :return: A list of protocol dicts, as returned by parse_protocols().
+    """
+    with BirdClient(BIRD_CTL_PATHS[version]) as bird:
+        return parse_protocols(bird.command("show protocols all"))
+
+
+def bgp_peer(protocol, version):
+    """
+    Get the peer of one of our BGP protocols.
+
+    :param protocol: A protocol dict, as returned by parse_protocols().
+    :param version: 4 or 6.
+    :return: A tuple of (peer address, peer type), or None if the protocol is
+    not one of our BGP peers.
+    """
+    for prefix, peer_type in PEER_TYPES:
+        if protocol["name"].startswith(prefix):
+            address = protocol["name"][len(prefix):].replace(
+                                        "_", "." if version == 4 else ":")
+            return address, peer_type
+    return None
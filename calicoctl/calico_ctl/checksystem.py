@@ -25,6 +25,7 @@ Options:
                        container, either "docker" or "rkt".
                        [default: docker]
 """
+import json
 import os
 import platform
 import re
@@ -37,7 +38,7 @@ from subprocess32 import check_output
 
 from utils import DOCKER_VERSION, DOCKER_LIBNETWORK_VERSION, REQUIRED_MODULES, \
     ETCD_VERSION
-from utils import enforce_root
+from utils import enforce_root, run_in_parallel
 from connectors import docker_client, client
 from pycalico.datastore import (ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT,
                                 ETCD_ENDPOINTS_ENV)
@@ -47,6 +48,13 @@ from pycalico.datastore import (ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT,
 MIN_KERNEL_VERSION_STR = "2.6.24"
 MIN_KERNEL_VERSION = [2, 6, 24]
 
+# The checks that have passed are cached (when requested) for the current boot
+# and kernel version.  Only the checks whose result cannot change without a
+# reboot are cached.
+CHECKSYSTEM_CACHE_FILE = "/var/run/calico/checksystem-cache.json"
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+CACHEABLE_CHECKS = ["modules", "kernel"]
+
 
 def checksystem(arguments):
     """
@@ -77,9 +85,11 @@ def checksystem(arguments):
 
 
 def check_system(quit_if_error=False, libnetwork=False, check_docker=True,
-                 check_modules=True, check_etcd=True, check_kernel=True):
+                 check_modules=True, check_etcd=True, check_kernel=True,
+                 use_cache=False):
     """
-    Checks that the system is setup correctly.
+    Checks that the system is setup correctly.  The checks are run
+    concurrently.
 
     :param check_etcd: Whether to perform etcd checks.
     :param check_docker: Whether to perform docker checks.
@@ -87,16 +97,42 @@ def check_system(quit_if_error=False, libnetwork=False, check_docker=True,
     :param quit_if_error: if True, quit with error code 1 if any issues are
     detected.
     :param libnetwork: If True, check for Docker version >= v1.21 to support libnetwork
+    :param use_cache: If True, skip the CACHEABLE_CHECKS that have already
+    passed since the host booted.
     :return: a tuple containing the results of the checks
 
     This function will sys.exit(1) instead of returning false if
     quit_if_error == True
     """
     enforce_root()
-    modules_ok = _check_modules() if check_modules else True
-    docker_ok = _check_docker_version(libnetwork) if check_docker else True
-    etcd_ok = check_etcd_version() if check_etcd else True
-    kernel_ok = _check_kernel_version() if check_kernel else True
+    checks = []
+    if check_modules:
+        checks.append(("modules", _check_modules))
+    if check_docker:
+        checks.append(("docker", lambda: _check_docker_version(libnetwork)))
+    if check_etcd:
+        checks.append(("etcd", check_etcd_version))
+    if check_kernel:
+        checks.append(("kernel", _check_kernel_version))
+
+    cache_key = _cache_key() if use_cache else None
+    passed = _load_passed_checks(cache_key) if cache_key else []
+    checks = [(name, check) for name, check in checks if name not in passed]
+
+    results = dict((name, True) for name in passed)
+    results.update(zip([name for name, _ in checks],
+                       run_in_parallel(lambda (name, check): check(),
+                                       checks, len(checks))))
+
+    if cache_key:
+        _save_passed_checks(cache_key,
+                            [name for name in CACHEABLE_CHECKS
+                             if results.get(name)])
+
+    modules_ok = results.get("modules", True)
+    docker_ok = results.get("docker", True)
+    etcd_ok = results.get("etcd", True)
+    kernel_ok = results.get("kernel", True)
 
     system_ok = modules_ok and docker_ok and etcd_ok and kernel_ok
 
@@ -106,6 +142,52 @@ def check_system(quit_if_error=False, libnetwork=False, check_docker=True,
     return (modules_ok, docker_ok, etcd_ok)
 
 
+def _cache_key():
+    """
+    :return: The boot ID and kernel version that the cached checks are valid
+    for, or None if the boot ID is not available.
+    """
+    try:
+        with open(BOOT_ID_FILE) as f:
+            boot_id = f.read().strip()
+    except IOError:
+        return None
+    return {"boot_id": boot_id, "kernel": platform.uname()[2]}
+
+
+def _load_passed_checks(cache_key):
+    """
+    :return: The names of the cached checks that have passed for this boot
+    and kernel version.
+    """
+    try:
+        with open(CHECKSYSTEM_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return []
+    if cache.get("key") != cache_key:
+        return []
+    return [name for name in cache.get("passed", [])
+            if name in CACHEABLE_CHECKS]
+
+
+def _save_passed_checks(cache_key, passed):
+    """
+    Atomically write the names of the checks that have passed to the cache.
+    Errors writing the cache are ignored.
+    """
+    try:
+        cache_dir = os.path.dirname(CHECKSYSTEM_CACHE_FILE)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = CHECKSYSTEM_CACHE_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"key": cache_key, "passed": passed}, f)
+        os.rename(tmp_path, CHECKSYSTEM_CACHE_FILE)
+    except (IOError, OSError):
+        pass
+
+
 def _check_modules():
     """
     Check system kernel modules
@@ -114,8 +196,7 @@ def _check_modules():
     """
     all_available = True
     try:
-        # Grab Kernel version with `uname`
-        kernel_version = check_output(["uname", "-r"]).rstrip()
+        kernel_version = platform.uname()[2]
 
         modules_loadable_path = "/lib/modules/%s/modules.dep" % kernel_version
         modules_builtin_path = "/lib/modules/%s/modules.builtin" % kernel_version
@@ -123,24 +204,22 @@ def _check_modules():
         # For the modules we're expecting to look for, the mainline case is that
         # they will be loadable modules. Therefore, loadable modules are checked
         # first and builtins are checked only if needed.
-        available_lines = open(modules_loadable_path).readlines()
-        builtin_lines = None
+        available = index_modules(modules_loadable_path)
+        builtin = None
 
         for module in REQUIRED_MODULES:
-            module_available = check_module_lines(available_lines, module)
-            if not module_available:
-                # Open and check builtin modules
-                if not builtin_lines:
-                    builtin_lines = open(modules_builtin_path).readlines()
-                module_builtin = check_module_lines(builtin_lines, module)
+            if normalize_module(module) not in available:
+                # Index and check builtin modules
+                if builtin is None:
+                    builtin = index_modules(modules_builtin_path)
 
                 # If module is not available or builtin, issue warning
-                if not module_builtin:
+                if normalize_module(module) not in builtin:
                     print >> sys.stderr, "WARNING: Unable to detect the %s " \
                                          "module as available or builtin." % module
                     all_available = False
 
-    # If something goes wrong with uname or file access, try lsmod.
+    # If something goes wrong with file access, try lsmod.
     except BaseException:
         try:
             modules = check_output(["lsmod"])
@@ -156,15 +235,33 @@ def _check_modules():
     return all_available
 
 
-def check_module_lines(lines, module):
+def index_modules(path):
+    """
+    Read the names of the modules listed in a modules.dep or modules.builtin
+    file.  The file is read a line at a time.
+
+    :param path: The path of the file.  Each line starts with the path of a
+    module, e.g. "kernel/net/netfilter/xt_set.ko", which in modules.dep is
+    followed by a ":" and the module's dependencies.
+    :return: A set of the normalized module names.
+    """
+    modules = set()
+    with open(path) as f:
+        for line in f:
+            module_path = line.split(":", 1)[0].strip()
+            if module_path:
+                modules.add(normalize_module(os.path.basename(module_path)))
+    return modules
+
+
+def normalize_module(module):
     """
-    Check if a normalized module name appears in the given lines
-    :param lines: The lines to check
-    :param module: A module name - e.g. "xt_set" or "ip6_tables"
-    :return: True if the module appears. False otherwise
+    Normalize a module name, or module filename, for comparison.
+    e.g.:   "ip6_tables" => "ip6_tables"
+            "xt-set.ko.gz" => "xt_set"
     """
-    full_module = "/%s.ko" % module
-    return any(full_module in line for line in lines)
+    # The kernel treats dashes and underscores in module names as equivalent.
+    return module.split(".ko", 1)[0].replace("-", "_")
 
 
 def normalize_version(version):
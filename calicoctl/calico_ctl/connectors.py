@@ -13,23 +13,76 @@
 # limitations under the License.
 import os
 import sys
-import docker
-import docker.errors
-
-from pycalico.ipam import IPAMClient
-from pycalico.datastore import (ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT,
-                                ETCD_SCHEME_ENV, ETCD_SCHEME_DEFAULT,
-                                ETCD_KEY_FILE_ENV, ETCD_CERT_FILE_ENV,
-                                ETCD_CA_CERT_FILE_ENV, DataStoreError)
+import threading
+
+from pycalico.datastore_errors import DataStoreError
 from utils import DOCKER_VERSION
 from utils import print_paragraph
-from pycalico.util import validate_hostname_port
-
-try:
-    client = IPAMClient()
-except DataStoreError as e:
-    print_paragraph(e.message)
-    sys.exit(1)
 
 DOCKER_URL = os.getenv("DOCKER_HOST", "unix://var/run/docker.sock")
-docker_client = docker.Client(version=DOCKER_VERSION, base_url=DOCKER_URL)
+
+
+class LazyClient(object):
+    """
+    Proxy for a client which is only created when it is first used.  This
+    avoids the cost of importing and creating clients which a command does
+    not need.
+
+    The proxy may be used from several threads (e.g. by run_in_parallel), so
+    the client is created under a lock.
+    """
+    def __init__(self, factory):
+        """
+        :param factory: Function called with no arguments to create the
+        client.
+        """
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+                client = self._client
+        return client
+
+    def reset(self):
+        """
+        Discard the client, so that a new one is created on next use.  This
+        is used in forked children so that connections are not shared with
+        the parent.
+        """
+        with self._lock:
+            self._client = None
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the proxy itself, so
+        # these are passed through to the real client.
+        return getattr(self._get_client(), name)
+
+    def __dir__(self):
+        # Expose the real client's attributes, so that the proxy can be
+        # used as a spec (e.g. by mock's autospec).
+        return dir(self._get_client())
+
+
+def _create_client():
+    # The datastore client pulls in etcd, so import it on first use.
+    from pycalico.ipam import IPAMClient
+    try:
+        return IPAMClient()
+    except DataStoreError as e:
+        print_paragraph(e.message)
+        sys.exit(1)
+
+
+def _create_docker_client():
+    import docker
+    return docker.Client(version=DOCKER_VERSION, base_url=DOCKER_URL)
+
+
+client = LazyClient(_create_client)
+docker_client = LazyClient(_create_docker_client)
@@ -5,6 +5,7 @@ Usage:
   calicoctl container <CONTAINER> profile (append|remove|set) [<PROFILES>...]
   calicoctl container add <CONTAINER> <IP> [--interface=<INTERFACE>]
   calicoctl container remove <CONTAINER>
+  calicoctl container add-many <MANIFEST> [--parallelism=<PARALLELISM>]
 
 Description:
   Add or remove containers to Calico networking, manage their IP addresses and profiles.
@@ -19,13 +20,24 @@ Options:
                            exactly match an existing Calico pool.
   --interface=<INTERFACE>  The name to give to the interface in the container
                            [default: eth1]
+  <MANIFEST>               A JSON (or YAML) file listing the containers to add,
+                           or "-" to read the manifest from stdin.  Each entry
+                           has a "container", an "ip" (which takes the same
+                           values as <IP>) and an optional "interface".
+  --parallelism=<PARALLELISM>  The maximum number of containers to configure
+                           concurrently. [default: 10]
 """
 
+import functools
+import json
 import os
 import sys
+import time
 import uuid
+from itertools import izip_longest
 
 import docker.errors
+from prettytable import PrettyTable
 from pycalico.util import validate_cidr
 from pycalico.util import validate_ip
 from requests.exceptions import ConnectionError
@@ -33,6 +45,9 @@ from urllib3.exceptions import MaxRetryError
 from subprocess import CalledProcessError
 from netaddr import IPAddress, IPNetwork
 from calico_ctl import endpoint
+from calico_ctl import endpoint_index
+from calico_ctl import journal
+from calico_ctl import reservations
 from pycalico import netns
 from pycalico.datastore_datatypes import Endpoint
 from pycalico.block import AlreadyAssignedError
@@ -43,6 +58,7 @@ from utils import hostname, DOCKER_ORCHESTRATOR_ID, NAMESPACE_ORCHESTRATOR_ID, \
     escape_etcd
 from utils import enforce_root
 from utils import print_paragraph
+from utils import run_in_parallel
 
 
 def assign_any(v4_count, v6_count, pool=(None, None)):
@@ -96,6 +112,14 @@ def validate_arguments(arguments):
             sys.exit(1)
 
 
+    # Validate PARALLELISM
+    parallelism = arguments.get("--parallelism")
+    if parallelism is not None and \
+            not (parallelism.isdigit() and int(parallelism) > 0):
+        print_paragraph("Invalid parallelism specified.  Argument must be a "
+                        "positive integer.")
+        sys.exit(1)
+
     # Validate PROFILE
     endpoint.validate_arguments(arguments)
 
@@ -156,6 +180,9 @@ def container(arguments):
                                               workload_id,
                                               None,
                                               arguments['<PROFILES>'])
+        elif arguments.get("add-many"):
+            container_add_many(arguments.get("<MANIFEST>"),
+                               int(arguments.get("--parallelism")))
         else:
             if arguments.get("add"):
                 container_add(arguments.get("<CONTAINER>"),
@@ -205,6 +232,7 @@ def container_add(container_id, ip, interface):
     """
     # The netns manipulations must be done as root.
     enforce_root()
+    journal.recover()
 
     # TODO: This section is redundant in container_add_ip and elsewhere
     if container_id.startswith("/") and os.path.exists(container_id):
@@ -253,16 +281,49 @@ def container_add(container_id, ip, interface):
                   state="active",
                   mac=None)
 
-    ip, _ = get_ip_and_pool(ip)
+    # Journal each step, so that the IP and veth are not leaked if we are
+    # interrupted before the endpoint is registered.
+    with journal.operation(journal.CONTAINER_ADD,
+                           hostname=hostname,
+                           orchestrator_id=ep.orchestrator_id,
+                           workload_id=ep.workload_id,
+                           endpoint_id=ep.endpoint_id,
+                           veth=ep.name) as op:
+        ip, _ = get_ip_and_pool(ip)
+        op.record("ip", ip=str(ip))
+
+        network = IPNetwork(ip)
+        if network.version == 4:
+            ep.ipv4_nets.add(network)
+        else:
+            ep.ipv6_nets.add(network)
 
-    network = IPNetwork(ip)
-    if network.version == 4:
-        ep.ipv4_nets.add(network)
-    else:
-        ep.ipv6_nets.add(network)
+        # Create the veth, move into the container namespace, add the IP and
+        # set up the default routes.
+        _setup_workload_interface(namespace, ep, ip, interface)
+
+        # Register the endpoint with Felix.
+        op.record("endpoint")
+        client.set_endpoint(ep)
+        endpoint_index.index_endpoint(ep)
+
+    # Let the caller know what endpoint was created.
+    print_paragraph("IP %s added to %s" % (str(ip), container_id))
+    return ep
 
-    # Create the veth, move into the container namespace, add the IP and
-    # set up the default routes.
+
+def _setup_workload_interface(namespace, ep, ip, interface):
+    """
+    Create the veth for an endpoint, move it into the container namespace, add
+    the IP and set up the default routes.  The MAC assigned to the veth in the
+    namespace is stored on the endpoint.
+
+    :param namespace: The netns.Namespace of the container.
+    :param ep: The Endpoint being configured.
+    :param ip: The IPAddress to add to the interface.
+    :param interface: The name of the interface in the container.
+    :return: None.
+    """
     netns.increment_metrics(namespace)
     netns.create_veth(ep.name, ep.temp_interface_name)
     netns.move_veth_into_ns(namespace, ep.temp_interface_name, interface)
@@ -272,12 +333,343 @@ def container_add(container_id, ip, interface):
     # Grab the MAC assigned to the veth in the namespace.
     ep.mac = netns.get_ns_veth_mac(namespace, interface)
 
-    # Register the endpoint with Felix.
-    client.set_endpoint(ep)
 
-    # Let the caller know what endpoint was created.
-    print_paragraph("IP %s added to %s" % (str(ip), container_id))
-    return ep
+class BatchEntry(object):
+    """
+    Holder class used to track the progress of a single manifest entry (see
+    the container_add_many() command).
+    """
+    def __init__(self, container_id, ip, interface):
+        self.container_id = container_id
+        self.requested_ip = ip
+        self.interface = interface
+        self.orchestrator_id = None
+        self.workload_id = None
+        self.namespace = None
+        self.endpoint = None
+        self.endpoint_id = uuid.uuid1().hex
+        self.ip = None
+        self.error = None
+
+
+def container_add_many(manifest, parallelism):
+    """
+    Add a batch of containers (on this host) to Calico networking.
+
+    This is equivalent to running container_add for each entry in the
+    manifest, but the datastore and Docker queries are made in bulk, all
+    auto-assigned addresses for a pool are requested in a single IPAM call,
+    and the namespace configuration is performed by a bounded pool of worker
+    threads.  A failure for one entry does not prevent the other entries
+    from being added.  The batch is journalled as a single operation, so
+    that the addresses assigned are not leaked if we are interrupted.
+
+    :param manifest: The manifest filename, or "-" to read from stdin.
+    :param parallelism: The maximum number of containers to configure
+    concurrently.
+    :return: The list of BatchEntry objects.
+    """
+    # The netns manipulations must be done as root.
+    enforce_root()
+    journal.recover()
+
+    start_time = time.time()
+    entries = load_manifest(manifest)
+
+    # Look up the workload for each container.  Docker does not provide a
+    # bulk inspect, so the inspections are made concurrently.
+    run_in_parallel(_resolve_batch_entry, entries, parallelism)
+
+    # Check for containers that are already networked with a single query
+    # for all of the endpoints on this host.
+    existing = {(ep.orchestrator_id, ep.workload_id)
+                for ep in client.get_endpoints(hostname=hostname)}
+    seen = set()
+    for entry in entries:
+        if entry.error:
+            continue
+        key = (entry.orchestrator_id, entry.workload_id)
+        if key in existing:
+            entry.error = "Already configured with Calico networking"
+        elif key in seen:
+            entry.error = "Container specified more than once"
+        seen.add(key)
+
+    batch = [entry for entry in entries if not entry.error]
+    for entry in batch:
+        entry.endpoint = Endpoint(hostname=hostname,
+                                  orchestrator_id=entry.orchestrator_id,
+                                  workload_id=entry.workload_id,
+                                  endpoint_id=entry.endpoint_id,
+                                  state="active",
+                                  mac=None)
+
+    # Journal the addresses assigned and the endpoints created, so that the
+    # addresses and veths are not leaked if we are interrupted, or an
+    # unexpected error stops the batch.
+    with journal.operation(journal.CONTAINER_ADD_MANY,
+                           endpoints=[{"hostname": hostname,
+                                       "orchestrator_id":
+                                           entry.orchestrator_id,
+                                       "workload_id": entry.workload_id,
+                                       "endpoint_id": entry.endpoint_id,
+                                       "veth": entry.endpoint.name}
+                                      for entry in batch]) as op:
+        _assign_batch_ips(batch, op)
+
+        run_in_parallel(functools.partial(_network_batch_entry, op),
+                        [entry for entry in batch if not entry.error],
+                        parallelism)
+
+    x = PrettyTable(["Container", "Interface", "IP", "Result"])
+    for entry in entries:
+        x.add_row([entry.container_id,
+                   entry.interface,
+                   entry.ip or "",
+                   entry.error or "Added"])
+    print str(x) + "\n"
+
+    failed = len([entry for entry in entries if entry.error])
+    print "Added %d of %d containers in %.2fs" % (len(entries) - failed,
+                                                  len(entries),
+                                                  time.time() - start_time)
+    if failed:
+        sys.exit(1)
+    return entries
+
+
+def load_manifest(manifest):
+    """
+    Load and validate a container manifest.  The manifest is either a JSON
+    list of entries, a stream of JSON entries with one per line, or (if PyYAML
+    is installed) a YAML list of entries.
+
+    :param manifest: The manifest filename, or "-" to read from stdin.
+    :return: A list of BatchEntry objects.  This method exits if the manifest
+    is not valid.
+    """
+    try:
+        if manifest == "-":
+            data = sys.stdin.read()
+        else:
+            with open(manifest) as f:
+                data = f.read()
+    except IOError as e:
+        print_paragraph("Unable to read manifest: %s" % e)
+        sys.exit(1)
+
+    try:
+        raw_entries = json.loads(data)
+    except ValueError:
+        try:
+            raw_entries = [json.loads(line) for line in data.splitlines()
+                           if line.strip()]
+        except ValueError:
+            raw_entries = _load_yaml_manifest(data)
+
+    if not isinstance(raw_entries, list):
+        print_paragraph("Manifest must contain a list of containers.")
+        sys.exit(1)
+
+    entries = []
+    for raw_entry in raw_entries:
+        if not isinstance(raw_entry, dict) or \
+                not raw_entry.get("container") or not raw_entry.get("ip"):
+            print_paragraph("Invalid manifest entry %s.  Each entry requires "
+                            "a container and an ip." % (raw_entry,))
+            sys.exit(1)
+
+        requested_ip = str(raw_entry["ip"])
+        if not (validate_ip(requested_ip, 4) or
+                validate_ip(requested_ip, 6) or
+                validate_cidr(requested_ip) or
+                requested_ip.lower() in ('ipv4', 'ipv6')):
+            print_paragraph("Invalid IP address %s specified for %s.  "
+                            "Argument must be a valid IP or CIDR." %
+                            (requested_ip, raw_entry["container"]))
+            sys.exit(1)
+
+        entries.append(BatchEntry(str(raw_entry["container"]),
+                                  requested_ip,
+                                  str(raw_entry.get("interface", "eth1"))))
+    return entries
+
+
+def _load_yaml_manifest(data):
+    """
+    Parse a YAML manifest.  YAML support is optional and depends on PyYAML
+    being installed.
+
+    :param data: The manifest data.
+    :return: The parsed manifest.  This method exits if the manifest cannot be
+    parsed.
+    """
+    try:
+        import yaml
+    except ImportError:
+        print_paragraph("Manifest is not valid JSON.  Install PyYAML to use "
+                        "a YAML manifest.")
+        sys.exit(1)
+
+    try:
+        return yaml.safe_load(data)
+    except yaml.YAMLError as e:
+        print_paragraph("Manifest is not valid JSON or YAML: %s" % e)
+        sys.exit(1)
+
+
+def _resolve_batch_entry(entry):
+    """
+    Determine the workload ID and namespace for a manifest entry.  Errors are
+    stored on the entry.
+
+    :param entry: The BatchEntry to resolve.
+    :return: None.
+    """
+    if entry.container_id.startswith("/") and \
+            os.path.exists(entry.container_id):
+        # The ID is a path. Don't do any docker lookups
+        entry.workload_id = escape_etcd(entry.container_id)
+        entry.orchestrator_id = NAMESPACE_ORCHESTRATOR_ID
+        entry.namespace = netns.Namespace(entry.container_id)
+        return
+
+    try:
+        info = docker_client.inspect_container(entry.container_id)
+    except docker.errors.APIError as e:
+        if e.response is not None and e.response.status_code == 404:
+            entry.error = "Container was not found"
+        else:
+            entry.error = str(e)
+        return
+    except ConnectionError:
+        entry.error = "Unable to run docker commands"
+        return
+
+    if not info["State"]["Running"]:
+        entry.error = "Container is not currently running"
+    elif info["HostConfig"]["NetworkMode"] == "host":
+        entry.error = "Container is running NetworkMode = host"
+    else:
+        entry.workload_id = info["Id"]
+        entry.orchestrator_id = DOCKER_ORCHESTRATOR_ID
+        entry.namespace = netns.PidNamespace(info["State"]["Pid"])
+
+
+def _assign_batch_ips(entries, op):
+    """
+    Assign IP addresses for a set of manifest entries.
+
+    Requested addresses are assigned individually.  Auto-assigned addresses
+    are grouped so that a single IPAM request is made for all of the "ipv4"
+    and "ipv6" entries, and a single request is made for each requested pool.
+    The addresses assigned by each request are recorded in the journal.
+
+    Errors are stored on the entries.
+
+    :param entries: The BatchEntry objects requiring addresses.
+    :param op: The journal.Operation for the batch.
+    :return: None.
+    """
+    # Load the pools once for each version, rather than looking up the pool
+    # for each IP address.
+    pools = {4: client.get_ip_pools(4), 6: client.get_ip_pools(6)}
+
+    # Group the auto-assigned entries by pool.  The key is the tuple of
+    # (IPv4 pool, IPv6 pool) passed to the IPAM client.
+    by_pool = {}
+    for entry in entries:
+        requested = entry.requested_ip.lower()
+        if requested in ("ipv4", "ipv6"):
+            version = int(requested[-1])
+            by_pool.setdefault((None, None), {4: [], 6: []})
+            by_pool[(None, None)][version].append(entry)
+        elif "/" in requested:
+            cidr = IPNetwork(requested)
+            matches = [p for p in pools[cidr.version] if p.cidr == cidr]
+            if not matches:
+                entry.error = "Pool %s is not found" % cidr
+                continue
+            key = (matches[0], None) if cidr.version == 4 \
+                                     else (None, matches[0])
+            by_pool.setdefault(key, {4: [], 6: []})
+            by_pool[key][cidr.version].append(entry)
+        else:
+            ip = IPAddress(requested)
+            if not any(ip in p.cidr for p in pools[ip.version]):
+                entry.error = "%s is not in any configured pools" % ip
+                continue
+            try:
+                client.assign_ip(ip, None, {})
+            except AlreadyAssignedError:
+                entry.error = "IP address is already assigned"
+            else:
+                entry.ip = ip
+                _record_batch_ips(op, [entry])
+
+    for pool, versions in by_pool.iteritems():
+        v4_list, v6_list = client.auto_assign_ips(len(versions[4]),
+                                                  len(versions[6]),
+                                                  None, {}, pool=pool)
+        assigned_entries = []
+        for version, assigned in ((4, v4_list), (6, v6_list)):
+            for entry, ip in izip_longest(versions[version], assigned):
+                if entry is None:
+                    # More addresses than requested - should not happen, but
+                    # don't leak it.
+                    client.release_ips({ip})
+                elif ip is None:
+                    entry.error = "Failed to allocate an IPv%s address.  " \
+                                  "Pools are likely exhausted." % version
+                else:
+                    entry.ip = ip
+                    assigned_entries.append(entry)
+        _record_batch_ips(op, assigned_entries)
+
+
+def _record_batch_ips(op, entries):
+    """
+    Record the addresses assigned to some manifest entries in the journal.
+    Each IPAM request is recorded as one step, named after its first entry.
+    """
+    if entries:
+        op.record("ips-%s" % entries[0].endpoint_id,
+                  ips=dict((entry.endpoint_id, str(entry.ip))
+                           for entry in entries))
+
+
+def _network_batch_entry(op, entry):
+    """
+    Configure the networking for a single manifest entry and register the
+    endpoint.  If this fails the assigned IP address is released.  Errors are
+    stored on the entry.
+
+    :param op: The journal.Operation for the batch.
+    :param entry: The BatchEntry to network.
+    :return: None.
+    """
+    ep = entry.endpoint
+    network = IPNetwork(entry.ip)
+    if network.version == 4:
+        ep.ipv4_nets.add(network)
+    else:
+        ep.ipv6_nets.add(network)
+
+    try:
+        _setup_workload_interface(entry.namespace, ep, entry.ip,
+                                  entry.interface)
+        op.record("endpoint-%s" % ep.endpoint_id)
+        client.set_endpoint(ep)
+        endpoint_index.index_endpoint(ep)
+    except Exception as e:
+        entry.error = "Failed to configure networking: %s" % e
+        try:
+            netns.remove_veth(ep.name)
+        except CalledProcessError:
+            pass
+        client.release_ips({entry.ip})
+        op.record("released-%s" % ep.endpoint_id)
+        entry.ip = None
 
 
 def container_remove(container_id):
@@ -292,14 +684,16 @@ def container_remove(container_id):
     """
     # The netns manipulations must be done as root.
     enforce_root()
+    journal.recover()
 
     # Resolve the name to ID.
     if container_id.startswith("/") and os.path.exists(container_id):
         # The ID is a path. Don't do any docker lookups
         orchestrator_id = NAMESPACE_ORCHESTRATOR_ID
+        workload_id = escape_etcd(container_id)
         endpoints = client.get_endpoints(hostname=hostname,
                                          orchestrator_id=orchestrator_id,
-                                         workload_id=escape_etcd(container_id))
+                                         workload_id=workload_id)
     else:
         # We know we're using "docker" as the orchestrator. If we have a direct
         # hit on the container id then we can proceed. Otherwise, ask docker to
@@ -314,25 +708,45 @@ def container_remove(container_id):
             endpoints = client.get_endpoints(hostname=hostname,
                                              orchestrator_id=orchestrator_id,
                                              workload_id=container_id)
-
-    for endpoint in endpoints:
-        # Remove any IP address assignments that this endpoint has
-        client.release_ips(set(map(IPAddress,
-                                   endpoint.ipv4_nets | endpoint.ipv6_nets)))
-
+        workload_id = container_id
+
+    # Journal the removal, so that it is finished if we are interrupted.
+    endpoints_data = [{"hostname": hostname,
+                       "orchestrator_id": orchestrator_id,
+                       "workload_id": workload_id,
+                       "endpoint_id": endpoint.endpoint_id,
+                       "veth": endpoint.name,
+                       "ips": [str(net.ip) for net in
+                               endpoint.ipv4_nets | endpoint.ipv6_nets]}
+                      for endpoint in endpoints]
+    with journal.operation(journal.CONTAINER_REMOVE,
+                           hostname=hostname,
+                           orchestrator_id=orchestrator_id,
+                           workload_id=container_id,
+                           endpoints=endpoints_data) as op:
+        for endpoint in endpoints:
+            # Remove any IP address assignments that this endpoint has
+            client.release_ips(set(map(IPAddress,
+                                       endpoint.ipv4_nets |
+                                       endpoint.ipv6_nets)))
+            op.record("released-%s" % endpoint.endpoint_id)
+
+            try:
+                # Remove the interface if it exists
+                netns.remove_veth(endpoint.name)
+            except CalledProcessError:
+                print "Could not remove Calico interface %s" % endpoint.name
+
+            endpoint_index.unindex_endpoint(endpoint)
+
+        # Always try to remove the workload, even if we didn't find any
+        # endpoints.
         try:
-            # Remove the interface if it exists
-            netns.remove_veth(endpoint.name)
-        except CalledProcessError:
-            print "Could not remove Calico interface %s" % endpoint.name
-
-    # Always try to remove the workload, even if we didn't find any
-    # endpoints.
-    try:
-        client.remove_workload(hostname, orchestrator_id, container_id)
-        print "Removed Calico from %s" % container_id
-    except KeyError:
-        print "Failed find Calico data for %s" % container_id
+            client.remove_workload(hostname, orchestrator_id, container_id)
+            print "Removed Calico from %s" % container_id
+        except KeyError:
+            print "Failed find Calico data for %s" % container_id
+        op.record("workload")
 
 
 # TODO: If container created with IPv4 and then add IPv6 address, do we set up the
@@ -345,11 +759,12 @@ def container_ip_add(container_id, ip, interface):
     :param ip: The IP to add
     :param interface: The name of the interface in the container.
 
-    :return: None
+    :return: The IPAddress added.
     """
 
     # The netns manipulations must be done as root.
     enforce_root()
+    journal.recover()
 
     if container_id.startswith("/") and os.path.exists(container_id):
         # The ID is a path. Don't do any docker lookups
@@ -377,38 +792,49 @@ def container_ip_add(container_id, ip, interface):
         print_container_not_in_calico_msg(container_id)
         sys.exit(1)
 
-    # From here, this method starts having side effects. If something
-    # fails then at least try to leave the system in a clean state.
-    address, pool = get_ip_and_pool(ip)
-
-    try:
-        if address.version == 4:
-            endpoint.ipv4_nets.add(IPNetwork(address))
-        else:
-            endpoint.ipv6_nets.add(IPNetwork(address))
-        client.update_endpoint(endpoint)
-    except (KeyError, ValueError):
-        client.release_ips({address})
-        print "Error updating datastore. Aborting."
-        sys.exit(1)
-
+    # Check the interface before assigning anything.
     if not netns.ns_veth_exists(namespace, interface):
         print "Interface provided does not exist in container. Aborting."
         sys.exit(1)
 
-    try:
-        netns.add_ip_to_ns_veth(namespace, address, interface)
-    except CalledProcessError:
-        print "Error updating networking in container. Aborting."
-        if address.version == 4:
-            endpoint.ipv4_nets.remove(IPNetwork(address))
-        else:
-            endpoint.ipv6_nets.remove(IPNetwork(address))
-        client.update_endpoint(endpoint)
-        client.release_ips({address})
-        sys.exit(1)
+    # From here, this method starts having side effects. If something
+    # fails then at least try to leave the system in a clean state.  The
+    # steps are journalled, so that the IP is not leaked if we are
+    # interrupted.
+    with journal.operation(journal.CONTAINER_IP_ADD,
+                           hostname=hostname,
+                           orchestrator_id=orchestrator_id,
+                           workload_id=workload_id) as op:
+        address, pool = get_ip_and_pool(ip)
+        op.record("ip", ip=str(address))
+
+        try:
+            if address.version == 4:
+                endpoint.ipv4_nets.add(IPNetwork(address))
+            else:
+                endpoint.ipv6_nets.add(IPNetwork(address))
+            op.record("endpoint")
+            client.update_endpoint(endpoint)
+        except (KeyError, ValueError):
+            client.release_ips({address})
+            print "Error updating datastore. Aborting."
+            sys.exit(1)
+
+        try:
+            netns.add_ip_to_ns_veth(namespace, address, interface)
+        except CalledProcessError:
+            print "Error updating networking in container. Aborting."
+            if address.version == 4:
+                endpoint.ipv4_nets.remove(IPNetwork(address))
+            else:
+                endpoint.ipv6_nets.remove(IPNetwork(address))
+            client.update_endpoint(endpoint)
+            client.release_ips({address})
+            sys.exit(1)
+        op.record("interface")
 
     print "IP %s added to %s" % (str(address), container_id)
+    return address
 
 
 def container_ip_remove(container_id, ip, interface):
@@ -425,6 +851,7 @@ def container_ip_remove(container_id, ip, interface):
 
     # The netns manipulations must be done as root.
     enforce_root()
+    journal.recover()
 
     if container_id.startswith("/") and os.path.exists(container_id):
         # The ID is a path. Don't do any docker lookups
@@ -460,21 +887,28 @@ def container_ip_remove(container_id, ip, interface):
         print "Container is unknown to Calico."
         sys.exit(1)
 
-    try:
-        nets.remove(IPNetwork(address))
-        client.update_endpoint(endpoint)
-    except (KeyError, ValueError):
-        print "Error updating datastore. Aborting."
-        sys.exit(1)
+    # Journal the removal, so that the IP is released if we are interrupted.
+    with journal.operation(journal.CONTAINER_IP_REMOVE,
+                           hostname=hostname,
+                           orchestrator_id=orchestrator_id,
+                           workload_id=workload_id,
+                           ip=str(address)) as op:
+        try:
+            nets.remove(IPNetwork(address))
+            client.update_endpoint(endpoint)
+        except (KeyError, ValueError):
+            print "Error updating datastore. Aborting."
+            sys.exit(1)
 
-    try:
-        netns.remove_ip_from_ns_veth(namespace, address, interface)
+        try:
+            netns.remove_ip_from_ns_veth(namespace, address, interface)
 
-    except CalledProcessError:
-        print "Error updating networking in container. Aborting."
-        sys.exit(1)
+        except CalledProcessError:
+            print "Error updating networking in container. Aborting."
+            sys.exit(1)
 
-    client.release_ips({address})
+        client.release_ips({address})
+        op.record("released")
 
     print "IP %s removed from %s" % (ip, container_id)
 
@@ -489,10 +923,20 @@ def get_ip_and_pool(ip_or_pool):
     allocated from that pool.  IF either "ipv6" or "ipv6" are specified, then
     an IP address is allocated from an arbitrary IPv4 or IPv6 pool
     respectively.
+    If IP reservations are enabled, auto-assigned addresses are taken from
+    this host's reservation cache where possible, which avoids any datastore
+    access.  The cache is then topped up in the background.
+
     :return: A tuple of (IPAddress, IPPool)
     """
     if ip_or_pool.lower() in ("ipv4", "ipv6"):
         # Requested to auto-assign an IP address
+        if reservations.reservation_count():
+            reserved = reservations.take_reserved_ip(int(ip_or_pool[-1]))
+            reservations.refill_in_background()
+            if reserved:
+                return reserved
+
         if ip_or_pool[-1] == '4':
             result = assign_any(1, 0)
             ip = result[0][0]
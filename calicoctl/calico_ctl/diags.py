@@ -13,28 +13,146 @@
 # limitations under the License.
 """
 Usage:
-  calicoctl diags [--log-dir=<LOG_DIR>]
+  calicoctl diags [--log-dir=<LOG_DIR>] [--max-log-bytes=<BYTES>]
+                  [--since=<SINCE>] [--datastore-prefix=<PREFIX>]
+                  [--datastore-host=<HOSTNAME>]
+  calicoctl diags --cluster [--refresh]
 
 Description:
   Save diagnostic information
 
+  With --cluster, the diagnostics summaries published by every Calico node
+  (route counts, iptables rule counts, ipset sizes, BIRD protocol states and
+  Felix stats) are gathered into one report.
+
 Options:
-  --log-dir=<LOG_DIR>  The directory for logs [default: /var/log/calico]
+  --log-dir=<LOG_DIR>          The directory for logs
+                               [default: /var/log/calico]
+  --max-log-bytes=<BYTES>      Only collect the last <BYTES> bytes of each log
+                               file.
+  --since=<SINCE>              Only collect log files modified in the last
+                               <SINCE>, for example 30m, 2h or 1d.
+  --datastore-prefix=<PREFIX>  Only dump the datastore keys under <PREFIX>
+                               [default: /calico]
+  --datastore-host=<HOSTNAME>  Only dump the per-host datastore keys of
+                               <HOSTNAME>.
+  --cluster                    Gather the diagnostics summaries of every node.
+  --refresh                    Ask every node to publish a new summary first.
 """
 import sys
 import os
 from datetime import datetime
+import functools
+import gzip
+import itertools
+import json
+import signal
 import tarfile
 import tempfile
+import threading
+import time
 import traceback
 import subprocess
 
 import re
-from etcd import EtcdException
+from etcd import EtcdException, EtcdKeyNotFound
 from pycalico.datastore import DatastoreClient
-from shutil import copytree, ignore_patterns
 
-from utils import print_paragraph, enforce_root
+from prettytable import PrettyTable
+from endpoint import get_hostnames
+from utils import print_paragraph, enforce_root, run_in_parallel
+
+# The commands to collect the output of, as (comment, command) tuples.
+COMMANDS = [
+    (None, "date"),
+    (None, "hostname"),
+    ("Dumping netstat", "netstat --all --numeric"),
+    ("Dumping routes (IPv4)", "ip -4 route"),
+    ("Dumping routes (IPv6)", "ip -6 route"),
+    ("Dumping interface info (IPv4)", "ip -4 addr"),
+    ("Dumping interface info (IPv6)", "ip -6 addr"),
+    ("Dumping iptables (IPv4)", "iptables-save"),
+    ("Dumping iptables (IPv6)", "ip6tables-save"),
+    ("Dumping ipsets", "ipset list"),
+    # If running under rkt, get the journal for the calico/node container.
+    ("Copying journal for calico-node.service",
+     "journalctl -u calico-node.service --no-pager"),
+]
+
+# The directory in the bundle that the diagnostics are stored in.
+ARCHIVE_DIR = "diagnostics"
+
+# The file in the bundle that records how long each collector took.
+TIMINGS_FILENAME = "collector_timings.json"
+
+COLLECTOR_PARALLELISM = 8
+COLLECTOR_TIMEOUT_SECS = 120
+
+# Datastore directories at this depth or deeper are read with a single
+# recursive read, shallower ones are read one level at a time.  At this depth,
+# a recursive read returns at most the workloads of one host.
+DATASTORE_SPLIT_DEPTH = 5
+
+# The datastore directories that hold a subdirectory for each host.
+DATASTORE_HOST_DIRS = ["/calico/v1/host", "/calico/bgp/v1/host",
+                       "/calico/ipam/v2/host", "/calico/felix/v1/host"]
+
+# The IPAM allocation blocks and handles are each held in one flat
+# directory, which etcd can only list by returning every value in it.
+# Instead, the blocks are found from the host affinities under
+# IPAM_HOST_PATH, the handles from the allocations in the blocks, and each is
+# read on its own, DATASTORE_READ_PARALLELISM at a time, in batches of
+# DATASTORE_READ_BATCH.
+IPAM_HOST_PATH = "/calico/ipam/v2/host"
+IPAM_ASSIGNMENT_PATH = "/calico/ipam/v2/assignment"
+IPAM_BLOCK_KEY = IPAM_ASSIGNMENT_PATH + "/ipv%s/block/%s"
+IPAM_HANDLE_PATH = "/calico/ipam/v2/handle"
+DATASTORE_READ_BATCH = 500
+DATASTORE_READ_PARALLELISM = 20
+
+# The etcd paths that calico/node publishes its diagnostics summaries to, and
+# that summaries are requested on.
+DIAGS_SUMMARY_PATH = "/calico/diags/v1/host/%s/summary"
+DIAGS_REQUEST_PATH = "/calico/diags/v1/request"
+
+CLUSTER_PARALLELISM = 20
+REFRESH_TIMEOUT_SECS = 15
+REFRESH_POLL_SECS = 0.5
+
+SINCE_RE = re.compile(r"^(\d+)([smhd])$")
+SINCE_UNIT_SECS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def validate_arguments(arguments):
+    """
+    Validate argument values:
+        <BYTES>
+        <SINCE>
+
+    :param arguments: Docopt processed arguments
+    """
+    max_log_bytes_ok = True
+    max_log_bytes = arguments.get("--max-log-bytes")
+    if max_log_bytes is not None:
+        try:
+            max_log_bytes_ok = int(max_log_bytes) > 0
+        except ValueError:
+            max_log_bytes_ok = False
+
+    since = arguments.get("--since")
+    since_ok = since is None or SINCE_RE.match(since) is not None
+
+    # Print error messages
+    if not max_log_bytes_ok:
+        print "Invalid maximum log size specified.  Must be a positive " \
+              "number of bytes."
+    if not since_ok:
+        print "Invalid --since value specified.  Must be a number followed " \
+              "by s, m, h or d, for example 2h."
+
+    # Exit if not valid arguments
+    if not (max_log_bytes_ok and since_ok):
+        sys.exit(1)
 
 
 def diags(arguments):
@@ -45,34 +163,58 @@ def diags(arguments):
     this file's docstring with docopt
     :return: None
     """
+    validate_arguments(arguments)
+
+    if arguments.get("--cluster"):
+        save_cluster_diags(arguments.get("--refresh"))
+        sys.exit(0)
+
     # The command has to be run as root for ipset collections (and iptables)
     enforce_root()
     print("Collecting diagnostics")
-    save_diags(arguments["--log-dir"])
+
+    max_log_bytes = arguments.get("--max-log-bytes")
+    since = arguments.get("--since")
+    save_diags(arguments["--log-dir"],
+               max_log_bytes=int(max_log_bytes) if max_log_bytes else None,
+               since=_since_secs(since) if since else None,
+               datastore_prefix=arguments["--datastore-prefix"],
+               datastore_host=arguments.get("--datastore-host"))
     sys.exit(0)
 
-temp_diags_dir = None
 
-def save_diags(log_dir):
-    # Create temp directory
+def _since_secs(since):
+    """
+    Convert a --since value, such as 2h, to a number of seconds.
+    """
+    count, unit = SINCE_RE.match(since).groups()
+    return int(count) * SINCE_UNIT_SECS[unit]
+
+
+def save_diags(log_dir, max_log_bytes=None, since=None,
+               datastore_prefix="/calico", datastore_host=None):
+    """
+    Collect the diagnostics into a gzipped tar bundle.
+
+    The commands, the datastore dump and the log files are collected
+    concurrently.  Each collector's output is added to the bundle as soon as
+    it finishes, and the logs are added straight from the log directory.
+
+    :param log_dir: The directory holding the Calico logs.
+    :param max_log_bytes: If set, only collect the last max_log_bytes bytes
+    of each log file.
+    :param since: If set, only collect log files modified in the last since
+    seconds.
+    :param datastore_prefix: The datastore path to dump.
+    :param datastore_host: If set, only dump the per-host datastore keys of
+    this host.
+    :return: None
+    """
     temp_dir = tempfile.mkdtemp()
-    global temp_diags_dir
-    temp_diags_dir = os.path.join(temp_dir, 'diagnostics')
-    os.mkdir(temp_diags_dir)
     print("Using temp dir: %s" % temp_dir)
-
-    write_diags(None, "date")
-    write_diags(None, "hostname")
-    write_diags("Dumping netstat", "netstat --all --numeric")
-    write_diags("Dumping routes (IPv4)", "ip -4 route")
-    write_diags("Dumping routes (IPv6)", "ip -6 route")
-    write_diags("Dumping interface info (IPv4)", "ip -4 addr")
-    write_diags("Dumping interface info (IPv6)", "ip -6 addr")
-    write_diags("Dumping iptables (IPv4)", "iptables-save")
-    write_diags("Dumping iptables (IPv6)", "ip6tables-save")
-    write_diags("Dumping ipsets", "ipset list")
-    # If running under rkt, get the journal for the calico/node container.
-    write_diags("Copying journal for calico-node.service", "journalctl -u calico-node.service --no-pager")
+    tar_filename = datetime.strftime(datetime.today(),
+                                     "diags-%d%m%y_%H%M%S.tar.gz")
+    full_tar_path = os.path.join(temp_dir, tar_filename)
 
     # Ask Felix to dump stats to its log file - ignore errors as the
     # calico/node container might not be running.  Gathering of the logs is
@@ -80,40 +222,28 @@ def save_diags(log_dir):
     print("Dumping felix stats")
     subprocess.call(["pkill", "-SIGUSR1", "felix"])
 
-    # Otherwise, calico logs are in the log directory.
+    # Calico logs are in the log directory.
+    logs = []
     if os.path.isdir(log_dir):
         print("Copying Calico logs")
-        # Skip the lock files as they can only be copied by root.
-        copytree(log_dir, os.path.join(temp_diags_dir, "logs"),
-                 ignore=ignore_patterns('lock'))
+        logs = find_log_files(log_dir, since)
     else:
         print('No logs found in %s; skipping log copying' % log_dir)
+    collectors = [(_command_filename(command),
+                   _command_collector(comment, command))
+                  for comment, command in COMMANDS]
+    collectors.append(("etcd_calico.jsonl.gz",
+                       lambda f: dump_datastore(f, datastore_prefix,
+                                                datastore_host)))
 
-    # Dump the contents of the etcd datastore.
-    print("Dumping datastore")
-    with DiagsErrorWriter(temp_diags_dir, 'etcd_calico') as f:
-        try:
-            datastore_client = DatastoreClient()
-            datastore_data = datastore_client.etcd_client.read("/calico",
-                                                               recursive=True)
-            f.write("dir?, key, value\n")
-            # TODO: python-etcd bug: Leaves show up twice in get_subtree().
-            for child in datastore_data.get_subtree():
-                if child.dir:
-                    f.write("DIR,  %s,\n" % child.key)
-                else:
-                    f.write("FILE, %s, %s\n" % (child.key, child.value))
-        except EtcdException, e:
-            print "Unable to dump etcd datastore"
-            f.write("Unable to dump etcd datastore: %s" % e)
-
-    # Create tar.
-    tar_filename = datetime.strftime(datetime.today(),
-                                     "diags-%d%m%y_%H%M%S.tar.gz")
-    full_tar_path = os.path.join(temp_dir, tar_filename)
-    with tarfile.open(full_tar_path, "w:gz") as tar:
-        # pass in arcname, otherwise zip contains layers of subfolders
-        tar.add(temp_dir, arcname="")
+    with DiagsBundle(full_tar_path) as bundle:
+        # The logs are usually the largest part of the bundle, so start
+        # adding them first.
+        tasks = [functools.partial(bundle.add_log, name, path, max_log_bytes)
+                 for name, path in logs]
+        tasks.extend(functools.partial(bundle.collect, name, collector)
+                     for name, collector in collectors)
+        run_in_parallel(lambda task: task(), tasks, COLLECTOR_PARALLELISM)
 
     print("\nDiags saved to %s\n" % (full_tar_path))
     print_paragraph("If required, you can upload the diagnostics bundle to a "
@@ -123,26 +253,537 @@ def save_diags(log_dir):
              (full_tar_path, os.path.basename(full_tar_path)))
 
 
-def write_diags(comment, command):
-    if comment:
-        print comment
-
+def _command_filename(command):
+    """
+    Return the filename to store the output of a command in.
+    """
     # Strip out non letters and numbers from the command to form the filename
     filename = re.sub(r'[^a-zA-Z0-9 -]', "", command)
 
     # And substitute underscore for spaces
-    filename = re.sub(r'\s', "_", filename)
+    return re.sub(r'\s', "_", filename)
+
+
+def _command_collector(comment, command):
+    """
+    Return a collector that writes the output of a command to a file.
+    """
+    def collector(f):
+        if comment:
+            print comment
+        return run_command(command, f)
+    return collector
+
+
+def find_log_files(log_dir, since=None):
+    """
+    Find the log files in a directory.
+
+    :param log_dir: The log directory.
+    :param since: If set, only find log files modified in the last since
+    seconds.
+    :return: A list of (name in the bundle, path) tuples.
+    """
+    cutoff = time.time() - since if since else None
+    logs = []
+    for dirpath, _, filenames in os.walk(log_dir):
+        for filename in sorted(filenames):
+            # Skip the lock files as they can only be read by root.
+            if filename == "lock":
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                if cutoff and os.stat(path).st_mtime < cutoff:
+                    continue
+            except OSError:
+                # Rotated away since we listed the directory.
+                continue
+            logs.append((os.path.join("logs", os.path.relpath(path, log_dir)),
+                         path))
+    return logs
+
+
+def run_command(command, f, timeout=COLLECTOR_TIMEOUT_SECS):
+    """
+    Run a shell command, writing its output to a file.  The command is killed
+    if it runs for longer than the timeout.
+
+    :param command: The command to run.
+    :param f: The file to write the command output to.
+    :param timeout: The timeout, in seconds.
+    :return: The status of the command: "ok", "timed out" or "exit code <N>".
+    """
+    # Run the command in its own process group, so that the shell and
+    # anything it runs can be killed together.
+    process = subprocess.Popen(command, shell=True, stdout=f,
+                               stderr=subprocess.STDOUT,
+                               preexec_fn=os.setsid)
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        retcode = process.wait()
+    finally:
+        timer.cancel()
+
+    f.seek(0, os.SEEK_END)
+    if timed_out:
+        print "Command timed out after %ds: %s" % (timeout, command)
+        f.write("\nCommand timed out after %ds: %s\n" % (timeout, command))
+        return "timed out"
+    elif retcode:
+        print "Problem running command: %s" % command
+        f.write("\nProblem running command: %s\n" % command)
+        return "exit code %d" % retcode
+    return "ok"
+
+
+def dump_datastore(f, prefix="/calico", hostname=None):
+    """
+    Dump the contents of the etcd datastore to a file, as gzipped JSON lines.
+    Each line is a JSON object holding the key, dir, value and modified_index
+    of a node in the datastore.
+
+    :param f: The file to write the dump to.
+    :param prefix: The datastore path to dump.
+    :param hostname: If set, only dump the per-host keys of this host.
+    :return: The status of the dump: "ok" or "error".
+    """
+    print("Dumping datastore")
+    status = "ok"
+    with gzip.GzipFile(fileobj=f, mode="wb") as gzip_file:
+        try:
+            etcd_client = DatastoreClient().etcd_client
+            for node in itertools.chain(
+                    walk_datastore(etcd_client, prefix, hostname),
+                    walk_ipam_assignments(etcd_client, prefix, hostname)):
+                gzip_file.write(json.dumps({
+                    "key": node.key,
+                    "dir": bool(node.dir),
+                    "value": None if node.dir else node.value,
+                    "modified_index": node.modifiedIndex}) + "\n")
+        except EtcdException, e:
+            print "Unable to dump etcd datastore"
+            gzip_file.write(json.dumps({
+                "error": "Unable to dump etcd datastore: %s" % e}) + "\n")
+            status = "error"
+    return status
+
+
+def walk_datastore(etcd_client, path, hostname=None):
+    """
+    Walk a subtree of the datastore, yielding each node in it once.
+
+    Directories shallower than DATASTORE_SPLIT_DEPTH are read one level at a
+    time, so no single read returns the whole datastore.  The IPAM blocks
+    and handles are skipped; see walk_ipam_assignments().
+
+    :param etcd_client: The etcd client.
+    :param path: The path of the subtree.
+    :param hostname: If set, skip the per-host subtrees of other hosts.
+    :return: An iterator of EtcdResults.
+    """
+    path = path.rstrip("/")
+    if any(_in_path(path, ipam_path)
+           for ipam_path in [IPAM_ASSIGNMENT_PATH, IPAM_HANDLE_PATH]):
+        return
+    recursive = path.count("/") >= DATASTORE_SPLIT_DEPTH
+    try:
+        result = etcd_client.read(path, recursive=recursive)
+    except EtcdKeyNotFound:
+        return
 
-    with DiagsErrorWriter(temp_diags_dir, filename) as f:
+    # Older versions of python-etcd return leaves twice from get_subtree().
+    seen = set()
+    subdirs = []
+    for node in result.get_subtree():
+        if node.key in seen:
+            continue
+        seen.add(node.key)
+        if node.dir and not recursive and node.key != result.key:
+            subdirs.append(node.key)
+        else:
+            yield node
+
+    for subdir in subdirs:
+        if hostname and path in DATASTORE_HOST_DIRS and \
+                subdir.rsplit("/", 1)[1] != hostname:
+            continue
+        for node in walk_datastore(etcd_client, subdir, hostname):
+            yield node
+
+
+def walk_ipam_assignments(etcd_client, prefix, hostname=None):
+    """
+    Walk the IPAM allocation blocks and handles under a path, yielding each
+    one.  The blocks are those affine to a host, found from the per-host
+    affinities, and the handles are those of the allocations in the blocks.
+
+    :param etcd_client: The etcd client.
+    :param prefix: The datastore path being dumped.
+    :param hostname: If set, only walk the blocks affine to this host, and
+    their handles.
+    :return: An iterator of EtcdResults.
+    """
+    prefix = prefix.rstrip("/")
+    dump_handles = _in_path(prefix, IPAM_HANDLE_PATH) or \
+        _in_path(IPAM_HANDLE_PATH, prefix)
+    if not (dump_handles or _in_path(prefix, IPAM_ASSIGNMENT_PATH) or
+            _in_path(IPAM_ASSIGNMENT_PATH, prefix)):
+        return
+
+    # Affinity keys are <IPAM_HOST_PATH>/<host>/ipv<version>/block/<cidr>.
+    block_keys = []
+    for node in walk_datastore(etcd_client, IPAM_HOST_PATH, hostname):
+        parts = node.key[len(IPAM_HOST_PATH):].split("/")
+        if not node.dir and len(parts) == 5 and parts[3] == "block":
+            block_keys.append(IPAM_BLOCK_KEY % (parts[2][-1], parts[4]))
+
+    # The blocks are read even if only the handles are being dumped, to find
+    # the handles.
+    if not dump_handles:
+        block_keys = [key for key in block_keys if _in_path(key, prefix)]
+    handle_keys = set()
+    for node in _read_keys(etcd_client, block_keys):
+        if _in_path(node.key, prefix):
+            yield node
+        if not dump_handles:
+            continue
+        try:
+            attributes = json.loads(node.value).get("attributes") or []
+        except (TypeError, ValueError, AttributeError):
+            continue
+        for attribute in attributes:
+            if attribute.get("handle_id"):
+                handle_keys.add("%s/%s" % (IPAM_HANDLE_PATH,
+                                           attribute["handle_id"]))
+
+    if dump_handles:
+        for node in _read_keys(etcd_client,
+                               sorted(key for key in handle_keys
+                                      if _in_path(key, prefix))):
+            yield node
+
+
+def _read_keys(etcd_client, keys):
+    """
+    Read keys on their own, in parallel batches.
+
+    :return: An iterator of the EtcdResults of the keys that exist.
+    """
+    def read(key):
+        try:
+            return etcd_client.read(key)
+        except EtcdKeyNotFound:
+            return None
+
+    for start in range(0, len(keys), DATASTORE_READ_BATCH):
+        for node in run_in_parallel(
+                read, keys[start:start + DATASTORE_READ_BATCH],
+                DATASTORE_READ_PARALLELISM):
+            if node is not None:
+                yield node
+
+
+def _in_path(key, path):
+    """
+    :return: Whether a key is at or under a datastore path.
+    """
+    return key == path or key.startswith(path.rstrip("/") + "/")
+
+
+def save_cluster_diags(refresh=False):
+    """
+    Gather the diagnostics summaries of every node into one report, print a
+    summary of it and save it as JSON.
+
+    :param refresh: Whether to ask every node to publish a new summary first.
+    :return: None
+    """
+    etcd_client = DatastoreClient().etcd_client
+    try:
+        hostnames = get_hostnames()
+        request_index = None
+        if refresh:
+            print("Requesting diagnostics summaries")
+            request_index = etcd_client.write(DIAGS_REQUEST_PATH,
+                                              str(time.time())).modifiedIndex
+    except EtcdException, e:
+        print "Unable to read hosts from the datastore: %s" % e
+        sys.exit(1)
+
+    print("Gathering diagnostics summaries from %d nodes" % len(hostnames))
+    report = merge_summaries(gather_summaries(etcd_client, hostnames,
+                                              request_index))
+
+    x = PrettyTable(["Host", "Age", "IPv4 routes", "IPv6 routes",
+                     "iptables rules", "ipset entries", "BGP established",
+                     "Felix", "Errors"])
+    now = time.time()
+    for hostname, summary in sorted(report["hosts"].iteritems()):
+        if summary is None:
+            x.add_row([hostname, "", "", "", "", "", "", "",
+                       "no summary"])
+            continue
+        totals = _summary_totals(summary)
+        x.add_row([hostname,
+                   "%ds" % (now - summary["time"]) if "time" in summary
+                   else "",
+                   totals["routes"].get("ipv4", ""),
+                   totals["routes"].get("ipv6", ""),
+                   sum(totals["iptables_rules"].values()),
+                   totals["ipset_entries"],
+                   "%d/%d" % (totals["bgp_sessions"]["established"],
+                              totals["bgp_sessions"]["total"]),
+                   "running" if totals["felix_running"] else "not running",
+                   ", ".join(sorted(summary.get("errors", {})))])
+    print(str(x))
+
+    totals = report["totals"]
+    print("%d nodes, %d without a summary, %d/%d BGP sessions established, "
+          "Felix running on %d nodes" %
+          (totals["hosts"], totals["hosts_missing"],
+           totals["bgp_sessions"]["established"],
+           totals["bgp_sessions"]["total"], totals["felix_running"]))
+
+    report_filename = datetime.strftime(datetime.today(),
+                                        "cluster-diags-%d%m%y_%H%M%S.json")
+    report_path = os.path.join(tempfile.mkdtemp(), report_filename)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("\nCluster diags saved to %s\n" % report_path)
+
+
+def _get_summary(etcd_client, hostname):
+    """
+    :return: The diagnostics summary of a node, or None if it has not
+    published one.
+    """
+    try:
+        return json.loads(etcd_client.read(DIAGS_SUMMARY_PATH %
+                                           hostname).value)
+    except EtcdKeyNotFound:
+        return None
+    except (EtcdException, ValueError) as e:
+        return {"hostname": hostname,
+                "errors": {"fetch": "Unable to read summary: %s" % e}}
+
+
+def gather_summaries(etcd_client, hostnames, request_index=None):
+    """
+    Fetch the diagnostics summaries of the nodes concurrently.
+
+    :param etcd_client: The etcd client.
+    :param hostnames: The hostnames of the nodes.
+    :param request_index: If set, keep fetching (for up to
+    REFRESH_TIMEOUT_SECS) the summaries of nodes that have not yet answered
+    the request with this etcd index.
+    :return: A dict of the summary (or None) of each node, by hostname.
+    """
+    summaries = {}
+    pending = list(hostnames)
+    deadline = time.time() + REFRESH_TIMEOUT_SECS
+    while pending:
+        results = run_in_parallel(
+            lambda hostname: _get_summary(etcd_client, hostname),
+            pending, CLUSTER_PARALLELISM)
+        summaries.update(zip(pending, results))
+        if request_index is None or time.time() > deadline:
+            break
+        pending = [hostname for hostname in pending
+                   if ((summaries[hostname] or {}).get("request_index")
+                       or 0) < request_index]
+        if pending:
+            time.sleep(REFRESH_POLL_SECS)
+    return summaries
+
+
+def _summary_totals(summary):
+    """
+    :return: The totals of a node's diagnostics summary.
+    """
+    protocols = [protocol
+                 for version in summary.get("bird_protocols", {}).values()
+                 for protocol in version.values()]
+    return {
+        "routes": summary.get("routes", {}),
+        "iptables_rules": dict(
+            (version, sum(tables.values())) for version, tables
+            in summary.get("iptables_rules", {}).iteritems()),
+        "ipset_entries": sum(summary.get("ipsets", {}).values()),
+        "bgp_sessions": {
+            "established": len([protocol for protocol in protocols
+                                if protocol["info"].startswith(
+                                    "Established")]),
+            "total": len(protocols)},
+        "felix_running": summary.get("felix", {}).get("running", False),
+        "endpoints": summary.get("felix", {}).get("endpoints", 0)}
+
+
+def merge_summaries(summaries):
+    """
+    Merge the diagnostics summaries of the nodes into one report.
+
+    :param summaries: A dict of the summary (or None) of each node, by
+    hostname.
+    :return: The report, holding the summaries and the cluster totals.
+    """
+    totals = {"hosts": len(summaries),
+              "hosts_missing": 0,
+              "routes": {"ipv4": 0, "ipv6": 0},
+              "iptables_rules": {"ipv4": 0, "ipv6": 0},
+              "ipset_entries": 0,
+              "bgp_sessions": {"established": 0, "total": 0},
+              "felix_running": 0,
+              "endpoints": 0}
+    for summary in summaries.values():
+        if summary is None:
+            totals["hosts_missing"] += 1
+            continue
+        host_totals = _summary_totals(summary)
+        for key in ["routes", "iptables_rules", "bgp_sessions"]:
+            for subkey, value in host_totals[key].iteritems():
+                totals[key][subkey] = totals[key].get(subkey, 0) + value
+        for key in ["ipset_entries", "felix_running", "endpoints"]:
+            totals[key] += int(host_totals[key])
+    return {"generated": time.time(), "totals": totals, "hosts": summaries}
+
+
+class DiagsBundle(object):
+    """
+    A gzipped tar bundle of diagnostics, which collectors running in
+    parallel add files to.  On close, the timings of the collectors are
+    added to the bundle as TIMINGS_FILENAME.
+    """
+    def __init__(self, path):
+        self.tar = tarfile.open(path, "w:gz")
+        self.lock = threading.Lock()
+        self.timings = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        timings = json.dumps(sorted(self.timings,
+                                    key=lambda timing: timing["start"]),
+                             indent=2)
+        with tempfile.TemporaryFile() as f:
+            f.write(timings)
+            self.add_file(TIMINGS_FILENAME, f)
+        self.tar.close()
+
+    def record(self, name, start, duration, status):
+        """
+        Record how long a collector took.
+
+        :param name: The name of the collector.
+        :param start: The time the collector started.
+        :param duration: How long the collector took, in seconds.
+        :param status: The status of the collector.
+        """
+        with self.lock:
+            self.timings.append({"name": name,
+                                 "start": round(start, 3),
+                                 "duration": round(duration, 3),
+                                 "status": status})
+
+    def collect(self, name, collector):
+        """
+        Run a collector, and add its output to the bundle.
+
+        The output is spooled to an unnamed temporary file (rather than held
+        in memory), since the size of each file in the tar must be known
+        before it is written.
+
+        :param name: The name of the file in the bundle.
+        :param collector: A function that writes to the file object it is
+        passed, and returns its status.
+        """
+        start = time.time()
+        status = "error"
+        with tempfile.TemporaryFile() as f:
+            with DiagsErrorWriter(f):
+                status = collector(f)
+            self.record(name, start, time.time() - start, status)
+            self.add_file(name, f)
+
+    def add_log(self, name, path, max_log_bytes=None):
+        """
+        Add a log file to the bundle, straight from the log directory.
+
+        The size of the log is taken when it is opened, and only that many
+        bytes are added, since logs may be appended to while being added.  If
+        the log is truncated (e.g. rotated) while being added, the rest of
+        the file in the bundle is padded with zeros, so that the bundle is
+        not corrupted.
+
+        :param name: The name of the file in the bundle.
+        :param path: The path of the log file.
+        :param max_log_bytes: If set, only add the last max_log_bytes bytes of
+        the log.
+        """
+        start = time.time()
         try:
-            output = subprocess.check_output(command,
-                                             shell=True,
-                                             stderr=subprocess.STDOUT)
-            f.write(output)
-        except subprocess.CalledProcessError as e:
-            print "Problem running command: %s\n  %s" % (command, e.output)
-            f.write("Problem running command: %s\n\n" % command)
-            f.write("%s\n" % e.output)
+            with open(path, "rb") as log_file:
+                size = os.fstat(log_file.fileno()).st_size
+                if max_log_bytes and size > max_log_bytes:
+                    log_file.seek(size - max_log_bytes)
+                    size = max_log_bytes
+                self.add_file(name, LogReader(log_file, size), size)
+            status = "ok"
+        except IOError as e:
+            print "Unable to copy log file %s: %s" % (path, e)
+            status = "error"
+        self.record(name, start, time.time() - start, status)
+
+    def add_file(self, name, f, size=None):
+        """
+        Add the contents of a file object to the bundle.
+
+        :param name: The name of the file in the bundle.
+        :param f: The file object.  The contents are read from the start,
+        unless size is given, and must not change while they are added.
+        :param size: If set, the number of bytes to add from the file object,
+        which must return exactly that many.
+        """
+        if size is None:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(0)
+        tarinfo = tarfile.TarInfo(os.path.join(ARCHIVE_DIR, name))
+        tarinfo.size = size
+        tarinfo.mtime = time.time()
+        tarinfo.mode = 0644
+        with self.lock:
+            self.tar.addfile(tarinfo, f)
+
+
+class LogReader(object):
+    """
+    Reads exactly size bytes from a log file, padding with zeros if the log
+    is truncated while it is being read.
+    """
+    def __init__(self, f, size):
+        self.file = f
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= size
+        return data + "\0" * (size - len(data))
 
 
 class DiagsErrorWriter(object):
@@ -154,23 +795,19 @@ class DiagsErrorWriter(object):
     possible.
     """
 
-    def __init__(self, temp_dir, filename):
-        self.temp_dir = temp_dir
-        self.filename = filename
-        self.file = None
+    def __init__(self, f):
+        self.file = f
 
     def __enter__(self):
         """
-        Open the diags file for writing, and return the file object.
+        Return the diags file object.
         :return: The file object.
         """
-        self.file = open(os.path.join(self.temp_dir, self.filename), "w")
         return self.file
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
-        Close the diagnostics file and if an error occurred, write that into
-        the file.
+        If an error occurred, write that into the diagnostics file.
         :param exc_type: The exception type, or None.
         :param exc_val: The exception instance, or None.
         :param exc_tb: The exception traceback, or None.
@@ -188,5 +825,4 @@ class DiagsErrorWriter(object):
             traceback.print_tb(exc_tb, None, self.file)
             rc = True
 
-        self.file.close()
         return rc
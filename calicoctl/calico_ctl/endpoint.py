@@ -15,10 +15,12 @@
 Usage:
   calicoctl endpoint show [--host=<HOSTNAME>] [--orchestrator=<ORCHESTRATOR_ID>]
     [--workload=<WORKLOAD_ID>] [--endpoint=<ENDPOINT_ID>] [--detailed]
+    [--output=<OUTPUT>] [--limit=<LIMIT>] [--continue=<TOKEN>]
   calicoctl endpoint <ENDPOINT_ID> profile (append|remove|set) [--host=<HOSTNAME>]
     [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>]  [<PROFILES>...]
   calicoctl endpoint <ENDPOINT_ID> profile show [--host=<HOSTNAME>]
     [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>]
+  calicoctl endpoint reindex [--parallelism=<PARALLELISM>]
 
 Description:
   Configure or show endpoints assigned to existing containers
@@ -29,26 +31,48 @@ Options:
  --orchestrator=<ORCHESTRATOR_ID>   Filters endpoints created on a specific orchestrator
  --workload=<WORKLOAD_ID>           Filters endpoints on a specific workload
  --endpoint=<ENDPOINT_ID>           Filters endpoints with a specific endpoint ID
+ --output=<OUTPUT>                  The output format: table, jsonl or tsv
+                                    [default: table]
+ --limit=<LIMIT>                    Show at most this many rows
+ --continue=<TOKEN>                 Continue from the last row shown by a
+                                    previous command using --limit
+ --parallelism=<PARALLELISM>        The number of concurrent datastore requests
+                                    to make [default: 10]
 
 Examples:
     Show all endpoints belonging to 'host1':
         $ calicoctl endpoint show --host=host1
 
+    Stream details of all endpoints as JSON, one endpoint per line, 1000 at a
+    time:
+        $ calicoctl endpoint show --detailed --output=jsonl --limit=1000
+
     Add a profile called 'profile-A' to the endpoint a1b2c3d4:
         $ calicoctl endpoint a1b2c3d4 profile append profile-A
 
     Add a profile called 'profile-A' to the endpoint a1b2c3d4, but faster,
     by providing more specific filters:
         $ calicoctl endpoint a1b2c3d4 profile append profile-A --host=host1 --orchestrator=docker --workload=f9e8d7e6
+
+    Endpoints created by calicoctl are indexed by endpoint ID and workload ID,
+    so these filters are not needed for them.  Rebuild the index (e.g. after
+    upgrading calicoctl, or if endpoints were created by other tools):
+        $ calicoctl endpoint reindex
 """
+import base64
+import json
 import sys
 from collections import defaultdict
 
+from etcd import EtcdKeyNotFound
+
 from prettytable import PrettyTable
+from pycalico.datastore import HOSTS_PATH
 from pycalico.datastore_errors import ProfileAlreadyInEndpoint
 from pycalico.datastore_errors import MultipleEndpointsMatch
 from pycalico.datastore_errors import ProfileNotInEndpoint
 
+import endpoint_index
 from connectors import client
 from utils import print_paragraph
 from pycalico.util import validate_characters
@@ -58,6 +82,10 @@ def validate_arguments(arguments):
     """
     Validate argument values:
         <PROFILES>
+        <OUTPUT>
+        <LIMIT>
+        <TOKEN>
+        <PARALLELISM>
 
     Arguments not validated:
         <HOSTNAME>
@@ -67,6 +95,34 @@ def validate_arguments(arguments):
 
     :param arguments: Docopt processed arguments
     """
+    # Validate OUTPUT
+    output = arguments.get("--output")
+    if output is not None and output not in OUTPUT_FORMATS:
+        print_paragraph("Invalid output format specified.  Must be one of: "
+                        "%s." % ", ".join(OUTPUT_FORMATS))
+        sys.exit(1)
+
+    # Validate LIMIT
+    limit = arguments.get("--limit")
+    if limit is not None and not (limit.isdigit() and int(limit) > 0):
+        print_paragraph("Invalid limit specified.  Argument must be a "
+                        "positive integer.")
+        sys.exit(1)
+
+    # Validate TOKEN
+    token = arguments.get("--continue")
+    if token is not None and _decode_continue_token(token) is None:
+        print_paragraph("Invalid continue token specified.")
+        sys.exit(1)
+
+    # Validate PARALLELISM
+    parallelism = arguments.get("--parallelism")
+    if parallelism is not None and \
+            not (parallelism.isdigit() and int(parallelism) > 0):
+        print_paragraph("Invalid parallelism specified.  Argument must be a "
+                        "positive integer.")
+        sys.exit(1)
+
     # Validate Profiles
     profile_ok = True
     profiles = arguments.get("<PROFILES>")
@@ -101,6 +157,34 @@ class EndpointSummary(object):
         self.workload_ids.add(endpoint.workload_id)
 
 
+OUTPUT_FORMATS = ["table", "jsonl", "tsv"]
+
+DETAILED_HEADINGS = ["Hostname",
+                     "Orchestrator ID",
+                     "Workload ID",
+                     "Endpoint ID",
+                     "Addresses",
+                     "MAC",
+                     "Profiles",
+                     "State"]
+DETAILED_FIELDS = ["hostname",
+                   "orchestrator_id",
+                   "workload_id",
+                   "endpoint_id",
+                   "addresses",
+                   "mac",
+                   "profiles",
+                   "state"]
+SUMMARY_HEADINGS = ["Hostname",
+                    "Orchestrator ID",
+                    "Number of Workloads",
+                    "Number of Endpoints"]
+SUMMARY_FIELDS = ["hostname",
+                  "orchestrator_id",
+                  "num_workloads",
+                  "num_endpoints"]
+
+
 def endpoint(arguments):
     """
     Main dispatcher for endpoint commands. Calls the corresponding helper
@@ -136,86 +220,286 @@ def endpoint(arguments):
                                   arguments.get("--orchestrator"),
                                   arguments.get("--workload"),
                                   arguments.get("<ENDPOINT_ID>"))
+    elif arguments.get("reindex"):
+        endpoint_reindex(int(arguments["--parallelism"]))
     else:
         # calicoctl endpoint show
+        limit = arguments.get("--limit")
+        token = arguments.get("--continue")
         endpoint_show(arguments.get("--host"),
                       arguments.get("--orchestrator"),
                       arguments.get("--workload"),
                       arguments.get("--endpoint"),
-                      arguments.get("--detailed"))
+                      arguments.get("--detailed"),
+                      output=arguments.get("--output") or "table",
+                      limit=int(limit) if limit else None,
+                      continue_key=_decode_continue_token(token)
+                                   if token else None)
 
 
 def endpoint_show(hostname, orchestrator_id, workload_id, endpoint_id,
-                  detailed):
+                  detailed, output="table", limit=None, continue_key=None):
     """
     List the profiles for a given endpoint. All parameters will be used to
     filter down which endpoints should be shown.
 
+    Endpoints are read one host at a time, and in the jsonl and tsv output
+    formats each row is printed as soon as its host has been read, so the
+    memory used does not grow with the number of hosts.
+
     :param endpoint_id: The endpoint ID.
     :param workload_id: The workload ID.
     :param orchestrator_id: The orchestrator ID.
     :param hostname: The hostname.
     :param detailed: Optional flag, when set to True, will provide more
     information in the shown table
+    :param output: The output format: table, jsonl or tsv.
+    :param limit: The maximum number of rows to show, or None for no limit.
+    :param continue_key: The key of the last row shown by a previous command
+    (decoded from its continue token), or None to start from the first row.
     :return: Nothing
     """
-    endpoints = client.get_endpoints(hostname=hostname,
-                                     orchestrator_id=orchestrator_id,
-                                     workload_id=workload_id,
-                                     endpoint_id=endpoint_id)
-
     if detailed:
-        headings = ["Hostname",
-                    "Orchestrator ID",
-                    "Workload ID",
-                    "Endpoint ID",
-                    "Addresses",
-                    "MAC",
-                    "Profiles",
-                    "State"]
-        x = PrettyTable(headings, sortby="Hostname")
-
-        for endpoint in endpoints:
-            addresses = "\n".join([str(net) for net in
-                                   endpoint.ipv4_nets | endpoint.ipv6_nets])
-            x.add_row([endpoint.hostname,
-                       endpoint.orchestrator_id,
-                       endpoint.workload_id,
-                       endpoint.endpoint_id,
-                       addresses,
-                       endpoint.mac,
-                       ','.join(endpoint.profile_ids),
-                       endpoint.state])
+        headings, fields = DETAILED_HEADINGS, DETAILED_FIELDS
     else:
-        headings = ["Hostname",
-                    "Orchestrator ID",
-                    "Number of Workloads",
-                    "Number of Endpoints"]
+        headings, fields = SUMMARY_HEADINGS, SUMMARY_FIELDS
+    start_host = continue_key[0] if continue_key else None
+    host_endpoints = _iter_host_endpoints(hostname, orchestrator_id,
+                                          workload_id, endpoint_id,
+                                          start_host=start_host)
+    rows = _iter_endpoint_rows(host_endpoints, detailed)
+    if continue_key:
+        rows = ((key, row) for key, row in rows if key > continue_key)
+
+    if output == "table":
         x = PrettyTable(headings, sortby="Hostname")
+    elif output == "tsv":
+        print "\t".join(fields)
+
+    last_key = None
+    for count, (key, row) in enumerate(rows):
+        if limit is not None and count == limit:
+            # There are more rows to show.
+            print >> sys.stderr, "More endpoints are available.  To show " \
+                                 "them, use --continue=%s" % \
+                                 _encode_continue_token(last_key)
+            break
+        last_key = key
+
+        if output == "table":
+            if detailed:
+                # Addresses are shown one per line.
+                row = row[:4] + ["\n".join(row[4]), row[5],
+                                 ",".join(row[6]), row[7]]
+            x.add_row(row)
+        elif output == "jsonl":
+            print json.dumps(dict(zip(fields, row)))
+        else:
+            # A missing value (such as an endpoint without a MAC) is an
+            # empty field.
+            print "\t".join(",".join(value) if isinstance(value, list)
+                            else "" if value is None else str(value)
+                            for value in row)
+        sys.stdout.flush()
+
+    if output == "table":
+        print str(x) + "\n"
+
+
+def get_hostnames():
+    """
+    Return the names of the hosts which have endpoints (or config) in the
+    datastore, without reading the endpoints themselves.
+
+    :return: A sorted list of hostnames.
+    """
+    try:
+        result = client.etcd_client.read(HOSTS_PATH)
+    except EtcdKeyNotFound:
+        return []
+    return sorted(leaf.key.rsplit("/", 1)[-1] for leaf in result.leaves
+                  if leaf.dir and
+                  leaf.key.rstrip("/") != HOSTS_PATH.rstrip("/"))
+
+
+def _iter_host_endpoints(hostname, orchestrator_id, workload_id, endpoint_id,
+                         start_host=None):
+    """
+    Generator which reads the endpoints matching the supplied filters one
+    host at a time.
 
-        # The summary table has one entry for each host/orchestrator
-        # combination.  We create a dictionary to maintain the summary
-        # information, using the (hostname, orchestrator_id) as the unique
-        # key, with a value of an EndpointSummary object to store unique
-        # workload IDs and a count of endpoint IDs.
-        #
-        # We use a default dict to automatically create an "empty" (zero count)
-        # EndpointSummary for each new table entry.
-        host_orch_summary = defaultdict(EndpointSummary)
+    :param start_host: Skip (without reading) the hosts which sort before
+    this hostname.
+    :return: An iterator of (hostname, list of endpoints) tuples, in
+    hostname order.
+    """
+    endpoints = _get_indexed_endpoints(hostname, orchestrator_id, workload_id,
+                                       endpoint_id)
+    if endpoints is not None:
+        by_host = defaultdict(list)
         for endpoint in endpoints:
-            key = (endpoint.hostname, endpoint.orchestrator_id)
-            summary = host_orch_summary[key]
-            summary.add_endpoint(endpoint)
+            by_host[endpoint.hostname].append(endpoint)
+        for host in sorted(by_host):
+            if not start_host or host >= start_host:
+                yield host, by_host[host]
+        return
+
+    hosts = [hostname] if hostname else get_hostnames()
+    for host in hosts:
+        if start_host and host < start_host:
+            continue
+        yield host, client.get_endpoints(hostname=host,
+                                         orchestrator_id=orchestrator_id,
+                                         workload_id=workload_id,
+                                         endpoint_id=endpoint_id)
+
+
+def _iter_endpoint_rows(host_endpoints, detailed):
+    """
+    Generator which converts the endpoints of each host into output rows.
+
+    :param host_endpoints: An iterator of (hostname, list of endpoints)
+    tuples, in hostname order.
+    :param detailed: True for a row per endpoint, False for a summary row per
+    host and orchestrator.
+    :return: An iterator of (key, row) tuples in key order, where the key
+    uniquely identifies the row.
+    """
+    for host, endpoints in host_endpoints:
+        if detailed:
+            rows = []
+            for endpoint in endpoints:
+                key = (endpoint.hostname, endpoint.orchestrator_id,
+                       endpoint.workload_id, endpoint.endpoint_id)
+                addresses = sorted(str(net) for net in
+                                   endpoint.ipv4_nets | endpoint.ipv6_nets)
+                rows.append((key, [endpoint.hostname,
+                                   endpoint.orchestrator_id,
+                                   endpoint.workload_id,
+                                   endpoint.endpoint_id,
+                                   addresses,
+                                   str(endpoint.mac) if endpoint.mac
+                                   else None,
+                                   list(endpoint.profile_ids),
+                                   endpoint.state]))
+        else:
+            # The summary has one row for each host/orchestrator
+            # combination, so can be completed once the host has been read.
+            # An EndpointSummary stores the unique workload IDs and a count
+            # of endpoints for each orchestrator.
+            host_orch_summary = defaultdict(EndpointSummary)
+            for endpoint in endpoints:
+                host_orch_summary[endpoint.orchestrator_id].add_endpoint(
+                                                                    endpoint)
+            rows = [((host, orchestrator_id),
+                     [host,
+                      orchestrator_id,
+                      len(summary.workload_ids),
+                      summary.num_endpoints])
+                    for orchestrator_id, summary in
+                    host_orch_summary.iteritems()]
+
+        # Drop this host's endpoints before reading the next host.
+        del endpoints
+        for key, row in sorted(rows):
+            yield key, row
+
+
+def _encode_continue_token(key):
+    """
+    Encode the key of the last row shown as a continue token.
+    """
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+
+def _decode_continue_token(token):
+    """
+    Decode a continue token into the key of the last row shown.
+
+    :return: The key as a tuple, or None if the token is invalid.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(key, list) or \
+            not all(isinstance(value, basestring) for value in key):
+        return None
+    return tuple(key)
+
 
-        # This table has one entry for each host/orchestrator combination.
-        for key, summary in host_orch_summary.iteritems():
-            hostname, orchestrator_id = key
-            x.add_row([hostname,
-                       orchestrator_id,
-                       len(summary.workload_ids),
-                       summary.num_endpoints])
-                
-    print str(x) + "\n"
+def _with_endpoint_index(method, *args, **filters):
+    """
+    Call a client method which operates on a single endpoint, using the
+    endpoint index to fill in any of the hostname, orchestrator_id and
+    workload_id filters that were not supplied.  This avoids searching every
+    host's endpoints.
+
+    If the index does not identify a single endpoint, or the indexed endpoint
+    no longer exists, the method is called with the supplied filters.
+
+    :param method: The client method to call.
+    :param args: Positional arguments for the method.
+    :param filters: The hostname, orchestrator_id, workload_id and
+    endpoint_id filters.
+    :return: The result of the method.
+    """
+    resolved = endpoint_index.resolve(filters["hostname"],
+                                      filters["orchestrator_id"],
+                                      filters["workload_id"],
+                                      filters["endpoint_id"])
+    if resolved:
+        hostname, orchestrator_id, workload_id, endpoint_id = resolved
+        try:
+            return method(*args, hostname=hostname,
+                          orchestrator_id=orchestrator_id,
+                          workload_id=workload_id,
+                          endpoint_id=endpoint_id)
+        except KeyError:
+            # The index is stale, so fall back to a search.
+            pass
+    return method(*args, **filters)
+
+
+def _get_indexed_endpoints(hostname, orchestrator_id, workload_id,
+                           endpoint_id):
+    """
+    Use the endpoint index to get the endpoints matching an endpoint ID or
+    workload ID filter, without searching every host's endpoints.
+
+    :return: The list of endpoints, or None if the index cannot be used (in
+    which case a search is required).
+    """
+    if hostname and orchestrator_id and workload_id:
+        return None
+    matches = endpoint_index.lookup(hostname, orchestrator_id, workload_id,
+                                    endpoint_id)
+    if not matches:
+        return None
+
+    endpoints = []
+    for match in matches:
+        found = client.get_endpoints(hostname=match[0],
+                                     orchestrator_id=match[1],
+                                     workload_id=match[2],
+                                     endpoint_id=match[3])
+        if not found:
+            # The index is stale.
+            return None
+        endpoints.extend(found)
+    return endpoints
+
+
+def endpoint_reindex(parallelism):
+    """
+    Rebuild the endpoint index from the endpoints in the datastore.
+
+    :param parallelism: The number of concurrent datastore requests to make.
+    :return: None
+    """
+    written, removed = endpoint_index.reindex(parallelism)
+    print "Endpoint index rebuilt: %d entries written, %d removed" % \
+          (written, removed)
 
 
 def endpoint_profile_append(hostname, orchestrator_id, workload_id,
@@ -248,11 +532,12 @@ def endpoint_profile_append(hostname, orchestrator_id, workload_id,
         print_paragraph("No profile specified.")
     else:
         try:
-            client.append_profiles_to_endpoint(profile_names,
-                                               hostname=hostname,
-                                               orchestrator_id=orchestrator_id,
-                                               workload_id=workload_id,
-                                               endpoint_id=endpoint_id)
+            _with_endpoint_index(client.append_profiles_to_endpoint,
+                                 profile_names,
+                                 hostname=hostname,
+                                 orchestrator_id=orchestrator_id,
+                                 workload_id=workload_id,
+                                 endpoint_id=endpoint_id)
             print_paragraph("Profile(s) %s appended." %
                             (", ".join(profile_names)))
         except KeyError:
@@ -296,11 +581,12 @@ def endpoint_profile_set(hostname, orchestrator_id, workload_id,
     validate_profile_list(profile_names)
 
     try:
-        client.set_profiles_on_endpoint(profile_names,
-                                        hostname=hostname,
-                                        orchestrator_id=orchestrator_id,
-                                        workload_id=workload_id,
-                                        endpoint_id=endpoint_id)
+        _with_endpoint_index(client.set_profiles_on_endpoint,
+                             profile_names,
+                             hostname=hostname,
+                             orchestrator_id=orchestrator_id,
+                             workload_id=workload_id,
+                             endpoint_id=endpoint_id)
         if not profile_names:
            print_paragraph("Removed all profiles from endpoint.")
         else:
@@ -342,11 +628,12 @@ def endpoint_profile_remove(hostname, orchestrator_id, workload_id,
         print_paragraph("No profile specified.")
     else:
         try:
-            client.remove_profiles_from_endpoint(profile_names,
-                                                 hostname=hostname,
-                                                 orchestrator_id=orchestrator_id,
-                                                 workload_id=workload_id,
-                                                 endpoint_id=endpoint_id)
+            _with_endpoint_index(client.remove_profiles_from_endpoint,
+                                 profile_names,
+                                 hostname=hostname,
+                                 orchestrator_id=orchestrator_id,
+                                 workload_id=workload_id,
+                                 endpoint_id=endpoint_id)
             print_paragraph("Profile(s) %s removed." %
                             (",".join(profile_names)))
         except KeyError:
@@ -374,10 +661,11 @@ def endpoint_profile_show(hostname, orchestrator_id, workload_id, endpoint_id):
     :return: None
     """
     try:
-        endpoint = client.get_endpoint(hostname=hostname,
-                                       orchestrator_id=orchestrator_id,
-                                       workload_id=workload_id,
-                                       endpoint_id=endpoint_id)
+        endpoint = _with_endpoint_index(client.get_endpoint,
+                                        hostname=hostname,
+                                        orchestrator_id=orchestrator_id,
+                                        workload_id=workload_id,
+                                        endpoint_id=endpoint_id)
     except MultipleEndpointsMatch:
         print "Failed to list profiles in endpoint.\n"
         print_paragraph("More than 1 endpoint matches the provided "
@@ -0,0 +1,215 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Secondary index of endpoints, maintained by calicoctl.
+
+Endpoints are stored in etcd under their host, orchestrator and workload, so
+finding an endpoint from just its endpoint ID (or workload ID) requires
+walking every host's workload tree.  This index maps endpoint IDs and workload
+IDs to the location of the endpoint:
+
+  /calico/calicoctl/v1/index/endpoint/<endpoint ID>
+  /calico/calicoctl/v1/index/workload/<workload ID>/<endpoint ID>
+
+each holding a JSON dict of the endpoint's hostname, orchestrator ID and
+workload ID.
+
+The index is only a hint.  Endpoints created by other tools are not indexed,
+so callers must fall back to a full search when a lookup misses or when the
+indexed endpoint no longer exists.  'calicoctl endpoint reindex' rebuilds the
+index from the endpoints in the datastore.
+"""
+import json
+import sys
+
+from etcd import EtcdException, EtcdKeyNotFound
+
+from connectors import client
+from utils import escape_etcd, run_in_parallel
+
+INDEX_PATH = "/calico/calicoctl/v1/index/"
+ENDPOINT_INDEX_PATH = INDEX_PATH + "endpoint/%(endpoint_id)s"
+WORKLOAD_INDEX_DIR = INDEX_PATH + "workload/%(workload_id)s/"
+WORKLOAD_INDEX_PATH = WORKLOAD_INDEX_DIR + "%(endpoint_id)s"
+
+
+def _index_keys(hostname, orchestrator_id, workload_id, endpoint_id):
+    """
+    Return the index keys and value for an endpoint.
+    """
+    params = {"endpoint_id": endpoint_id,
+              "workload_id": escape_etcd(workload_id)}
+    value = json.dumps({"hostname": hostname,
+                        "orchestrator_id": orchestrator_id,
+                        "workload_id": workload_id})
+    return [ENDPOINT_INDEX_PATH % params, WORKLOAD_INDEX_PATH % params], value
+
+
+def index_endpoint(endpoint):
+    """
+    Add an endpoint to the index.  Failures are reported but not fatal, since
+    lookups fall back to a full search.
+
+    :param endpoint: The Endpoint.
+    :return: None.
+    """
+    keys, value = _index_keys(endpoint.hostname, endpoint.orchestrator_id,
+                              endpoint.workload_id, endpoint.endpoint_id)
+    try:
+        for key in keys:
+            client.etcd_client.write(key, value)
+    except EtcdException as e:
+        print >> sys.stderr, "Failed to index endpoint %s: %s" % \
+                             (endpoint.endpoint_id, e)
+
+
+def unindex_endpoint(endpoint):
+    """
+    Remove an endpoint from the index.  Failures are reported but not fatal,
+    since stale index entries are ignored.
+
+    :param endpoint: The Endpoint.
+    :return: None.
+    """
+    keys, _ = _index_keys(endpoint.hostname, endpoint.orchestrator_id,
+                          endpoint.workload_id, endpoint.endpoint_id)
+    for key in keys:
+        try:
+            client.etcd_client.delete(key)
+        except EtcdKeyNotFound:
+            pass
+        except EtcdException as e:
+            print >> sys.stderr, "Failed to unindex endpoint %s: %s" % \
+                                 (endpoint.endpoint_id, e)
+
+    # Tidy up the workload directory if this was its last endpoint.
+    try:
+        client.etcd_client.delete(
+            WORKLOAD_INDEX_DIR % {"workload_id":
+                                  escape_etcd(endpoint.workload_id)},
+            dir=True)
+    except EtcdException:
+        pass
+
+
+def _matches(entry, hostname, orchestrator_id, workload_id):
+    """
+    Return whether an index entry is consistent with the supplied filters.
+    """
+    return ((not hostname or entry["hostname"] == hostname) and
+            (not orchestrator_id or
+             entry["orchestrator_id"] == orchestrator_id) and
+            (not workload_id or entry["workload_id"] == workload_id))
+
+
+def lookup(hostname, orchestrator_id, workload_id, endpoint_id):
+    """
+    Use the index to find the endpoints matching the supplied filters.  An
+    endpoint ID or workload ID is required to use the index.
+
+    :param hostname: The hostname, or None.
+    :param orchestrator_id: The orchestrator ID, or None.
+    :param workload_id: The workload ID, or None.
+    :param endpoint_id: The endpoint ID, or None.
+    :return: A list of (hostname, orchestrator_id, workload_id, endpoint_id)
+    tuples for the matching index entries, or None if the index cannot be
+    used or has no matching entries.
+    """
+    try:
+        if endpoint_id:
+            result = client.etcd_client.read(
+                            ENDPOINT_INDEX_PATH % {"endpoint_id": endpoint_id})
+            entries = [(json.loads(result.value), endpoint_id)]
+        elif workload_id:
+            result = client.etcd_client.read(
+                WORKLOAD_INDEX_DIR % {"workload_id": escape_etcd(workload_id)},
+                recursive=True)
+            entries = [(json.loads(leaf.value), leaf.key.rsplit("/", 1)[-1])
+                       for leaf in result.leaves if not leaf.dir]
+        else:
+            return None
+    except (EtcdException, ValueError):
+        return None
+
+    matches = [(entry["hostname"], entry["orchestrator_id"],
+                entry["workload_id"], ep_id)
+               for entry, ep_id in entries
+               if _matches(entry, hostname, orchestrator_id, workload_id)]
+    return matches or None
+
+
+def resolve(hostname, orchestrator_id, workload_id, endpoint_id):
+    """
+    Use the index to fill in the filters used to find a single endpoint.
+
+    :param hostname: The hostname, or None.
+    :param orchestrator_id: The orchestrator ID, or None.
+    :param workload_id: The workload ID, or None.
+    :param endpoint_id: The endpoint ID, or None.
+    :return: A tuple of (hostname, orchestrator_id, workload_id, endpoint_id)
+    if the index identifies a single endpoint, otherwise None.
+    """
+    if hostname and orchestrator_id and workload_id:
+        # Nothing to gain from the index.
+        return None
+
+    matches = lookup(hostname, orchestrator_id, workload_id, endpoint_id)
+    if not matches or len(matches) != 1:
+        return None
+    return matches[0]
+
+
+def reindex(parallelism):
+    """
+    Rebuild the index from the endpoints in the datastore, adding missing
+    entries and removing stale ones.
+
+    :param parallelism: The number of concurrent datastore requests to make.
+    :return: A tuple of (number of entries written, number removed).
+    """
+    desired = {}
+    for endpoint in client.get_endpoints():
+        keys, value = _index_keys(endpoint.hostname, endpoint.orchestrator_id,
+                                  endpoint.workload_id, endpoint.endpoint_id)
+        for key in keys:
+            desired[key] = value
+
+    existing = {}
+    try:
+        result = client.etcd_client.read(INDEX_PATH, recursive=True)
+        for leaf in result.leaves:
+            if not leaf.dir:
+                existing[leaf.key] = leaf.value
+    except EtcdKeyNotFound:
+        pass
+
+    writes = [(key, value) for key, value in desired.iteritems()
+              if existing.get(key) != value]
+    deletes = [key for key in existing if key not in desired]
+
+    run_in_parallel(_write_key, writes, parallelism)
+    run_in_parallel(_delete_key, deletes, parallelism)
+    return len(writes), len(deletes)
+
+
+def _write_key(key_value):
+    key, value = key_value
+    client.etcd_client.write(key, value)
+
+
+def _delete_key(key):
+    try:
+        client.etcd_client.delete(key)
+    except EtcdKeyNotFound:
+        pass
@@ -0,0 +1,84 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Start-up profiling for calicoctl, enabled by setting the
+CALICOCTL_PROFILE_STARTUP environment variable.
+
+This records the time taken by each import which loads new modules, and
+writes a report to stderr when calicoctl exits, in the same format as
+Python 3's "-X importtime" (times are in microseconds, and nested imports
+are indented and listed before the import that triggered them).
+"""
+import __builtin__
+import atexit
+import os
+import sys
+import time
+
+PROFILE_STARTUP_ENV = "CALICOCTL_PROFILE_STARTUP"
+
+_original_import = __builtin__.__import__
+_start_time = None
+
+# Stack of the time spent in nested imports, for each import in progress.
+_nested_time = []
+
+# (depth, name, self time, cumulative time) in order of completion.
+_records = []
+
+
+def _timed_import(name, *args, **kwargs):
+    modules_before = len(sys.modules)
+    _nested_time.append(0.0)
+    start = time.time()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        nested = _nested_time.pop()
+        if _nested_time:
+            _nested_time[-1] += elapsed
+        if len(sys.modules) != modules_before:
+            _records.append((len(_nested_time), name, elapsed - nested,
+                             elapsed))
+
+
+def install():
+    """
+    Start profiling imports if profiling is enabled in the environment.
+    :return: None.
+    """
+    global _start_time
+    if not os.getenv(PROFILE_STARTUP_ENV) or _start_time is not None:
+        return
+    _start_time = time.time()
+    __builtin__.__import__ = _timed_import
+    atexit.register(report)
+
+
+def report(out=None):
+    """
+    Write the import profile to stderr.
+    :param out: The stream to write the report to (default sys.stderr).
+    :return: None.
+    """
+    out = out or sys.stderr
+    out.write("import time: self [us] | cumulative | imported package\n")
+    for depth, name, self_time, cumulative in _records:
+        out.write("import time: %9d | %10d | %s%s\n" %
+                  (self_time * 1e6, cumulative * 1e6, "  " * depth, name))
+    total = sum(cumulative for depth, _, _, cumulative in _records
+                if depth == 0)
+    out.write("calicoctl: %.1fms in imports, %.1fms total\n" %
+              (total * 1000, (time.time() - _start_time) * 1000))
@@ -15,27 +15,69 @@
 Usage:
   calicoctl ipam release <IP>
   calicoctl ipam info <IP>
+  calicoctl ipam reservation show
+  calicoctl ipam reservation refill
+  calicoctl ipam reservation reconcile [--release-all]
+  calicoctl ipam show [--pool=<CIDR>] [--by-host]
+  calicoctl ipam gc [--dry-run] [--grace=<SECONDS>]
 
 Description:
   Manage Calico assigned IP addresses
 
+  The show command reports how much of each IP pool is assigned, and how the
+  pool's allocation blocks are claimed by hosts.
+
+  The gc command finds leaked IP addresses - those assigned in IPAM but not
+  used by any endpoint - and releases them.
+
+  The reservation commands manage this host's cache of reserved IP addresses,
+  which is enabled by setting CALICOCTL_IP_RESERVATIONS to the number of
+  addresses of each IP version to reserve.
+
+Options:
+  --release-all      Release all of this host's reserved addresses, rather than
+                     only stale ones.
+  --pool=<CIDR>      Only show the IP pool with this CIDR.
+  --by-host          Also show the allocation blocks claimed by each host.
+  --dry-run          Report leaked addresses without releasing them.
+  --grace=<SECONDS>  Only release addresses which are still leaked this many
+                     seconds after they are first found, so that addresses
+                     being assigned to new endpoints are not released.
+                     [default: 60]
+
 Warnings:
   -  Releasing an in-use IP address can result in it being assigned to multiple
      workloads.
 """
+import json
 import sys
+import time
+from collections import defaultdict
 
-from netaddr import IPAddress
-from pycalico.block import AddressNotAssignedError
-from pycalico.util import validate_ip
+from etcd import EtcdKeyNotFound
+from netaddr import IPAddress, IPNetwork
+from prettytable import PrettyTable
+from pycalico.block import AddressNotAssignedError, BLOCK_PREFIXLEN
+from pycalico.datastore import IPAM_BLOCK_PATH
+from pycalico.util import validate_ip, validate_cidr
 
+import reservations
 from connectors import client
+from endpoint import get_hostnames
+from utils import enforce_root, run_in_parallel
+
+# The number of allocation blocks to read (and hold in memory) at a time, and
+# how many of those to read concurrently.
+BLOCK_READ_BATCH = 500
+BLOCK_READ_PARALLELISM = 20
 
 
 def validate_arguments(arguments):
     """
     Validate argument values:
         <IP>
+        <CIDR>
+        <SECONDS>
 
     :param arguments: Docopt processed arguments
     """
@@ -44,10 +86,29 @@ def validate_arguments(arguments):
                       validate_ip(arguments["<IP>"], 4) or \
                       validate_ip(arguments["<IP>"], 6)
 
+    # Validate pool
+    pool_ok = arguments.get("--pool") is None or \
+              validate_cidr(arguments["--pool"])
+
+    # Validate grace period
+    grace_ok = True
+    if arguments.get("--grace") is not None:
+        try:
+            grace_ok = int(arguments["--grace"]) >= 0
+        except ValueError:
+            grace_ok = False
+
     # Print error message and exit if not valid argument
     if not container_ip_ok:
         print "Invalid IP address specified."
         sys.exit(1)
+    if not pool_ok:
+        print "Invalid CIDR specified."
+        sys.exit(1)
+    if not grace_ok:
+        print "Invalid grace period specified.  Argument must be a " \
+              "non-negative integer."
+        sys.exit(1)
 
 
 def ipam(arguments):
@@ -61,10 +122,23 @@ def ipam(arguments):
     """
     validate_arguments(arguments)
 
-    if arguments.get("release"):
+    if arguments.get("reservation"):
+        # The reservation cache is stored under /var/run/calico.
+        enforce_root()
+        if arguments.get("show"):
+            reservations.show()
+        elif arguments.get("refill"):
+            reservation_refill()
+        elif arguments.get("reconcile"):
+            reservation_reconcile(arguments.get("--release-all"))
+    elif arguments.get("release"):
         release(arguments["<IP>"])
     elif arguments.get("info"):
         info(arguments["<IP>"])
+    elif arguments.get("show"):
+        show(arguments.get("--pool"), arguments.get("--by-host"))
+    elif arguments.get("gc"):
+        gc(arguments.get("--dry-run"), int(arguments["--grace"]))
 
 
 def release(ip):
@@ -95,3 +169,267 @@ def info(ip):
             print "No attributes defined for %s" % address
     except AddressNotAssignedError:
         print "IP %s is not currently assigned" % address
+
+
+def reservation_refill():
+    """
+    Top up this host's cache of reserved IP addresses.
+    """
+    if not reservations.reservation_count():
+        print "IP reservations are not enabled (set %s)" % \
+              reservations.RESERVATIONS_ENV
+        sys.exit(1)
+    print "Reserved %d addresses" % reservations.refill()
+
+
+def reservation_reconcile(release_all):
+    """
+    Return stale reserved IP addresses for this host to IPAM.
+
+    :param release_all: True to release all reserved addresses.
+    """
+    print "Released %d addresses" % reservations.reconcile(release_all)
+
+
+def show(pool_cidr, by_host):
+    """
+    Print the utilisation of each IP pool, and optionally of the allocation
+    blocks claimed by each host.
+
+    The allocation blocks are read in a single pass (per IP version), and
+    each block is reduced to a count of its assigned addresses without
+    creating an object per address, so this only holds a few counters per
+    pool and per host in memory.  The number of
+    unclaimed blocks in a pool is calculated, rather than counted, so large
+    pools (including IPv6 pools) are as quick to report on as small ones.
+
+    :param pool_cidr: Only show the pool with this CIDR, or None for all
+    pools.
+    :param by_host: True to show the blocks claimed by each host.
+    """
+    pools = [pool.cidr for pool in client.get_ip_pools(4)] + \
+            [pool.cidr for pool in client.get_ip_pools(6)]
+    if pool_cidr:
+        pool_cidr = IPNetwork(pool_cidr).cidr
+        if pool_cidr not in pools:
+            print "%s is not a configured pool." % pool_cidr
+            sys.exit(1)
+        pools = [pool_cidr]
+
+    # Pool -> [assigned addresses, claimed blocks, empty claimed blocks].
+    pool_stats = dict((pool, [0, 0, 0]) for pool in pools)
+    # Host -> [affine blocks, assigned addresses, free addresses].
+    host_stats = defaultdict(lambda: [0, 0, 0])
+    for version in set(pool.version for pool in pools):
+        for block in _iter_blocks(version):
+            cidr = IPNetwork(block["cidr"])
+            pool = next((pool for pool in pools if cidr in pool), None)
+            if pool is None:
+                continue
+            allocations = block["allocations"]
+            assigned = len(allocations) - allocations.count(None)
+            stats = pool_stats[pool]
+            stats[0] += assigned
+            stats[1] += 1
+            if not assigned:
+                stats[2] += 1
+
+            affinity = block.get("affinity") or ""
+            host = affinity[len("host:"):] \
+                   if affinity.startswith("host:") else "(none)"
+            host_stats[host][0] += 1
+            host_stats[host][1] += assigned
+            host_stats[host][2] += cidr.size - assigned
+
+    x = PrettyTable(["Pool", "Assigned", "Utilisation", "Claimed blocks",
+                     "Empty blocks", "Unclaimed blocks", "Fragmentation"],
+                    sortby="Pool")
+    for pool, (assigned, claimed, empty) in pool_stats.iteritems():
+        address_bits = 32 if pool.version == 4 else 128
+        block_size = 2 ** (address_bits - BLOCK_PREFIXLEN[pool.version])
+        claimed_size = claimed * block_size
+        # Fragmentation is the proportion of the claimed blocks which is not
+        # assigned.  Addresses in a block claimed by one host are only used
+        # by other hosts once the pool has no unclaimed blocks left.
+        x.add_row([str(pool),
+                   "%d/%d" % (assigned, pool.size),
+                   _percentage(assigned, pool.size),
+                   claimed,
+                   empty,
+                   max(0, pool.size // block_size - claimed),
+                   _percentage(claimed_size - assigned, claimed_size)])
+    print x.get_string()
+
+    if by_host:
+        x = PrettyTable(["Host", "Affine blocks", "Assigned", "Free"],
+                        sortby="Host")
+        for host, (blocks, assigned, free) in host_stats.iteritems():
+            x.add_row([host, blocks, assigned, free])
+        print x.get_string()
+
+
+def _percentage(value, total):
+    """
+    Format value as a percentage of total.
+    """
+    if not total:
+        return "-"
+    return "%.1f%%" % (100.0 * value / total)
+
+
+def gc(dry_run, grace):
+    """
+    Find IP addresses which are assigned in IPAM but not used by any
+    endpoint, and release them.  Addresses are only released if they are
+    still leaked after the grace period, since new endpoints are created
+    after their addresses are assigned.
+
+    :param dry_run: True to report leaked addresses without releasing them.
+    :param grace: The grace period, in seconds.
+    """
+    allocated, leaked = _find_leaked_ips()
+    if not dry_run and leaked:
+        print "Found %d leaked addresses, checking again in %d seconds" % \
+              (sum(len(ips) for ips in leaked.itervalues()), grace)
+        time.sleep(grace)
+        allocated, still_leaked = _find_leaked_ips()
+        leaked = dict((cidr, ips & leaked[cidr])
+                      for cidr, ips in still_leaked.iteritems()
+                      if cidr in leaked and ips & leaked[cidr])
+
+    _print_leak_summary(allocated, leaked)
+
+    total = sum(len(ips) for ips in leaked.itervalues())
+    if dry_run:
+        print "Found %d leaked addresses (dry run, none released)" % total
+        return
+
+    unassigned = 0
+    for cidr in sorted(leaked):
+        # Releasing the addresses of each block is a single datastore update.
+        unassigned += len(client.release_ips(leaked[cidr]) or ())
+    print "Released %d leaked addresses" % (total - unassigned)
+
+
+def _get_in_use_ips():
+    """
+    Return the IP addresses in use by endpoints (or as IP-in-IP tunnel
+    addresses), reading the endpoints one host at a time.
+
+    :return: A dict of IP version to set of addresses in use, as ints (which
+    take much less memory than IPAddress objects).
+    """
+    in_use = {4: set(), 6: set()}
+    for host in get_hostnames():
+        for endpoint in client.get_endpoints(hostname=host):
+            for net in endpoint.ipv4_nets:
+                in_use[4].add(int(net.ip))
+            for net in endpoint.ipv6_nets:
+                in_use[6].add(int(net.ip))
+        tunnel_addr = client.get_per_host_config(host, "IpInIpTunnelAddr")
+        if tunnel_addr:
+            address = IPAddress(tunnel_addr)
+            in_use[address.version].add(int(address))
+    return in_use
+
+
+def _iter_blocks(version):
+    """
+    Generator which reads the IPAM allocation blocks of an IP version.
+
+    The block directory is listed without recursing, and then the blocks are
+    read and parsed in batches of BLOCK_READ_BATCH, so that only one batch
+    of blocks is held in memory at a time.  Blocks deleted since the listing
+    are skipped.
+
+    :return: An iterator of dicts, each the JSON data of a block.
+    """
+    try:
+        result = client.etcd_client.read(IPAM_BLOCK_PATH %
+                                         {"version": version})
+    except EtcdKeyNotFound:
+        return
+    keys = [leaf.key for leaf in result.leaves if not leaf.dir]
+    del result
+
+    for start in range(0, len(keys), BLOCK_READ_BATCH):
+        batch = keys[start:start + BLOCK_READ_BATCH]
+        for block in run_in_parallel(_read_block, batch,
+                                     BLOCK_READ_PARALLELISM):
+            if block is not None:
+                yield block
+
+
+def _read_block(key):
+    """
+    Read a single IPAM allocation block.
+
+    :param key: The etcd key of the block.
+    :return: The JSON data of the block, or None if it has been deleted.
+    """
+    try:
+        return json.loads(client.etcd_client.read(key).value)
+    except EtcdKeyNotFound:
+        return None
+
+
+def _find_leaked_ips():
+    """
+    Compare the addresses assigned in each allocation block with the
+    addresses in use by endpoints.  Addresses held in calicoctl's per-host
+    reservations are not leaked.
+
+    Only the addresses in use and the leaked addresses are held in memory -
+    each block is discarded once it has been checked.
+
+    :return: A tuple of (dict of block CIDR to the number of assigned
+    addresses, dict of block CIDR to the set of leaked IPAddresses).
+    """
+    in_use = _get_in_use_ips()
+    allocated = {}
+    leaked = {}
+    for version in (4, 6):
+        for block in _iter_blocks(version):
+            cidr = IPNetwork(block["cidr"])
+            attributes = block.get("attributes", [])
+            count = 0
+            block_leaked = set()
+            for ordinal, attr_index in enumerate(block["allocations"]):
+                if attr_index is None:
+                    continue
+                count += 1
+                address = cidr.first + ordinal
+                if address in in_use[version]:
+                    continue
+                handle_id = attributes[attr_index].get("handle_id") or ""
+                if handle_id.startswith(
+                                reservations.RESERVATION_HANDLE_PREFIX):
+                    continue
+                block_leaked.add(IPAddress(address, version))
+            allocated[cidr] = count
+            if block_leaked:
+                leaked[cidr] = block_leaked
+    return allocated, leaked
+
+
+def _print_leak_summary(allocated, leaked):
+    """
+    Print the number of assigned and leaked addresses in each IP pool.
+
+    :param allocated: A dict of block CIDR to the number of assigned
+    addresses.
+    :param leaked: A dict of block CIDR to the set of leaked addresses.
+    """
+    pools = [pool.cidr for pool in client.get_ip_pools(4)] + \
+            [pool.cidr for pool in client.get_ip_pools(6)]
+    counts = defaultdict(lambda: [0, 0])
+    for cidr, count in allocated.iteritems():
+        pool = next((str(pool) for pool in pools if cidr in pool),
+                    "(no pool)")
+        counts[pool][0] += count
+        counts[pool][1] += len(leaked.get(cidr, ()))
+
+    x = PrettyTable(["Pool", "Assigned", "Leaked"], sortby="Pool")
+    for pool, (assigned_count, leaked_count) in counts.iteritems():
+        x.add_row([pool, assigned_count, leaked_count])
+    print x.get_string()
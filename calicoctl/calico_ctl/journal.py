@@ -0,0 +1,389 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local write-ahead journal of container networking operations.
+
+Adding or removing a container (or one of its IP addresses) takes several
+steps across IPAM, the host's network namespaces and the endpoint data.  If
+calicoctl is killed part way through, IP addresses and veths can be leaked.
+
+Each operation therefore records its progress in a journal file under
+JOURNAL_DIR, writing each step before (or, where the step's outcome is only
+known afterwards, immediately after) carrying it out, and deletes the file
+when it completes.  Any journal files left behind are recovered the next time
+a container command or 'calicoctl node' is run on this host: incomplete adds
+are rolled back and incomplete removes are rolled forward.  This only needs to
+look at the pending operations, rather than auditing the whole datastore.
+
+A journal file is a series of JSON lines.  The first holds the operation type
+and its data, and each following line holds a step.  The running operation
+holds an exclusive lock on its file, so that recovery never touches an
+operation that is still in progress.
+"""
+import errno
+import fcntl
+import json
+import os
+import sys
+import threading
+import uuid
+from contextlib import contextmanager
+from subprocess import CalledProcessError
+
+from netaddr import IPAddress, IPNetwork
+from pycalico import netns
+from pycalico.datastore_datatypes import Endpoint
+
+import endpoint_index
+from connectors import client
+
+JOURNAL_DIR = "/var/run/calico/calicoctl-journal"
+JOURNAL_SUFFIX = ".log"
+
+CONTAINER_ADD = "container_add"
+CONTAINER_ADD_MANY = "container_add_many"
+CONTAINER_REMOVE = "container_remove"
+CONTAINER_IP_ADD = "container_ip_add"
+CONTAINER_IP_REMOVE = "container_ip_remove"
+
+
+class Operation(object):
+    """
+    A journalled operation.  Use the operation() context manager rather than
+    creating this directly.
+    """
+    def __init__(self, op_type, data):
+        if not os.path.exists(JOURNAL_DIR):
+            os.makedirs(JOURNAL_DIR)
+        # Steps may be recorded from several threads.
+        self.lock = threading.Lock()
+        self.path = os.path.join(JOURNAL_DIR,
+                                 "%s-%s%s" % (op_type, uuid.uuid4().hex,
+                                              JOURNAL_SUFFIX))
+
+        # Lock and write the file before giving it its journal name, so that
+        # recovery never sees an empty or unlocked journal.
+        tmp_path = self.path + ".tmp"
+        while True:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         os.O_APPEND, 0o644)
+            self.journal_file = os.fdopen(fd, "a")
+            fcntl.flock(self.journal_file, fcntl.LOCK_EX)
+            # Recovery may have locked the file between our creating and
+            # locking it, and removed it as an operation that never started.
+            # If so, start again with a new file.
+            if os.fstat(fd).st_nlink:
+                break
+            self.journal_file.close()
+        self._write({"op": op_type, "data": data})
+        os.rename(tmp_path, self.path)
+
+    def _write(self, entry):
+        with self.lock:
+            self.journal_file.write(json.dumps(entry) + "\n")
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+
+    def record(self, step, **data):
+        """
+        Record a step of the operation.
+
+        :param step: The name of the step.
+        :param data: Any data needed to recover the step.
+        :return: None.
+        """
+        self._write({"step": step, "data": data})
+
+    def complete(self):
+        """
+        Mark the operation as complete, removing it from the journal.
+        :return: None.
+        """
+        os.remove(self.path)
+        self.journal_file.close()
+
+    def abandon(self):
+        """
+        Leave the operation in the journal to be recovered later.
+        :return: None.
+        """
+        self.journal_file.close()
+
+
+@contextmanager
+def operation(op_type, **data):
+    """
+    Context manager which journals an operation.
+
+    The operation is complete when the block exits normally, or calls
+    sys.exit() (the command has handled the failure itself).  If the block
+    raises any other exception, or is interrupted (calicoctl's SIGINT handler
+    raises KeyboardInterrupt), the operation is recovered straight away, and
+    left for later recovery if that fails.
+
+    :param op_type: The type of operation.
+    :param data: The data needed to recover the operation.
+    :return: The Operation, used to record steps.
+    """
+    op = Operation(op_type, data)
+    try:
+        yield op
+    except SystemExit:
+        op.complete()
+        raise
+    except BaseException:
+        try:
+            _recover_file(op.path)
+        except Exception as e:
+            print >> sys.stderr, "Failed to clean up after %s: %s" % \
+                                 (op_type, e)
+            op.abandon()
+        else:
+            op.complete()
+        raise
+    else:
+        op.complete()
+
+
+def recover():
+    """
+    Recover any operations left incomplete by an earlier calicoctl command.
+    Operations which are still in progress are skipped.
+
+    :return: The number of operations recovered.
+    """
+    try:
+        names = sorted(os.listdir(JOURNAL_DIR))
+    except OSError:
+        # Nothing has been journalled.
+        return 0
+
+    recovered = 0
+    for name in names:
+        started = name.endswith(JOURNAL_SUFFIX)
+        if not (started or name.endswith(JOURNAL_SUFFIX + ".tmp")):
+            continue
+        path = os.path.join(JOURNAL_DIR, name)
+        try:
+            journal_file = open(path, "r+")
+        except IOError:
+            # Completed since we listed the directory.
+            continue
+        with journal_file:
+            try:
+                fcntl.flock(journal_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                # The operation is still in progress.
+                continue
+            if not os.path.exists(path):
+                continue
+            if not started:
+                # Killed before the operation started, so nothing was done.
+                os.remove(path)
+                continue
+            try:
+                _recover_file(path)
+            except Exception as e:
+                print >> sys.stderr, "Failed to recover %s: %s" % (name, e)
+                continue
+            os.remove(path)
+            recovered += 1
+    return recovered
+
+
+def _read_file(path):
+    """
+    Read a journal file.
+
+    :return: A tuple of (operation type, data, dict of step name to data).
+    """
+    with open(path) as journal_file:
+        lines = journal_file.read().splitlines()
+
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            # A step that was being written when calicoctl was killed.
+            break
+    if not entries:
+        return None, None, {}
+    steps = dict((entry["step"], entry["data"]) for entry in entries[1:])
+    return entries[0]["op"], entries[0]["data"], steps
+
+
+def _recover_file(path):
+    """
+    Recover the operation in a journal file.
+    """
+    op_type, data, steps = _read_file(path)
+    if op_type is None:
+        # Killed before the operation was recorded, so nothing was done.
+        return
+    RECOVERY_HANDLERS[op_type](data, steps)
+
+
+def _get_endpoint(data):
+    try:
+        return client.get_endpoint(hostname=data["hostname"],
+                                   orchestrator_id=data["orchestrator_id"],
+                                   workload_id=data["workload_id"],
+                                   endpoint_id=data.get("endpoint_id"))
+    except KeyError:
+        return None
+
+
+def _remove_veth(name):
+    try:
+        netns.remove_veth(name)
+    except CalledProcessError:
+        print >> sys.stderr, "Could not remove Calico interface %s" % name
+
+
+def _recover_container_add(data, steps):
+    """
+    Roll back an incomplete container add, unless the endpoint was created.
+
+    Steps:
+      - "ip": the IP address was assigned.
+      - "endpoint": the endpoint is about to be created.
+    """
+    if "endpoint" in steps:
+        endpoint = _get_endpoint(data)
+        if endpoint:
+            # Only the index is missing, so finish the operation.
+            endpoint_index.index_endpoint(endpoint)
+            return
+
+    _remove_veth(data["veth"])
+    if "ip" in steps:
+        client.release_ips({IPAddress(steps["ip"]["ip"])})
+
+
+def _recover_container_add_many(data, steps):
+    """
+    Roll back each container of an incomplete container add-many as for a
+    container add, unless its endpoint was created.
+
+    Steps:
+      - "ips-<endpoint ID>": the IP addresses were assigned by one IPAM
+        request, as a dict of endpoint ID to address.
+      - "endpoint-<endpoint ID>": the endpoint is about to be created.
+      - "released-<endpoint ID>": adding the container failed, and its IP
+        address was released.
+    """
+    ips = {}
+    for step, step_data in steps.iteritems():
+        if step.startswith("ips-"):
+            ips.update(step_data["ips"])
+
+    for endpoint_data in data["endpoints"]:
+        endpoint_id = endpoint_data["endpoint_id"]
+        # Nothing was done for a container until its address was assigned.
+        if endpoint_id not in ips or "released-%s" % endpoint_id in steps:
+            continue
+        add_steps = {"ip": {"ip": ips[endpoint_id]}}
+        if "endpoint-%s" % endpoint_id in steps:
+            add_steps["endpoint"] = {}
+        _recover_container_add(endpoint_data, add_steps)
+
+
+def _recover_container_remove(data, steps):
+    """
+    Roll forward an incomplete container remove.  Each step is repeated
+    unless it was recorded as done.
+
+    Steps:
+      - "released-<endpoint ID>": the endpoint's IP addresses were released.
+      - "workload": the workload was removed.
+    """
+    for endpoint_data in data["endpoints"]:
+        if "released-%s" % endpoint_data["endpoint_id"] not in steps:
+            client.release_ips(set(IPAddress(ip)
+                                   for ip in endpoint_data["ips"]))
+        _remove_veth(endpoint_data["veth"])
+        endpoint_index.unindex_endpoint(
+            Endpoint(hostname=endpoint_data["hostname"],
+                     orchestrator_id=endpoint_data["orchestrator_id"],
+                     workload_id=endpoint_data["workload_id"],
+                     endpoint_id=endpoint_data["endpoint_id"],
+                     state=None,
+                     mac=None))
+
+    if "workload" not in steps:
+        try:
+            client.remove_workload(data["hostname"], data["orchestrator_id"],
+                                   data["workload_id"])
+        except KeyError:
+            pass
+
+
+def _recover_container_ip_add(data, steps):
+    """
+    Roll back an incomplete container IP add, unless the address was added to
+    the container's interface.
+
+    Steps:
+      - "ip": the IP address was assigned.
+      - "endpoint": the endpoint is about to be updated with the address.
+      - "interface": the address was added to the container's interface.
+    """
+    if "ip" not in steps or "interface" in steps:
+        return
+
+    address = IPAddress(steps["ip"]["ip"])
+    if "endpoint" in steps:
+        endpoint = _get_endpoint(data)
+        if endpoint:
+            nets = endpoint.ipv4_nets if address.version == 4 \
+                                      else endpoint.ipv6_nets
+            if IPNetwork(address) in nets:
+                nets.remove(IPNetwork(address))
+                client.update_endpoint(endpoint)
+    client.release_ips({address})
+
+
+def _recover_container_ip_remove(data, steps):
+    """
+    Roll forward an incomplete container IP remove.  The address cannot be
+    removed from the container's interface, since the container may no
+    longer exist, but it is removed from the endpoint and released.
+
+    Steps:
+      - "released": the IP address was released.
+    """
+    if "released" in steps:
+        return
+
+    address = IPAddress(data["ip"])
+    endpoint = _get_endpoint(data)
+    if endpoint:
+        nets = endpoint.ipv4_nets if address.version == 4 \
+                                  else endpoint.ipv6_nets
+        if IPNetwork(address) in nets:
+            nets.remove(IPNetwork(address))
+            client.update_endpoint(endpoint)
+    client.release_ips({address})
+
+
+RECOVERY_HANDLERS = {
+    CONTAINER_ADD: _recover_container_add,
+    CONTAINER_ADD_MANY: _recover_container_add_many,
+    CONTAINER_REMOVE: _recover_container_remove,
+    CONTAINER_IP_ADD: _recover_container_ip_add,
+    CONTAINER_IP_REMOVE: _recover_container_ip_remove,
+}
@@ -0,0 +1,261 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Migration of container IP addresses from one IP pool to another.
+
+Each address in the old pool is moved by adding an address from the new pool
+to the container (as 'calicoctl container <CONTAINER> ip add') and then
+removing the old address (as 'calicoctl container <CONTAINER> ip remove').
+Container networking can only be changed on the container's host, so each
+host migrates its own containers.
+
+Progress is saved in a checkpoint file, so that an interrupted migration is
+resumed by running the same command again.  For each endpoint the file holds:
+  -  "before": the endpoint's addresses in the new pool when the migration
+     started, which are not used as replacements
+  -  "moved": a dict of each old address to the new address replacing it.
+An address added to the endpoint which is in neither is one that was added
+just before the migration was interrupted, so is used rather than adding
+another.
+"""
+import json
+import os
+import threading
+import time
+
+from netaddr import IPNetwork
+from pycalico.block import BLOCK_PREFIXLEN
+
+import container
+from connectors import client
+from endpoint import get_hostnames
+from utils import hostname, DOCKER_ORCHESTRATOR_ID, run_in_parallel
+
+CHECKPOINT_DIR = "/var/run/calico"
+CHECKPOINT_FILE = "pool-migrate-%s-%s.json"
+
+
+def _nets(endpoint, version):
+    return endpoint.ipv4_nets if version == 4 else endpoint.ipv6_nets
+
+
+def _addresses_in(endpoint, cidr):
+    """
+    Return the addresses of an endpoint in a CIDR, sorted.
+    """
+    return sorted(net.ip for net in _nets(endpoint, cidr.version)
+                  if net.ip in cidr)
+
+
+def plan(from_cidr):
+    """
+    Work out the addresses in a pool which are used by endpoints, host by
+    host.
+
+    :param from_cidr: The IPNetwork of the pool to migrate from.
+    :return: A dict of hostname to a tuple of (number of endpoints to migrate,
+    number of addresses to migrate, number of blocks they are in, number of
+    endpoints which cannot be migrated by calicoctl).
+    """
+    result = {}
+    for host in get_hostnames():
+        endpoints = 0
+        addresses = 0
+        blocks = set()
+        unsupported = 0
+        for endpoint in client.get_endpoints(hostname=host):
+            ips = _addresses_in(endpoint, from_cidr)
+            if not ips:
+                continue
+            if endpoint.orchestrator_id != DOCKER_ORCHESTRATOR_ID:
+                unsupported += 1
+                continue
+            endpoints += 1
+            addresses += len(ips)
+            for ip in ips:
+                blocks.add(IPNetwork("%s/%d" % (
+                    ip, BLOCK_PREFIXLEN[from_cidr.version])).cidr)
+        if endpoints or unsupported:
+            result[host] = (endpoints, addresses, len(blocks), unsupported)
+    return result
+
+
+class RateLimiter(object):
+    """
+    Limits the rate at which threads proceed.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the calling thread may proceed.
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Checkpoint(object):
+    """
+    The saved progress of a migration on this host.
+    """
+    def __init__(self, from_cidr, to_cidr):
+        self.path = os.path.join(CHECKPOINT_DIR, CHECKPOINT_FILE % (
+            str(from_cidr).replace("/", "-"), str(to_cidr).replace("/", "-")))
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.endpoints = json.load(f)
+        except (IOError, ValueError):
+            self.endpoints = {}
+
+    def start(self, key, before):
+        """
+        Start migrating an endpoint, unless it was started earlier.
+
+        :param key: The endpoint's key in the checkpoint.
+        :param before: The endpoint's addresses in the new pool.
+        :return: The endpoint's progress, a dict of "before" and "moved".
+        """
+        with self.lock:
+            return self.endpoints.setdefault(
+                key, {"before": [str(ip) for ip in before], "moved": {}})
+
+    def record(self, key, old_ip, new_ip):
+        """
+        Record the address replacing an old address, and save the checkpoint.
+
+        :param key: The endpoint's key in the checkpoint.
+        :param old_ip: The old address.
+        :param new_ip: The new address.
+        """
+        with self.lock:
+            self.endpoints[key]["moved"][str(old_ip)] = str(new_ip)
+            self._write()
+
+    def save(self):
+        """
+        Save the checkpoint.
+        """
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        """
+        Atomically write the checkpoint file.  Must be called with the lock
+        held.
+        """
+        if not os.path.exists(CHECKPOINT_DIR):
+            os.makedirs(CHECKPOINT_DIR)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.endpoints, f)
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        """
+        Remove the checkpoint file once the migration is complete.
+        """
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def migrate(from_cidr, to_cidr, interface, rate, parallelism):
+    """
+    Migrate the addresses of this host's containers from one pool to another.
+    Containers are migrated concurrently, and the addresses of each container
+    one at a time.
+
+    :param from_cidr: The IPNetwork of the pool to migrate from.
+    :param to_cidr: The IPNetwork of the pool to migrate to.
+    :param interface: The name of the containers' Calico interface.
+    :param rate: The maximum number of addresses to migrate per second.
+    :param parallelism: The maximum number of containers to migrate
+    concurrently.
+    :return: A tuple of (number of addresses migrated, number of containers
+    which failed).
+    """
+    checkpoint = Checkpoint(from_cidr, to_cidr)
+    endpoints = []
+    unsupported = 0
+    for endpoint in client.get_endpoints(hostname=hostname):
+        if not _addresses_in(endpoint, from_cidr):
+            continue
+        if endpoint.orchestrator_id != DOCKER_ORCHESTRATOR_ID:
+            unsupported += 1
+            continue
+        progress = checkpoint.start(endpoint.workload_id,
+                                    _addresses_in(endpoint, to_cidr))
+        endpoints.append((endpoint, progress))
+    checkpoint.save()
+    if unsupported:
+        print "Skipping %d endpoints which are not Docker containers" % \
+              unsupported
+
+    limiter = RateLimiter(rate)
+
+    def migrate_endpoint(endpoint_progress):
+        endpoint, progress = endpoint_progress
+        try:
+            return _migrate_endpoint(endpoint, progress, from_cidr, to_cidr,
+                                     interface, checkpoint, limiter)
+        except SystemExit:
+            # The container command has reported the error.
+            return None
+
+    results = run_in_parallel(migrate_endpoint, endpoints, parallelism)
+    failed = results.count(None)
+    if not failed:
+        checkpoint.remove()
+    return sum(result for result in results if result is not None), failed
+
+
+def _migrate_endpoint(endpoint, progress, from_cidr, to_cidr, interface,
+                      checkpoint, limiter):
+    """
+    Migrate the addresses of a single endpoint.
+
+    :return: The number of addresses migrated.
+    """
+    migrated = 0
+    for old_ip in _addresses_in(endpoint, from_cidr):
+        limiter.wait()
+        new_ip = progress["moved"].get(str(old_ip))
+        if new_ip is None:
+            # Use an address added before we were interrupted, if any.
+            current = client.get_endpoint(
+                hostname=endpoint.hostname,
+                orchestrator_id=endpoint.orchestrator_id,
+                workload_id=endpoint.workload_id,
+                endpoint_id=endpoint.endpoint_id)
+            used = set(progress["before"]) | set(progress["moved"].values())
+            new_ip = next((str(ip) for ip in _addresses_in(current, to_cidr)
+                           if str(ip) not in used), None)
+        if new_ip is None:
+            new_ip = str(container.container_ip_add(endpoint.workload_id,
+                                                    str(to_cidr), interface))
+        checkpoint.record(endpoint.workload_id, old_ip, new_ip)
+
+        container.container_ip_remove(endpoint.workload_id, str(old_ip),
+                                      interface)
+        migrated += 1
+    return migrated
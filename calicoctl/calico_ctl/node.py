@@ -14,28 +14,36 @@
 import os
 import signal
 import sys
+import threading
+from collections import defaultdict
 
 import docker
 import docker.errors
 import docker.utils
-from netaddr import IPAddress, AddrFormatError
+from netaddr import IPAddress, IPNetwork, AddrFormatError
 from prettytable import PrettyTable
 from pycalico.datastore import (ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT,
                                 ETCD_KEY_FILE_ENV, ETCD_CERT_FILE_ENV,
                                 ETCD_CA_CERT_FILE_ENV, ETCD_SCHEME_ENV,
                                 ETCD_SCHEME_DEFAULT, ETCD_ENDPOINTS_ENV)
+from pycalico.block import BLOCK_PREFIXLEN
 from pycalico.datastore_datatypes import BGPPeer
 from pycalico.datastore_errors import DataStoreError
 from pycalico.netns import remove_veth
 from pycalico.util import validate_asn, validate_ip
-from subprocess32 import call
+from subprocess32 import call, check_output, Popen, PIPE, CalledProcessError
 
+import endpoint_index
+import journal
+import reservations
+from bgp import reselect_route_reflectors
 from checksystem import check_system
 from connectors import client, docker_client
+from status import print_startup_timings
 from utils import (REQUIRED_MODULES, running_in_container, enforce_root,
                    get_container_ipv_from_arguments, hostname, print_paragraph,
                    convert_asn_to_asplain,
-                   ipv6_enabled)
+                   ipv6_enabled, run_in_parallel)
 
 __doc__ = """
 Usage:
@@ -45,6 +53,7 @@ Usage:
     [(--libnetwork [--libnetwork-image=<LIBNETWORK_IMAGE_NAME>])]
   calicoctl node stop [--force]
   calicoctl node remove [--hostname=<HOSTNAME>] [--remove-endpoints]
+    [--parallelism=<PARALLELISM>]
   calicoctl node show
   calicoctl node bgp peer add <PEER_IP> as <AS_NUM>
   calicoctl node bgp peer remove <PEER_IP>
@@ -73,6 +82,8 @@ Options:
                             [default: calico/node-libnetwork:latest]
   --log-dir=<LOG_DIR>       The directory for logs [default: /var/log/calico]
   --no-pull                 Prevent from pulling the Calico node Docker images.
+  --parallelism=<PARALLELISM>  The number of concurrent datastore requests to
+                            make when removing a node. [default: 10]
   --node-image=<DOCKER_IMAGE_NAME>    Docker image to use for Calico's per-node
                             container. [default: calico/node:latest]
   --remove-endpoints        Remove the endpoint data when deleting the node
@@ -93,6 +104,8 @@ ETCD_KEY_NODE_FILE = "/etc/calico/certs/key.pem"
 ETCD_CERT_NODE_FILE = "/etc/calico/certs/cert.crt"
 ETCD_CA_CERT_NODE_FILE = "/etc/calico/certs/ca_cert.crt"
 
+DEFAULT_PARALLELISM = 10
+
 def validate_arguments(arguments):
     """
     Validate argument values:
@@ -101,6 +114,7 @@ def validate_arguments(arguments):
         <PEER_IP>
         <AS_NUM>
         <DETACH>
+        <PARALLELISM>
 
     Arguments not validated:
         <DOCKER_IMAGE_NAME>
@@ -135,6 +149,10 @@ def validate_arguments(arguments):
     detach_libnetwork_ok = (arguments.get("--detach") == "true" or
                             not arguments.get("--libnetwork"))
 
+    parallelism = arguments.get("--parallelism")
+    parallelism_ok = parallelism is None or \
+                     (parallelism.isdigit() and int(parallelism) > 0)
+
     # Print error message
     if not ip_ok:
         print "Invalid IPv4 address specified with --ip argument."
@@ -150,10 +168,14 @@ def validate_arguments(arguments):
         print "The only valid value for --detach is 'true' when using libnetwork"
     if not runtime_ok:
         print "Runtime must be 'docker', 'rkt' or 'none'."
+    if not parallelism_ok:
+        print_paragraph("Invalid parallelism specified.  Argument must be a "
+                        "positive integer.")
 
     # Exit if not valid argument
     if not (ip_ok and ip6_ok and container_ip_ok and peer_ip_ok and asnum_ok
-            and detach_ok and detach_libnetwork_ok and runtime_ok):
+            and detach_ok and detach_libnetwork_ok and runtime_ok and
+            parallelism_ok):
         sys.exit(1)
 
 
@@ -187,7 +209,8 @@ def node(arguments):
         node_stop(arguments.get("--force"))
     elif arguments.get("remove"):
         node_remove(arguments.get("--remove-endpoints"),
-                    arguments.get("--hostname"))
+                    arguments.get("--hostname"),
+                    int(arguments["--parallelism"]))
     elif arguments.get("show"):
         node_show()
     else:
@@ -253,7 +276,8 @@ def node_start(node_image, runtime, log_dir, ip, ip6, as_num, detach,
         (_, docker_ok, etcd_ok) = \
             check_system(quit_if_error=False, libnetwork=libnetwork_image,
                          check_docker=using_docker,
-                         check_modules=not running_in_container())
+                         check_modules=not running_in_container(),
+                         use_cache=True)
 
         if not etcd_ok or (using_docker and not docker_ok):
             sys.exit(1)
@@ -297,6 +321,14 @@ def node_start(node_image, runtime, log_dir, ip, ip6, as_num, detach,
                                       "ro": True}
         etcd_envs.append("ETCD_CERT_FILE=%s" % ETCD_CERT_NODE_FILE)
 
+    # Finish or roll back any container operations that were interrupted.
+    journal.recover()
+
+    # Return any stale IP reservations to IPAM and top up the cache.
+    if reservations.reservation_count():
+        reservations.reconcile()
+        reservations.refill()
+
     if runtime == 'docker':
         _start_node_container_docker(ip, ip6, as_num, log_dir, node_image, detach,
                                      etcd_envs, etcd_volumes, etcd_binds, no_pull)
@@ -406,6 +438,7 @@ def _start_node_container_docker(ip, ip6, as_num, log_dir, node_image, detach, e
     print "Calico node is running with id: %s" % cid
     print "Waiting for successful startup"
     _attach_and_stream(container, detach)
+    print_startup_timings()
 
 def _start_node_container_rkt(ip, ip6, as_num, node_image, etcd_envs,
                               etcd_volumes, etcd_binds):
@@ -619,16 +652,21 @@ def node_stop(force):
         # systemctl not installed, ignore error.
         pass
 
+    # Return the IP reservations for this host to IPAM.
+    if reservations.reservation_count():
+        reservations.reconcile(release_all=True)
+
     print "Node stopped"
 
 
-def node_remove(remove_endpoints, host):
+def node_remove(remove_endpoints, host, parallelism=DEFAULT_PARALLELISM):
     """
     Remove a node from the Calico network.
     :param remove_endpoints: Whether the endpoint data should be forcibly
     removed.
     :param host: The hostname of the host whose node will be removed, or None if
     removing this host's node.
+    :param parallelism: The number of concurrent datastore requests to make.
     :return: None.
     """
     host_to_remove = host or hostname
@@ -651,15 +689,39 @@ def node_remove(remove_endpoints, host):
                         "in the normal way.")
         sys.exit(1)
 
-    # Remove the veths, and release all IPs associated with the endpoints.  To
-    # release the IPs, we construct a set of all IP addresses across all
+    # Remove the veths, and release all IPs associated with the endpoints.
+    # Each step is idempotent, and the host data is only removed once every
+    # step has succeeded, so after a partial failure the command can simply
+    # be re-run to finish the cleanup.
+    if endpoints:
+        print "Removing %d endpoint(s)" % len(endpoints)
+        _remove_veths([endpoint.name for endpoint in endpoints])
+        print "Removed veths"
+        run_in_parallel(endpoint_index.unindex_endpoint, endpoints,
+                        parallelism)
+
+    # To release the IPs, we construct a set of all IP addresses across all
     # endpoints (this assumes the endpoint nets are all single IPs).
     ips = set()
     for endpoint in endpoints:
-        remove_veth(endpoint.name)
         ips |= {net.ip for net in endpoint.ipv4_nets}
         ips |= {net.ip for net in endpoint.ipv6_nets}
-    client.release_ips(ips)
+    failed_blocks = _release_ips_by_block(ips, parallelism)
+    if failed_blocks:
+        print_paragraph("Failed to release the IP addresses in %d block(s).  "
+                        "The node configuration has not been removed - "
+                        "re-run this command to retry." % len(failed_blocks))
+        sys.exit(1)
+
+    # Release any addresses reserved for the host by calicoctl.
+    try:
+        client.release_ip_by_handle(
+                            reservations.reservation_handle(host_to_remove))
+    except KeyError:
+        # The host has no reservations.
+        pass
+    if host_to_remove == hostname:
+        reservations.clear()
 
     # Remove the IPAM host data.
     client.remove_ipam_host(host_to_remove)
@@ -676,9 +738,80 @@ def node_remove(remove_endpoints, host):
     client.remove_per_host_config(host_to_remove, "IpInIpTunnelAddr")
     client.remove_host(host_to_remove)
 
+    # If the node was a BGP route reflector, select another in its place.
+    reselect_route_reflectors(host_to_remove)
+
     print "Node configuration removed"
 
 
+def _remove_veths(veth_names):
+    """
+    Remove a list of veths using a single 'ip -batch' session, rather than
+    running a separate command for each veth.  Any veths which still exist
+    afterwards are removed individually.
+
+    :param veth_names: The names of the veths to remove.
+    :return: None.
+    """
+    if not veth_names:
+        return
+
+    # -force continues past errors for veths which do not exist (for example,
+    # those of another host).
+    commands = "".join("link del %s\n" % name for name in veth_names)
+    process = Popen(["ip", "-force", "-batch", "-"],
+                    stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    process.communicate(commands)
+
+    try:
+        links = check_output(["ip", "-o", "link", "show"])
+    except CalledProcessError:
+        links = ""
+    existing = set(line.split(":")[1].strip().split("@")[0]
+                   for line in links.splitlines() if ":" in line)
+    for name in veth_names:
+        if name in existing:
+            remove_veth(name)
+
+
+def _release_ips_by_block(ips, parallelism):
+    """
+    Release IP addresses, making one request for each allocation block so
+    that blocks are released concurrently.  Progress is reported as each
+    block is released.
+
+    :param ips: The set of IP addresses to release.
+    :param parallelism: The maximum number of concurrent requests.
+    :return: The list of block CIDRs whose addresses could not be released.
+    """
+    blocks = defaultdict(set)
+    for ip in ips:
+        block_cidr = IPNetwork("%s/%s" % (ip, BLOCK_PREFIXLEN[ip.version]))
+        blocks[block_cidr.cidr].add(ip)
+    if not blocks:
+        return []
+
+    lock = threading.Lock()
+    progress = {"done": 0}
+
+    def release_block(block_cidr):
+        try:
+            client.release_ips(blocks[block_cidr])
+        except Exception as e:
+            with lock:
+                print >> sys.stderr, "Failed to release IP addresses in " \
+                                     "block %s: %s" % (block_cidr, e)
+            return block_cidr
+        with lock:
+            progress["done"] += 1
+            print "Released IP addresses in block %s (%d/%d)" % \
+                  (block_cidr, progress["done"], len(blocks))
+            sys.stdout.flush()
+
+    results = run_in_parallel(release_block, sorted(blocks), parallelism)
+    return [block_cidr for block_cidr in results if block_cidr]
+
+
 def _container_running(container_name):
     """
     Check if a container is currently running or not.
@@ -14,25 +14,51 @@
 """
 Usage:
   calicoctl pool add <CIDRS>... [--ipip] [--nat-outgoing]
-  calicoctl pool remove <CIDRS>...
+  calicoctl pool add --file=<FILE> [--ipip] [--nat-outgoing]
+    [--parallelism=<PARALLELISM>]
+  calicoctl pool remove <CIDRS>... [--async] [--parallelism=<PARALLELISM>]
   calicoctl pool range add <START_IP> <END_IP> [--ipip] [--nat-outgoing]
   calicoctl pool show [--ipv4 | --ipv6]
+  calicoctl pool migrate <FROM_CIDR> <TO_CIDR> [--dry-run]
+    [--interface=<INTERFACE>] [--rate=<RATE>] [--parallelism=<PARALLELISM>]
 
 Description:
   Configure IP Pools
 
+  The migrate command moves the IP addresses of this host's containers from
+  one pool to another, or with --dry-run shows the addresses to be moved on
+  each host.
+
 Options:
-  --ipv4          Show IPv4 information only
-  --ipv6          Show IPv6 information only
-  --nat-outgoing  Apply NAT to outgoing traffic
-  --ipip          Use IP-over-IP encapsulation across hosts
+  --ipv4                       Show IPv4 information only
+  --ipv6                       Show IPv6 information only
+  --nat-outgoing               Apply NAT to outgoing traffic
+  --ipip                       Use IP-over-IP encapsulation across hosts
+  --file=<FILE>                Add the pools listed in a file, one CIDR per
+                               line.  The pools are all validated before any
+                               are added, but are not added atomically.
+  --async                      Disable the pools and return, leaving the
+                               pools to be removed in the background
+  --parallelism=<PARALLELISM>  The number of concurrent datastore requests to
+                               make, or containers to migrate [default: 10]
+  --dry-run                    Show the migration plan without migrating
+                               anything
+  --interface=<INTERFACE>      The name of the Calico interface in the
+                               containers [default: eth1]
+  --rate=<RATE>                The maximum number of addresses to migrate per
+                               second [default: 10]
  """
+import bisect
+import functools
+import json
 import sys
 import time
 
 import netaddr
 from netaddr import IPNetwork, IPRange, IPAddress
+from etcd import EtcdEventIndexCleared, EtcdKeyNotFound, EtcdWatchTimedOut
 from prettytable import PrettyTable
+from pycalico.datastore import IP_POOLS_PATH, IPAM_BLOCK_PATH
 from pycalico.datastore_datatypes import IPPool
 from pycalico.datastore_errors import InvalidBlockSizeError
 from pycalico.block import BLOCK_PREFIXLEN
@@ -40,17 +66,63 @@ from pycalico.ipam import HostAffinityClaimedError
 from pycalico.util import validate_ip, validate_cidr
 
 from connectors import client
-from utils import (get_container_ipv_from_arguments,
-                   print_paragraph)
+from utils import (enforce_root, get_container_ipv_from_arguments, hostname,
+                   print_paragraph, run_in_background, run_in_parallel)
+
+# Pools are removed once none of their allocation blocks has been claimed or
+# allocated from for DRAIN_QUIET_SECS, and none of them is then affine to a
+# host, since no more addresses can then be auto-assigned from them.  If
+# blocks are still being claimed after DRAIN_TIMEOUT_SECS the pools are
+# removed anyway.  Between passes that find affine blocks we back off from
+# DRAIN_BACKOFF_SECS up to DRAIN_MAX_BACKOFF_SECS.
+DRAIN_QUIET_SECS = 1
+DRAIN_TIMEOUT_SECS = 30
+DRAIN_BACKOFF_SECS = 0.5
+DRAIN_MAX_BACKOFF_SECS = 4
 
 
 def validate_arguments(arguments):
     """
     Validate argument values:
         <CIDRS>
+        <START_IP>
+        <END_IP>
+        <PARALLELISM>
+        <FROM_CIDR>
+        <TO_CIDR>
+        <RATE>
 
     :param arguments: Docopt processed arguments
     """
+    # Validate parallelism
+    parallelism = arguments.get("--parallelism")
+    if parallelism is not None and \
+            not (parallelism.isdigit() and int(parallelism) > 0):
+        print_paragraph("Invalid parallelism specified.  Argument must be a "
+                        "positive integer.")
+        sys.exit(1)
+
+    # Validate rate
+    rate = arguments.get("--rate")
+    if rate is not None and not (rate.isdigit() and int(rate) > 0):
+        print "Invalid rate specified.  Argument must be a positive integer."
+        sys.exit(1)
+
+    # Validate migration CIDRs
+    from_cidr = arguments.get("<FROM_CIDR>")
+    to_cidr = arguments.get("<TO_CIDR>")
+    if from_cidr or to_cidr:
+        for cidr in (from_cidr, to_cidr):
+            if not validate_cidr(cidr):
+                print "Invalid CIDR specified %s" % cidr
+                sys.exit(1)
+        if IPNetwork(from_cidr).version != IPNetwork(to_cidr).version:
+            print "FROM_CIDR and TO_CIDR must be the same ip version"
+            sys.exit(1)
+        if IPNetwork(from_cidr).cidr == IPNetwork(to_cidr).cidr:
+            print "FROM_CIDR and TO_CIDR must be different pools"
+            sys.exit(1)
+
     # Validate CIDR
     cidrs = arguments.get("<CIDRS>")
     start_ip = arguments.get("<START_IP>")
@@ -93,13 +165,28 @@ def pool(arguments):
                               ip_version,
                               arguments.get("--ipip"),
                               arguments.get("--nat-outgoing"))
+        elif arguments.get("--file"):
+            ip_pool_add_file(arguments.get("--file"),
+                             arguments.get("--ipip"),
+                             arguments.get("--nat-outgoing"),
+                             int(arguments.get("--parallelism")))
         else:
             ip_pool_add(arguments.get("<CIDRS>"),
                         ip_version,
                         arguments.get("--ipip"),
                         arguments.get("--nat-outgoing"))
     elif arguments.get("remove"):
-        ip_pool_remove(arguments.get("<CIDRS>"), ip_version)
+        ip_pool_remove(arguments.get("<CIDRS>"),
+                       ip_version,
+                       arguments.get("--async"),
+                       int(arguments.get("--parallelism")))
+    elif arguments.get("migrate"):
+        ip_pool_migrate(arguments.get("<FROM_CIDR>"),
+                        arguments.get("<TO_CIDR>"),
+                        arguments.get("--dry-run"),
+                        arguments.get("--interface"),
+                        int(arguments.get("--rate")),
+                        int(arguments.get("--parallelism")))
     elif arguments.get("show"):
         if not ip_version:
             ip_pool_show(4)
@@ -122,8 +209,9 @@ def ip_pool_add(cidrs, version, ipip, masquerade):
         print "IP in IP not supported for IPv6 pools"
         sys.exit(1)
 
-    current_pools = client.get_ip_pools(version)
+    current_pools = PoolIndex(client.get_ip_pools(version))
     new_pools = []
+    new_pool_index = PoolIndex()
 
     # Ensure new pools are valid and do not overlap with each other or existing
     # pools.
@@ -139,14 +227,14 @@ def ip_pool_add(cidrs, version, ipip, masquerade):
             sys.exit(1)
 
         # Check if new pool overlaps with any existing pool
-        overlapping_pool = _get_overlapping_pool(pool, current_pools)
+        overlapping_pool = current_pools.get_overlapping_pool(pool.cidr)
         if overlapping_pool:
             print "Cannot add IP pool %s - pool overlaps with an " \
                   "existing pool %s" % (cidr, overlapping_pool.cidr)
             sys.exit(1)
 
         # Check if this new pool overlaps with any other new pool
-        overlapping_pool = _get_overlapping_pool(pool, new_pools)
+        overlapping_pool = new_pool_index.get_overlapping_pool(pool.cidr)
         if overlapping_pool:
             print "Cannot add IP pool %s - pool overlaps with another " \
                   "new pool %s" % (cidr, overlapping_pool.cidr)
@@ -154,6 +242,7 @@ def ip_pool_add(cidrs, version, ipip, masquerade):
 
         # Append pool to pending list of new pools to add to Calico
         new_pools.append(pool)
+        new_pool_index.add(pool)
 
 
     # Make client call to add each pool to Calico
@@ -161,27 +250,163 @@ def ip_pool_add(cidrs, version, ipip, masquerade):
         client.add_ip_pool(version, new_pool)
 
 
-def _get_overlapping_pool(pool, other_pools):
+def ip_pool_add_file(path, ipip, masquerade, parallelism):
     """
-    Check if the given pool overlaps with any pool in the list of other_pools.
+    Add the CIDRs listed in a file to the IP address allocation pool.  The
+    file has one CIDR per line - blank lines and comments starting with '#'
+    are ignored.
+
+    The whole file is validated before any pools are added, and every problem
+    is reported rather than just the first.  The pools are then added with
+    concurrent datastore requests.  The datastore cannot add them all in one
+    update, so if adding some of the pools fails, the others are still added
+    and the pools which failed are reported.
+
+    :param path: The path of the file.
+    :param ipip: Use IP in IP for the pools.
+    :param masquerade: Enable masquerade (outgoing NAT) for the pools.
+    :param parallelism: The number of concurrent datastore requests to make.
+    :return: None
+    """
+    try:
+        with open(path) as pool_file:
+            lines = pool_file.read().splitlines()
+    except IOError as e:
+        print "Could not read %s: %s" % (path, e.strerror)
+        sys.exit(1)
 
-    Ignore when a pool's CIDR is an exact match of another pool's CIDR in case
-    a pool is being updated.
+    current_pools = PoolIndex(client.get_ip_pools(4) +
+                              client.get_ip_pools(6))
+    new_pools = []
+    new_pool_index = PoolIndex()
+    errors = []
+    for line_number, line in enumerate(lines, 1):
+        cidr = line.split("#", 1)[0].strip()
+        if not cidr:
+            continue
+        if not validate_cidr(cidr):
+            errors.append("Line %d: invalid CIDR %s" % (line_number, cidr))
+            continue
+
+        version = IPNetwork(cidr).version
+        if version == 6 and ipip:
+            errors.append("Line %d: IP in IP not supported for IPv6 pool %s" %
+                          (line_number, cidr))
+            continue
+        try:
+            pool = IPPool(cidr, ipip=ipip, masquerade=masquerade)
+        except InvalidBlockSizeError:
+            errors.append("Line %d: an IPv%s pool must have a prefix length "
+                          "of %s or lower, given %s" %
+                          (line_number, version, BLOCK_PREFIXLEN[version],
+                           cidr))
+            continue
+
+        overlapping_pool = current_pools.get_overlapping_pool(pool.cidr)
+        if overlapping_pool:
+            errors.append("Line %d: pool %s overlaps with an existing pool "
+                          "%s" % (line_number, cidr, overlapping_pool.cidr))
+            continue
+        overlapping_pool = new_pool_index.get_overlapping_pool(pool.cidr)
+        if overlapping_pool:
+            errors.append("Line %d: pool %s overlaps with another new pool "
+                          "%s" % (line_number, cidr, overlapping_pool.cidr))
+            continue
+
+        new_pools.append(pool)
+        new_pool_index.add(pool)
+
+    if errors:
+        for error in errors:
+            print error
+        print "No pools added."
+        sys.exit(1)
+
+    errors = run_in_parallel(_add_pool, new_pools, parallelism)
+    failed = [(pool, error) for pool, error in zip(new_pools, errors)
+              if error]
+    print "Added %d pools" % (len(new_pools) - len(failed))
+    if failed:
+        for pool, error in failed:
+            print "Failed to add pool %s: %s" % (pool.cidr, error)
+        sys.exit(1)
 
-    :param pool: IPPool to check overlap for.
-    :param other_pools: List of IPPools to check for overlap.
-    :return: The first IPPool in other_pools that overlaps with pool, or None if
-    no overlap.
-    """
-    for other_pool in other_pools:
-        # Allow the cidr to be exactly the same in case pool is being updated,
-        # for example to add/remove IP-IP support.
-        if ((pool.cidr in other_pool.cidr or other_pool.cidr in pool.cidr) and
-            (pool.cidr != other_pool.cidr)):
-            return other_pool
 
+def _add_pool(pool):
+    """
+    Add a pool, returning the error if that fails.
+    """
+    try:
+        client.add_ip_pool(pool.cidr.version, pool)
+    except Exception as e:
+        return e
     return None
 
+
+class PoolIndex(object):
+    """
+    Index of IP pools sorted by address, used to find the pools that overlap
+    a CIDR or range without comparing it against every pool.
+
+    Two CIDRs are either disjoint or one contains the other.  As long as the
+    indexed pools do not overlap each other (which calicoctl checks before
+    adding a pool), a pool which overlaps a range of addresses must therefore
+    be next to the position of the range in the sorted index.
+    """
+    def __init__(self, pools=()):
+        pools = sorted(pools, key=self._key)
+        self._keys = [self._key(pool) for pool in pools]
+        self._pools = pools
+
+    @staticmethod
+    def _key(pool):
+        return pool.cidr.version, pool.cidr.first, pool.cidr.last
+
+    def add(self, pool):
+        """
+        Add a pool to the index.
+
+        :param pool: The IPPool.
+        """
+        key = self._key(pool)
+        index = bisect.bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        self._pools.insert(index, pool)
+
+    def find_overlap(self, version, first, last):
+        """
+        Find a pool which overlaps a range of addresses.
+
+        :param version: The IP version of the range.
+        :param first: The first address of the range, as an int.
+        :param last: The last address of the range, as an int.
+        :return: An IPPool which overlaps the range, or None if no pool does.
+        """
+        index = bisect.bisect_right(self._keys, (version, first, last))
+        for neighbour in (index - 1, index):
+            if 0 <= neighbour < len(self._keys):
+                pool_version, pool_first, pool_last = self._keys[neighbour]
+                if (pool_version == version and pool_first <= last and
+                        pool_last >= first):
+                    return self._pools[neighbour]
+        return None
+
+    def get_overlapping_pool(self, cidr):
+        """
+        Find a pool which overlaps a CIDR.
+
+        Ignore a pool whose CIDR is an exact match of the CIDR, in case a
+        pool is being updated.
+
+        :param cidr: The IPNetwork to check for overlap.
+        :return: An IPPool which overlaps the CIDR, or None if no pool does.
+        """
+        pool = self.find_overlap(cidr.version, cidr.first, cidr.last)
+        if pool is not None and pool.cidr == cidr:
+            return None
+        return pool
+
+
 def ip_pool_range_add(start_ip, end_ip, version, ipip, masquerade):
     """
     Add the range of ip addresses as CIDRs to the IP address allocation pool.
@@ -198,18 +423,12 @@ def ip_pool_range_add(start_ip, end_ip, version, ipip, masquerade):
         sys.exit(1)
 
     ip_range = IPRange(start_ip, end_ip)
-    pools = client.get_ip_pools(version)
-    for pool in pools:
-        pool_net = IPNetwork(pool.cidr)
-        # Reject the new ip range if any of the following are true:
-        # - The new ip range contains all ips of any existing pool
-        # - An existing pool overlaps ips with the start of the new ip range
-        # - An existing pool overlaps ips with the end of the new ip range
-        if (pool_net in ip_range or
-            start_ip in pool_net or
-            end_ip in pool_net):
-            print "Cannot add range - range conflicts with pool %s" % pool.cidr
-            sys.exit(1)
+    pools = PoolIndex(client.get_ip_pools(version))
+    # Reject the new ip range if it overlaps any existing pool.
+    pool = pools.find_overlap(version, ip_range.first, ip_range.last)
+    if pool:
+        print "Cannot add range - range conflicts with pool %s" % pool.cidr
+        sys.exit(1)
 
     cidrs = netaddr.iprange_to_cidrs(start_ip, end_ip)
     new_pools = []
@@ -229,50 +448,214 @@ def ip_pool_range_add(start_ip, end_ip, version, ipip, masquerade):
         client.add_ip_pool(version, new_pool)
 
 
-def ip_pool_remove(cidrs, version):
+def ip_pool_remove(cidrs, version, in_background=False, parallelism=10):
     """
     Remove the given CIDRs from the IP address allocation pool.
 
     :param cidrs: The pools to remove in CIDR format, e.g. 192.168.0.0/16
     :param version: 4 or 6
+    :param in_background: True to return once the pools are disabled, and
+    remove them in a background process.
+    :param parallelism: The number of concurrent datastore requests to make.
     :return: None
     """
+    # Get the existing IP Pools so that we can disable them.
+    pools = []
     for cidr in cidrs:
-        # Get the existing IP Pool so that we can disable it,
         try:
-            pool = client.get_ip_pool_config(version, IPNetwork(cidr))
+            pools.append(client.get_ip_pool_config(version, IPNetwork(cidr)))
         except KeyError:
             print "%s is not a configured pool." % cidr
             sys.exit(1)
 
-        try:
-            # Disable the pool to prevent any further allocation blocks from
-            # being assigned from the pool.  Existing allocation blocks will
-            # still exist and may be allocated from until affinity is removed
-            # from the blocks.
-            print "Disabling IP Pool"
-            pool.disabled = True
-            client.set_ip_pool_config(version, pool)
-
-            # Remove affinity from the allocation blocks for the pool.  This
-            # will prevent these blocks from being used for auto-allocations.
-            # We pause before removing the affinities and the pool to allow
-            # any in-progress IP allocations to complete - there is a known
-            # timing window here, which can be closed but at the expense of
-            # additional etcd reads for each affine block allocation - since
-            # deletion of a pool is not common, it is simplest to pause in
-            # between disabling and deleting the pool.
-            print "Removing IPAM configuration for pool"
-            time.sleep(3)
-            client.release_pool_affinities(pool)
-            client.remove_ip_pool(version, pool.cidr)
-
-            print "Deleted IP Pool"
-        except (KeyError, HostAffinityClaimedError):
-            print_paragraph("Conflicting modifications have been made to the "
-                            "IPAM configuration for this pool.  Please retry "
-                            "the command.")
-            sys.exit(1)
+    # Every read returns the current etcd index.  The allocation blocks are
+    # watched from here, so no block claimed after the pools are disabled is
+    # missed.
+    start_index = client.etcd_client.read(IP_POOLS_PATH % {
+        "version": version}).etcd_index
+
+    # Disable the pools to prevent any further allocation blocks from being
+    # assigned from them.  Existing allocation blocks will still exist and
+    # may be allocated from until affinity is removed from the blocks.
+    print "Disabling IP Pools"
+    for pool in pools:
+        pool.disabled = True
+    run_in_parallel(functools.partial(client.set_ip_pool_config, version),
+                    pools, parallelism)
+
+    if in_background:
+        print_paragraph("The pools will be removed in the background.  "
+                        "Disabled pools are shown by 'calicoctl pool show' "
+                        "until they have been removed.")
+        run_in_background(_remove_disabled_pools_in_child, pools, version,
+                          parallelism, start_index)
+    else:
+        _remove_disabled_pools(pools, version, parallelism, start_index)
+
+
+def _remove_disabled_pools_in_child(pools, version, parallelism,
+                                    start_index):
+    # Don't share the parent's datastore connections.
+    client.reset()
+    _remove_disabled_pools(pools, version, parallelism, start_index)
+
+
+def _remove_disabled_pools(pools, version, parallelism, start_index):
+    """
+    Wait for in-progress IP allocations from disabled pools to complete, then
+    remove the pools.
+
+    :param pools: The disabled IPPools.
+    :param version: 4 or 6
+    :param parallelism: The number of concurrent datastore requests to make.
+    :param start_index: The etcd index from before the pools were disabled.
+    :return: None
+    """
+    # Remove affinity from the allocation blocks for the pools, which will
+    # prevent these blocks from being used for auto-allocations.  Blocks
+    # claimed by allocations which started before the pools were disabled
+    # are waited for, and released in turn.
+    print "Waiting for IP allocations from the pools to complete"
+    if not _wait_for_pools_to_drain(pools, version, parallelism,
+                                    start_index):
+        print "IP allocations are still in progress, removing pools anyway"
+
+    print "Removing IPAM configuration for pools"
+    removed = run_in_parallel(functools.partial(_remove_pool, version),
+                              pools, parallelism)
+    if not all(removed):
+        print_paragraph("Conflicting modifications have been made to the "
+                        "IPAM configuration for these pools.  Please retry "
+                        "the command.")
+        sys.exit(1)
+
+
+def _remove_pool(version, pool):
+    """
+    Remove a disabled pool.
+
+    :return: True if the pool was removed, False if the IPAM configuration
+    for the pool was modified while it was being removed.
+    """
+    try:
+        client.release_pool_affinities(pool)
+        client.remove_ip_pool(version, pool.cidr)
+    except (KeyError, HostAffinityClaimedError):
+        return False
+    print "Deleted IP Pool %s" % pool.cidr
+    return True
+
+
+def _wait_for_pools_to_drain(pools, version, parallelism, start_index):
+    """
+    Wait for the allocations from the given (disabled) pools to finish, and
+    release the affinity of their allocation blocks.
+
+    Auto-assignment only uses blocks which are affine to the assigning host,
+    and new blocks are only claimed from enabled pools.  However, an
+    allocation which read the pools before they were disabled can still
+    claim a block.  The block tree is watched from before the pools were
+    disabled, until none of the pools' blocks has been claimed or allocated
+    from for DRAIN_QUIET_SECS.  The affinities are then released, and the
+    pools are drained if none of their blocks is affine to a host.
+    Otherwise a block was claimed in the meantime, and we back off and wait
+    again.
+
+    :param pools: The disabled IPPools.
+    :param version: 4 or 6
+    :param parallelism: The number of concurrent datastore requests to make.
+    :param start_index: The etcd index from before the pools were disabled.
+    :return: True if the pools are drained, False if we timed out waiting.
+    """
+    path = IPAM_BLOCK_PATH % {"version": version}
+    deadline = time.time() + DRAIN_TIMEOUT_SECS
+    wait_index = start_index + 1
+    backoff = DRAIN_BACKOFF_SECS
+    while True:
+        quiet_until = time.time() + DRAIN_QUIET_SECS
+        while True:
+            now = time.time()
+            if now >= quiet_until:
+                break
+            if now >= deadline:
+                return False
+            try:
+                result = client.etcd_client.read(
+                    path, recursive=True, wait=True, waitIndex=wait_index,
+                    timeout=min(quiet_until, deadline) - now)
+            except EtcdWatchTimedOut:
+                continue
+            except EtcdEventIndexCleared:
+                # We have missed some changes, so assume blocks in the pools
+                # were claimed, and watch from now.
+                wait_index = None
+                quiet_until = time.time() + DRAIN_QUIET_SECS
+                continue
+            wait_index = result.modifiedIndex + 1
+            # Releasing an affinity writes the block too, but leaves it with
+            # no affinity.
+            if _block_in_pools(result.key, pools) and \
+                    _block_affinity(result.value):
+                quiet_until = time.time() + DRAIN_QUIET_SECS
+
+        run_in_parallel(_release_pool_affinities, pools, parallelism)
+        if not _get_affine_blocks(pools, version):
+            return True
+        if time.time() + backoff >= deadline:
+            return False
+        time.sleep(backoff)
+        backoff = min(backoff * 2, DRAIN_MAX_BACKOFF_SECS)
+
+
+def _release_pool_affinities(pool):
+    try:
+        client.release_pool_affinities(pool)
+    except HostAffinityClaimedError:
+        # A block was claimed while we were releasing them.  It is found and
+        # released on the next pass.
+        pass
+
+
+def _get_affine_blocks(pools, version):
+    """
+    Read the allocation blocks of the given pools.
+
+    :param pools: The IPPools.
+    :param version: 4 or 6
+    :return: A list of the keys of the blocks in the pools which are affine
+    to a host.
+    """
+    try:
+        result = client.etcd_client.read(IPAM_BLOCK_PATH %
+                                         {"version": version})
+    except EtcdKeyNotFound:
+        return []
+    return [leaf.key for leaf in result.leaves
+            if not leaf.dir and _block_in_pools(leaf.key, pools) and
+            _block_affinity(leaf.value)]
+
+
+def _block_affinity(value):
+    """
+    :return: The host affinity of an allocation block, given its JSON value,
+    or None if it has none.
+    """
+    try:
+        return json.loads(value).get("affinity")
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _block_in_pools(key, pools):
+    """
+    Return whether an allocation block key is for a block in one of the
+    pools.  Block keys end in the block CIDR, e.g. .../10.0.0.0-26
+    """
+    try:
+        block = IPNetwork(key.rsplit("/", 1)[-1].replace("-", "/"))
+    except (ValueError, netaddr.AddrFormatError):
+        return True
+    return any(block in pool.cidr for pool in pools)
 
 
 def ip_pool_show(version):
@@ -291,7 +674,65 @@ def ip_pool_show(version):
                 enabled_options.append("ipip")
             if pool.masquerade:
                 enabled_options.append("nat-outgoing")
+        if pool.disabled:
+            enabled_options.append("disabled")
         # convert option array to string
         row = [str(pool.cidr), ','.join(enabled_options)]
         x.add_row(row)
     print x.get_string(sortby=headings[0])
+
+
+def ip_pool_migrate(from_cidr, to_cidr, dry_run, interface, rate,
+                    parallelism):
+    """
+    Move the IP addresses of this host's containers from one pool to another,
+    or show the addresses to be moved on each host.
+
+    :param from_cidr: The CIDR of the pool to migrate from.
+    :param to_cidr: The CIDR of the pool to migrate to.
+    :param dry_run: True to show the migration plan for all hosts, rather
+    than migrating this host's containers.
+    :param interface: The name of the Calico interface in the containers.
+    :param rate: The maximum number of addresses to migrate per second.
+    :param parallelism: The maximum number of containers to migrate
+    concurrently.
+    :return: None
+    """
+    # Only imported when needed, since this pulls in the container commands.
+    import migration
+
+    from_cidr = IPNetwork(from_cidr).cidr
+    to_cidr = IPNetwork(to_cidr).cidr
+    pools = {}
+    for cidr in (from_cidr, to_cidr):
+        try:
+            pools[cidr] = client.get_ip_pool_config(cidr.version, cidr)
+        except KeyError:
+            print "%s is not a configured pool." % cidr
+            sys.exit(1)
+    if pools[to_cidr].disabled:
+        print "Cannot migrate to pool %s - the pool is disabled." % to_cidr
+        sys.exit(1)
+
+    if dry_run:
+        x = PrettyTable(["Host", "Containers", "Addresses", "Blocks",
+                         "Not migratable"], sortby="Host")
+        for host, counts in migration.plan(from_cidr).iteritems():
+            x.add_row([host] + list(counts))
+        print x.get_string()
+        print_paragraph("Run 'calicoctl pool migrate %s %s' on each host "
+                        "to migrate its containers." % (from_cidr, to_cidr))
+        return
+
+    # The container networking changes must be done as root.
+    enforce_root()
+    print "Migrating containers on %s from %s to %s" % \
+          (hostname, from_cidr, to_cidr)
+    migrated, failed = migration.migrate(from_cidr, to_cidr, interface, rate,
+                                         parallelism)
+    print "Migrated %d addresses" % migrated
+    if failed:
+        print_paragraph("Failed to migrate %d containers.  Run the command "
+                        "again to retry - the migration continues from where "
+                        "it stopped." % failed)
+        sys.exit(1)
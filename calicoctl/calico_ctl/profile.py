@@ -13,7 +13,7 @@
 # limitations under the License.
 """
 Usage:
-  calicoctl profile show [--detailed]
+  calicoctl profile show [--detailed | --count-only]
   calicoctl profile add <PROFILE>
   calicoctl profile remove <PROFILE> [--no-check]
   calicoctl profile <PROFILE> tag show
@@ -53,6 +53,7 @@ Description:
 
 Options:
   --detailed        Show additional information.
+  --count-only      Show the number of endpoints using each profile.
   --no-check        Remove a profile without checking if there are endpoints
                     associated with the profile.
   --at=<POSITION>   Specify the position in the chain where the rule should
@@ -65,18 +66,23 @@ Examples:
   $ calicoctl profile only-local-pings rule add inbound --at=0 allow from 192.168.0.0/16
 """
 import copy
+import json
 import sys
 import re
+from collections import defaultdict
 
 import docker
 import docker.errors
+from etcd import EtcdKeyNotFound
 from prettytable import PrettyTable
+from pycalico.datastore import HOSTS_PATH
 from pycalico.datastore import Rule
 from pycalico.datastore import Rules
 
 from connectors import client, DOCKER_URL
+from endpoint import get_hostnames
 from utils import print_paragraph, DOCKER_LIBNETWORK_VERSION
-from pycalico.datastore_datatypes import Profile
+from pycalico.datastore_datatypes import Endpoint, Profile
 from pycalico.util import (validate_characters, validate_ports,
                            validate_icmp_type, validate_cidr, validate_cidr_versions)
 
@@ -241,7 +247,8 @@ def profile(arguments):
     elif arguments.get("remove"):
         profile_remove(arguments.get("<PROFILE>"), arguments.get("--no-check"))
     elif arguments.get("show"):
-        profile_show(arguments.get("--detailed"))
+        profile_show(arguments.get("--detailed"),
+                     count_only=arguments.get("--count-only"))
 
 
 def profile_add(profile_name):
@@ -275,9 +282,7 @@ def profile_remove(profile_name, nocheck):
             rm_profile = True
         else:
             # Check if the the profile has endpoints associated with it
-            members = client.get_profile_members(profile_name)
-            if not members:
-                rm_profile = True
+            rm_profile = not _profile_in_use(profile_name)
         # Remove the profile if criteria was met
         if rm_profile:
             client.remove_profile(profile_name)
@@ -290,14 +295,27 @@ def profile_remove(profile_name, nocheck):
         print "Profile %s not found." % profile_name
 
 
-def profile_show(detailed):
+def profile_show(detailed, count_only=False):
+    """
+    Show the profiles known to Calico.
+
+    The endpoints using each profile are found from a single read of all
+    endpoints, rather than searching the endpoints separately for each
+    profile.
+
+    :param detailed: True to show the endpoints using each profile.
+    :param count_only: True to show the number of endpoints using each
+    profile.
+    :return: None.
+    """
     profiles = client.get_profile_names()
 
     if detailed:
         x = PrettyTable(["Name", "Host", "Orchestrator ID", "Workload ID",
                          "Endpoint ID", "State"])
+        profile_members = _get_profile_members(profiles)
         for name in profiles:
-            members = client.get_profile_members(name)
+            members = profile_members[name]
             if not members:
                 x.add_row([name, "None", "None", "None", "None", "None"])
                 continue
@@ -309,6 +327,11 @@ def profile_show(detailed):
                            endpoint.workload_id,
                            endpoint.endpoint_id,
                            endpoint.state])
+    elif count_only:
+        x = PrettyTable(["Name", "Number of Endpoints"])
+        member_counts = _get_profile_members(profiles, count_only=True)
+        for name in profiles:
+            x.add_row([name, member_counts[name]])
     else:
         x = PrettyTable(["Name"])
         for name in profiles:
@@ -317,6 +340,69 @@ def profile_show(detailed):
     print x.get_string(sortby="Name")
 
 
+def _get_profile_members(profile_names, count_only=False):
+    """
+    Find the endpoints using each of the supplied profiles, reading the
+    endpoints one host at a time.
+
+    :param profile_names: The names of the profiles.
+    :param count_only: True to only count the endpoints using each profile,
+    without creating an Endpoint for each of them.
+    :return: A dict of profile name to the list of endpoints using the
+    profile, or to the number of endpoints with count_only.
+    """
+    profile_names = set(profile_names)
+    members = defaultdict(int if count_only else list)
+    for key, value in _iter_endpoint_values():
+        try:
+            names = set(json.loads(value).get("profile_ids", [])) & \
+                    profile_names
+        except ValueError:
+            # Not a valid endpoint.
+            continue
+
+        if count_only:
+            for name in names:
+                members[name] += 1
+        elif names:
+            endpoint = Endpoint.from_json(key, value)
+            for name in names:
+                members[name].append(endpoint)
+    return members
+
+
+def _iter_endpoint_values():
+    """
+    Generator which reads the endpoints one host at a time, without
+    converting them into Endpoints.
+
+    :return: An iterator of (endpoint key, endpoint JSON) tuples.
+    """
+    for hostname in get_hostnames():
+        # Endpoint keys are <workload path><orchestrator ID>/<workload ID>/
+        # endpoint/<endpoint ID>.
+        workload_path = HOSTS_PATH + hostname + "/workload/"
+        try:
+            result = client.etcd_client.read(workload_path, recursive=True)
+        except EtcdKeyNotFound:
+            continue
+        for leaf in result.leaves:
+            parts = leaf.key[len(workload_path):].split("/")
+            if not leaf.dir and len(parts) == 4 and parts[2] == "endpoint":
+                yield leaf.key, leaf.value
+
+
+def _profile_in_use(profile_name):
+    """
+    Check whether any endpoint is using a profile.
+
+    :param profile_name: The name of the profile.
+    :return: True if the profile is in use.
+    """
+    return any(profile_name in endpoint.profile_ids
+               for endpoint in client.get_endpoints())
+
+
 def profile_tag_show(name):
     """Show the tags on the profile."""
     try:
@@ -0,0 +1,335 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-host cache of reserved IP addresses.
+
+When enabled (by setting CALICOCTL_IP_RESERVATIONS to the number of addresses
+of each IP version to keep reserved), calicoctl assigns addresses from this
+host's affine blocks ahead of time and records them in a local state file.
+Auto-assigning an address for a container then only needs to take one from
+the file, and the cache is topped up again in the background.
+
+Reserved addresses are assigned in IPAM with a per-host handle, so that they
+can be found and returned to IPAM if the state file is lost (e.g. on reboot),
+or when the node is started, stopped or removed.
+
+The state file holds:
+  -  "ipv4"/"ipv6": lists of available reservations, each holding the
+     address and the settings of the pool it was assigned from
+  -  "taken": a dict of addresses taken from the cache (but not yet
+     confirmed to be in use by an endpoint) to the time they were taken.
+"""
+import errno
+import fcntl
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from netaddr import IPAddress
+from pycalico.block import AddressNotAssignedError
+from pycalico.datastore_datatypes import IPPool
+
+from connectors import client
+from utils import hostname, run_in_background
+
+RESERVATIONS_ENV = "CALICOCTL_IP_RESERVATIONS"
+RESERVATIONS_DIR = "/var/run/calico"
+RESERVATIONS_FILE = os.path.join(RESERVATIONS_DIR, "ip-reservations.json")
+LOCK_FILE = os.path.join(RESERVATIONS_DIR, "ip-reservations.lock")
+REFILL_LOCK_FILE = os.path.join(RESERVATIONS_DIR, "ip-reservations-refill.lock")
+
+# Addresses taken from the cache are treated as in use for this long, to give
+# the command that took them time to create the endpoint.
+TAKEN_GRACE_SECS = 300
+
+RESERVATION_HANDLE_PREFIX = "calicoctl-reservation-"
+
+
+def reservation_handle(host):
+    """
+    Return the IPAM handle used for the reservations of a host.
+    :param host: The hostname.
+    :return: The handle ID.
+    """
+    return RESERVATION_HANDLE_PREFIX + host
+
+
+def reservation_count():
+    """
+    Return the number of addresses of each IP version to keep reserved.
+    :return: The count, 0 if reservations are disabled.
+    """
+    try:
+        return max(0, int(os.getenv(RESERVATIONS_ENV, "0")))
+    except ValueError:
+        return 0
+
+
+@contextmanager
+def _flock(path, blocking=True):
+    """
+    Context manager which holds an exclusive lock on the given file.  Yields
+    True if the lock was acquired (always the case when blocking).
+    """
+    if not os.path.exists(RESERVATIONS_DIR):
+        os.makedirs(RESERVATIONS_DIR)
+    with open(path, "a") as lock_file:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+        else:
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_state():
+    """
+    Read the state file.  Must be called with the lock held.
+    """
+    try:
+        with open(RESERVATIONS_FILE) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+    state.setdefault("ipv4", [])
+    state.setdefault("ipv6", [])
+    state.setdefault("taken", {})
+    return state
+
+
+def _write_state(state):
+    """
+    Atomically write the state file.  Must be called with the lock held.
+    """
+    tmp_file = RESERVATIONS_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f)
+    os.rename(tmp_file, RESERVATIONS_FILE)
+
+
+def take_reserved_ip(version):
+    """
+    Take a reserved address from the cache.
+
+    :param version: The IP version (4 or 6).
+    :return: A tuple of (IPAddress, IPPool), or None if there are no reserved
+    addresses for this IP version.
+    """
+    with _flock(LOCK_FILE):
+        state = _read_state()
+        reservations = state["ipv%d" % version]
+        if not reservations:
+            return None
+        reservation = reservations.pop(0)
+        state["taken"][reservation["ip"]] = time.time()
+        _write_state(state)
+    pool = IPPool(reservation["cidr"], ipip=reservation["ipip"],
+                  masquerade=reservation["masquerade"])
+    return IPAddress(reservation["ip"]), pool
+
+
+def refill():
+    """
+    Confirm the addresses that have been taken from the cache, and top up the
+    cache to the configured number of reserved addresses.  Only one refill
+    runs at a time - if another is in progress this does nothing.
+
+    :return: The number of addresses reserved.
+    """
+    with _flock(REFILL_LOCK_FILE, blocking=False) as locked:
+        if not locked:
+            return 0
+        _confirm_taken()
+
+        count = reservation_count()
+        with _flock(LOCK_FILE):
+            state = _read_state()
+        needed = {4: max(0, count - len(state["ipv4"])),
+                  6: max(0, count - len(state["ipv6"]))}
+        pools = {}
+        for version in (4, 6):
+            if needed[version]:
+                pools[version] = client.get_ip_pools(version)
+            if not pools.get(version):
+                needed[version] = 0
+        if not any(needed.values()):
+            return 0
+
+        handle = reservation_handle(hostname)
+        v4_list, v6_list = client.auto_assign_ips(needed[4], needed[6],
+                                                  handle, {})
+        reservations = {4: [], 6: []}
+        unused = set()
+        for ip in v4_list + v6_list:
+            pool = next((pool for pool in pools[ip.version]
+                         if ip in pool.cidr), None)
+            if pool:
+                reservations[ip.version].append(
+                    {"ip": str(ip), "cidr": str(pool.cidr),
+                     "ipip": pool.ipip, "masquerade": pool.masquerade})
+            else:
+                unused.add(ip)
+        if unused:
+            client.release_ips(unused)
+
+        with _flock(LOCK_FILE):
+            state = _read_state()
+            state["ipv4"].extend(reservations[4])
+            state["ipv6"].extend(reservations[6])
+            _write_state(state)
+        return len(reservations[4]) + len(reservations[6])
+
+
+def _confirm_taken():
+    """
+    Forget the addresses taken from the cache which no longer need to be
+    tracked:
+      -  those in use by one of this host's endpoints, which are now released
+         with the endpoint
+      -  those which are no longer assigned in IPAM, e.g. because the
+         container was removed.  These are never re-assigned, since that
+         would leak them
+      -  those taken more than TAKEN_GRACE_SECS ago, which are left for
+         reconcile() to release if they are not in use.
+    """
+    with _flock(LOCK_FILE):
+        taken = _read_state()["taken"]
+    if not taken:
+        return
+
+    in_use = set()
+    for endpoint in client.get_endpoints(hostname=hostname):
+        in_use |= set(str(net.ip) for net in endpoint.ipv4_nets)
+        in_use |= set(str(net.ip) for net in endpoint.ipv6_nets)
+
+    now = time.time()
+    done = set()
+    for ip, taken_time in taken.iteritems():
+        if ip in in_use or now - taken_time >= TAKEN_GRACE_SECS:
+            done.add(ip)
+            continue
+        try:
+            client.get_assignment_attributes(IPAddress(ip))
+        except AddressNotAssignedError:
+            print >> sys.stderr, "Reserved IP %s was released" % ip
+            done.add(ip)
+
+    with _flock(LOCK_FILE):
+        state = _read_state()
+        for ip in done:
+            state["taken"].pop(ip, None)
+        _write_state(state)
+
+
+def refill_in_background():
+    """
+    Refill the cache in a detached background process, so that the current
+    command does not wait for it.
+    :return: None.
+    """
+    if not reservation_count():
+        return
+
+    run_in_background(_refill_in_child)
+
+
+def _refill_in_child():
+    # Don't share the parent's datastore connections.
+    client.reset()
+    refill()
+
+
+def reconcile(release_all=False):
+    """
+    Return stale reservations for this host to IPAM.  A reservation is stale
+    if it is assigned in IPAM with this host's reservation handle but is
+    neither available in the cache, recently taken, nor in use by one of this
+    host's endpoints.
+
+    :param release_all: True to release all available reservations as well.
+    :return: The number of addresses released.
+    """
+    with _flock(REFILL_LOCK_FILE), _flock(LOCK_FILE):
+        state = _read_state()
+        try:
+            assigned = set(client.get_ip_assignments_by_handle(
+                                        reservation_handle(hostname)))
+        except KeyError:
+            # There are no reservations for this host.
+            assigned = set()
+
+        now = time.time()
+        taken = set(IPAddress(ip) for ip, taken_time in
+                    state["taken"].iteritems()
+                    if now - taken_time < TAKEN_GRACE_SECS)
+        available = {}
+        for version in (4, 6):
+            available[version] = [reservation for reservation in
+                                  state["ipv%d" % version]
+                                  if IPAddress(reservation["ip"]) in assigned]
+            if release_all:
+                available[version] = []
+        keep = taken | set(IPAddress(reservation["ip"]) for reservation in
+                           available[4] + available[6])
+
+        stale = assigned - keep
+        if stale:
+            for endpoint in client.get_endpoints(hostname=hostname):
+                stale -= set(net.ip for net in endpoint.ipv4_nets)
+                stale -= set(net.ip for net in endpoint.ipv6_nets)
+        if stale:
+            client.release_ips(stale)
+
+        state["ipv4"] = available[4]
+        state["ipv6"] = available[6]
+        state["taken"] = dict((str(ip), state["taken"][str(ip)])
+                              for ip in taken)
+        _write_state(state)
+    return len(stale)
+
+
+def clear():
+    """
+    Forget the reservations cached on this host, e.g. once they have been
+    released.
+    :return: None.
+    """
+    try:
+        os.remove(RESERVATIONS_FILE)
+    except OSError:
+        pass
+
+
+def show():
+    """
+    Print the reservations cached on this host.
+    :return: None.
+    """
+    with _flock(LOCK_FILE):
+        state = _read_state()
+    print "Reserving %d addresses of each IP version (%s)" % \
+          (reservation_count(), RESERVATIONS_ENV)
+    for version in (4, 6):
+        ips = [reservation["ip"] for reservation in state["ipv%d" % version]]
+        print "IPv%d reserved: %s" % (version, ", ".join(ips) or "none")
+    print "Taken, not yet confirmed: %s" % \
+          (", ".join(sorted(state["taken"])) or "none")
@@ -0,0 +1,262 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Usage:
+  calicoctl serve [--socket=<SOCKET>]
+
+Description:
+  Run a long-lived calicoctl server listening on a Unix domain socket.
+
+  The server keeps the Python interpreter, imported modules and datastore
+  connections warm, so that commands sent by a thin client (such as
+  calicoctl_client.py) avoid the start-up cost of a fresh calicoctl process.
+
+  Commands are run one at a time using the environment and privileges of the
+  server process.  Output written directly by subprocesses is not forwarded
+  to the client.  Commands which run until interrupted (such as
+  'calicoctl status --watch' and 'calicoctl node --detach=false') would block
+  every other client, so are refused.
+
+Options:
+  --socket=<SOCKET>  The path of the Unix socket to listen on.
+                     [default: /var/run/calico/calicoctl.sock]
+"""
+import SocketServer
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+from StringIO import StringIO
+
+import dispatcher
+from utils import enforce_root, print_paragraph
+
+# Framing used for responses.  Output is streamed back to the client as
+# "o<len>\n<data>" (stdout) and "e<len>\n<data>" (stderr) chunks, and the
+# response is terminated with "x<exit code>\n".
+STDOUT_FRAME = "o"
+STDERR_FRAME = "e"
+EXIT_FRAME = "x"
+
+# Maximum size of a request line.
+MAX_REQUEST_BYTES = 1024 * 1024
+
+# Commands which run until interrupted, as (command, option) pairs, where an
+# option of None refuses the command outright.
+LONG_RUNNING_COMMANDS = [("serve", None),
+                         ("status", "--watch"),
+                         ("node", "--detach=false")]
+
+
+def serve(arguments):
+    """
+    Main dispatcher for serve commands. Calls the corresponding helper
+    function.
+
+    :param arguments: A dictionary of arguments already processed through
+    this file's docstring with docopt
+    :return: None
+    """
+    run_server(arguments["--socket"])
+
+
+class FramedWriter(object):
+    """
+    File-like object which forwards writes to the client socket as framed
+    chunks of a single stream.
+    """
+    def __init__(self, sock, frame):
+        self.sock = sock
+        self.frame = frame
+
+    def write(self, data):
+        if not data:
+            return
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        try:
+            self.sock.sendall("%s%d\n%s" % (self.frame, len(data), data))
+        except socket.error:
+            # The client has gone away.  Carry on running the command to
+            # completion so that we don't leave things half-configured.
+            pass
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class CalicoctlRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handles a single calicoctl command received on the server socket.
+    """
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_BYTES)
+        try:
+            request = json.loads(line)
+            argv = [str(arg) for arg in request["argv"]]
+        except (ValueError, KeyError, TypeError):
+            self.wfile.write("%s%d\n" % (EXIT_FRAME, 2))
+            return
+
+        exit_code = run_command(argv,
+                                FramedWriter(self.connection, STDOUT_FRAME),
+                                FramedWriter(self.connection, STDERR_FRAME),
+                                cwd=request.get("cwd"))
+        self.wfile.write("%s%d\n" % (EXIT_FRAME, exit_code))
+
+
+class CalicoctlServer(SocketServer.UnixStreamServer):
+    """
+    Unix socket server which handles one request at a time.  Commands
+    redirect the process-wide stdout and stderr, so must not run
+    concurrently.
+    """
+    def handle_error(self, request, client_address):
+        traceback.print_exc()
+
+
+def run_command(argv, stdout, stderr, cwd=None):
+    """
+    Run a single calicoctl command in this process with its output
+    redirected.
+
+    :param argv: The command line arguments (excluding the program name).
+    :param stdout: The file-like object to use for stdout.
+    :param stderr: The file-like object to use for stderr.
+    :param cwd: The working directory of the client, used for relative paths.
+    :return: The exit code of the command.
+    """
+    refused = _long_running(argv)
+    if refused:
+        print >> stderr, "'calicoctl %s' is not supported by the calicoctl " \
+                         "server.  Run calicoctl directly instead." % refused
+        return 1
+
+    saved_streams = (sys.stdout, sys.stderr, sys.stdin)
+    saved_handlers = dict((sig, signal.getsignal(sig))
+                          for sig in (signal.SIGINT, signal.SIGTERM))
+    saved_cwd = os.getcwd()
+    sys.stdout, sys.stderr, sys.stdin = stdout, stderr, StringIO()
+    exit_code = 0
+    try:
+        if cwd:
+            os.chdir(cwd)
+        dispatcher.dispatch(argv)
+    except SystemExit as e:
+        exit_code = _exit_code(e.code)
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout, sys.stderr, sys.stdin = saved_streams
+        for sig, handler in saved_handlers.iteritems():
+            signal.signal(sig, handler)
+        os.chdir(saved_cwd)
+    return exit_code
+
+
+def _long_running(argv):
+    """
+    Check whether a command runs until interrupted.
+
+    :param argv: The command line arguments (excluding the program name).
+    :return: A description of the long-running command, or None.
+    """
+    for command, option in LONG_RUNNING_COMMANDS:
+        if argv[:1] != [command]:
+            continue
+        if option is None:
+            return command
+        name, _, value = option.partition("=")
+        for i, arg in enumerate(argv[1:], 1):
+            if not value and (arg == name or arg.startswith(name + "=")):
+                return "%s %s" % (command, name)
+            # Options with a value may be given as "--opt=value" or
+            # "--opt value".
+            if value and (arg == option or
+                          (arg == name and argv[i + 1:i + 2] == [value])):
+                return "%s %s" % (command, option)
+    return None
+
+
+def _exit_code(code):
+    """
+    Convert the code passed to sys.exit() into a process exit code.
+    """
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code
+    # sys.exit("message") prints the message and exits with 1.
+    print >> sys.stderr, code
+    return 1
+
+
+def run_server(socket_path):
+    """
+    Run the calicoctl server until it is interrupted.
+
+    :param socket_path: The path of the Unix socket to listen on.
+    :return: None.
+    """
+    enforce_root()
+
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir and not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir)
+    if os.path.exists(socket_path):
+        # Only remove a stale socket - don't trample on a running server.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            os.unlink(socket_path)
+        else:
+            print_paragraph("A calicoctl server is already listening on "
+                            "%s." % socket_path)
+            sys.exit(1)
+        finally:
+            probe.close()
+
+    # Only root may connect, since commands run with the server's privileges.
+    old_umask = os.umask(0o177)
+    try:
+        server = CalicoctlServer(socket_path, CalicoctlRequestHandler)
+    finally:
+        os.umask(old_umask)
+
+    def handle_signal(sig, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    print "calicoctl server listening on %s" % socket_path
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Stopping calicoctl server"
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+    sys.exit(0)
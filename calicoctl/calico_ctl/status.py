@@ -13,29 +13,86 @@
 # limitations under the License.
 """
 Usage:
-  calicoctl status [--runtime=<RUNTIME>]
+  calicoctl status [--runtime=<RUNTIME>] [--output=<OUTPUT>]
+                   [--watch=<INTERVAL>]
 
 Description:
-  Print current status information regarding calico-node container
-  and the BIRD routing daemon.
+  Print current status information regarding calico-node container,
+  how long each stage of its startup took, and the BIRD routing daemon.
 
 Options:
   --runtime=<RUNTIME>       Specify the runtime used to run the calico/node
                             container, either "docker" or "rkt".
                             [default: docker]
+  --output=<OUTPUT>         The output format: table or json
+                            [default: table]
+  --watch=<INTERVAL>        Print the status every <INTERVAL> seconds until
+                            interrupted.
 """
+import json
+import os
 import re
 import sys
+import time
+from datetime import datetime
 
-import subprocess32
+import docker.errors
 from prettytable import PrettyTable
 from pycalico.datastore_errors import DataStoreError
 from requests import ConnectionError
 from subprocess32 import Popen, PIPE
 
+import bird
 from connectors import docker_client, client
 from utils import hostname, RKT_CONTAINER_RE, enforce_root
 
+# Written by the calico-node container as it starts up.
+STARTUP_TIMINGS_FILE = "/var/run/calico/startup-timings.json"
+
+# The Felix version of the calico-node container, which only changes when the
+# container is recreated.
+FELIX_VERSION_CACHE_FILE = "/var/run/calico/felix-version.json"
+
+CALICO_NODE_CONTAINER = "calico-node"
+
+OUTPUT_FORMATS = ["table", "json"]
+
+
+def validate_arguments(arguments):
+    """
+    Validate argument values:
+        <RUNTIME>
+        <OUTPUT>
+        <INTERVAL>
+
+    :param arguments: Docopt processed arguments
+    """
+    runtime = arguments.get("--runtime")
+    runtime_ok = runtime in ["docker", "rkt"]
+    output_ok = arguments.get("--output") in [None] + OUTPUT_FORMATS
+
+    watch_ok = True
+    watch = arguments.get("--watch")
+    if watch is not None:
+        try:
+            watch_ok = float(watch) > 0
+        except ValueError:
+            watch_ok = False
+
+    # Print error messages
+    if not runtime_ok:
+        print "Invalid runtime specified: '%s'" % runtime
+    if not output_ok:
+        print "Invalid output format specified.  Must be one of: %s." % \
+              ", ".join(OUTPUT_FORMATS)
+    if not watch_ok:
+        print "Invalid watch interval specified.  Must be a positive " \
+              "number of seconds."
+
+    # Exit if not valid arguments
+    if not (runtime_ok and output_ok and watch_ok):
+        sys.exit(1)
+
 
 def status(arguments):
     """
@@ -46,85 +103,229 @@ def status(arguments):
     this file's docstring with docopt
     :return: None
     """
-    # Check runtime.
+    validate_arguments(arguments)
     runtime = arguments.get("--runtime")
-    if not runtime in ["docker", "rkt"]:
-        print "Invalid runtime specified: '%s'" % runtime
-        sys.exit(1)
+    output = arguments.get("--output") or "table"
+    watch = arguments.get("--watch")
 
-    # Start by locating the calico-node container and querying the package
-    # summary file.
     if runtime == "rkt":
         enforce_root()
-        check_container_status_rkt()
-    else:
-        check_container_status_docker()
 
-    # Now query the host BGP details.  If the AS number is not specified on the
-    # host then it must be inheriting the default.
+    collector = StatusCollector(runtime)
+    node_status = None
     try:
-        bgp_ipv4, bgp_ipv6 = client.get_host_bgp_ips(hostname)
-        bgp_as = client.get_host_as(hostname)
-        if bgp_as is None:
-            bgp_as = client.get_default_node_as()
-            bgp_as += " (inherited)"
-    except DataStoreError:
-        print "Error connecting to etcd.  Ensure ETCD_ENDPOINTS or ETCD_AUTHORITY is set properly."
-        bgp_ipv4 = bgp_ipv6 = "unknown"
-        bgp_as = "unknown"
+        while True:
+            node_status = collector.collect()
+            if output == "json":
+                # In watch mode, print one status per line.
+                print json.dumps(node_status, sort_keys=True,
+                                 indent=None if watch else 2)
+            else:
+                print_status(node_status)
+
+            if not watch:
+                break
+            sys.stdout.flush()
+            time.sleep(float(watch))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+
+    if node_status and "error" in node_status["container"]:
+        sys.exit(1)
 
-    # TODO: Add additional information to the BIRD section:
-    # TODO: - Include AS numbers of peers
-    # TODO: - Include host name of peers when the peer is a calico-node
-    # TODO: - Include details of peers configured multiple times
 
-    print "\nIPv4 BGP status"
-    if bgp_ipv4:
-        print "IP: %s    AS Number: %s" % (bgp_ipv4, bgp_as)
-        pprint_bird_protocols(4)
-    else:
-        print "No IPv4 address configured.\n"
+class StatusCollector(object):
+    """
+    Collects the status of this node.  In --watch mode, the collector is kept
+    between polls so that the BIRD control socket connections, and the Felix
+    version of the calico-node container, are reused.
+    """
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.birds = {}
+        # The Felix version, by calico-node container ID.
+        self.felix_versions = {}
+
+    def close(self):
+        for bird_client in self.birds.values():
+            bird_client.close()
+        self.birds = {}
+
+    def collect(self):
+        """
+        :return: A dict holding the status of the calico-node container,
+        its startup timings and the BGP status of this node.  The BGP status
+        is only included if the container was found.
+        """
+        if self.runtime == "rkt":
+            container = get_container_status_rkt()
+        else:
+            container = self.get_container_status_docker()
+
+        node_status = {"container": container,
+                       "startup_timings": load_startup_timings(),
+                       "bgp": {}}
+        if "error" in container:
+            return node_status
+
+        # Now query the host BGP details.  If the AS number is not specified
+        # on the host then it must be inheriting the default.
+        try:
+            bgp_ipv4, bgp_ipv6 = client.get_host_bgp_ips(hostname)
+            bgp_as = client.get_host_as(hostname)
+            if bgp_as is None:
+                bgp_as = client.get_default_node_as()
+                bgp_as += " (inherited)"
+        except DataStoreError:
+            node_status["error"] = "Error connecting to etcd.  Ensure " \
+                                   "ETCD_ENDPOINTS or ETCD_AUTHORITY is " \
+                                   "set properly."
+            bgp_ipv4 = bgp_ipv6 = "unknown"
+            bgp_as = "unknown"
+
+        for version, bgp_ip in [(4, bgp_ipv4), (6, bgp_ipv6)]:
+            bgp = {"ip": bgp_ip, "as_num": bgp_as, "peers": [],
+                   "error": None}
+            if bgp_ip:
+                bgp["peers"], bgp["error"] = self.get_bgp_peers(version)
+            node_status["bgp"]["ipv%d" % version] = bgp
+        return node_status
+
+    def get_container_status_docker(self):
+        """
+        :return: The status of the calico/node container when running in
+        Docker.
+        """
+        try:
+            info = docker_client.inspect_container(CALICO_NODE_CONTAINER)
+        except ConnectionError:
+            return {"running": False, "error": "Docker is not running"}
+        except docker.errors.APIError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            info = None
+
+        if not info or not info["State"]["Running"]:
+            return {"running": False,
+                    "error": "calico-node container not running"}
+
+        container_id = info["Id"]
+        if container_id not in self.felix_versions:
+            try:
+                # Only the current container's version is worth keeping.
+                self.felix_versions = {
+                    container_id: get_felix_version(container_id)}
+            except docker.errors.APIError:
+                # The container may have stopped since it was inspected, so
+                # try again on the next poll.
+                pass
+        return {"runtime": "docker",
+                "running": True,
+                "status": "Up %s" % _since(info["State"]["StartedAt"]),
+                "started_at": info["State"]["StartedAt"],
+                "felix_version": self.felix_versions.get(container_id)}
+
+    def get_bgp_peers(self, version):
+        """
+        Get the BGP peers from BIRD, using (and keeping open) a connection to
+        its control socket.
+
+        :param version: The IP version (4 or 6).
+        :return: A tuple of (list of peer dicts, error talking to BIRD or
+        None).
+        """
+        # This needs to be run as root to access the bird data in
+        # /var/run/calico
+        enforce_root()
 
-    print "IPv6 BGP status"
-    if bgp_ipv6:
-        print "IP: %s    AS Number: %s" % (bgp_ipv6, bgp_as)
-        pprint_bird_protocols(6)
-    else:
-        print "No IPv6 address configured.\n"
+        try:
+            if version not in self.birds:
+                self.birds[version] = \
+                    bird.BirdClient(bird.BIRD_CTL_PATHS[version])
+            protocols = bird.parse_protocols(
+                self.birds[version].command("show protocols"))
+        except bird.BirdError:
+            # Reconnect on the next poll.
+            bird_client = self.birds.pop(version, None)
+            if bird_client:
+                bird_client.close()
+            return [], "Couldn't connect to bird."
+
+        peers = []
+        for protocol in protocols:
+            peer = bird.bgp_peer(protocol, version)
+            if peer is None:
+                # This is not a BGP Peer, so do not include in the output.
+                continue
+            peers.append({"peer_address": peer[0],
+                          "peer_type": peer[1],
+                          "state": protocol["state"],
+                          "since": protocol["since"],
+                          "info": protocol["info"]})
+        return peers, None
+
+
+def get_felix_version(container_id):
+    """
+    Get the Felix version of the calico-node container.  This is cached in
+    FELIX_VERSION_CACHE_FILE for the container, so that the container is
+    only exec'd into once.
 
+    :param container_id: The ID of the calico-node container.
+    :return: The Felix version, or None if it could not be determined.
+    """
+    try:
+        with open(FELIX_VERSION_CACHE_FILE) as f:
+            cache = json.load(f)
+        if cache["container_id"] == container_id:
+            return cache["version"]
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    libraries_cmd = docker_client.exec_create(CALICO_NODE_CONTAINER,
+                                              ["sh", "-c",
+                                               "cat libraries.txt"])
+    libraries_out = docker_client.exec_start(libraries_cmd)
+    result = re.search(r"^calico\s*\((.*)\)\s*$", libraries_out,
+                       re.MULTILINE)
+    if result is None:
+        return None
+    version = result.group(1)
 
-def check_container_status_docker():
+    try:
+        tmp_path = FELIX_VERSION_CACHE_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"container_id": container_id, "version": version}, f)
+        os.rename(tmp_path, FELIX_VERSION_CACHE_FILE)
+    except (IOError, OSError):
+        # Not running as root, or the calico-node container has not created
+        # /var/run/calico.
+        pass
+    return version
+
+
+def _since(started_at):
     """
-    Checks and prints the calico/node container status when running in Docker.
+    Describe how long ago a Docker timestamp was, e.g. "5 minutes".
     """
     try:
-        calico_node_info = filter(lambda container: "/calico-node" in
-                                  container["Names"],
-                                  docker_client.containers())
-        if len(calico_node_info) == 0:
-            print "calico-node container not running"
-            sys.exit(1)
-        else:
-            print "calico-node container is running. Status: %s" % \
-                  calico_node_info[0]["Status"]
-
-            libraries_cmd = docker_client.exec_create("calico-node",
-                                                      ["sh", "-c",
-                                                       "cat libraries.txt"])
-            libraries_out = docker_client.exec_start(libraries_cmd)
-            result = re.search(r"^calico\s*\((.*)\)\s*$", libraries_out,
-                               re.MULTILINE)
-
-            if result is not None:
-                print "Running felix version %s" % result.group(1)
-    except ConnectionError:
-        print "Docker is not running"
-        sys.exit(1)
-
-
-def check_container_status_rkt():
+        started = datetime.strptime(started_at[:19], "%Y-%m-%dT%H:%M:%S")
+    except (TypeError, ValueError):
+        return "since %s" % started_at
+    seconds = max(0, int((datetime.utcnow() - started).total_seconds()))
+    for unit, unit_seconds in [("day", 24 * 60 * 60), ("hour", 60 * 60),
+                               ("minute", 60)]:
+        if seconds >= unit_seconds:
+            count = seconds // unit_seconds
+            return "%d %s%s" % (count, unit, "s" if count > 1 else "")
+    return "%d seconds" % seconds
+
+
+def get_container_status_rkt():
     """
-    Checks and prints the calico/node container status when running in rkt.
+    :return: The status of the calico/node container when running in rkt.
     """
     list_cmd = ["sudo", "rkt", "list"]
     p = Popen(list_cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
@@ -132,123 +333,102 @@ def check_container_status_rkt():
     containers = RKT_CONTAINER_RE.findall(stdout)
 
     if p.returncode:
-        print "Unable to list rkt containers: '%s'" % stderr.strip()
-        sys.exit(1)
+        return {"running": False,
+                "error": "Unable to list rkt containers: '%s'" %
+                         stderr.strip()}
 
     if len(containers) == 0:
-        print "calico-node container not running"
-        sys.exit(1)
-    else:
-        # Get statuses for all calico/node containers, and determine
-        # if any are running.
-        statuses = [c[2] for c in containers]
-        running = "running" in statuses
+        return {"running": False,
+                "error": "calico-node container not running"}
+
+    # Get statuses for all calico/node containers, and determine if any are
+    # running.  If one is running, status is "running".  Else, use the status
+    # of the first container.
+    statuses = [c[2] for c in containers]
+    running = "running" in statuses
+    return {"runtime": "rkt",
+            "running": running,
+            "status": "running" if running else statuses[0]}
 
-        # If one is running, status is "running".  Else, use the status of
-        # the first container.
-        status = "running" if running else statuses[0]
 
-        # Print status.  If it at least one is running, this will display
-        # "running" status.
-        print "calico-node container status: %s" % status
+def load_startup_timings():
+    """
+    :return: How long each stage of the calico-node container's startup
+    took, or None if the timings are not available, for example when running
+    an older calico/node image.
+    """
+    try:
+        with open(STARTUP_TIMINGS_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
 
 
-def pprint_bird_protocols(version):
+def print_status(node_status):
     """
-    Pretty print the output from the BIRD "show protocols".  This parses the
-    existing output and lays it out in pretty printed table.
+    Print the status of this node as tables.
 
-    :param version:  The IP version (4 or 6).
+    :param node_status: The status, as returned by StatusCollector.collect().
     :return: None.
     """
-    # This needs to be run as root to access the bird data in /var/run/calico
-    enforce_root()
-
-    # Based on the IP version, run the appropriate BIRD command, and select
-    # the appropriate separator char for an IP address.
-    if getattr(sys, 'frozen', False):
-        # We're running under pyinstaller
-        birdcl = sys._MEIPASS + "/birdcl"
-    else:
-        birdcl = "birdcl"
-    try:
-        if version == 4:
-            results = subprocess32.check_output(
-                   "echo show protocols | %s -s /var/run/calico/bird.ctl" % birdcl,
-                   shell=True)
-            ip_sep = "."
-        else:
-            results = subprocess32.check_output(
-                  "echo show protocols | %s -s /var/run/calico/bird6.ctl" % birdcl,
-                  shell=True)
-            ip_sep = ":"
-    except subprocess32.CalledProcessError:
-        print "Couldn't connect to bird."
+    container = node_status["container"]
+    if "error" in container:
+        print container["error"]
         return
+    elif container["runtime"] == "rkt":
+        print "calico-node container status: %s" % container["status"]
+    else:
+        print "calico-node container is running. Status: %s" % \
+              container["status"]
+        if container["felix_version"]:
+            print "Running felix version %s" % container["felix_version"]
 
-    # Parse the output from BIRD to extract the values in the protocol status
-    # table.  We'll further parse the name since that includes details about
-    # the type of peer and the peer IP address.
-    x = PrettyTable(["Peer address", "Peer type", "State",
-                     "Since", "Info"])
-    lines = results.split("\n")
-    found_table = False
-    for line in lines:
-        # When BIRD displays its protocol table, it prints the bird> prompt and
-        # then shifts the cursor to print back over the prompt.  However, this
-        # means that we get rogue prompts when parsing the output.  For this
-        # processing just remove the prompt if it is present.
-        if line.startswith("bird>"):
-            line = line[5:]
-
-        # Skip blank lines.
-        line = line.strip()
-        if not line:
-            continue
+    _print_startup_timings(node_status["startup_timings"])
+
+    if "error" in node_status:
+        print node_status["error"]
 
-        # Split the line into columns based on whitespace separators.  We split
-        # a maximum of 5 times because the 6th "info" column may contain a
-        # string that itself includes whitespace that should be maintained.
-        columns = re.split("\s+", line.strip(), 5)
+    # TODO: Add additional information to the BIRD section:
+    # TODO: - Include AS numbers of peers
+    # TODO: - Include host name of peers when the peer is a calico-node
+    # TODO: - Include details of peers configured multiple times
 
-        # Loop until we find the table heading.
-        if columns == ["name", "proto", "table", "state", "since", "info"]:
-            found_table = True
+    for version in [4, 6]:
+        bgp = node_status["bgp"]["ipv%d" % version]
+        print "%sIPv%d BGP status" % ("\n" if version == 4 else "", version)
+        if not bgp["ip"]:
+            print "No IPv%d address configured.\n" % version
             continue
-        elif not found_table:
+        print "IP: %s    AS Number: %s" % (bgp["ip"], bgp["as_num"])
+        if bgp["error"]:
+            print bgp["error"]
             continue
+        x = PrettyTable(["Peer address", "Peer type", "State",
+                         "Since", "Info"])
+        for peer in bgp["peers"]:
+            x.add_row([peer["peer_address"], peer["peer_type"],
+                       peer["state"], peer["since"], peer["info"]])
+        print str(x) + "\n"
 
-        # We expect either 5 or 6 columns depending on whether there was a
-        # value in the info column.  Anything else is not handled, so revert
-        # to displaying the raw BIRD output.
-        if not (5 <= len(columns) <= 6):
-            found_table = False
-            break
-
-        # Parse the name, we name our BGP peers as "Mesh", "Node" or "Global"
-        # followed by the IP address.  Extract the info so we can pretty
-        # print it.
-        combined = columns[0]
-        if combined.startswith("Mesh_"):
-            name = combined[5:].replace("_", ip_sep)
-            ptype = "node-to-node mesh"
-        elif combined.startswith("Node_"):
-            name = combined[5:].replace("_", ip_sep)
-            ptype = "node specific"
-        elif combined.startswith("Global_"):
-            name = combined[7:].replace("_", ip_sep)
-            ptype = "global"
-        else:
-            # This is not a BGP Peer, so do not include in the output.
-            continue
 
-        x.add_row([name, ptype, columns[3], columns[4],
-                   columns[5] if len(columns) == 6 else ""])
+def print_startup_timings():
+    """
+    Print how long each stage of the calico-node container's startup took.
+    Nothing is printed if the timings are not available, for example when
+    running an older calico/node image.
+
+    :return: None.
+    """
+    _print_startup_timings(load_startup_timings())
 
-    # If we parsed the table then pretty print the table, otherwise just output
-    # the BIRD output directly.  The first line of the BIRD output provides an
-    # overall BIRD status.
-    if found_table:
-        print str(x) + "\n"
-    else:
-        print results + "\n"
+
+def _print_startup_timings(timings):
+    if not timings:
+        return
+
+    x = PrettyTable(["Stage", "Started", "Duration"])
+    for stage in sorted(timings["stages"], key=lambda stage: stage["start"]):
+        x.add_row([stage["name"], "+%.3fs" % stage["start"],
+                   "%.3fs" % stage["duration"]])
+    print "\nStartup timings"
+    print str(x) + "\n"
@@ -18,6 +18,7 @@ import re
 import sys
 import textwrap
 import urllib
+from multiprocessing.pool import ThreadPool
 
 import netaddr
 from netaddr.core import AddrFormatError
@@ -32,6 +33,11 @@ NAMESPACE_ORCHESTRATOR_ID = "namespace"
 REQUIRED_MODULES = ["xt_set", "ip6_tables"]
 hostname = get_hostname()
 
+# Upper bound (in seconds) on how long we wait for a batch of parallel
+# operations.  A timeout is always supplied so that the main thread stays
+# responsive to Ctrl-C while the worker threads are running.
+PARALLEL_TIMEOUT_SECS = 24 * 60 * 60
+
 # Extracts UUID, version and container status from rkt list output.
 RKT_CONTAINER_RE = re.compile("([a-z0-9]+)\s+.*calico\/node:([a-z0-9\.\_\-]+)\s+([a-z]+)\s+")
 
@@ -53,13 +59,15 @@ def running_in_container():
     """
     return os.getenv("CALICO_CTL_CONTAINER")
 
-def print_paragraph(msg, file=sys.stdout):
+def print_paragraph(msg, file=None):
     """
     Print a fixed width (80 chars) paragraph of text.
     :param msg: The msg to print.
-    :param file: The text stream to write to (default sys.stdout)
+    :param file: The text stream to write to (default sys.stdout).  This is
+    looked up at call time so that redirected output is honoured.
     :return: None.
     """
+    file = file or sys.stdout
     print("\n".join(textwrap.wrap(msg, width=80)), file=file)
     print("", file=file)
 
@@ -126,6 +134,34 @@ def ipv6_enabled():
     return os.path.exists('/proc/sys/net/ipv6')
 
 
+def run_in_parallel(fn, items, parallelism):
+    """
+    Call a function for each item in a list using a bounded pool of worker
+    threads.  The function should handle its own errors - any exception
+    raised by the function is re-raised in the calling thread.
+
+    :param fn: The function to call.  This takes a single item as argument.
+    :param items: The list of items to process.
+    :param parallelism: The maximum number of concurrent calls.
+    :return: A list of the function results, in the same order as the items.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    pool = ThreadPool(max(1, min(parallelism, len(items))))
+    try:
+        results = pool.map_async(fn, items).get(PARALLEL_TIMEOUT_SECS)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return results
+
+
 class URLGetter(urllib.FancyURLopener):
     """
     Retrieves binaries.  Overridden in order to handle errors when
@@ -144,3 +180,42 @@ class URLGetter(urllib.FancyURLopener):
         # Call the super-class
         urllib.FancyURLopener.http_error_default(self, url, fp, errcode,
                                                  errmsg, headers)
+
+
+def run_in_background(fn, *args):
+    """
+    Call a function in a detached background process, so that the current
+    command does not wait for it.  The background process has no stdin,
+    stdout or stderr, and exits once the function returns.
+
+    A function which uses the datastore should reset the datastore client
+    first, so that it does not share the parent's connections.
+
+    :param fn: The function to call.
+    :param args: The arguments to pass to the function.
+    :return: None.
+    """
+    pid = os.fork()
+    if pid:
+        # Reap the intermediate child, leaving the grandchild orphaned.
+        os.waitpid(pid, 0)
+        return
+
+    # Intermediate child.  Fork again and exit, so the grandchild is not our
+    # parent's responsibility.
+    exit_code = 0
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            # Don't hold the caller's output open.  The calicoctl server
+            # replaces sys.stdout and sys.stderr with writers on the client
+            # socket, so reset those as well as the file descriptors.
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            sys.stdout = sys.stderr = os.fdopen(os.dup(devnull), "w")
+            fn(*args)
+    except BaseException:
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
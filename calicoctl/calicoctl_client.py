@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Thin client for a running 'calicoctl serve' process.
+
+This only uses the standard library, so that it starts quickly.  It takes
+the same arguments as calicoctl, sends them to the server and relays the
+output and exit code.  If no server is listening, the full calicoctl is run
+instead.
+
+Environment:
+  CALICOCTL_SOCKET    The server socket [default: /var/run/calico/calicoctl.sock]
+  CALICOCTL_FALLBACK  The calicoctl binary to run if the server is not
+                      available [default: calicoctl]
+"""
+import json
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET = "/var/run/calico/calicoctl.sock"
+DEFAULT_FALLBACK = "calicoctl"
+
+
+def connect(socket_path):
+    """
+    Connect to the calicoctl server.
+
+    :param socket_path: The path of the server socket.
+    :return: The connected socket.
+    :raises socket.error: if the server cannot be contacted.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def run_remote(sock, argv):
+    """
+    Run a command on the calicoctl server.
+
+    :param sock: A socket connected to the server.
+    :param argv: The command line arguments (excluding the program name).
+    :return: The exit code of the command.
+    """
+    try:
+        request = json.dumps({"argv": argv, "cwd": os.getcwd()})
+        sock.sendall(request + "\n")
+        response = sock.makefile("rb")
+        streams = {"o": sys.stdout, "e": sys.stderr}
+        while True:
+            header = response.readline()
+            if not header:
+                sys.stderr.write("Lost connection to calicoctl server\n")
+                return 1
+            frame, value = header[0], header[1:].strip()
+            if frame == "x":
+                return int(value)
+            stream = streams[frame]
+            stream.write(response.read(int(value)))
+            stream.flush()
+    finally:
+        sock.close()
+
+
+def main():
+    socket_path = os.environ.get("CALICOCTL_SOCKET", DEFAULT_SOCKET)
+    argv = sys.argv[1:]
+    try:
+        sock = connect(socket_path)
+    except socket.error:
+        # No server running - fall back to running calicoctl directly.
+        fallback = os.environ.get("CALICOCTL_FALLBACK", DEFAULT_FALLBACK)
+        try:
+            os.execvp(fallback, [fallback] + argv)
+        except OSError as e:
+            sys.stderr.write("Unable to run %s: %s\n" % (fallback, e))
+            sys.exit(1)
+
+    try:
+        exit_code = run_remote(sock, argv)
+    except socket.error as e:
+        sys.stderr.write("Error communicating with calicoctl server: %s\n" % e)
+        exit_code = 1
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
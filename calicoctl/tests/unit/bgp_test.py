@@ -15,11 +15,12 @@
 import unittest
 from StringIO import StringIO
 
-from mock import patch, Mock
+from etcd import EtcdKeyNotFound
+from mock import patch, Mock, call
 from nose_parameterized import parameterized
 from netaddr import IPAddress
 
-from calico_ctl import bgp
+from calico_ctl import bgp, bird
 from pycalico.datastore_datatypes import BGPPeer
 
 
@@ -38,7 +39,12 @@ class TestBgp(unittest.TestCase):
         ({'<AS_NUM>': '65535'} , False),
         ({'<AS_NUM>': '65536.0'} , True),
         ({'<AS_NUM>': '65535.65536'} , True),
-        ({'<AS_NUM>': '65535.'} , True)
+        ({'<AS_NUM>': '65535.'} , True),
+        ({'--count': '3'}, False),
+        ({'--count': '0'}, True),
+        ({'--count': 'three'}, True),
+        ({'--output': 'json'}, False),
+        ({'--output': 'yaml'}, True)
     ])
     def test_validate_arguments(self, case, sys_exit_called):
         """
@@ -122,6 +128,7 @@ class TestBgp(unittest.TestCase):
         # Set up mock objects
         expected_return = '15'
         m_client.get_bgp_node_mesh.return_value = expected_return
+        m_client.etcd_client.read.side_effect = EtcdKeyNotFound()
 
         # Call method under test
         bgp.show_bgp_node_mesh()
@@ -152,9 +159,136 @@ class TestBgp(unittest.TestCase):
         """
         Test for set_bgp_node_mesh for calicoctl bgp
         """
+        m_client.etcd_client.read.side_effect = EtcdKeyNotFound()
+
         # Call method under test
         bgp.set_bgp_node_mesh(True)
 
         # Assert
         m_client.set_bgp_node_mesh.assert_called_once_with(True)
 
+
+    def setup_datastore(self, m_client, hosts, route_reflectors):
+        """
+        Set up the etcd directories of BGP hosts and route reflectors.
+        """
+        def read(path):
+            names = hosts if path == "/calico/bgp/v1/host/" \
+                          else route_reflectors
+            if not names:
+                raise EtcdKeyNotFound()
+            return Mock(leaves=[Mock(key=path + name) for name in names])
+        m_client.etcd_client.read.side_effect = read
+
+    @parameterized.expand([
+        (["a", "b", "c", "d"], [], 2),
+        (["a", "b", "c", "d"], ["d"], 2),
+        (["a", "b"], [], 3),
+    ])
+    def test_select_route_reflectors(self, hosts, current, count):
+        """
+        Test select_route_reflectors keeps existing route reflectors, and
+        selects the same nodes whatever order they are listed in.
+        """
+        selected = bgp.select_route_reflectors(hosts, current, count)
+        self.assertEqual(len(selected), min(count, len(hosts)))
+        self.assertTrue(set(current) <= set(selected))
+        self.assertEqual(
+            bgp.select_route_reflectors(list(reversed(hosts)), current, count),
+            selected)
+
+    @patch('calico_ctl.bgp.client', autospec=True)
+    def test_set_route_reflectors(self, m_client):
+        """
+        Test set_route_reflectors adds the new route reflectors before
+        removing the old ones, and enables the mesh.
+        """
+        self.setup_datastore(m_client, ["a", "b", "c"], ["x"])
+        with patch('calico_ctl.bgp.select_route_reflectors', autospec=True,
+                   return_value=["a", "b"]) as m_select:
+            bgp.set_route_reflectors(2)
+
+        m_select.assert_called_once_with(["a", "b", "c"], ["x"], 2)
+        self.assertEqual(m_client.etcd_client.mock_calls[-3:],
+                         [call.write(bgp.BGP_RR_PATH + "a", ""),
+                          call.write(bgp.BGP_RR_PATH + "b", ""),
+                          call.delete(bgp.BGP_RR_PATH + "x")])
+        m_client.set_bgp_node_mesh.assert_called_once_with(True)
+
+    @patch('calico_ctl.bgp.client', autospec=True)
+    def test_reselect_route_reflectors(self, m_client):
+        """
+        Test removing a route reflector node selects a replacement.
+        """
+        self.setup_datastore(m_client, ["a", "b", "c"], ["a", "c"])
+        bgp.reselect_route_reflectors("c")
+
+        m_client.etcd_client.write.assert_called_once_with(
+                                                bgp.BGP_RR_PATH + "b", "")
+        m_client.etcd_client.delete.assert_called_once_with(
+                                                bgp.BGP_RR_PATH + "c")
+
+    @patch('calico_ctl.bgp.client', autospec=True)
+    def test_reselect_route_reflectors_not_rr(self, m_client):
+        """
+        Test removing a node which is not a route reflector changes nothing.
+        """
+        self.setup_datastore(m_client, ["a", "b", "c"], ["a"])
+        bgp.reselect_route_reflectors("c")
+
+        self.assertFalse(m_client.etcd_client.write.called)
+        self.assertFalse(m_client.etcd_client.delete.called)
+
+    @patch('calico_ctl.bgp.bird.show_protocols', autospec=True)
+    @patch('calico_ctl.bgp.client', autospec=True)
+    def test_get_peer_status(self, m_client, m_show_protocols):
+        """
+        Test get_peer_status joins the configured peers with the BGP
+        sessions in BIRD.
+        """
+        m_client.get_bgp_peers.side_effect = \
+            lambda version, hostname=None: \
+                [Mock(ip=IPAddress("10.0.0.2"), as_num=64513)] if hostname else \
+                [Mock(ip=IPAddress("10.0.0.1"), as_num=64512)]
+        m_show_protocols.return_value = [
+            {"name": "kernel1", "state": "up"},
+            {"name": "Global_10_0_0_1", "state": "up", "since": "17:54:00",
+             "bgp_state": "Established", "info": "Established",
+             "routes_imported": 3, "routes_exported": 1,
+             "neighbor_as": "64512"},
+            {"name": "Mesh_172_17_8_102", "state": "start",
+             "since": "17:53:58", "bgp_state": "Connect",
+             "info": "Connect", "neighbor_as": "64511",
+             "last_error": "Socket: Connection refused"}]
+
+        peers, error = bgp.get_peer_status(4)
+
+        self.assertEqual(error, None)
+        self.assertEqual([(peer["peer_address"], peer["peer_type"],
+                           peer["as_num"], peer["state"]) for peer in peers],
+                         [("10.0.0.1", "global", "64512", "up"),
+                          ("10.0.0.2", "node specific", "64513",
+                           "not running"),
+                          ("172.17.8.102", "node-to-node mesh", "64511",
+                           "start")])
+        self.assertEqual(peers[0]["routes_imported"], 3)
+        self.assertEqual(peers[2]["last_error"], "Socket: Connection refused")
+        self.assertEqual(sorted(peers[1]), sorted(bgp.PEER_STATUS_FIELDS))
+
+    @patch('calico_ctl.bgp.bird.show_protocols', autospec=True)
+    @patch('calico_ctl.bgp.client', autospec=True)
+    def test_get_peer_status_bird_down(self, m_client, m_show_protocols):
+        """
+        Test get_peer_status still shows the configured peers if BIRD is not
+        running.
+        """
+        m_client.get_bgp_peers.side_effect = \
+            lambda version, hostname=None: \
+                [] if hostname else \
+                [Mock(ip=IPAddress("10.0.0.1"), as_num=64512)]
+        m_show_protocols.side_effect = bird.BirdError("Couldn't connect")
+
+        peers, error = bgp.get_peer_status(4)
+
+        self.assertEqual(error, "Couldn't connect")
+        self.assertEqual([peer["state"] for peer in peers], ["not running"])
@@ -0,0 +1,133 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from calico_ctl import bird
+
+SHOW_PROTOCOLS_ALL = """\
+2002-name     proto    table    state  since       info
+1002-static1  Static   master   up     17:53:58    
+1006-  Preference:     200
+     Input filter:   ACCEPT
+     Output filter:  REJECT
+     Routes:         1 imported, 0 exported, 1 preferred
+ 
+1002-Mesh_172_17_8_102 BGP      master   up     17:54:00    Established   
+1006-  Description:    Connection to BGP peer
+     Preference:     100
+     Input filter:   ACCEPT
+     Output filter:  calico_pools
+     Routes:         2 imported, 1 exported, 2 preferred
+     Route change stats:     received   rejected   filtered    ignored   accepted
+       Import updates:              2          0          0          0          2
+       Export updates:              4          2          1        ---          1
+     BGP state:          Established
+       Neighbor address: 172.17.8.102
+       Neighbor AS:      64511
+       Neighbor ID:      172.17.8.102
+       Hold timer:       171/240
+       Keepalive timer:  34/80
+ 
+1002-Global_10_0_0_1 BGP      master   start  17:53:58    Connect       Socket: Connection refused
+1006-  Description:    Connection to BGP peer
+     Preference:     100
+     Input filter:   ACCEPT
+     Output filter:  calico_pools
+     Routes:         0 imported, 0 exported, 0 preferred
+     BGP state:          Connect
+       Neighbor address: 10.0.0.1
+       Neighbor AS:      64512
+       Last error:       Socket: Connection refused
+ 
+0000 
+"""
+
+
+class TestBird(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.ctl_path = os.path.join(self.tmpdir, "bird.ctl")
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.ctl_path)
+        self.server.listen(1)
+        self.addCleanup(self.server.close)
+        self.commands = []
+
+    def serve(self, replies):
+        """
+        Act as BIRD, sending each reply in turn in response to a command.
+        """
+        def serve():
+            conn, _ = self.server.accept()
+            conn_file = conn.makefile("r")
+            conn.sendall("0001 BIRD 1.5.0 ready.\n")
+            for reply in replies:
+                self.commands.append(conn_file.readline().strip())
+                conn.sendall(reply)
+            conn_file.close()
+            conn.close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+    def test_show_protocols(self):
+        """
+        Test show protocols all is parsed into the details of each protocol.
+        """
+        self.serve([SHOW_PROTOCOLS_ALL])
+        with bird.BirdClient(self.ctl_path) as client:
+            protocols = bird.parse_protocols(
+                                        client.command("show protocols all"))
+
+        self.assertEqual(self.commands, ["show protocols all"])
+        self.assertEqual([protocol["name"] for protocol in protocols],
+                         ["static1", "Mesh_172_17_8_102", "Global_10_0_0_1"])
+        self.assertEqual(protocols[1], {
+            "name": "Mesh_172_17_8_102", "proto": "BGP", "table": "master",
+            "state": "up", "since": "17:54:00", "info": "Established",
+            "description": "Connection to BGP peer",
+            "routes_imported": 2, "routes_exported": 1,
+            "routes_preferred": 2, "bgp_state": "Established",
+            "neighbor_address": "172.17.8.102", "neighbor_as": "64511",
+            "neighbor_id": "172.17.8.102", "hold_timer": "171/240",
+            "keepalive_timer": "34/80"})
+        self.assertEqual(protocols[2]["info"],
+                         "Connect       Socket: Connection refused")
+        self.assertEqual(protocols[2]["last_error"],
+                         "Socket: Connection refused")
+        self.assertEqual(bird.bgp_peer(protocols[2], 4),
+                         ("10.0.0.1", "global"))
+        self.assertEqual(bird.bgp_peer(protocols[0], 4), None)
+
+    def test_error_reply(self):
+        """
+        Test an error reply from BIRD raises a BirdError.
+        """
+        self.serve(["9001 syntax error, unexpected CF_SYM_UNDEFINED\n"])
+        with bird.BirdClient(self.ctl_path) as client:
+            self.assertRaises(bird.BirdError, client.command, "show foo")
+
+    def test_not_running(self):
+        """
+        Test a BirdError is raised if BIRD is not running.
+        """
+        self.assertRaises(bird.BirdError, bird.BirdClient,
+                          os.path.join(self.tmpdir, "missing.ctl"))
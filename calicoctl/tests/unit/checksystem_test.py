@@ -11,12 +11,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
+import shutil
+import tempfile
 import unittest
 from mock import patch, Mock, call
 from subprocess32 import CalledProcessError
 from nose_parameterized import parameterized
 from calico_ctl.checksystem import (check_system, _check_modules,
-                                    _check_kernel_version)
+                                    _check_kernel_version, index_modules)
 
 
 class TestCheckSystem(unittest.TestCase):
@@ -100,81 +103,144 @@ class TestCheckSystem(unittest.TestCase):
         # Call method under test expecting a SystemExit when fail detected
         self.assertRaises(SystemExit, check_system, quit_if_error=True)
 
-    # Numbered modules exist within the mocked files and should be valid
+    @patch('calico_ctl.checksystem.enforce_root', autospec=True)
+    @patch('calico_ctl.checksystem._check_modules', autospec=True)
+    @patch('calico_ctl.checksystem._check_kernel_version', autospec=True,
+           return_value=True)
+    @patch('calico_ctl.checksystem._check_docker_version', autospec=True,
+           return_value=True)
+    @patch('calico_ctl.checksystem.check_etcd_version', autospec=True,
+           return_value=True)
+    @patch('calico_ctl.checksystem._cache_key', autospec=True)
+    def test_check_system_cache(self, m_cache_key, m_check_etcd_version,
+                                m_check_docker_version, m_check_kernel_version,
+                                m_check_modules, m_enforce_root):
+        """
+        Test for check_system with use_cache
+
+        Assert that the module and kernel checks are skipped once they have
+        passed, until the boot ID or kernel version changes, and that the
+        docker and etcd checks are always run.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        m_cache_key.return_value = {"boot_id": "boot1", "kernel": "4.4.0"}
+        m_check_modules.return_value = False
+
+        with patch('calico_ctl.checksystem.CHECKSYSTEM_CACHE_FILE',
+                   os.path.join(tmpdir, "checksystem-cache.json")):
+            # The module check fails, so is not cached.
+            self.assertEqual(check_system(use_cache=True),
+                             (False, True, True))
+            m_check_modules.return_value = True
+            self.assertEqual(check_system(use_cache=True),
+                             (True, True, True))
+            self.assertEqual(check_system(use_cache=True),
+                             (True, True, True))
+            self.assertEqual(m_check_modules.call_count, 2)
+            self.assertEqual(m_check_kernel_version.call_count, 1)
+            self.assertEqual(m_check_docker_version.call_count, 3)
+            self.assertEqual(m_check_etcd_version.call_count, 3)
+
+            # After a reboot, the checks are run again.
+            m_cache_key.return_value = {"boot_id": "boot2",
+                                        "kernel": "4.4.0"}
+            check_system(use_cache=True)
+            self.assertEqual(m_check_modules.call_count, 3)
+            self.assertEqual(m_check_kernel_version.call_count, 2)
+
+    # Numbered modules exist within the mocked indexes and should be valid
     # check_modules should return False if searching for invalid module
     @parameterized.expand([
         (["mod_one", "mod_four"], True),
-        (["mod_four", "mod_five"], True),
+        (["mod_four", "mod-five"], True),
         (["mod_invalid"], False),
         (["mod_one", "mod_invalid"], False),
         (["mod_four", "mod_invalid"], False),
     ])
-    @patch('__builtin__.open', autospec=True)
+    @patch('calico_ctl.checksystem.index_modules', autospec=True)
     @patch('sys.stderr', autospec=True)
-    @patch('calico_ctl.checksystem.check_output', autospec=True, return_value="version")
+    @patch('platform.uname', autospec=True,
+           return_value=("Linux", "host", "version", "date", "x86_64",
+                         "x86_64"))
     def test_check_modules_double_open(self, requirements, expected_return,
-                                       m_get_version, m_stderr, m_open):
+                                       m_uname, m_stderr, m_index_modules):
         """Test _check_module for different requirements (opening 2 files)
         Use parameterized requirements to test a variety of states in which
-        modules may or not be found. Check the number of calls to open().
-        Numbered modules exist within the mocked files and should be valid.
+        modules may or not be found. Check the files indexed.
+        Numbered modules exist within the mocked indexes and should be valid.
         check_modules should return False if searching for the invalid module.
         """
-        m_file = Mock()
-        m_file.readlines.side_effect = [["/mod_one.ko", "/mod_two.ko", "/mod_three.ko"], # Mocked Available modules
-                                        ["/mod_four.ko", "/mod_five.ko"],                # Mocked Builtin modules
-                                       ]
-        m_open.return_value = m_file
+        m_index_modules.side_effect = iter([
+            {"mod_one", "mod_two", "mod_three"},  # Mocked Available modules
+            {"mod_four", "mod_five"},             # Mocked Builtin modules
+        ])
 
         with patch('calico_ctl.checksystem.REQUIRED_MODULES', requirements):
             return_val = _check_modules()
 
         self.assertEquals(return_val, expected_return)
-        m_open.assert_has_calls([call("/lib/modules/version/modules.dep"),
-                                 call().readlines(),
-                                 call("/lib/modules/version/modules.builtin"),
-                                 call().readlines(),
-                                ])
+        self.assertEqual(m_index_modules.call_args_list,
+                         [call("/lib/modules/version/modules.dep"),
+                          call("/lib/modules/version/modules.builtin")])
 
     @parameterized.expand([
         (["mod_one", "mod_two"], True),
         (["mod_three"], True),
     ])
-    @patch('__builtin__.open', autospec=True)
+    @patch('calico_ctl.checksystem.index_modules', autospec=True)
     @patch('sys.stderr', autospec=True)
-    @patch('calico_ctl.checksystem.check_output', autospec=True, return_value="version")
+    @patch('platform.uname', autospec=True,
+           return_value=("Linux", "host", "version", "date", "x86_64",
+                         "x86_64"))
     def test_check_modules_single_open(self, requirements, expected_return,
-                                       m_get_version, m_stderr, m_open):
+                                       m_uname, m_stderr, m_index_modules):
         """Test _check_module for different requirements (opening 1 file)
         Use parameterized requirements to test a variety of states in which
-        modules may or not be found. Check the number of calls to open().
-        Numbered modules exist within the mocked file and should be valid.
+        modules may or not be found. Check the files indexed.
+        Numbered modules exist within the mocked index and should be valid.
         """
-        m_file = Mock()
-        m_file.readlines.return_value = ["/mod_one.ko", "/mod_two.ko", "/mod_three.ko"] # Mocked Available modules
-
-        m_open.return_value = m_file
+        m_index_modules.return_value = {"mod_one", "mod_two", "mod_three"}
 
         with patch('calico_ctl.checksystem.REQUIRED_MODULES', requirements):
             return_val = _check_modules()
 
-        m_open.assert_called_once_with("/lib/modules/version/modules.dep")
+        m_index_modules.assert_called_once_with(
+            "/lib/modules/version/modules.dep")
         self.assertEquals(return_val, expected_return)
 
+    def test_index_modules(self):
+        """
+        Test the module names are read from modules.dep and modules.builtin
+        format files.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "modules.dep")
+        with open(path, "w") as f:
+            f.write("kernel/net/netfilter/xt_set.ko: "
+                    "kernel/net/netfilter/ipset/ip_set.ko\n"
+                    "kernel/net/ipv6/netfilter/ip6_tables.ko.xz:\n"
+                    "kernel/drivers/net/dummy-net.ko\n"
+                    "\n")
+
+        self.assertEqual(index_modules(path),
+                         {"xt_set", "ip6_tables", "dummy_net"})
+
     @parameterized.expand([
         (["mod_one", "mod_two"], True),
         (["mod_three", "mod_invalid"], False),
     ])
-    @patch('__builtin__.open', autospec=True)
+    @patch('calico_ctl.checksystem.index_modules', autospec=True)
     @patch('sys.stderr', autospec=True)
     @patch('calico_ctl.checksystem.check_output', autospec=True)
     def test_check_modules_lsmod(self, requirements, expected_return,
-                                 m_check_out, m_stderr, m_open):
+                                 m_check_out, m_stderr, m_index_modules):
         """Test _check_module using lsmod
         Cause failure on file open and check_system should
         find modules in lsmod output.
         """
-        m_open.side_effect = CalledProcessError
+        m_index_modules.side_effect = IOError
         m_check_out.return_value = "mod_one\n mod_two\n mod_three\n"
 
         with patch('calico_ctl.checksystem.REQUIRED_MODULES', requirements):
@@ -182,13 +248,16 @@ class TestCheckSystem(unittest.TestCase):
 
         self.assertEquals(return_val, expected_return)
 
+    @patch('calico_ctl.checksystem.index_modules', autospec=True)
     @patch('sys.stderr', autospec=True)
     @patch('calico_ctl.checksystem.check_output', autospec=True)
-    def test_check_modules_error(self, m_check_out, m_stderr):
+    def test_check_modules_error(self, m_check_out, m_stderr,
+                                 m_index_modules):
         """Test _check_module lsmod failure
-        All check_output calls raise an error, meaning check_system
-        should return false.
+        Reading the module files and lsmod raise an error, meaning
+        check_system should return false.
         """
+        m_index_modules.side_effect = IOError
         m_check_out.side_effect = CalledProcessError
         return_val = _check_modules()
         self.assertFalse(return_val)
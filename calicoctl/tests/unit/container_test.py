@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from mock import patch, Mock, call
@@ -28,6 +31,17 @@ from pycalico.block import AlreadyAssignedError
 
 class TestContainer(unittest.TestCase):
 
+    def setUp(self):
+        # Journal container operations in a temporary directory.
+        self.journal_dir = tempfile.mkdtemp()
+        self.journal_patch = patch('calico_ctl.journal.JOURNAL_DIR',
+                                   self.journal_dir)
+        self.journal_patch.start()
+
+    def tearDown(self):
+        self.journal_patch.stop()
+        shutil.rmtree(self.journal_dir)
+
     @parameterized.expand([
         ({'<CONTAINER>':'node1', 'ip':1, 'add':1, '<IP>':'127.a.0.1'}, True),
         ({'<CONTAINER>':'node1', 'ip':1, 'add':1, '<IP>':'aa:bb::zz'}, True),
@@ -55,13 +69,15 @@ class TestContainer(unittest.TestCase):
             # Assert method exits if bad input
             self.assertEqual(m_sys_exit.called, sys_exit_called)
 
+    @patch('calico_ctl.container.endpoint_index', autospec=True)
     @patch('calico_ctl.container.enforce_root', autospec=True)
     @patch('calico_ctl.container.get_container_info_or_exit', autospec=True)
     @patch('calico_ctl.container.client', autospec=True)
     @patch('calico_ctl.container.get_pool_or_exit', autospec=True)
     @patch('calico_ctl.container.netns', autospec=True)
     def test_container_add(self, m_netns, m_get_pool_or_exit, m_client,
-                           m_get_container_info_or_exit, m_enforce_root):
+                           m_get_container_info_or_exit, m_enforce_root,
+                           m_endpoint_index):
         """
         Test container_add method of calicoctl container command
         """
@@ -96,6 +112,7 @@ class TestContainer(unittest.TestCase):
         self.assertTrue(m_netns.add_ns_default_route.called)
         self.assertTrue(m_netns.get_ns_veth_mac.called)
         self.assertTrue(m_client.set_endpoint.called)
+        m_endpoint_index.index_endpoint.assert_called_once_with(test_return)
 
     @patch('calico_ctl.container.enforce_root', autospec=True)
     @patch('calico_ctl.container.get_container_info_or_exit', autospec=True)
@@ -187,6 +204,11 @@ class TestContainer(unittest.TestCase):
         Assert that the system then exits and all expected calls are made
         """
         # Set up mock object
+        m_get_container_info_or_exit.return_value = {
+            'Id': 'container1_id',
+            'State': {'Running': 1, 'Pid': 'Pid_info'},
+            'HostConfig': {'NetworkMode': 'bridge'}
+        }
         m_client.get_endpoint.side_effect = KeyError
         m_client.assign_ip.side_effect = AlreadyAssignedError
 
@@ -203,10 +225,12 @@ class TestContainer(unittest.TestCase):
         self.assertFalse(m_netns.increment_metrics.called)
         self.assertFalse(m_netns.create_veth.called)
 
+    @patch('calico_ctl.container.endpoint_index', autospec=True)
     @patch('calico_ctl.container.enforce_root', autospec=True)
     @patch('calico_ctl.container.client', autospec=True)
     @patch('calico_ctl.container.netns', autospec=True)
-    def test_container_remove(self, m_netns, m_client, m_enforce_root):
+    def test_container_remove(self, m_netns, m_client, m_enforce_root,
+                              m_endpoint_index):
         """
         Test for container_remove of calicoctl container command
         """
@@ -233,15 +257,18 @@ class TestContainer(unittest.TestCase):
         )
         self.assertEqual(m_client.release_ips.call_count, 1)
         m_netns.remove_veth.assert_called_once_with("eth1234")
+        m_endpoint_index.unindex_endpoint.assert_called_once_with(m_endpoint)
         m_client.remove_workload.assert_called_once_with(
             utils.hostname, utils.DOCKER_ORCHESTRATOR_ID, "container1")
 
+    @patch('calico_ctl.container.endpoint_index', autospec=True)
     @patch('calico_ctl.container.enforce_root', autospec=True)
     @patch('calico_ctl.container.get_workload_id', autospec=True)
     @patch('calico_ctl.container.client', autospec=True)
     @patch('calico_ctl.container.netns', autospec=True)
     def test_container_remove_with_lookup(self, m_netns, m_client,
-                                          m_get_workload_id, m_enforce_root):
+                                          m_get_workload_id, m_enforce_root,
+                                          m_endpoint_index):
         """
         Test for container_remove of calicoctl container command
         """
@@ -263,12 +290,14 @@ class TestContainer(unittest.TestCase):
             utils.hostname, utils.DOCKER_ORCHESTRATOR_ID, "long_id")
 
 
+    @patch('calico_ctl.container.endpoint_index', autospec=True)
     @patch('calico_ctl.container.enforce_root', autospec=True)
     @patch('calico_ctl.container.get_workload_id', autospec=True)
     @patch('calico_ctl.container.client', autospec=True)
     @patch('calico_ctl.container.netns', autospec=True)
     def test_container_remove_error_on_remove_workload(self, m_netns, m_client,
-                                          m_get_workload_id, m_enforce_root):
+                                          m_get_workload_id, m_enforce_root,
+                                          m_endpoint_index):
         """
         Test for container_remove of calicoctl container command
         """
@@ -716,7 +745,7 @@ class TestContainer(unittest.TestCase):
         self.assertTrue(m_client.get_endpoint.called)
         self.assertTrue(m_client.assign_ip.called)
         m_client.release_ips.assert_called_once_with({IPAddress(ip)})
-        self.assertFalse(m_ns_veth_exists.called)
+        self.assertTrue(m_ns_veth_exists.called)
         self.assertFalse(m_netns_add_ip_to_ns_veth.called)
 
     @patch('calico_ctl.container.enforce_root', autospec=True)
@@ -905,11 +934,12 @@ class TestContainer(unittest.TestCase):
 
         # Assert
         self.assertTrue(m_enforce_root.called)
-        self.assertTrue(m_get_pool_or_exit.called)
+        self.assertFalse(m_get_pool_or_exit.called)
         self.assertTrue(m_get_container_info_or_exit.called)
         self.assertTrue(m_client.get_endpoint.called)
-        self.assertTrue(m_client.assign_ip.called)
         m_netns.ns_veth_exists.assert_called_once_with(m_namespace, bad_if)
+        self.assertFalse(m_client.assign_ip.called)
+        self.assertFalse(m_client.update_endpoint.called)
         self.assertFalse(m_netns.add_ip_to_ns_veth.called)
 
     @patch('calico_ctl.container.enforce_root', autospec=True)
@@ -1188,3 +1218,159 @@ class TestContainer(unittest.TestCase):
         self.assertTrue(m_netns.remove_ip_from_ns_veth.called)
         self.assertFalse(m_client.release_ips.called)
 
+
+    @patch('calico_ctl.container.sys.stdin', autospec=True)
+    def test_load_manifest_json_lines(self, m_stdin):
+        """
+        Test load_manifest parses a stream of JSON entries from stdin.
+        """
+        m_stdin.read.return_value = \
+            '{"container": "c1", "ip": "ipv4"}\n' \
+            '{"container": "c2", "ip": "10.0.0.0/8", "interface": "eth2"}\n'
+
+        entries = container.load_manifest("-")
+
+        self.assertEqual([(e.container_id, e.requested_ip, e.interface)
+                          for e in entries],
+                         [("c1", "ipv4", "eth1"),
+                          ("c2", "10.0.0.0/8", "eth2")])
+
+    @parameterized.expand([
+        ('{"container": "c1"}',),
+        ('[{"container": "c1", "ip": "1.2.3.4.5"}]',),
+        ('{"not": "a list"}',),
+    ])
+    @patch('calico_ctl.container.sys.stdin', autospec=True)
+    def test_load_manifest_invalid(self, manifest, m_stdin):
+        """
+        Test load_manifest exits when the manifest is not valid.
+        """
+        m_stdin.read.return_value = manifest
+        self.assertRaises(SystemExit, container.load_manifest, "-")
+
+    @patch('calico_ctl.container.client', autospec=True)
+    def test_assign_batch_ips(self, m_client):
+        """
+        Test _assign_batch_ips makes a single auto-assign request for all
+        "ipv4" and "ipv6" entries.
+        """
+        m_client.get_ip_pools.return_value = []
+        m_client.auto_assign_ips.return_value = (
+            [IPAddress("10.0.0.1"), IPAddress("10.0.0.2")],
+            [IPAddress("aa::1")]
+        )
+        entries = [container.BatchEntry("c1", "ipv4", "eth1"),
+                   container.BatchEntry("c2", "ipv6", "eth1"),
+                   container.BatchEntry("c3", "ipv4", "eth1")]
+        m_op = Mock()
+
+        container._assign_batch_ips(entries, m_op)
+
+        m_client.auto_assign_ips.assert_called_once_with(
+            2, 1, None, {}, pool=(None, None))
+        self.assertEqual([e.ip for e in entries],
+                         [IPAddress("10.0.0.1"), IPAddress("aa::1"),
+                          IPAddress("10.0.0.2")])
+        m_op.record.assert_called_once_with(
+            "ips-%s" % entries[0].endpoint_id,
+            ips={entries[0].endpoint_id: "10.0.0.1",
+                 entries[1].endpoint_id: "aa::1",
+                 entries[2].endpoint_id: "10.0.0.2"})
+
+    @patch('calico_ctl.container.client', autospec=True)
+    def test_assign_batch_ips_exhausted(self, m_client):
+        """
+        Test _assign_batch_ips flags the entries that could not be given an
+        address when the pools are exhausted.
+        """
+        m_client.get_ip_pools.return_value = []
+        m_client.auto_assign_ips.return_value = ([IPAddress("10.0.0.1")], [])
+        entries = [container.BatchEntry("c1", "ipv4", "eth1"),
+                   container.BatchEntry("c2", "ipv4", "eth1")]
+
+        container._assign_batch_ips(entries, Mock())
+
+        self.assertEqual(entries[0].ip, IPAddress("10.0.0.1"))
+        self.assertIsNone(entries[0].error)
+        self.assertIsNone(entries[1].ip)
+        self.assertIsNotNone(entries[1].error)
+
+    @patch('calico_ctl.container.endpoint_index', autospec=True)
+    @patch('calico_ctl.container.enforce_root', autospec=True)
+    @patch('calico_ctl.container.load_manifest', autospec=True)
+    @patch('calico_ctl.container.docker_client', autospec=True)
+    @patch('calico_ctl.container.client', autospec=True)
+    @patch('calico_ctl.container.netns', autospec=True)
+    def test_container_add_many(self, m_netns, m_client, m_docker_client,
+                                m_load_manifest, m_enforce_root,
+                                m_endpoint_index):
+        """
+        Test container_add_many networks each container and skips containers
+        that are already networked.
+        """
+        m_load_manifest.return_value = [
+            container.BatchEntry("c1", "ipv4", "eth1"),
+            container.BatchEntry("c2", "ipv4", "eth1")
+        ]
+        m_docker_client.inspect_container.side_effect = lambda name: {
+            'Id': name + "_id",
+            'State': {'Running': 1, 'Pid': 'Pid_info'},
+            'HostConfig': {'NetworkMode': "not host"}
+        }
+        existing = Mock()
+        existing.orchestrator_id = utils.DOCKER_ORCHESTRATOR_ID
+        existing.workload_id = "c2_id"
+        m_client.get_endpoints.return_value = [existing]
+        m_client.get_ip_pools.return_value = []
+        m_client.auto_assign_ips.return_value = ([IPAddress("10.0.0.1")], [])
+
+        # One container is already networked, so we expect a failure exit.
+        self.assertRaises(SystemExit, container.container_add_many, "-", 5)
+
+        m_enforce_root.assert_called_once_with()
+        m_client.get_endpoints.assert_called_once_with(
+            hostname=utils.hostname)
+        m_client.auto_assign_ips.assert_called_once_with(
+            1, 0, None, {}, pool=(None, None))
+        self.assertEqual(m_netns.create_veth.call_count, 1)
+        self.assertEqual(m_client.set_endpoint.call_count, 1)
+        endpoint = m_client.set_endpoint.call_args[0][0]
+        self.assertEqual(endpoint.workload_id, "c1_id")
+
+    @patch('calico_ctl.journal.netns', autospec=True)
+    @patch('calico_ctl.journal.client', autospec=True)
+    @patch('calico_ctl.container.enforce_root', autospec=True)
+    @patch('calico_ctl.container.load_manifest', autospec=True)
+    @patch('calico_ctl.container.docker_client', autospec=True)
+    @patch('calico_ctl.container.client', autospec=True)
+    @patch('calico_ctl.container.netns', autospec=True)
+    def test_container_add_many_assign_error(self, m_netns, m_client,
+                                             m_docker_client, m_load_manifest,
+                                             m_enforce_root, m_journal_client,
+                                             m_journal_netns):
+        """
+        Test the addresses already assigned are released if assigning the
+        rest of the batch fails.
+        """
+        m_load_manifest.return_value = [
+            container.BatchEntry("c1", "10.0.0.5", "eth1"),
+            container.BatchEntry("c2", "ipv4", "eth1")
+        ]
+        m_docker_client.inspect_container.side_effect = lambda name: {
+            'Id': name + "_id",
+            'State': {'Running': 1, 'Pid': 'Pid_info'},
+            'HostConfig': {'NetworkMode': "not host"}
+        }
+        m_client.get_endpoints.return_value = []
+        m_client.get_ip_pools.return_value = [Mock(cidr=IPNetwork(
+                                                           "10.0.0.0/24"))]
+        m_client.auto_assign_ips.side_effect = RuntimeError("etcd down")
+
+        self.assertRaises(RuntimeError, container.container_add_many, "-", 5)
+
+        m_client.assign_ip.assert_called_once_with(IPAddress("10.0.0.5"),
+                                                   None, {})
+        m_journal_client.release_ips.assert_called_once_with(
+                                                {IPAddress("10.0.0.5")})
+        self.assertFalse(m_netns.create_veth.called)
+        self.assertEqual(os.listdir(self.journal_dir), [])
@@ -0,0 +1,371 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import gzip
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import unittest
+
+from etcd import EtcdKeyNotFound, EtcdResult
+from mock import Mock, patch
+from nose_parameterized import parameterized
+
+from calico_ctl import diags
+
+
+class FakeEtcdClient(object):
+    """
+    An etcd client reading from a dict of keys and values, which records the
+    reads made.
+    """
+    def __init__(self, keys):
+        self.keys = keys
+        self.reads = []
+
+    def _node(self, key, recursive):
+        if key in self.keys:
+            return {"key": key, "value": self.keys[key], "modifiedIndex": 1}
+        prefix = key + "/"
+        children = sorted(set(prefix + k[len(prefix):].split("/")[0]
+                              for k in self.keys if k.startswith(prefix)))
+        if not children:
+            raise EtcdKeyNotFound()
+        node = {"key": key, "dir": True, "modifiedIndex": 1, "nodes": []}
+        for child in children:
+            if child in self.keys:
+                node["nodes"].append(self._node(child, recursive))
+            elif recursive:
+                node["nodes"].append(self._node(child, True))
+            else:
+                node["nodes"].append({"key": child, "dir": True,
+                                      "modifiedIndex": 1})
+        return node
+
+    def read(self, key, recursive=False):
+        self.reads.append((key, recursive))
+        return EtcdResult(None, self._node(key, recursive))
+
+
+class TestDiags(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.tar_path = os.path.join(self.tmpdir, "diags.tar.gz")
+
+    def read_bundle(self):
+        with tarfile.open(self.tar_path) as tar:
+            return dict((member.name, tar.extractfile(member).read())
+                        for member in tar.getmembers())
+
+    @parameterized.expand([
+        ({'--max-log-bytes': '1000'}, False),
+        ({'--max-log-bytes': '0'}, True),
+        ({'--max-log-bytes': 'lots'}, True),
+        ({'--since': '2h'}, False),
+        ({'--since': '30m'}, False),
+        ({'--since': '2'}, True),
+        ({'--since': 'yesterday'}, True),
+    ])
+    def test_validate_arguments(self, case, sys_exit_called):
+        """
+        Test validate_arguments for calicoctl diags.
+        """
+        with patch('sys.exit', autospec=True) as m_sys_exit:
+            diags.validate_arguments(case)
+            self.assertEqual(m_sys_exit.called, sys_exit_called)
+
+    def test_run_command(self):
+        """
+        Test the output and status of commands are written to the file.
+        """
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(diags.run_command("echo hello", f), "ok")
+            self.assertEqual(diags.run_command("exit 3", f), "exit code 3")
+            f.seek(0)
+            self.assertEqual(f.read(),
+                             "hello\n\nProblem running command: exit 3\n")
+
+    def test_run_command_timeout(self):
+        """
+        Test commands are killed when they time out.
+        """
+        start = time.time()
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(diags.run_command("sleep 10", f, timeout=0.1),
+                             "timed out")
+        self.assertLess(time.time() - start, 5)
+
+    def test_bundle_collect(self):
+        """
+        Test collector output and timings are added to the bundle, and that
+        errors from a collector are written to its file.
+        """
+        def failing_collector(f):
+            f.write("partial\n")
+            raise ValueError("oops")
+
+        with diags.DiagsBundle(self.tar_path) as bundle:
+            bundle.collect("good", lambda f: f.write("output") or "ok")
+            bundle.collect("bad", failing_collector)
+
+        files = self.read_bundle()
+        self.assertEqual(files["diagnostics/good"], "output")
+        self.assertTrue(files["diagnostics/bad"].startswith(
+            "partial\n\nError gathering diagnostics\n"))
+        timings = json.loads(files["diagnostics/collector_timings.json"])
+        self.assertEqual(sorted((timing["name"], timing["status"])
+                                for timing in timings),
+                         [("bad", "error"), ("good", "ok")])
+
+    def test_bundle_logs(self):
+        """
+        Test logs are filtered by modification time and truncated to the
+        maximum size, and lock files are skipped.
+        """
+        log_dir = os.path.join(self.tmpdir, "logs")
+        os.makedirs(os.path.join(log_dir, "felix"))
+        for path, contents in [("felix/current", "0123456789"),
+                               ("felix/old", "old"),
+                               ("felix/lock", ""),
+                               ("bird", "bird")]:
+            with open(os.path.join(log_dir, path), "w") as f:
+                f.write(contents)
+        old = time.time() - 2 * 60 * 60
+        os.utime(os.path.join(log_dir, "felix/old"), (old, old))
+
+        with diags.DiagsBundle(self.tar_path) as bundle:
+            for name, path in diags.find_log_files(log_dir, since=60 * 60):
+                bundle.add_log(name, path, max_log_bytes=4)
+
+        files = self.read_bundle()
+        del files["diagnostics/collector_timings.json"]
+        self.assertEqual(files, {"diagnostics/logs/felix/current": "6789",
+                                 "diagnostics/logs/bird": "bird"})
+
+    def test_bundle_add_truncated_log(self):
+        """
+        Test a log which is truncated while it is being added is padded with
+        zeros, leaving a valid bundle.
+        """
+        path = os.path.join(self.tmpdir, "felix")
+        with open(path, "w") as f:
+            f.write("0123")
+        real_fstat = os.fstat
+
+        def fstat(fd):
+            # The log was 10 bytes when it was opened.
+            return Mock(st_size=10, st_mtime=real_fstat(fd).st_mtime)
+
+        with diags.DiagsBundle(self.tar_path) as bundle:
+            with patch('calico_ctl.diags.os.fstat', fstat):
+                bundle.add_log("logs/felix", path)
+            bundle.collect("after", lambda f: f.write("after") or "ok")
+
+        files = self.read_bundle()
+        self.assertEqual(files["diagnostics/logs/felix"],
+                         "0123" + "\0" * 6)
+        self.assertEqual(files["diagnostics/after"], "after")
+
+    def test_walk_datastore(self):
+        """
+        Test the datastore is walked one level at a time down to the split
+        depth, and that other hosts are skipped when a host is given.
+        """
+        client = FakeEtcdClient({
+            "/calico/v1/config/InterfacePrefix": "cali",
+            "/calico/v1/host/h1/bird_ip": "10.0.0.1",
+            "/calico/v1/host/h1/workload/docker/w1/endpoint/e1": "{}",
+            "/calico/v1/host/h2/bird_ip": "10.0.0.2",
+        })
+
+        keys = [(node.key, bool(node.dir)) for node in
+                diags.walk_datastore(client, "/calico", hostname="h1")]
+
+        self.assertEqual(keys, [
+            ("/calico", True),
+            ("/calico/v1", True),
+            ("/calico/v1/config", True),
+            ("/calico/v1/config/InterfacePrefix", False),
+            ("/calico/v1/host", True),
+            ("/calico/v1/host/h1", True),
+            ("/calico/v1/host/h1/bird_ip", False),
+            ("/calico/v1/host/h1/workload", True),
+            ("/calico/v1/host/h1/workload/docker", True),
+            ("/calico/v1/host/h1/workload/docker/w1", True),
+            ("/calico/v1/host/h1/workload/docker/w1/endpoint", True),
+            ("/calico/v1/host/h1/workload/docker/w1/endpoint/e1", False)])
+        self.assertIn(("/calico/v1/host/h1/workload", True), client.reads)
+        self.assertNotIn(("/calico/v1/host/h2", False), client.reads)
+
+    def test_walk_datastore_host_dirs(self):
+        """
+        Test the IPAM and Felix per-host keys of other hosts are skipped, and
+        the IPAM blocks and handles are not listed.
+        """
+        client = FakeEtcdClient({
+            "/calico/felix/v1/host/h1/status": "up",
+            "/calico/felix/v1/host/h2/status": "up",
+            "/calico/ipam/v2/host/h1/ipv4/block/10.0.0.0-26": "",
+            "/calico/ipam/v2/host/h2/ipv4/block/10.0.0.64-26": "",
+            "/calico/ipam/v2/assignment/ipv4/block/10.0.0.0-26": "{}",
+            "/calico/ipam/v2/handle/hd1": "{}",
+        })
+
+        keys = [node.key for node in
+                diags.walk_datastore(client, "/calico", hostname="h1")
+                if not node.dir]
+
+        self.assertEqual(keys, [
+            "/calico/felix/v1/host/h1/status",
+            "/calico/ipam/v2/host/h1/ipv4/block/10.0.0.0-26"])
+        self.assertFalse([key for key, _ in client.reads
+                          if key.startswith("/calico/ipam/v2/assignment") or
+                          key.startswith("/calico/ipam/v2/handle")])
+
+    @parameterized.expand([
+        ("/calico", None,
+         ["/calico/ipam/v2/assignment/ipv4/block/10.0.0.0-26",
+          "/calico/ipam/v2/assignment/ipv6/block/aa::-122",
+          "/calico/ipam/v2/handle/hd1",
+          "/calico/ipam/v2/handle/hd2"]),
+        ("/calico", "h1",
+         ["/calico/ipam/v2/assignment/ipv4/block/10.0.0.0-26",
+          "/calico/ipam/v2/handle/hd1"]),
+        ("/calico/ipam/v2/handle", None,
+         ["/calico/ipam/v2/handle/hd1",
+          "/calico/ipam/v2/handle/hd2"]),
+        ("/calico/v1", None, []),
+    ])
+    def test_walk_ipam_assignments(self, prefix, hostname, expected):
+        """
+        Test the IPAM blocks are read one at a time from the host
+        affinities, and the handles from the blocks' allocations.
+        """
+        def block(handle_id):
+            return json.dumps({"attributes": [{"handle_id": handle_id},
+                                              {"handle_id": None}]})
+        client = FakeEtcdClient({
+            "/calico/ipam/v2/host/h1/ipv4/block/10.0.0.0-26": "",
+            "/calico/ipam/v2/host/h2/ipv6/block/aa::-122": "",
+            "/calico/ipam/v2/assignment/ipv4/block/10.0.0.0-26": block("hd1"),
+            "/calico/ipam/v2/assignment/ipv6/block/aa::-122": block("hd2"),
+            "/calico/ipam/v2/handle/hd1": "{}",
+            "/calico/ipam/v2/handle/hd2": "{}",
+        })
+
+        keys = sorted(node.key for node in
+                      diags.walk_ipam_assignments(client, prefix, hostname))
+
+        self.assertEqual(keys, expected)
+        self.assertFalse([key for key, _ in client.reads
+                          if key in ("/calico/ipam/v2/assignment/ipv4/block",
+                                     "/calico/ipam/v2/handle")])
+
+    def test_walk_datastore_missing(self):
+        """
+        Test walking a path that does not exist returns nothing.
+        """
+        client = FakeEtcdClient({})
+        self.assertEqual(list(diags.walk_datastore(client, "/calico")), [])
+
+    @patch('calico_ctl.diags.DatastoreClient', autospec=True)
+    def test_dump_datastore(self, m_DatastoreClient):
+        """
+        Test the datastore is dumped as gzipped JSON lines.
+        """
+        m_DatastoreClient.return_value.etcd_client = FakeEtcdClient({
+            "/calico/v1/Ready": "true"})
+
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(diags.dump_datastore(f), "ok")
+            f.seek(0)
+            lines = gzip.GzipFile(fileobj=f, mode="rb").read().splitlines()
+
+        self.assertEqual([json.loads(line) for line in lines], [
+            {"key": "/calico", "dir": True, "value": None,
+             "modified_index": 1},
+            {"key": "/calico/v1", "dir": True, "value": None,
+             "modified_index": 1},
+            {"key": "/calico/v1/Ready", "dir": False, "value": "true",
+             "modified_index": 1}])
+
+    @patch('calico_ctl.diags.REFRESH_POLL_SECS', 0)
+    def test_gather_summaries_refresh(self):
+        """
+        Test summaries are refetched until the nodes have answered the
+        request.
+        """
+        published = {"host1": [5, 12], "host2": [12], "host3": [None, 12]}
+
+        def read(path):
+            hostname = path.split("/")[-2]
+            request_index = published[hostname].pop(0)
+            if request_index is None:
+                raise EtcdKeyNotFound()
+            return Mock(value=json.dumps({"hostname": hostname,
+                                          "request_index": request_index}))
+        etcd_client = Mock()
+        etcd_client.read.side_effect = read
+
+        summaries = diags.gather_summaries(etcd_client,
+                                           ["host1", "host2", "host3"],
+                                           request_index=12)
+
+        self.assertEqual(summaries,
+                         {"host1": {"hostname": "host1", "request_index": 12},
+                          "host2": {"hostname": "host2", "request_index": 12},
+                          "host3": {"hostname": "host3", "request_index": 12}})
+        self.assertEqual(etcd_client.read.call_count, 5)
+
+    def test_gather_summaries_missing(self):
+        """
+        Test nodes without a summary are reported as None.
+        """
+        etcd_client = Mock()
+        etcd_client.read.side_effect = EtcdKeyNotFound()
+        self.assertEqual(diags.gather_summaries(etcd_client, ["host1"]),
+                         {"host1": None})
+
+    def test_merge_summaries(self):
+        """
+        Test the cluster totals are summed over the node summaries.
+        """
+        summary = {
+            "routes": {"ipv4": 10, "ipv6": 2},
+            "iptables_rules": {"ipv4": {"filter": 20, "nat": 3},
+                               "ipv6": {"filter": 5}},
+            "ipsets": {"felix-v4-all-hosts": 3, "felix-v4-profile": 1},
+            "bird_protocols": {
+                "ipv4": {"Mesh_10_0_0_2": {"state": "up",
+                                           "info": "Established"},
+                         "Mesh_10_0_0_3": {"state": "start",
+                                           "info": "Connect"}}},
+            "felix": {"running": True, "endpoints": 4}}
+
+        report = diags.merge_summaries({"host1": summary, "host2": summary,
+                                        "host3": None})
+
+        self.assertEqual(report["totals"], {
+            "hosts": 3,
+            "hosts_missing": 1,
+            "routes": {"ipv4": 20, "ipv6": 4},
+            "iptables_rules": {"ipv4": 46, "ipv6": 10},
+            "ipset_entries": 8,
+            "bgp_sessions": {"established": 2, "total": 4},
+            "felix_running": 2,
+            "endpoints": 8})
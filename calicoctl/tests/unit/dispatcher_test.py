@@ -0,0 +1,85 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+import unittest
+
+from mock import patch, Mock
+from nose.tools import assert_raises
+
+from calico_ctl import dispatcher
+from calico_ctl.connectors import LazyClient
+
+
+class TestDispatcher(unittest.TestCase):
+
+    @patch('importlib.import_module', autospec=True)
+    def test_dispatch_unknown_command(self, m_import_module):
+        """
+        Test dispatch shows help for commands which are not in COMMANDS,
+        without importing anything.
+        """
+        assert_raises(SystemExit, dispatcher.dispatch, ["utils"])
+        self.assertFalse(m_import_module.called)
+
+    @patch('importlib.import_module', autospec=True)
+    def test_dispatch_imports_command_only(self, m_import_module):
+        """
+        Test dispatch imports and runs only the requested command.
+        """
+        m_module = Mock(__doc__="Usage:\n  calicoctl version\n")
+        m_import_module.return_value = m_module
+
+        dispatcher.dispatch(["version"])
+
+        m_import_module.assert_called_once_with("calico_ctl.version")
+        m_module.version.assert_called_once_with({"version": True})
+
+
+class TestLazyClient(unittest.TestCase):
+
+    def test_lazy_client(self):
+        """
+        Test the client is created on first use, and only once.
+        """
+        m_factory = Mock()
+        client = LazyClient(m_factory)
+        self.assertFalse(m_factory.called)
+
+        client.get_endpoints(hostname="host")
+        client.get_endpoints(hostname="host")
+
+        m_factory.assert_called_once_with()
+        self.assertEqual(m_factory.return_value.get_endpoints.call_count, 2)
+
+    def test_lazy_client_threads(self):
+        """
+        Test the client is only created once when first used from several
+        threads at the same time.
+        """
+        def factory():
+            # Give the other threads a chance to race with this one.
+            time.sleep(0.05)
+            return Mock()
+        m_factory = Mock(side_effect=factory)
+        client = LazyClient(m_factory)
+
+        threads = [threading.Thread(target=client.get_endpoints)
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        m_factory.assert_called_once_with()
@@ -12,11 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import unittest
+from StringIO import StringIO
 
-from mock import patch
+from etcd import EtcdKeyNotFound
+from mock import patch, Mock, call
 from nose_parameterized import parameterized, param
 from calico_ctl import endpoint
+from calico_ctl import endpoint_index
 
 
 class TestEndpoint(unittest.TestCase):
@@ -122,4 +126,195 @@ class TestEndpoint(unittest.TestCase):
                                                hostname=hostname,
                                                orchestrator_id=orchestrator_id,
                                                workload_id=workload_id,
-                                               endpoint_id=endpoint_id)
\ No newline at end of file
+                                               endpoint_id=endpoint_id)
+    @patch("calico_ctl.endpoint.endpoint_index", autospec=True)
+    @patch("calico_ctl.endpoint.client", autospec=True)
+    def test_endpoint_profile_show_indexed(self, m_client, m_endpoint_index):
+        """
+        Test an endpoint ID-only lookup uses the filters from the index.
+        """
+        m_endpoint_index.resolve.return_value = ("host", "docker", "wid",
+                                                 "eid")
+        m_client.get_endpoint.return_value = Mock(profile_ids=[])
+
+        endpoint.endpoint_profile_show(None, None, None, "eid")
+
+        m_endpoint_index.resolve.assert_called_once_with(None, None, None,
+                                                         "eid")
+        m_client.get_endpoint.assert_called_once_with(
+            hostname="host", orchestrator_id="docker", workload_id="wid",
+            endpoint_id="eid")
+
+    @patch("calico_ctl.endpoint.endpoint_index", autospec=True)
+    @patch("calico_ctl.endpoint.client", autospec=True)
+    def test_endpoint_profile_show_stale_index(self, m_client,
+                                               m_endpoint_index):
+        """
+        Test a stale index entry falls back to a search.
+        """
+        m_endpoint_index.resolve.return_value = ("host", "docker", "wid",
+                                                 "eid")
+        m_client.get_endpoint.side_effect = [KeyError,
+                                             Mock(profile_ids=[])]
+
+        endpoint.endpoint_profile_show(None, None, None, "eid")
+
+        self.assertEqual(m_client.get_endpoint.call_args_list,
+                         [call(hostname="host", orchestrator_id="docker",
+                               workload_id="wid", endpoint_id="eid"),
+                          call(hostname=None, orchestrator_id=None,
+                               workload_id=None, endpoint_id="eid")])
+
+    def _mock_hosts(self, m_client, endpoints):
+        """
+        Set up the mock client to return the supplied endpoints, which are
+        stored under hosts in reverse hostname order.
+        """
+        hosts = sorted(set(ep.hostname for ep in endpoints), reverse=True)
+        m_client.etcd_client.read.return_value = Mock(
+            leaves=[Mock(dir=True, key="/calico/v1/host/" + host)
+                    for host in hosts])
+        m_client.get_endpoints.side_effect = \
+            lambda hostname, **kwargs: [ep for ep in endpoints
+                                        if ep.hostname == hostname]
+
+    def _mock_endpoint(self, hostname, workload_id, endpoint_id):
+        return Mock(hostname=hostname, orchestrator_id="docker",
+                    workload_id=workload_id, endpoint_id=endpoint_id,
+                    ipv4_nets={"10.0.0.1/32"}, ipv6_nets=set(),
+                    mac="aa:bb:cc:dd:ee:ff", profile_ids=["PROF"],
+                    state="active")
+
+    @patch("sys.stdout", new_callable=StringIO)
+    @patch("calico_ctl.endpoint.client", autospec=True)
+    def test_endpoint_show_jsonl(self, m_client, m_stdout):
+        """
+        Test endpoint details are streamed one host at a time, in order.
+        """
+        self._mock_hosts(m_client, [self._mock_endpoint("host2", "w3", "e3"),
+                                    self._mock_endpoint("host1", "w2", "e2"),
+                                    self._mock_endpoint("host1", "w1", "e1")])
+
+        endpoint.endpoint_show(None, None, None, None, True, output="jsonl")
+
+        self.assertEqual([kwargs["hostname"] for _, kwargs in
+                          m_client.get_endpoints.call_args_list],
+                         ["host1", "host2"])
+        rows = [json.loads(line) for line in m_stdout.getvalue().splitlines()]
+        self.assertEqual([row["endpoint_id"] for row in rows],
+                         ["e1", "e2", "e3"])
+        self.assertEqual(rows[0], {"hostname": "host1",
+                                   "orchestrator_id": "docker",
+                                   "workload_id": "w1",
+                                   "endpoint_id": "e1",
+                                   "addresses": ["10.0.0.1/32"],
+                                   "mac": "aa:bb:cc:dd:ee:ff",
+                                   "profiles": ["PROF"],
+                                   "state": "active"})
+
+    @parameterized.expand([
+        ("jsonl", "null"),
+        ("tsv", ""),
+    ])
+    @patch("sys.stdout", new_callable=StringIO)
+    @patch("calico_ctl.endpoint.client", autospec=True)
+    def test_endpoint_show_no_mac(self, output, expected, m_client,
+                                  m_stdout):
+        """
+        Test an endpoint without a MAC is shown with a null MAC in jsonl and
+        an empty field in tsv, rather than "None".
+        """
+        ep = self._mock_endpoint("host1", "w1", "e1")
+        ep.mac = None
+        self._mock_hosts(m_client, [ep])
+
+        endpoint.endpoint_show(None, None, None, None, True, output=output)
+
+        line = m_stdout.getvalue().splitlines()[-1]
+        if output == "jsonl":
+            self.assertIn('"mac": %s' % expected, line)
+        else:
+            self.assertEqual(line.split("\t")[5], expected)
+        self.assertNotIn("None", line)
+
+    @patch("sys.stderr", new_callable=StringIO)
+    @patch("sys.stdout", new_callable=StringIO)
+    @patch("calico_ctl.endpoint.client", autospec=True)
+    def test_endpoint_show_continue(self, m_client, m_stdout, m_stderr):
+        """
+        Test paging through the endpoint summary with --limit and --continue.
+        """
+        self._mock_hosts(m_client, [self._mock_endpoint("host1", "w1", "e1"),
+                                    self._mock_endpoint("host1", "w1", "e2"),
+                                    self._mock_endpoint("host2", "w3", "e3"),
+                                    self._mock_endpoint("host3", "w4", "e4")])
+
+        endpoint.endpoint_show(None, None, None, None, False, output="tsv",
+                               limit=2)
+        self.assertEqual(m_stdout.getvalue().splitlines(),
+                         ["hostname\torchestrator_id\tnum_workloads\t"
+                          "num_endpoints",
+                          "host1\tdocker\t1\t2",
+                          "host2\tdocker\t1\t1"])
+        token = m_stderr.getvalue().rsplit("--continue=", 1)[1].strip()
+
+        m_stdout.truncate(0)
+        m_stderr.truncate(0)
+        m_client.get_endpoints.reset_mock()
+        endpoint.endpoint_show(None, None, None, None, False, output="tsv",
+                               continue_key=endpoint._decode_continue_token(
+                                                                    token))
+
+        # Hosts before the last row shown are not read again.
+        self.assertEqual([kwargs["hostname"] for _, kwargs in
+                          m_client.get_endpoints.call_args_list],
+                         ["host2", "host3"])
+        self.assertEqual(m_stdout.getvalue().splitlines()[1:],
+                         ["host3\tdocker\t1\t1"])
+        self.assertEqual(m_stderr.getvalue(), "")
+
+    @parameterized.expand([
+        ({"--output": "xml"}, True),
+        ({"--output": "jsonl"}, False),
+        ({"--limit": "0"}, True),
+        ({"--limit": "10"}, False),
+        ({"--continue": "not-a-token"}, True),
+        ({"--continue": endpoint._encode_continue_token(["host1", "docker"])},
+         False),
+    ])
+    def test_validate_show_arguments(self, case, sys_exit_called):
+        """
+        Test validate_arguments for the calicoctl endpoint show options
+        """
+        with patch('sys.exit', autospec=True) as m_sys_exit:
+            endpoint.validate_arguments(case)
+            self.assertEqual(m_sys_exit.called, sys_exit_called)
+
+
+class TestEndpointIndex(unittest.TestCase):
+
+    @patch("calico_ctl.endpoint_index.client", autospec=True)
+    def test_resolve_workload(self, m_client):
+        """
+        Test resolving a workload ID only succeeds if it identifies a single
+        endpoint matching the supplied filters.
+        """
+        leaves = [Mock(dir=False,
+                       key=endpoint_index.INDEX_PATH + "workload/wid/" + eid,
+                       value=json.dumps({"hostname": host,
+                                         "orchestrator_id": "docker",
+                                         "workload_id": "wid"}))
+                  for host, eid in (("host1", "eid1"), ("host2", "eid2"))]
+        m_client.etcd_client.read.return_value = Mock(leaves=leaves)
+
+        self.assertIsNone(endpoint_index.resolve(None, None, "wid", None))
+        self.assertEqual(endpoint_index.resolve("host2", None, "wid", None),
+                         ("host2", "docker", "wid", "eid2"))
+
+    @patch("calico_ctl.endpoint_index.client", autospec=True)
+    def test_resolve_not_indexed(self, m_client):
+        """
+        Test resolving an endpoint which is not in the index.
+        """
+        m_client.etcd_client.read.side_effect = EtcdKeyNotFound
+        self.assertIsNone(endpoint_index.resolve(None, None, None, "eid"))
@@ -0,0 +1,161 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import unittest
+
+from mock import patch, Mock
+from netaddr import IPAddress, IPNetwork
+from nose_parameterized import parameterized
+from pycalico.datastore_datatypes import IPPool
+
+from calico_ctl import ipam
+
+BLOCK_1 = {"cidr": "10.0.0.0/26",
+           "affinity": "host:host1",
+           "allocations": [0, 1, None, 0, 2] + [None] * 59,
+           "attributes": [{"handle_id": None},
+                          {"handle_id": "calicoctl-reservation-host1"},
+                          {"handle_id": "other"}]}
+BLOCK_2 = {"cidr": "10.0.0.64/26",
+           "allocations": [None, 0] + [None] * 62,
+           "attributes": [{"handle_id": None}]}
+BLOCK_3 = {"cidr": "10.0.0.128/26",
+           "affinity": "host:host2",
+           "allocations": [None] * 64,
+           "attributes": []}
+
+
+class TestIpam(unittest.TestCase):
+
+    @parameterized.expand([
+        ({'<IP>': '10.0.0.1'}, False),
+        ({'<IP>': 'fd80::1'}, False),
+        ({'<IP>': '10.0.0.256'}, True),
+        ({'--pool': '10.0.0.0/16'}, False),
+        ({'--pool': '10.0.0.0/33'}, True),
+        ({'--grace': '0'}, False),
+        ({'--grace': '-1'}, True),
+        ({'--grace': 'soon'}, True),
+    ])
+    def test_validate_arguments(self, case, sys_exit_called):
+        """
+        Test validate_arguments for calicoctl ipam
+        """
+        with patch('sys.exit', autospec=True) as m_sys_exit:
+            ipam.validate_arguments(case)
+            self.assertEqual(m_sys_exit.called, sys_exit_called)
+
+    def setup_datastore(self, m_client, m_get_hostnames, blocks):
+        m_get_hostnames.return_value = ["host1"]
+        m_client.get_endpoints.return_value = [
+            Mock(ipv4_nets={IPNetwork("10.0.0.0/32")}, ipv6_nets=set())]
+        m_client.get_per_host_config.return_value = "10.0.0.65"
+        m_client.get_ip_pools.side_effect = \
+            lambda version: [IPPool("10.0.0.0/16")] if version == 4 else []
+        m_client.release_ips.return_value = set()
+
+        values = dict(("/blocks/%s" % block["cidr"], json.dumps(block))
+                      for block in blocks)
+
+        def read(path, recursive=False):
+            self.assertFalse(recursive)
+            if path in values:
+                return Mock(value=values[path])
+            if "ipv4" not in path:
+                raise ipam.EtcdKeyNotFound()
+            return Mock(leaves=[Mock(dir=False, key=key)
+                                for key in sorted(values)])
+        m_client.etcd_client.read.side_effect = read
+
+    @patch('calico_ctl.ipam.time', autospec=True)
+    @patch('calico_ctl.ipam.get_hostnames', autospec=True)
+    @patch('calico_ctl.ipam.client', autospec=True)
+    def test_gc(self, m_client, m_get_hostnames, m_time):
+        """
+        Test gc releases addresses which are not used by endpoints, tunnels
+        or reservations, one block at a time.
+        """
+        self.setup_datastore(m_client, m_get_hostnames, [BLOCK_1, BLOCK_2])
+
+        ipam.gc(False, 60)
+
+        m_time.sleep.assert_called_once_with(60)
+        self.assertEqual(m_client.release_ips.call_args_list,
+                         [((set([IPAddress("10.0.0.3"),
+                                 IPAddress("10.0.0.4")]),), {})])
+
+    @patch('calico_ctl.ipam.time', autospec=True)
+    @patch('calico_ctl.ipam.get_hostnames', autospec=True)
+    @patch('calico_ctl.ipam.client', autospec=True)
+    def test_gc_grace(self, m_client, m_get_hostnames, m_time):
+        """
+        Test gc does not release addresses which come into use during the
+        grace period.
+        """
+        self.setup_datastore(m_client, m_get_hostnames, [BLOCK_1])
+
+        def sleep(grace):
+            m_client.get_endpoints.return_value = [
+                Mock(ipv4_nets={IPNetwork("10.0.0.0/32"),
+                                IPNetwork("10.0.0.3/32")},
+                     ipv6_nets=set())]
+        m_time.sleep.side_effect = sleep
+
+        ipam.gc(False, 60)
+
+        m_client.release_ips.assert_called_once_with({IPAddress("10.0.0.4")})
+
+    @patch('calico_ctl.ipam.time', autospec=True)
+    @patch('calico_ctl.ipam.get_hostnames', autospec=True)
+    @patch('calico_ctl.ipam.client', autospec=True)
+    def test_gc_dry_run(self, m_client, m_get_hostnames, m_time):
+        """
+        Test gc --dry-run does not release anything.
+        """
+        self.setup_datastore(m_client, m_get_hostnames, [BLOCK_1, BLOCK_2])
+
+        ipam.gc(True, 60)
+
+        self.assertFalse(m_time.sleep.called)
+        self.assertFalse(m_client.release_ips.called)
+
+    @patch('calico_ctl.ipam.get_hostnames', autospec=True)
+    @patch('calico_ctl.ipam.client', autospec=True)
+    def test_show(self, m_client, m_get_hostnames):
+        """
+        Test show counts the assigned addresses and blocks of each pool and
+        host.
+        """
+        self.setup_datastore(m_client, m_get_hostnames,
+                             [BLOCK_1, BLOCK_2, BLOCK_3])
+
+        with patch('calico_ctl.ipam.PrettyTable', autospec=True) as m_table:
+            ipam.show(None, True)
+
+        rows = [call[0][0] for call in
+                m_table.return_value.add_row.call_args_list]
+        self.assertEqual(rows[0], ["10.0.0.0/16", "5/65536", "0.0%", 3, 1,
+                                   1021, "97.4%"])
+        self.assertEqual(sorted(rows[1:]),
+                         [["(none)", 1, 1, 63],
+                          ["host1", 1, 4, 60],
+                          ["host2", 1, 0, 64]])
+
+    @patch('calico_ctl.ipam.client', autospec=True)
+    def test_show_not_a_pool(self, m_client):
+        """
+        Test show exits if the pool is not configured.
+        """
+        m_client.get_ip_pools.return_value = []
+        self.assertRaises(SystemExit, ipam.show, "10.0.0.0/16", False)
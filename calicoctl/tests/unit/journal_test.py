@@ -0,0 +1,233 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from mock import patch, Mock
+from netaddr import IPAddress, IPNetwork
+
+from calico_ctl import dispatcher, journal
+
+ADD_DATA = {"hostname": "host",
+            "orchestrator_id": "docker",
+            "workload_id": "wid",
+            "endpoint_id": "eid",
+            "veth": "calieid"}
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        patchers = [
+            patch('calico_ctl.journal.JOURNAL_DIR', self.tmpdir),
+            patch('calico_ctl.journal.client', autospec=True),
+            patch('calico_ctl.journal.netns', autospec=True),
+            patch('calico_ctl.journal.endpoint_index', autospec=True),
+        ]
+        self.m_client, self.m_netns, self.m_endpoint_index = \
+            [patcher.start() for patcher in patchers][1:]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def leave_operation(self, op_type, data, steps):
+        """
+        Leave an operation in the journal, as if calicoctl had been killed.
+        """
+        op = journal.Operation(op_type, data)
+        for step, step_data in steps:
+            op.record(step, **step_data)
+        op.abandon()
+
+    def test_operation_complete(self):
+        """
+        Test a completed operation is removed from the journal.
+        """
+        with journal.operation(journal.CONTAINER_ADD, **ADD_DATA) as op:
+            op.record("ip", ip="10.0.0.1")
+            self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertFalse(self.m_client.release_ips.called)
+
+    def test_operation_interrupted(self):
+        """
+        Test an interrupted container add is rolled back straight away.
+        """
+        def interrupted():
+            with journal.operation(journal.CONTAINER_ADD, **ADD_DATA) as op:
+                op.record("ip", ip="10.0.0.1")
+                raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, interrupted)
+
+        self.m_netns.remove_veth.assert_called_once_with("calieid")
+        self.m_client.release_ips.assert_called_once_with(
+                                                {IPAddress("10.0.0.1")})
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_operation_sigint(self):
+        """
+        Test a container add interrupted by SIGINT (e.g. Ctrl-C) is rolled
+        back, rather than being treated as complete.
+        """
+        old_handler = signal.signal(signal.SIGINT,
+                                    dispatcher.interrupt_handler)
+        self.addCleanup(signal.signal, signal.SIGINT, old_handler)
+
+        def interrupted():
+            with journal.operation(journal.CONTAINER_ADD, **ADD_DATA) as op:
+                op.record("ip", ip="10.0.0.1")
+                os.kill(os.getpid(), signal.SIGINT)
+                self.fail("Not interrupted")
+        self.assertRaises(KeyboardInterrupt, interrupted)
+
+        self.m_netns.remove_veth.assert_called_once_with("calieid")
+        self.m_client.release_ips.assert_called_once_with(
+                                                {IPAddress("10.0.0.1")})
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_operation_recovered_before_locked(self):
+        """
+        Test an operation whose new journal file is removed by a concurrent
+        recovery, before the operation locks it, starts again with a new
+        file.
+        """
+        real_flock = journal.fcntl.flock
+        recovered = []
+
+        def flock(f, operation):
+            if not recovered:
+                # Another command's recovery runs before we lock the file.
+                recovered.append(True)
+                journal.recover()
+            real_flock(f, operation)
+
+        with patch('calico_ctl.journal.fcntl.flock', side_effect=flock):
+            with journal.operation(journal.CONTAINER_ADD, **ADD_DATA) as op:
+                op.record("ip", ip="10.0.0.1")
+                self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertFalse(self.m_client.release_ips.called)
+
+    def test_recover_container_add_rolled_forward(self):
+        """
+        Test a container add which created its endpoint is completed.
+        """
+        self.leave_operation(journal.CONTAINER_ADD, ADD_DATA,
+                             [("ip", {"ip": "10.0.0.1"}), ("endpoint", {})])
+        m_endpoint = Mock()
+        self.m_client.get_endpoint.return_value = m_endpoint
+
+        self.assertEqual(journal.recover(), 1)
+
+        self.m_endpoint_index.index_endpoint.assert_called_once_with(
+                                                                m_endpoint)
+        self.assertFalse(self.m_netns.remove_veth.called)
+        self.assertFalse(self.m_client.release_ips.called)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_recover_container_remove(self):
+        """
+        Test an incomplete container remove is finished, without releasing
+        the IPs of endpoints that were already released.
+        """
+        endpoints = [dict(ADD_DATA, endpoint_id="eid1", veth="calieid1",
+                          ips=["10.0.0.1"]),
+                     dict(ADD_DATA, endpoint_id="eid2", veth="calieid2",
+                          ips=["10.0.0.2"])]
+        self.leave_operation(journal.CONTAINER_REMOVE,
+                             {"hostname": "host", "orchestrator_id": "docker",
+                              "workload_id": "wid", "endpoints": endpoints},
+                             [("released-eid1", {})])
+
+        self.assertEqual(journal.recover(), 1)
+
+        self.m_client.release_ips.assert_called_once_with(
+                                                {IPAddress("10.0.0.2")})
+        self.assertEqual(self.m_netns.remove_veth.call_count, 2)
+        self.assertEqual(self.m_endpoint_index.unindex_endpoint.call_count, 2)
+        self.m_client.remove_workload.assert_called_once_with(
+                                                    "host", "docker", "wid")
+
+    def test_recover_container_add_many(self):
+        """
+        Test an incomplete container add-many rolls back each container
+        whose address was assigned, unless its endpoint was created or its
+        address was already released.
+        """
+        endpoints = [dict(ADD_DATA, workload_id="w%d" % i,
+                          endpoint_id="e%d" % i, veth="calie%d" % i)
+                     for i in range(4)]
+        self.leave_operation(
+            journal.CONTAINER_ADD_MANY, {"endpoints": endpoints},
+            [("ips-e0", {"ips": {"e0": "10.0.0.0", "e1": "10.0.0.1"}}),
+             ("ips-e2", {"ips": {"e2": "10.0.0.2"}}),
+             ("endpoint-e0", {}),
+             ("released-e2", {})])
+        m_endpoint = Mock()
+        self.m_client.get_endpoint.return_value = m_endpoint
+
+        self.assertEqual(journal.recover(), 1)
+
+        self.m_endpoint_index.index_endpoint.assert_called_once_with(
+                                                                m_endpoint)
+        self.m_netns.remove_veth.assert_called_once_with("calie1")
+        self.m_client.release_ips.assert_called_once_with(
+                                                {IPAddress("10.0.0.1")})
+
+    def test_recover_container_ip_add(self):
+        """
+        Test an incomplete container IP add is rolled back.
+        """
+        self.leave_operation(journal.CONTAINER_IP_ADD,
+                             {"hostname": "host", "orchestrator_id": "docker",
+                              "workload_id": "wid"},
+                             [("ip", {"ip": "10.0.0.1"}), ("endpoint", {})])
+        m_endpoint = Mock(ipv4_nets={IPNetwork("10.0.0.1/32"),
+                                     IPNetwork("10.0.0.2/32")})
+        self.m_client.get_endpoint.return_value = m_endpoint
+
+        self.assertEqual(journal.recover(), 1)
+
+        self.assertEqual(m_endpoint.ipv4_nets, {IPNetwork("10.0.0.2/32")})
+        self.m_client.update_endpoint.assert_called_once_with(m_endpoint)
+        self.m_client.release_ips.assert_called_once_with(
+                                                {IPAddress("10.0.0.1")})
+
+    def test_recover_skips_running_operation(self):
+        """
+        Test recovery does not touch an operation that is still running.
+        """
+        with journal.operation(journal.CONTAINER_ADD, **ADD_DATA) as op:
+            op.record("ip", ip="10.0.0.1")
+            self.assertEqual(journal.recover(), 0)
+            self.assertFalse(self.m_client.release_ips.called)
+            self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+
+    def test_recover_partial_step(self):
+        """
+        Test a step that was only partly written is ignored.
+        """
+        self.leave_operation(journal.CONTAINER_ADD, ADD_DATA, [])
+        path = os.path.join(self.tmpdir, os.listdir(self.tmpdir)[0])
+        with open(path, "a") as journal_file:
+            journal_file.write('{"step": "ip", "da')
+
+        self.assertEqual(journal.recover(), 1)
+
+        self.m_netns.remove_veth.assert_called_once_with("calieid")
+        self.assertFalse(self.m_client.release_ips.called)
@@ -0,0 +1,132 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, Mock
+from netaddr import IPAddress, IPNetwork
+
+from calico_ctl import migration
+
+FROM_CIDR = IPNetwork("10.0.0.0/16")
+TO_CIDR = IPNetwork("10.1.0.0/16")
+
+
+def make_endpoint(workload_id, ips, orchestrator_id="docker"):
+    return Mock(hostname="host", orchestrator_id=orchestrator_id,
+                workload_id=workload_id, endpoint_id="e" + workload_id,
+                ipv4_nets=set(IPNetwork(ip) for ip in ips), ipv6_nets=set())
+
+
+class TestMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        patchers = [
+            patch('calico_ctl.migration.CHECKPOINT_DIR', self.tmpdir),
+            patch('calico_ctl.migration.hostname', "host"),
+            patch('calico_ctl.migration.client', autospec=True),
+            patch('calico_ctl.migration.container', autospec=True),
+            patch('calico_ctl.migration.get_hostnames', autospec=True),
+        ]
+        self.m_client, self.m_container, self.m_get_hostnames = \
+            [patcher.start() for patcher in patchers][2:]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.checkpoint_path = os.path.join(
+            self.tmpdir, "pool-migrate-10.0.0.0-16-10.1.0.0-16.json")
+
+    def test_plan(self):
+        """
+        Test plan counts the containers, addresses and blocks to migrate on
+        each host.
+        """
+        self.m_get_hostnames.return_value = ["host1", "host2"]
+        endpoints = {
+            "host1": [make_endpoint("w1", ["10.0.0.1", "10.0.0.70"]),
+                      make_endpoint("w2", ["10.0.0.2"]),
+                      make_endpoint("w3", ["10.0.0.3"], "libnetwork"),
+                      make_endpoint("w4", ["10.2.0.1"])],
+            "host2": [make_endpoint("w5", ["10.2.0.2"])],
+        }
+        self.m_client.get_endpoints.side_effect = \
+            lambda hostname: endpoints[hostname]
+
+        self.assertEqual(migration.plan(FROM_CIDR), {"host1": (2, 3, 2, 1)})
+
+    def test_migrate(self):
+        """
+        Test migrate moves each address by adding a new address and removing
+        the old one, and removes the checkpoint when complete.
+        """
+        self.m_client.get_endpoints.return_value = [
+            make_endpoint("w1", ["10.0.0.1", "10.0.0.2"]),
+            make_endpoint("w2", ["10.0.0.3"], "namespace")]
+        self.m_client.get_endpoint.return_value = make_endpoint("w1", [])
+        self.m_container.container_ip_add.side_effect = \
+            [IPAddress("10.1.0.1"), IPAddress("10.1.0.2")]
+
+        self.assertEqual(
+            migration.migrate(FROM_CIDR, TO_CIDR, "eth1", 1000, 10), (2, 0))
+
+        self.assertEqual(self.m_container.container_ip_add.call_count, 2)
+        self.m_container.container_ip_add.assert_called_with(
+                                                "w1", "10.1.0.0/16", "eth1")
+        self.assertEqual(
+            [call[0] for call in
+             self.m_container.container_ip_remove.call_args_list],
+            [("w1", "10.0.0.1", "eth1"), ("w1", "10.0.0.2", "eth1")])
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_migrate_resume(self):
+        """
+        Test an interrupted migration resumes without adding addresses that
+        were added before it was interrupted.
+        """
+        with open(self.checkpoint_path, "w") as f:
+            json.dump({"w1": {"before": ["10.1.0.9"],
+                              "moved": {"10.0.0.1": "10.1.0.1"}}}, f)
+        self.m_client.get_endpoints.return_value = [
+            make_endpoint("w1", ["10.0.0.1", "10.0.0.2", "10.1.0.1",
+                                 "10.1.0.2", "10.1.0.9"])]
+        self.m_client.get_endpoint.return_value = \
+            self.m_client.get_endpoints.return_value[0]
+
+        self.assertEqual(
+            migration.migrate(FROM_CIDR, TO_CIDR, "eth1", 1000, 10), (2, 0))
+
+        self.assertFalse(self.m_container.container_ip_add.called)
+        self.assertEqual(self.m_container.container_ip_remove.call_count, 2)
+
+    def test_migrate_failure(self):
+        """
+        Test a failed container leaves the checkpoint for a later retry.
+        """
+        self.m_client.get_endpoints.return_value = [
+            make_endpoint("w1", ["10.0.0.1"])]
+        self.m_client.get_endpoint.return_value = make_endpoint("w1", [])
+        self.m_container.container_ip_add.return_value = IPAddress("10.1.0.1")
+        self.m_container.container_ip_remove.side_effect = SystemExit(1)
+
+        self.assertEqual(
+            migration.migrate(FROM_CIDR, TO_CIDR, "eth1", 1000, 10), (0, 1))
+
+        with open(self.checkpoint_path) as f:
+            self.assertEqual(json.load(f),
+                             {"w1": {"before": [],
+                                     "moved": {"10.0.0.1": "10.1.0.1"}}})
@@ -33,8 +33,11 @@ from pycalico.datastore import (ETCD_AUTHORITY_DEFAULT, ETCD_SCHEME_DEFAULT,
 from calico_ctl import node
 from calico_ctl.node import (ETCD_CA_CERT_NODE_FILE, ETCD_CERT_NODE_FILE,
                              ETCD_KEY_NODE_FILE, CALICO_NETWORKING_DEFAULT)
+from calico_ctl.reservations import RESERVATIONS_ENV
 import calico_ctl
 from pycalico.datastore_datatypes import IPPool
+from pycalico.datastore_errors import DataStoreError
+from subprocess32 import PIPE
 
 
 class TestAttachAndStream(unittest.TestCase):
@@ -228,8 +231,8 @@ class TestNode(unittest.TestCase):
         m_check_system.assert_called_once_with(quit_if_error=False,
                                                libnetwork=libnetwork,
                                                check_docker=False,
-                                               check_modules=True
-                                               )
+                                               check_modules=True,
+                                               use_cache=True)
         m_setup_ip.assert_called_once_with()
 
         self.assertFalse(m_docker_client.remove_container.called)
@@ -328,7 +331,8 @@ class TestNode(unittest.TestCase):
         m_check_system.assert_called_once_with(quit_if_error=False,
                                                libnetwork=libnetwork,
                                                check_docker=True,
-                                               check_modules=True)
+                                               check_modules=True,
+                                               use_cache=True)
         m_setup_ip.assert_called_once_with()
 
         m_docker_client.remove_container.assert_called_once_with(
@@ -400,7 +404,8 @@ class TestNode(unittest.TestCase):
                ETCD_SCHEME_ENV: "https",
                ETCD_CA_CERT_FILE_ENV: etcd_ca_path,
                ETCD_CERT_FILE_ENV: etcd_cert_path,
-               ETCD_KEY_FILE_ENV: etcd_key_path}
+               ETCD_KEY_FILE_ENV: etcd_key_path,
+               RESERVATIONS_ENV: "0"}
         def m_getenv(env_var, *args, **kwargs):
             return env[env_var]
         m_os_getenv.side_effect = m_getenv
@@ -470,7 +475,8 @@ class TestNode(unittest.TestCase):
         m_check_system.assert_called_once_with(quit_if_error=False,
                                                libnetwork=libnetwork_image,
                                                check_docker=True,
-                                               check_modules=True)
+                                               check_modules=True,
+                                               use_cache=True)
         m_setup_ip.assert_called_once_with()
 
         m_docker_client.remove_container.assert_has_calls([
@@ -645,10 +651,13 @@ class TestNode(unittest.TestCase):
             # Call method under test expecting an exception
             self.assertRaises(APIError, node.node_stop, True)
 
-    @patch('calico_ctl.node.remove_veth', autospec=True)
+    @patch('calico_ctl.node.reselect_route_reflectors', autospec=True)
+    @patch('calico_ctl.node.endpoint_index', autospec=True)
+    @patch('calico_ctl.node._remove_veths', autospec=True)
     @patch('calico_ctl.node._container_running', autospec=True, return_value=False)
     @patch('calico_ctl.node.client', autospec=True)
-    def test_node_remove(self, m_client, m_cont_running, m_veth):
+    def test_node_remove(self, m_client, m_cont_running, m_veth,
+                         m_endpoint_index, m_reselect):
         """
         Test the client removes the host when node_remove called, and that
         endpoints are removed when remove_endpoints flag is set.
@@ -667,14 +676,21 @@ class TestNode(unittest.TestCase):
 
         # Assert
         m_client.get_endpoints.assert_called_once_with(hostname=node.hostname)
-        m_client.release_ips.assert_called_once_with({IPAddress("1.2.3.4"),
-                                                      IPAddress("aa:bb::cc")})
+        m_client.release_ips.assert_has_calls([call({IPAddress("1.2.3.4")}),
+                                               call({IPAddress("aa:bb::cc")})],
+                                              any_order=True)
+        self.assertEqual(m_client.release_ips.call_count, 2)
+        m_endpoint_index.unindex_endpoint.assert_has_calls(
+                            [call(endpoint1), call(endpoint2)], any_order=True)
+        m_client.release_ip_by_handle.assert_called_once_with(
+                            "calicoctl-reservation-%s" % node.hostname)
         m_client.remove_ipam_host.assert_called_once_with(node.hostname)
-        m_veth.assert_has_calls([call("vethname1"), call("vethname2")])
+        m_veth.assert_called_once_with(["vethname1", "vethname2"])
         m_cont_running.assert_has_calls([call("calico-node"), call("calico-libnetwork")])
         m_client.remove_host.assert_called_once_with(node.hostname)
+        m_reselect.assert_called_once_with(node.hostname)
 
-    @patch('calico_ctl.node.remove_veth', autospec=True)
+    @patch('calico_ctl.node._remove_veths', autospec=True)
     @patch('calico_ctl.node._container_running', autospec=True, return_value=True)
     @patch('calico_ctl.node.client', autospec=True)
     def test_node_remove_node_running(self, m_client, m_cont_running, m_veth):
@@ -688,7 +704,7 @@ class TestNode(unittest.TestCase):
         self.assertEquals(m_client.remove_host.call_count, 0)
         self.assertEquals(m_veth.call_count, 0)
 
-    @patch('calico_ctl.node.remove_veth', autospec=True)
+    @patch('calico_ctl.node._remove_veths', autospec=True)
     @patch('calico_ctl.node._container_running', autospec=True, return_value=False)
     @patch('calico_ctl.node.client', autospec=True)
     def test_node_remove_endpoints_exist(self, m_client, m_cont_running, m_veth):
@@ -705,10 +721,13 @@ class TestNode(unittest.TestCase):
         self.assertEquals(m_client.remove_host.call_count, 0)
         self.assertEquals(m_veth.call_count, 0)
 
-    @patch('calico_ctl.node.remove_veth', autospec=True)
+    @patch('calico_ctl.node.reselect_route_reflectors', autospec=True)
+    @patch('calico_ctl.node.endpoint_index', autospec=True)
+    @patch('calico_ctl.node._remove_veths', autospec=True)
     @patch('calico_ctl.node._container_running', autospec=True, return_value=False)
     @patch('calico_ctl.node.client', autospec=True)
-    def test_node_remove_specific_host(self, m_client, m_cont_running, m_veth):
+    def test_node_remove_specific_host(self, m_client, m_cont_running, m_veth,
+                                       m_endpoint_index, m_reselect):
         """
         Test the client removes the specific host when node_remove called, and
         that endpoints are removed when remove_endpoints flag is set.
@@ -732,7 +751,62 @@ class TestNode(unittest.TestCase):
         m_client.release_ips.assert_called_once_with({IPAddress("1.2.3.4")})
         m_client.remove_ipam_host.assert_called_once_with("other-host")
         m_client.remove_host.assert_called_once_with("other-host")
-        m_veth.assert_has_calls([call("vethname1"), call("vethname2")])
+        m_reselect.assert_called_once_with("other-host")
+        m_veth.assert_called_once_with(["vethname1", "vethname2"])
+
+    @patch('calico_ctl.node.endpoint_index', autospec=True)
+    @patch('calico_ctl.node._remove_veths', autospec=True)
+    @patch('calico_ctl.node._container_running', autospec=True, return_value=False)
+    @patch('calico_ctl.node.client', autospec=True)
+    def test_node_remove_release_fails(self, m_client, m_cont_running,
+                                       m_veth, m_endpoint_index):
+        """
+        Test the host is not removed if the IPs in a block cannot be
+        released, so that the command can be re-run.
+        """
+        endpoint1 = Mock()
+        endpoint1.name = "vethname1"
+        endpoint1.ipv4_nets = {IPNetwork("1.2.3.4/32"),
+                               IPNetwork("1.2.3.5/32"),
+                               IPNetwork("5.6.7.8/32")}
+        endpoint1.ipv6_nets = set()
+        m_client.get_endpoints.return_value = [endpoint1]
+
+        def release_ips(ips):
+            if IPAddress("5.6.7.8") in ips:
+                raise DataStoreError("Failed")
+            return set()
+        m_client.release_ips.side_effect = release_ips
+
+        self.assertRaises(SystemExit, node.node_remove, True, False)
+
+        # The addresses are released one block at a time.
+        m_client.release_ips.assert_has_calls(
+                    [call({IPAddress("1.2.3.4"), IPAddress("1.2.3.5")}),
+                     call({IPAddress("5.6.7.8")})], any_order=True)
+        self.assertFalse(m_client.remove_ipam_host.called)
+        self.assertFalse(m_client.remove_host.called)
+
+    @patch('calico_ctl.node.remove_veth', autospec=True)
+    @patch('calico_ctl.node.check_output', autospec=True)
+    @patch('calico_ctl.node.Popen', autospec=True)
+    def test_remove_veths(self, m_popen, m_check_output, m_remove_veth):
+        """
+        Test veths are removed in a single ip batch, and any left over are
+        removed individually.
+        """
+        m_popen.return_value.communicate.return_value = ("", "")
+        m_check_output.return_value = \
+            "1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536\n" \
+            "7: vethname2@if6: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n"
+
+        node._remove_veths(["vethname1", "vethname2"])
+
+        m_popen.assert_called_once_with(["ip", "-force", "-batch", "-"],
+                                        stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        m_popen.return_value.communicate.assert_called_once_with(
+            "link del vethname1\nlink del vethname2\n")
+        m_remove_veth.assert_called_once_with("vethname2")
 
     @patch('calico_ctl.node.client')
     def test_node_show(self, m_client):
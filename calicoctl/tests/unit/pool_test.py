@@ -12,8 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from StringIO import StringIO
 
+from etcd import EtcdWatchTimedOut
 from mock import patch, Mock
 from nose_parameterized import parameterized
 from netaddr import IPNetwork
@@ -42,6 +48,16 @@ class TestPool(unittest.TestCase):
           '<END_IP>':'1.2.3.1'}, True),
         ({'range':1, 'add':1, '<START_IP>':'1.2.3.255',
           '<END_IP>':'aaaa::'}, True),
+        ({'add':1, '--file':'pools.txt', '--parallelism':'10'}, False),
+        ({'add':1, '--file':'pools.txt', '--parallelism':'0'}, True),
+        ({'migrate':1, '<FROM_CIDR>':'10.0.0.0/16',
+          '<TO_CIDR>':'10.1.0.0/16', '--rate':'10'}, False),
+        ({'migrate':1, '<FROM_CIDR>':'10.0.0.0/16',
+          '<TO_CIDR>':'10.0.0.0/16', '--rate':'10'}, True),
+        ({'migrate':1, '<FROM_CIDR>':'10.0.0.0/16',
+          '<TO_CIDR>':'fd80::/64', '--rate':'10'}, True),
+        ({'migrate':1, '<FROM_CIDR>':'10.0.0.0/16',
+          '<TO_CIDR>':'10.1.0.0/16', '--rate':'0'}, True),
     ])
     def test_validate_arguments(self, case, sys_exit_called):
         """
@@ -78,12 +94,14 @@ class TestPool(unittest.TestCase):
 
             self.assertTrue(m_sys_exit.called)
 
-    @patch("time.sleep")
+    @patch("calico_ctl.pool._wait_for_pools_to_drain", autospec=True)
     @patch("calico_ctl.pool.client", autospec=True)
-    def test_ip_pool_remove(self, m_client, m_sleep):
+    def test_ip_pool_remove(self, m_client, m_wait):
         """
         Test mainline function of ip_pool_remove.
         """
+        m_wait.return_value = True
+        m_client.etcd_client.read.return_value = Mock(etcd_index=7)
         net1 = IPNetwork("1.2.3.0/24")
         m_client.remove_ip_pool.side_effect = HostAffinityClaimedError
 
@@ -97,6 +115,137 @@ class TestPool(unittest.TestCase):
         self.assertEqual(m_pool.disabled, True)
         m_client.release_pool_affinities.assert_called_once_with(m_pool)
         m_client.remove_ip_pool.assert_called_once_with(4, net1.ip)
+        m_wait.assert_called_once_with([m_pool], 4, 10, 7)
+
+    @patch("calico_ctl.pool.run_in_background", autospec=True)
+    @patch("calico_ctl.pool._wait_for_pools_to_drain", autospec=True)
+    @patch("calico_ctl.pool.client", autospec=True)
+    def test_ip_pool_remove_async(self, m_client, m_wait, m_background):
+        """
+        Test ip_pool_remove --async disables the pools and leaves removing
+        them to a background process.
+        """
+        pools = [IPPool("1.2.3.0/24"), IPPool("1.2.4.0/24")]
+        m_client.get_ip_pool_config.side_effect = pools
+        m_client.etcd_client.read.return_value = Mock(etcd_index=7)
+
+        pool.ip_pool_remove(["1.2.3.0/24", "1.2.4.0/24"], 4, True, 10)
+
+        self.assertTrue(all(p.disabled for p in pools))
+        self.assertEqual(m_client.set_ip_pool_config.call_count, 2)
+        m_background.assert_called_once_with(
+            pool._remove_disabled_pools_in_child, pools, 4, 10, 7)
+        self.assertFalse(m_wait.called)
+        self.assertFalse(m_client.remove_ip_pool.called)
+
+    def block_listing(self, affinities):
+        """
+        Return a read of the IPv4 block directory, holding a block with each
+        of the given CIDRs and affinities.
+        """
+        return Mock(leaves=[
+            Mock(dir=False,
+                 key="/calico/ipam/v2/assignment/ipv4/block/%s" %
+                     cidr.replace("/", "-"),
+                 value=json.dumps({"cidr": cidr, "affinity": affinity}))
+            for cidr, affinity in affinities])
+
+    def block_event(self, cidr, affinity, index):
+        """
+        Return a watch event for a write of an IPv4 block.
+        """
+        return Mock(key="/calico/ipam/v2/assignment/ipv4/block/%s" %
+                        cidr.replace("/", "-"),
+                    value=json.dumps({"cidr": cidr, "affinity": affinity}),
+                    modifiedIndex=index)
+
+    def fake_datastore(self, m_client, m_time, events, listings):
+        """
+        Set up a fake clock, and a datastore which returns the given watch
+        events (None for a watch that times out) and block listings in turn.
+        """
+        clock = [0.0]
+
+        def sleep(secs):
+            clock[0] += secs
+
+        def read(path, recursive=False, wait=False, waitIndex=None,
+                 timeout=None):
+            if not wait:
+                return listings.pop(0)
+            event = events.pop(0)
+            if event is None:
+                sleep(timeout)
+                raise EtcdWatchTimedOut()
+            sleep(0.1)
+            return event
+        m_time.time.side_effect = lambda: clock[0]
+        m_time.sleep.side_effect = sleep
+        m_client.etcd_client.read.side_effect = read
+
+    @patch("calico_ctl.pool.time", autospec=True)
+    @patch("calico_ctl.pool.client", autospec=True)
+    def test_wait_for_pools_to_drain(self, m_client, m_time):
+        """
+        Test _wait_for_pools_to_drain watches the blocks from before the pools
+        were disabled until the pools' blocks are quiet, then releases their
+        affinities, backing off and waiting again if a block was claimed in
+        the meantime.  Other pools' blocks and released blocks are ignored.
+        """
+        pools = [IPPool("1.2.3.0/24")]
+        m_client.release_pool_affinities.side_effect = [
+            HostAffinityClaimedError(), None]
+        self.fake_datastore(
+            m_client, m_time,
+            events=[self.block_event("1.2.3.64/26", "host:host1", 11),
+                    self.block_event("9.9.9.0/26", "host:host1", 12),
+                    None,
+                    self.block_event("1.2.3.64/26", None, 14),
+                    None],
+            listings=[self.block_listing([("1.2.3.128/26", "host:host2"),
+                                          ("9.9.9.0/26", "host:host1")]),
+                      self.block_listing([("1.2.3.128/26", None),
+                                          ("9.9.9.0/26", "host:host1")])])
+
+        self.assertTrue(pool._wait_for_pools_to_drain(pools, 4, 10, 5))
+        self.assertEqual([c[1].get("waitIndex") for c in
+                          m_client.etcd_client.read.call_args_list
+                          if c[1].get("wait")],
+                         [6, 12, 13, 13, 15])
+        self.assertEqual(m_client.release_pool_affinities.call_args_list,
+                         [((pools[0],), {}), ((pools[0],), {})])
+        m_time.sleep.assert_called_once_with(pool.DRAIN_BACKOFF_SECS)
+
+    @patch("calico_ctl.pool.time", autospec=True)
+    @patch("calico_ctl.pool.client", autospec=True)
+    def test_wait_for_pools_to_drain_timeout(self, m_client, m_time):
+        """
+        Test _wait_for_pools_to_drain backs off between passes, and gives up
+        if blocks in the pools keep being claimed.
+        """
+        listing = self.block_listing([("1.2.3.64/26", "host:host1")])
+        self.fake_datastore(m_client, m_time, events=[None] * 20,
+                            listings=[listing] * 20)
+
+        self.assertFalse(pool._wait_for_pools_to_drain(
+                                            [IPPool("1.2.3.0/24")], 4, 10, 5))
+        self.assertEqual([c[0][0] for c in m_time.sleep.call_args_list],
+                         [0.5, 1, 2, 4, 4, 4, 4])
+
+    @patch("calico_ctl.pool.time", autospec=True)
+    @patch("calico_ctl.pool.client", autospec=True)
+    def test_wait_for_pools_to_drain_claims(self, m_client, m_time):
+        """
+        Test _wait_for_pools_to_drain gives up without releasing the
+        affinities if the pools' blocks are never quiet.
+        """
+        events = [self.block_event("1.2.3.64/26", "host:host1", index)
+                  for index in range(6, 6 + 400)]
+        self.fake_datastore(m_client, m_time, events=events, listings=[])
+
+        self.assertFalse(pool._wait_for_pools_to_drain(
+                                            [IPPool("1.2.3.0/24")], 4, 10, 5))
+        self.assertFalse(m_client.release_pool_affinities.called)
 
     @patch("calico_ctl.pool.client", autospec=True)
     def test_add_overlapping_existing_pool(self, m_client):
@@ -139,3 +288,94 @@ class TestPool(unittest.TestCase):
                              version=4, ipip=False, masquerade=False)
 
             self.assertTrue(m_sys_exit.called)
+
+    @patch("calico_ctl.pool.client", autospec=True)
+    def test_add_range_overlapping_pool(self, m_client):
+        """
+        Test ip_pool_range_add exits when the range overlaps an existing pool.
+        """
+        m_client.get_ip_pools.return_value = [IPPool("10.10.10.0/24"),
+                                              IPPool("10.10.12.0/24")]
+        self.assertRaises(SystemExit, pool.ip_pool_range_add,
+                          "10.10.11.0", "10.10.12.10", 4, False, False)
+        self.assertFalse(m_client.add_ip_pool.called)
+
+    @parameterized.expand([
+        ("10.0.0.0/24", None),
+        ("10.0.1.0/24", "10.0.1.0/26"),
+        ("10.0.1.128/25", "10.0.1.128/26"),
+        ("10.0.0.0/8", "10.0.1.0/26"),
+        ("10.0.2.0/24", None),
+        ("10.0.1.0/26", None),
+        ("10.2.0.0/15", None),
+        ("10.2.0.0/16", "10.2.0.0/15"),
+        ("10.3.2.0/24", "10.2.0.0/15"),
+        ("::/0", "fd80::/64"),
+    ])
+    def test_pool_index(self, cidr, overlapping_cidr):
+        """
+        Test PoolIndex finds the pool overlapping a CIDR, ignoring exact
+        matches.
+        """
+        index = pool.PoolIndex([IPPool("10.2.0.0/15"),
+                                IPPool("fd80::/64"),
+                                IPPool("10.0.1.0/26")])
+        index.add(IPPool("10.0.1.128/26"))
+        overlapping_pool = index.get_overlapping_pool(IPNetwork(cidr))
+        if overlapping_cidr is None:
+            self.assertIsNone(overlapping_pool)
+        else:
+            self.assertEqual(overlapping_pool.cidr, IPNetwork(overlapping_cidr))
+
+    @patch("calico_ctl.pool.client", autospec=True)
+    def test_add_file(self, m_client):
+        """
+        Test ip_pool_add_file adds every pool in the file, or none of them if
+        any is invalid.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "pools.txt")
+        m_client.get_ip_pools.side_effect = \
+            lambda version: [IPPool("10.10.0.0/16")] if version == 4 else []
+
+        with open(path, "w") as pool_file:
+            pool_file.write("# Pools\n10.11.0.0/16\n\nfd80::/64  # v6\n")
+        pool.ip_pool_add_file(path, False, True, 10)
+        self.assertEqual(sorted(m_client.add_ip_pool.call_args_list),
+                         [((4, IPPool("10.11.0.0/16", masquerade=True)), {}),
+                          ((6, IPPool("fd80::/64", masquerade=True)), {})])
+
+        m_client.add_ip_pool.reset_mock()
+        with open(path, "w") as pool_file:
+            pool_file.write("10.12.0.0/16\n10.10.1.0/24\nbad\n")
+        self.assertRaises(SystemExit, pool.ip_pool_add_file,
+                          path, False, False, 10)
+        self.assertFalse(m_client.add_ip_pool.called)
+
+    @patch('calico_ctl.pool.client', autospec=True)
+    def test_add_file_partial_failure(self, m_client):
+        """
+        Test ip_pool_add_file adds the other pools when adding one fails, and
+        reports the failure.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "pools.txt")
+        with open(path, "w") as pool_file:
+            pool_file.write("10.11.0.0/16\n10.12.0.0/16\n")
+        m_client.get_ip_pools.return_value = []
+
+        def add_ip_pool(version, new_pool):
+            if new_pool.cidr == IPNetwork("10.12.0.0/16"):
+                raise ValueError("datastore unavailable")
+        m_client.add_ip_pool.side_effect = add_ip_pool
+
+        with patch('sys.stdout', new=StringIO()) as m_stdout:
+            self.assertRaises(SystemExit, pool.ip_pool_add_file,
+                              path, False, False, 10)
+        self.assertEqual(m_client.add_ip_pool.call_count, 2)
+        self.assertEqual(m_stdout.getvalue(),
+                         "Added 1 pools\n"
+                         "Failed to add pool 10.12.0.0/16: "
+                         "datastore unavailable\n")
@@ -13,12 +13,15 @@
 # limitations under the License.
 
 import docker
+import json
 import unittest
+from StringIO import StringIO
 from mock import patch, Mock, call
 from nose_parameterized import parameterized
 from calico_ctl.bgp import *
 from calico_ctl.profile import validate_arguments, profile_rule_show,\
-    profile_rule_update, profile_rule_add_remove
+    profile_rule_update, profile_rule_add_remove, profile_show, \
+    profile_remove, _get_profile_members
 from pycalico.datastore_datatypes import Profile, Rules, Rule
 
 
@@ -449,3 +452,98 @@ class TestProfile(unittest.TestCase):
         self.assertRaises(SystemExit, profile_rule_add_remove,
                           operation, name, position, action, direction)
 
+
+    def _endpoint_leaves(self, m_client, m_get_hostnames, host_profiles):
+        """
+        Set up the endpoints read for each host, with the profile IDs of each
+        of their endpoints.
+        """
+        m_get_hostnames.return_value = sorted(host_profiles)
+
+        def read(path, recursive):
+            host = path.split("/")[4]
+            leaves = [Mock(dir=True, key=path + "docker/wid-%s" % host)]
+            for ii, profile_ids in enumerate(host_profiles[host]):
+                leaves.append(Mock(
+                    dir=False,
+                    key=path + "docker/wid-%s/endpoint/eid-%s-%s" %
+                        (host, host, ii),
+                    value=json.dumps({"profile_ids": profile_ids})))
+            # Other keys under the workload tree are skipped.
+            leaves.append(Mock(dir=False, key=path + "docker/wid-%s/other" %
+                                                 host, value="{}"))
+            return Mock(leaves=leaves)
+        m_client.etcd_client.read.side_effect = read
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('calico_ctl.profile.Endpoint')
+    @patch('calico_ctl.profile.get_hostnames', autospec=True)
+    @patch('calico_ctl.profile.client', autospec=True)
+    def test_profile_show_detailed(self, m_client, m_get_hostnames,
+                                   m_Endpoint, m_stdout):
+        """
+        Test profile_show with the detailed flag reads the endpoints once,
+        one host at a time, rather than once per profile.
+        """
+        m_client.get_profile_names.return_value = ["PROF1", "PROF2", "PROF3"]
+        self._endpoint_leaves(m_client, m_get_hostnames,
+                              {"host1": [["PROF1", "PROF2"]],
+                               "host2": [["PROF1"]]})
+
+        def from_json(key, value):
+            parts = key.split("/")
+            return Mock(hostname=parts[4], orchestrator_id=parts[6],
+                        workload_id=parts[7], endpoint_id=parts[9],
+                        state="active")
+        m_Endpoint.from_json.side_effect = from_json
+
+        profile_show(True)
+
+        m_client.etcd_client.read.assert_has_calls([
+            call("/calico/v1/host/host1/workload/", recursive=True),
+            call("/calico/v1/host/host2/workload/", recursive=True)])
+        self.assertEqual(m_Endpoint.from_json.call_count, 2)
+        self.assertFalse(m_client.get_endpoints.called)
+        self.assertFalse(m_client.get_profile_members.called)
+        output = m_stdout.getvalue()
+        self.assertEqual(output.count("PROF1"), 2)
+        self.assertEqual(output.count("PROF2"), 1)
+        self.assertIn("eid-host2-0", output)
+        self.assertRegexpMatches(output, r"PROF3 \|\s+None")
+
+    @patch('calico_ctl.profile.Endpoint')
+    @patch('calico_ctl.profile.get_hostnames', autospec=True)
+    @patch('calico_ctl.profile.client', autospec=True)
+    def test_profile_member_counts(self, m_client, m_get_hostnames,
+                                   m_Endpoint):
+        """
+        Test counting the endpoints using each profile, without creating an
+        Endpoint for each of them.
+        """
+        self._endpoint_leaves(m_client, m_get_hostnames,
+                              {"host1": [["PROF1", "PROF2"], []],
+                               "host2": [["PROF1", "UNKNOWN"]]})
+
+        counts = _get_profile_members(["PROF1", "PROF2", "PROF3"],
+                                      count_only=True)
+
+        self.assertEqual(dict(counts), {"PROF1": 2, "PROF2": 1})
+        self.assertEqual(counts["PROF3"], 0)
+        self.assertFalse(m_Endpoint.from_json.called)
+        self.assertFalse(m_client.get_endpoints.called)
+
+    @parameterized.expand([
+        (["PROF2"], True),
+        (["PROF1", "PROF2"], False),
+    ])
+    @patch('calico_ctl.profile.client', autospec=True)
+    def test_profile_remove(self, profile_ids, removed, m_client):
+        """
+        Test profile_remove only removes a profile with no endpoints.
+        """
+        m_client.profile_exists.return_value = True
+        m_client.get_endpoints.return_value = [Mock(profile_ids=profile_ids)]
+
+        profile_remove("PROF1", False)
+
+        self.assertEqual(m_client.remove_profile.called, removed)
@@ -0,0 +1,159 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from mock import patch, Mock
+from netaddr import IPAddress, IPNetwork
+from pycalico.block import AddressNotAssignedError
+from pycalico.datastore_datatypes import IPPool
+
+from calico_ctl import reservations
+
+
+class TestReservations(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmpdir, "ip-reservations.json")
+        patchers = [
+            patch('calico_ctl.reservations.RESERVATIONS_DIR', self.tmpdir),
+            patch('calico_ctl.reservations.RESERVATIONS_FILE',
+                  self.state_file),
+            patch('calico_ctl.reservations.LOCK_FILE',
+                  os.path.join(self.tmpdir, "lock")),
+            patch('calico_ctl.reservations.REFILL_LOCK_FILE',
+                  os.path.join(self.tmpdir, "refill.lock")),
+            patch.dict(os.environ, {reservations.RESERVATIONS_ENV: "2"}),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write_state(self, state):
+        with open(self.state_file, "w") as f:
+            json.dump(state, f)
+
+    def read_state(self):
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def test_take_reserved_ip(self):
+        """
+        Test take_reserved_ip takes the first reservation for the version.
+        """
+        self.write_state({"ipv4": [{"ip": "10.0.0.1", "cidr": "10.0.0.0/16",
+                                    "ipip": True, "masquerade": False}],
+                          "ipv6": []})
+
+        ip, pool = reservations.take_reserved_ip(4)
+        self.assertEqual(ip, IPAddress("10.0.0.1"))
+        self.assertEqual(pool, IPPool("10.0.0.0/16", ipip=True))
+        self.assertIsNone(reservations.take_reserved_ip(4))
+        self.assertIsNone(reservations.take_reserved_ip(6))
+
+        state = self.read_state()
+        self.assertEqual(state["ipv4"], [])
+        self.assertEqual(state["taken"].keys(), ["10.0.0.1"])
+
+    @patch('calico_ctl.reservations.client', autospec=True)
+    def test_refill(self, m_client):
+        """
+        Test refill tops up the cache from the reservation handle.
+        """
+        self.write_state({"ipv4": [{"ip": "10.0.0.1", "cidr": "10.0.0.0/16",
+                                    "ipip": False, "masquerade": False}],
+                          "ipv6": []})
+        pool = IPPool("10.0.0.0/16")
+        m_client.get_ip_pools.side_effect = lambda version: \
+            [pool] if version == 4 else []
+        m_client.auto_assign_ips.return_value = ([IPAddress("10.0.0.2")], [])
+
+        self.assertEqual(reservations.refill(), 1)
+
+        m_client.auto_assign_ips.assert_called_once_with(
+            1, 0, reservations.reservation_handle(reservations.hostname), {})
+        self.assertEqual([r["ip"] for r in self.read_state()["ipv4"]],
+                         ["10.0.0.1", "10.0.0.2"])
+
+    @patch('calico_ctl.reservations.client', autospec=True)
+    def test_refill_after_release(self, m_client):
+        """
+        Test an address which is taken and then released (e.g. by removing
+        the container) is forgotten, and not assigned again by the refill.
+        """
+        self.write_state({"ipv4": [{"ip": "10.0.0.1", "cidr": "10.0.0.0/16",
+                                    "ipip": False, "masquerade": False}],
+                          "ipv6": []})
+        reservations.take_reserved_ip(4)
+        m_client.get_endpoints.return_value = []
+        m_client.get_assignment_attributes.side_effect = \
+            AddressNotAssignedError()
+        m_client.get_ip_pools.return_value = []
+
+        reservations.refill()
+
+        m_client.get_assignment_attributes.assert_called_once_with(
+            IPAddress("10.0.0.1"))
+        self.assertFalse(m_client.assign_ip.called)
+        self.assertEqual(self.read_state()["taken"], {})
+
+    @patch('calico_ctl.reservations.client', autospec=True)
+    def test_refill_confirms_in_use(self, m_client):
+        """
+        Test an address which is in use by an endpoint is forgotten without
+        checking IPAM, and recently taken addresses which are still assigned
+        are kept.
+        """
+        self.write_state({"ipv4": [], "ipv6": [],
+                          "taken": {"10.0.0.1": time.time(),
+                                    "10.0.0.2": time.time()}})
+        endpoint = Mock(ipv4_nets={IPNetwork("10.0.0.1/32")}, ipv6_nets=set())
+        m_client.get_endpoints.return_value = [endpoint]
+        m_client.get_ip_pools.return_value = []
+
+        reservations.refill()
+
+        m_client.get_assignment_attributes.assert_called_once_with(
+            IPAddress("10.0.0.2"))
+        self.assertEqual(self.read_state()["taken"].keys(), ["10.0.0.2"])
+
+    @patch('calico_ctl.reservations.client', autospec=True)
+    def test_reconcile(self, m_client):
+        """
+        Test reconcile only releases reserved addresses which are not cached,
+        recently taken or in use by an endpoint.
+        """
+        self.write_state({"ipv4": [{"ip": "10.0.0.1", "cidr": "10.0.0.0/16",
+                                    "ipip": False, "masquerade": False}],
+                          "ipv6": [],
+                          "taken": {"10.0.0.2": time.time(),
+                                    "10.0.0.3": 0}})
+        m_client.get_ip_assignments_by_handle.return_value = [
+            IPAddress("10.0.0.%d" % i) for i in range(1, 6)]
+        endpoint = Mock(ipv4_nets={IPNetwork("10.0.0.4/32")}, ipv6_nets=set())
+        m_client.get_endpoints.return_value = [endpoint]
+
+        self.assertEqual(reservations.reconcile(), 2)
+
+        m_client.release_ips.assert_called_once_with({IPAddress("10.0.0.3"),
+                                                      IPAddress("10.0.0.5")})
+        state = self.read_state()
+        self.assertEqual([r["ip"] for r in state["ipv4"]], ["10.0.0.1"])
+        self.assertEqual(state["taken"].keys(), ["10.0.0.2"])
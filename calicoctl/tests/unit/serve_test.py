@@ -0,0 +1,99 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import unittest
+from StringIO import StringIO
+
+from mock import patch, Mock
+from nose_parameterized import parameterized
+
+from calico_ctl import serve
+
+
+class TestServe(unittest.TestCase):
+
+    @parameterized.expand([
+        (None, 0),
+        (0, 0),
+        (3, 3),
+        ("message", 1),
+    ])
+    @patch('calico_ctl.dispatcher.dispatch', autospec=True)
+    def test_run_command_exit_code(self, code, exit_code, m_dispatch):
+        """
+        Test run_command converts SystemExit to an exit code.
+        """
+        m_dispatch.side_effect = SystemExit(code)
+        stdout, stderr = StringIO(), StringIO()
+        self.assertEqual(serve.run_command(["version"], stdout, stderr),
+                         exit_code)
+        m_dispatch.assert_called_once_with(["version"])
+
+    @patch('calico_ctl.dispatcher.dispatch', autospec=True)
+    def test_run_command_redirects_output(self, m_dispatch):
+        """
+        Test run_command redirects output for the duration of the command.
+        """
+        def dispatch(argv):
+            print "out"
+            print >> sys.stderr, "err"
+        m_dispatch.side_effect = dispatch
+        saved_stdout = sys.stdout
+        stdout, stderr = StringIO(), StringIO()
+
+        self.assertEqual(serve.run_command(["version"], stdout, stderr), 0)
+        self.assertEqual(stdout.getvalue(), "out\n")
+        self.assertEqual(stderr.getvalue(), "err\n")
+        self.assertIs(sys.stdout, saved_stdout)
+
+    @patch('calico_ctl.dispatcher.dispatch', autospec=True)
+    def test_run_command_exception(self, m_dispatch):
+        """
+        Test run_command handles unexpected exceptions.
+        """
+        m_dispatch.side_effect = KeyError
+        stdout, stderr = StringIO(), StringIO()
+        self.assertEqual(serve.run_command(["version"], stdout, stderr), 1)
+        self.assertIn("KeyError", stderr.getvalue())
+
+    def test_framed_writer(self):
+        """
+        Test FramedWriter frames output chunks.
+        """
+        m_sock = Mock()
+        writer = serve.FramedWriter(m_sock, serve.STDOUT_FRAME)
+        writer.write("hello\n")
+        writer.write("")
+        m_sock.sendall.assert_called_once_with("o6\nhello\n")
+
+    @parameterized.expand([
+        (["status", "--watch=5"], True),
+        (["status", "--watch", "5"], True),
+        (["status", "--output=json"], False),
+        (["node", "--detach=false"], True),
+        (["node", "--detach", "false"], True),
+        (["node", "--detach=true"], False),
+        (["serve"], True),
+        (["version"], False),
+    ])
+    @patch('calico_ctl.dispatcher.dispatch', autospec=True)
+    def test_run_command_long_running(self, argv, refused, m_dispatch):
+        """
+        Test run_command refuses commands which run until interrupted.
+        """
+        stdout, stderr = StringIO(), StringIO()
+        exit_code = serve.run_command(argv, stdout, stderr)
+        self.assertEqual(exit_code, 1 if refused else 0)
+        self.assertEqual(m_dispatch.called, not refused)
+        self.assertEqual("not supported" in stderr.getvalue(), refused)
@@ -0,0 +1,230 @@
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import docker.errors
+from mock import Mock, patch
+from nose_parameterized import parameterized
+
+from calico_ctl import bird, status
+
+
+class TestStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.timings_file = os.path.join(self.tmpdir, "startup-timings.json")
+        self.felix_version_file = os.path.join(self.tmpdir,
+                                               "felix-version.json")
+        for patcher in [
+                patch('calico_ctl.status.STARTUP_TIMINGS_FILE',
+                      self.timings_file),
+                patch('calico_ctl.status.FELIX_VERSION_CACHE_FILE',
+                      self.felix_version_file),
+                patch('calico_ctl.status.enforce_root', autospec=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_print_startup_timings(self):
+        """
+        Test the startup timings are printed in the order the stages started.
+        """
+        with open(self.timings_file, "w") as f:
+            json.dump({"started": 1000.0,
+                       "stages": [
+                           {"name": "confd_pass", "start": 1.5,
+                            "duration": 2.0},
+                           {"name": "startup_checks", "start": 0.0,
+                            "duration": 1.25}]}, f)
+
+        with patch('calico_ctl.status.PrettyTable', autospec=True) as m_table:
+            status.print_startup_timings()
+
+        rows = [call[0][0] for call in
+                m_table.return_value.add_row.call_args_list]
+        self.assertEqual(rows, [["startup_checks", "+0.000s", "1.250s"],
+                                ["confd_pass", "+1.500s", "2.000s"]])
+
+    def test_print_startup_timings_missing(self):
+        """
+        Test nothing is printed if the node has not recorded any timings.
+        """
+        with patch('calico_ctl.status.PrettyTable', autospec=True) as m_table:
+            status.print_startup_timings()
+        self.assertFalse(m_table.called)
+
+    @parameterized.expand([
+        ({'--runtime': 'docker', '--output': 'json'}, False),
+        ({'--runtime': 'docker', '--watch': '10'}, False),
+        ({'--runtime': 'docker', '--watch': '0.5'}, False),
+        ({'--runtime': 'lxc'}, True),
+        ({'--runtime': 'docker', '--output': 'yaml'}, True),
+        ({'--runtime': 'docker', '--watch': '0'}, True),
+        ({'--runtime': 'docker', '--watch': 'often'}, True),
+    ])
+    def test_validate_arguments(self, case, sys_exit_called):
+        """
+        Test validate_arguments for calicoctl status.
+        """
+        with patch('sys.exit', autospec=True) as m_sys_exit:
+            status.validate_arguments(case)
+            self.assertEqual(m_sys_exit.called, sys_exit_called)
+
+    @patch('calico_ctl.status.client', autospec=True)
+    @patch('calico_ctl.status.docker_client', autospec=True)
+    @patch('calico_ctl.status.bird.BirdClient', autospec=True)
+    def test_collect(self, m_BirdClient, m_docker_client, m_client):
+        """
+        Test the status is collected from the calico-node container, etcd and
+        BIRD, and that the BIRD connection and Felix version are reused
+        between polls.
+        """
+        m_docker_client.inspect_container.return_value = {
+            "Id": "abcd",
+            "State": {"Running": True,
+                      "StartedAt": "2016-05-06T09:00:00.123456789Z"}}
+        m_docker_client.exec_start.return_value = \
+            "calico (1.3.0)\npython-etcd (0.4.3)\n"
+        m_client.get_host_bgp_ips.return_value = ("172.17.8.100", None)
+        m_client.get_host_as.return_value = None
+        m_client.get_default_node_as.return_value = "64511"
+        m_BirdClient.return_value.command.return_value = [
+            ("2002", "name     proto    table    state  since       info"),
+            ("1002", "static1  Static   master   up     09:00:01"),
+            ("1002", "Mesh_172_17_8_101 BGP      master   up     09:00:02  "
+                     "Established")]
+
+        collector = status.StatusCollector("docker")
+        for _ in range(2):
+            node_status = collector.collect()
+        collector.close()
+
+        self.assertEqual(node_status["container"]["felix_version"], "1.3.0")
+        self.assertTrue(node_status["container"]["running"])
+        self.assertEqual(node_status["bgp"], {
+            "ipv4": {"ip": "172.17.8.100", "as_num": "64511 (inherited)",
+                     "error": None,
+                     "peers": [{"peer_address": "172.17.8.101",
+                                "peer_type": "node-to-node mesh",
+                                "state": "up", "since": "09:00:02",
+                                "info": "Established"}]},
+            "ipv6": {"ip": None, "as_num": "64511 (inherited)",
+                     "error": None, "peers": []}})
+        m_docker_client.inspect_container.assert_called_with("calico-node")
+        self.assertFalse(m_docker_client.containers.called)
+        self.assertEqual(m_docker_client.exec_create.call_count, 1)
+        m_BirdClient.assert_called_once_with("/var/run/calico/bird.ctl")
+        m_BirdClient.return_value.close.assert_called_once_with()
+
+    @patch('calico_ctl.status.docker_client', autospec=True)
+    def test_container_status_felix_version(self, m_docker_client):
+        """
+        Test the Felix version is looked up again when the calico-node
+        container is recreated, and that a failure to look it up is retried
+        on the next poll.
+        """
+        info = {"Id": "abcd",
+                "State": {"Running": True,
+                          "StartedAt": "2016-05-06T09:00:00.123456789Z"}}
+        m_docker_client.inspect_container.return_value = info
+        m_docker_client.exec_start.side_effect = [
+            "calico (1.3.0)\n",
+            docker.errors.APIError("container stopped", Mock(),
+                                   explanation="container stopped"),
+            "calico (1.4.0)\n"]
+
+        collector = status.StatusCollector("docker")
+        versions = [collector.get_container_status_docker()["felix_version"]]
+        info["Id"] = "efgh"
+        for _ in range(3):
+            versions.append(
+                collector.get_container_status_docker()["felix_version"])
+
+        self.assertEqual(versions, ["1.3.0", None, "1.4.0", "1.4.0"])
+        self.assertEqual(m_docker_client.exec_create.call_count, 3)
+
+    @patch('calico_ctl.status.client', autospec=True)
+    @patch('calico_ctl.status.bird.BirdClient', autospec=True)
+    def test_get_bgp_peers_bird_down(self, m_BirdClient, m_client):
+        """
+        Test BIRD errors are reported, and the connection is retried on the
+        next poll.
+        """
+        m_BirdClient.side_effect = bird.BirdError("Connection refused")
+
+        collector = status.StatusCollector("docker")
+        self.assertEqual(collector.get_bgp_peers(4),
+                         ([], "Couldn't connect to bird."))
+        collector.get_bgp_peers(4)
+        self.assertEqual(m_BirdClient.call_count, 2)
+
+    @patch('calico_ctl.status.docker_client', autospec=True)
+    def test_get_felix_version_cached(self, m_docker_client):
+        """
+        Test the Felix version is only looked up once for a container.
+        """
+        m_docker_client.exec_start.return_value = "calico (1.3.0)\n"
+
+        self.assertEqual(status.get_felix_version("abcd"), "1.3.0")
+        self.assertEqual(status.get_felix_version("abcd"), "1.3.0")
+        self.assertEqual(m_docker_client.exec_create.call_count, 1)
+
+        # A new container is looked up again.
+        m_docker_client.exec_start.return_value = "calico (1.4.0)\n"
+        self.assertEqual(status.get_felix_version("efgh"), "1.4.0")
+
+    @patch('calico_ctl.status.StatusCollector', autospec=True)
+    def test_status_json(self, m_StatusCollector):
+        """
+        Test the status is printed as JSON, and that calicoctl exits with an
+        error if the calico-node container is not running.
+        """
+        node_status = {"container": {"running": False,
+                                     "error": "Docker is not running"},
+                       "startup_timings": None, "bgp": {}}
+        m_StatusCollector.return_value.collect.return_value = node_status
+
+        with patch('sys.stdout') as m_stdout:
+            self.assertRaises(SystemExit, status.status,
+                              {"--runtime": "docker", "--output": "json",
+                               "--watch": None})
+
+        printed = "".join(call[0][0] for call in
+                          m_stdout.write.call_args_list)
+        self.assertEqual(json.loads(printed), node_status)
+        m_StatusCollector.return_value.close.assert_called_once_with()
+
+    @patch('calico_ctl.status.time.sleep', autospec=True)
+    @patch('calico_ctl.status.StatusCollector', autospec=True)
+    def test_status_watch(self, m_StatusCollector, m_sleep):
+        """
+        Test the status is printed every interval until interrupted.
+        """
+        m_StatusCollector.return_value.collect.return_value = {
+            "container": {"runtime": "rkt", "running": True,
+                          "status": "running"},
+            "startup_timings": None, "bgp": {}}
+        m_sleep.side_effect = iter([None, KeyboardInterrupt()])
+
+        with patch('sys.stdout'):
+            status.status({"--runtime": "docker", "--output": "json",
+                           "--watch": "10"})
+
+        self.assertEqual(m_StatusCollector.return_value.collect.call_count, 2)
+        m_sleep.assert_called_with(10.0)